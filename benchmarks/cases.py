@@ -0,0 +1,128 @@
+from struct import pack
+
+from benchmarks.streams import ImmediateIOLoop, ReplayStream
+from memcrashed.handlers.binary import BinaryProtocolHandler
+from memcrashed.handlers.text import TextProtocolHandler
+from memcrashed.parser import BinaryParser, TextParser
+from memcrashed.proxy import ProxyRepository
+
+
+CASES = []
+
+KEYS = [('key:%d' % number).encode('ascii') for number in range(10)]
+VALUE = b'x' * 100
+NODES = [('10.0.0.1', 11211), ('10.0.0.2', 11211), ('10.0.0.3', 11211)]
+
+
+def benchmark(name):
+    '''
+    Registers a case: The decorated function sets it up, returning the callable doing one operation.
+    '''
+    def register(setup):
+        CASES.append((name, setup))
+        return setup
+    return register
+
+
+def round_trip(handler, client_stream, backend_stream, *other_streams):
+    streams = (client_stream, backend_stream) + other_streams
+
+    def run():
+        for stream in streams:
+            stream.rewind()
+        handler.process(client_stream, backend_stream, lambda: None)
+    return run
+
+
+def binary_request(opcode, key=b'', extras=b'', value=b''):
+    body_bytes = extras + key + value
+    return BinaryParser().pack_request_header(
+        opcode, key_length=len(key), extra_length=len(extras), total_body_length=len(body_bytes)) + body_bytes
+
+
+def binary_response(opcode, key=b'', extras=b'', value=b''):
+    body_bytes = extras + key + value
+    return BinaryParser().pack_response_header(
+        opcode, 0, key_length=len(key), extra_length=len(extras), total_body_length=len(body_bytes)) + body_bytes
+
+
+def text_hits(keys):
+    return b''.join(b'VALUE ' + key + b' 0 100\r\n' + VALUE + b'\r\n' for key in keys) + b'END\r\n'
+
+
+@benchmark('binary_parser.unpack_request_header')
+def unpack_binary_request_header():
+    parser = BinaryParser()
+    header_bytes = binary_request(0x00, KEYS[0])[:24]
+    return lambda: parser.unpack_request_header(header_bytes)
+
+
+@benchmark('binary_parser.unpack_response_header')
+def unpack_binary_response_header():
+    parser = BinaryParser()
+    header_bytes = binary_response(0x00, extras=pack('! I', 0), value=VALUE)[:24]
+    return lambda: parser.unpack_response_header(header_bytes)
+
+
+@benchmark('text_parser.unpack_request_header.set')
+def unpack_text_storage_header():
+    parser = TextParser()
+    return lambda: parser.unpack_request_header(b'set key:0 0 0 100\r\n')
+
+
+@benchmark('text_parser.unpack_request_header.get')
+def unpack_text_retrieval_header():
+    parser = TextParser()
+    header_bytes = b'get ' + b' '.join(KEYS) + b'\r\n'
+    return lambda: parser.unpack_request_header(header_bytes)
+
+
+@benchmark('text_handler.extract_bytes_quantity')
+def extract_bytes_quantity():
+    handler = TextProtocolHandler(ImmediateIOLoop())
+    return lambda: handler._extract_bytes_quantity(b'set key:0 0 0 100\r\n', bytes_index=4)
+
+
+@benchmark('text_handler.get')
+def text_get():
+    return round_trip(
+        TextProtocolHandler(ImmediateIOLoop()), ReplayStream(b'get key:0\r\n'), ReplayStream(text_hits(KEYS[:1])))
+
+
+@benchmark('text_handler.set')
+def text_set():
+    return round_trip(
+        TextProtocolHandler(ImmediateIOLoop()), ReplayStream(b'set key:0 0 0 100\r\n' + VALUE + b'\r\n'),
+        ReplayStream(b'STORED\r\n'))
+
+
+@benchmark('text_handler.multi_get_sharded')
+def text_sharded_multi_get():
+    handler = TextProtocolHandler(ImmediateIOLoop())
+    repository = handler.pool_repository = ProxyRepository(handler.io_loop, NODES)
+    for node, keys in repository.read_keys_by_node(KEYS).items():
+        repository.streams[node] = [ReplayStream(text_hits(keys))]
+    return round_trip(
+        handler, ReplayStream(b'get ' + b' '.join(KEYS) + b'\r\n'), ReplayStream(),
+        *[streams[0] for streams in repository.streams.values()])
+
+
+@benchmark('binary_handler.getk')
+def binary_get():
+    return round_trip(
+        BinaryProtocolHandler(ImmediateIOLoop()), ReplayStream(binary_request(0x0c, KEYS[0])),
+        ReplayStream(binary_response(0x0c, KEYS[0], pack('! I', 0), VALUE)))
+
+
+@benchmark('binary_handler.set')
+def binary_set():
+    return round_trip(
+        BinaryProtocolHandler(ImmediateIOLoop()), ReplayStream(binary_request(0x01, KEYS[0], pack('! I I', 0, 0), VALUE)),
+        ReplayStream(binary_response(0x01)))
+
+
+@benchmark('binary_handler.quiet_multi_get')
+def binary_quiet_multi_get():
+    requests = b''.join(binary_request(0x0d, key) for key in KEYS) + binary_request(0x0a)
+    responses = b''.join(binary_response(0x0d, key, pack('! I', 0), VALUE) for key in KEYS) + binary_response(0x0a)
+    return round_trip(BinaryProtocolHandler(ImmediateIOLoop()), ReplayStream(requests), ReplayStream(responses))
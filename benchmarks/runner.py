@@ -0,0 +1,146 @@
+import argparse
+import json
+import os
+import sys
+import timeit
+
+try:
+    import tracemalloc
+except ImportError:  # Python 2
+    tracemalloc = None
+
+from benchmarks.cases import CASES
+
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+
+def operations_per_second(run, min_time, repeat):
+    '''
+    Best rate out of "repeat" batches, each one running the operation enough times to take at least
+    "min_time" seconds.
+    '''
+    number = 1
+    while True:
+        elapsed = timeit.timeit(run, number=number)
+        if elapsed >= min_time:
+            break
+        number *= 2
+    best = min([elapsed] + timeit.repeat(run, number=number, repeat=repeat - 1))
+    return number / best
+
+
+def peak_bytes(run):
+    '''
+    Highest memory allocated at once by one operation, or None without tracemalloc.
+    '''
+    if tracemalloc is None:
+        return None
+    tracemalloc.start()
+    try:
+        run()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def measure(setup, min_time, repeat):
+    run = setup()
+    run()
+    return {
+        'ops_per_second': operations_per_second(run, min_time, repeat),
+        'peak_bytes': peak_bytes(run),
+    }
+
+
+def regressions(result, baseline, tolerance):
+    found = []
+    if result['ops_per_second'] < baseline['ops_per_second'] * (1 - tolerance):
+        found.append('ops/s')
+    if None not in (result['peak_bytes'], baseline.get('peak_bytes')) and result['peak_bytes'] > baseline['peak_bytes'] * (1 + tolerance):
+        found.append('peak bytes')
+    return found
+
+
+def describe(name, result, baseline, tolerance):
+    line = '{:<45} {:>12,.0f} ops/s'.format(name, result['ops_per_second'])
+    if baseline is not None:
+        line += ' ({:+.1%})'.format(result['ops_per_second'] / baseline['ops_per_second'] - 1)
+    if result['peak_bytes'] is not None:
+        line += ' {:>8} peak bytes'.format(result['peak_bytes'])
+        if baseline is not None and baseline.get('peak_bytes') is not None:
+            line += ' ({:+d})'.format(result['peak_bytes'] - baseline['peak_bytes'])
+    if baseline is None:
+        line += ' [no baseline]'
+    else:
+        found = regressions(result, baseline, tolerance)
+        if found:
+            line += ' [REGRESSED: {}]'.format(', '.join(found))
+    return line
+
+
+def load_baseline(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as baseline_file:
+        return json.load(baseline_file)
+
+
+def save_baseline(path, results):
+    with open(path, 'w') as baseline_file:
+        json.dump(results, baseline_file, indent=2, sort_keys=True)
+        baseline_file.write('\n')
+
+
+def create_options_from_arguments(args):
+    default_tolerance = 0.1
+    default_min_time = 0.2
+    default_repeat = 5
+    parser = argparse.ArgumentParser(description="Micro-benchmarks for the memcrashed parsers and handlers")
+    parser.add_argument('-k', '--filter', action='store', dest='filter', default=None,
+                        help='If provided, runs only the cases whose name contains it.')
+    parser.add_argument('--baseline', action='store', dest='baseline', default=DEFAULT_BASELINE,
+                        help='Path of the baseline to compare with. "benchmarks/baseline.json" by default.')
+    parser.add_argument('--save', action='store_true', dest='save', default=False,
+                        help='If provided, records the results in the baseline, keeping the cases not run.')
+    parser.add_argument('--check', action='store_true', dest='check', default=False,
+                        help='If provided, exits with an error when any case regressed beyond the tolerance.')
+    parser.add_argument('--tolerance', action='store', dest='tolerance', default=default_tolerance, type=float,
+                        help='Fraction of slowdown or of extra peak bytes tolerated. "{}" by default.'.format(default_tolerance))
+    parser.add_argument('--min-time', action='store', dest='min_time', default=default_min_time, type=float,
+                        help='Seconds each timed batch lasts at least. "{}" by default.'.format(default_min_time))
+    parser.add_argument('--repeat', action='store', dest='repeat', default=default_repeat, type=int,
+                        help='Timed batches per case, of which the best counts. "{}" by default.'.format(default_repeat))
+    return parser.parse_args(args)
+
+
+def run_benchmarks(options, output=sys.stdout):
+    '''
+    Runs the cases, writing each result next to its baseline, and returns whether none regressed.
+    '''
+    baseline = load_baseline(options.baseline)
+    results = {}
+    passed = True
+    for name, setup in CASES:
+        if options.filter and options.filter not in name:
+            continue
+        results[name] = result = measure(setup, options.min_time, options.repeat)
+        output.write(describe(name, result, baseline.get(name), options.tolerance) + '\n')
+        output.flush()
+        if name in baseline and regressions(result, baseline[name], options.tolerance):
+            passed = False
+    if options.save:
+        baseline.update(results)
+        save_baseline(options.baseline, baseline)
+    return passed
+
+
+def main():
+    options = create_options_from_arguments(sys.argv[1:])
+    passed = run_benchmarks(options)
+    if options.check and not passed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':  # pragma: no cover
+    main()
@@ -0,0 +1,51 @@
+class ReplayStream(object):
+    '''
+    In-memory stand-in for an IOStream, answering its reads from the same bytes again after each rewind and
+    throwing away whatever gets written, so that a request can be run over and over without any socket.
+    '''
+
+    def __init__(self, incoming=b''):
+        self.incoming = incoming
+        self.position = 0
+        self.bytes_written = 0
+
+    def rewind(self):
+        self.position = 0
+
+    def read_until(self, delimiter, callback):
+        end = self.incoming.index(delimiter, self.position) + len(delimiter)
+        self._consume(end, callback)
+
+    def read_bytes(self, byte_quantity, callback):
+        self._consume(self.position + byte_quantity, callback)
+
+    def _consume(self, end, callback):
+        data = self.incoming[self.position:end]
+        self.position = end
+        callback(data)
+
+    def write(self, data, callback=None):
+        self.bytes_written += len(data)
+        if callback is not None:
+            callback()
+
+    def closed(self):
+        return False
+
+    def close(self):
+        pass
+
+
+class ImmediateIOLoop(object):
+    '''
+    IOLoop stand-in running callbacks right away and never firing timeouts.
+    '''
+
+    def add_callback(self, callback):
+        callback()
+
+    def add_timeout(self, deadline, callback):
+        return object()
+
+    def remove_timeout(self, timeout):
+        pass
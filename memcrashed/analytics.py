@@ -0,0 +1,167 @@
+from collections import OrderedDict
+from zlib import crc32
+
+from memcrashed.proxy import node_name
+
+
+class AccessCounts(object):
+    '''
+    Fenwick tree counting the keys whose last access happened at each logical time, so that the keys
+    accessed after a given time get counted in logarithmic time.
+    '''
+
+    def __init__(self, size):
+        self.size = size
+        self.counts = [0] * (size + 1)
+
+    def add(self, time, amount):
+        while time <= self.size:
+            self.counts[time] += amount
+            time += time & -time
+
+    def count_up_to(self, time):
+        total = 0
+        while time > 0:
+            total += self.counts[time]
+            time -= time & -time
+        return total
+
+
+class MissRatioCurve(object):
+    '''
+    Estimates the miss ratio an LRU cache would have at each size, in keys, from the accesses to a spatially
+    sampled set of keys, like SHARDS does: The reuse distance of each access, being the distinct sampled keys
+    accessed since the previous access to the same key, is scaled up by the sampling rate. Up to "max_keys"
+    sampled keys are tracked, the least recently accessed being forgotten first, so the reuses farther than
+    max_keys / rate count as cold misses.
+    '''
+
+    DEFAULT_MAX_KEYS = 10000
+
+    def __init__(self, rate, max_keys=DEFAULT_MAX_KEYS):
+        self.rate = rate
+        self.max_keys = max_keys
+        self.last_access = OrderedDict()
+        self.access_counts = AccessCounts(2 * max_keys)
+        self.time = 0
+        self.histogram = {}
+        self.accesses = 0
+        self.cold_misses = 0
+
+    def access(self, key):
+        self.accesses += 1
+        previous = self.last_access.pop(key, None)
+        if previous is None:
+            self.cold_misses += 1
+        else:
+            distance = len(self.last_access) - self.access_counts.count_up_to(previous - 1)
+            self.access_counts.add(previous, -1)
+            bucket = int(distance / self.rate).bit_length()
+            self.histogram[bucket] = self.histogram.get(bucket, 0) + 1
+        if self.time >= self.access_counts.size:
+            self._renumber()
+        self.time += 1
+        self.last_access[key] = self.time
+        self.access_counts.add(self.time, 1)
+        if len(self.last_access) > self.max_keys:
+            key, time = self.last_access.popitem(last=False)
+            self.access_counts.add(time, -1)
+
+    def _renumber(self):
+        # The logical times run out every so many accesses, so the tracked keys get numbered again in order.
+        self.access_counts = AccessCounts(self.access_counts.size)
+        for time, key in enumerate(list(self.last_access), 1):
+            self.last_access[key] = time
+            self.access_counts.add(time, 1)
+        self.time = len(self.last_access)
+
+    def working_set(self):
+        '''
+        Estimated number of distinct keys accessed, as far as they're tracked.
+        '''
+        return int(len(self.last_access) / self.rate)
+
+    def points(self):
+        '''
+        The (cache size, miss ratio) pairs of the curve, for sizes doubling from 1 up to the farthest reuse
+        seen.
+        '''
+        if not self.accesses:
+            return []
+        points = []
+        hits = 0
+        for bucket in range(max(self.histogram or [0]) + 1):
+            hits += self.histogram.get(bucket, 0)
+            points.append((1 << bucket, 1 - float(hits) / self.accesses))
+        return points
+
+    def describe(self):
+        return 'accesses={} working_set={} miss_ratios={}'.format(
+            int(self.accesses / self.rate), self.working_set(),
+            ','.join('{}:{:.4f}'.format(size, ratio) for size, ratio in self.points()))
+
+
+class KeySpaceAnalytics(object):
+    '''
+    Samples the keys accessed through the proxy by their hash, so that every access to a sampled key gets
+    seen, and keeps a miss ratio curve for the whole key space, for each backend, and for each key prefix up
+    to "prefix_separator" when one is given; Up to "max_prefixes" prefixes get curves, the least recently
+    seen being forgotten first. The hash differs from the ring's, so that the sample spreads over every
+    backend.
+    '''
+
+    DEFAULT_SAMPLE_RATE = 0.01
+    DEFAULT_MAX_PREFIXES = 100
+    HASH_SPACE = 1 << 32
+
+    def __init__(self, sample_rate=DEFAULT_SAMPLE_RATE, prefix_separator=None, max_keys=MissRatioCurve.DEFAULT_MAX_KEYS,
+                 max_prefixes=DEFAULT_MAX_PREFIXES):
+        self.sample_rate = sample_rate
+        self.threshold = int(sample_rate * self.HASH_SPACE)
+        self.prefix_separator = prefix_separator
+        self.max_keys = max_keys
+        self.max_prefixes = max_prefixes
+        self.curve = MissRatioCurve(sample_rate, max_keys)
+        self.node_curves = {}
+        self.prefix_curves = OrderedDict()
+
+    def is_sampled(self, key):
+        return crc32(key) & 0xffffffff < self.threshold
+
+    def record(self, keys, node):
+        '''
+        Records the accesses to the keys of a request served by the node.
+        '''
+        for key in keys:
+            if not self.is_sampled(key):
+                continue
+            self.curve.access(key)
+            node_curve = self.node_curves.get(node)
+            if node_curve is None:
+                node_curve = self.node_curves[node] = MissRatioCurve(self.sample_rate, self.max_keys)
+            node_curve.access(key)
+            if self.prefix_separator is not None:
+                self._prefix_curve(key).access(key)
+
+    def _prefix_curve(self, key):
+        prefix, separator, rest = key.partition(self.prefix_separator)
+        prefix = prefix if separator else b''
+        curve = self.prefix_curves.pop(prefix, None)
+        if curve is None:
+            if len(self.prefix_curves) >= self.max_prefixes:
+                self.prefix_curves.popitem(last=False)
+            curve = MissRatioCurve(self.sample_rate, self.max_keys)
+        self.prefix_curves[prefix] = curve
+        return curve
+
+    def dump(self, output):
+        '''
+        Writes the curves, for the whole key space first.
+        '''
+        output.write('Key space: {}\n'.format(self.curve.describe()))
+        for node, curve in self.node_curves.items():
+            output.write('Key space: backend={} {}\n'.format(node_name(node), curve.describe()))
+        for prefix, curve in self.prefix_curves.items():
+            prefix = prefix.decode('latin-1').encode('ascii', 'backslashreplace').decode('ascii')
+            output.write('Key space: prefix={} {}\n'.format(prefix, curve.describe()))
+        output.flush()
@@ -0,0 +1,90 @@
+from collections import deque
+
+from tornado import gen
+
+
+class BackendClient(object):
+    '''
+    Minimal text protocol client used by the proxy to issue its own commands to a backend. Requests are
+    pipelined: they get written right away, and the responses are read back in the same order.
+    '''
+
+    EOL = b'\r\n'
+    END = b'END' + EOL
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.pending = deque()
+        self.reading = False
+
+    def closed(self):
+        return self.stream.closed()
+
+    def close(self):
+        self.stream.close()
+
+    def get(self, keys, callback):
+        '''
+        Calls back with a dict mapping each key found to a (flags, value) tuple.
+        '''
+        request = b'get ' + b' '.join(keys) + self.EOL
+        self._request(request, self._read_values, callback)
+
+    def set(self, key, flags, exptime, value, callback, command=b'set'):
+        '''
+        Calls back with the response line, like "STORED", without the line ending.
+        '''
+        header = b' '.join([command, key, self._number(flags), self._number(exptime), self._number(len(value))])
+        self._request(header + self.EOL + value + self.EOL, self._read_line, callback)
+
+    def flags(self, key, callback):
+        '''
+        Calls back with the flags of the key, or None if it's missing, without its value being fetched.
+        '''
+        self._request(b'mg ' + key + b' f' + self.EOL, self._read_flags, callback)
+
+    def delete(self, key, callback):
+        self._request(b'delete ' + key + self.EOL, self._read_line, callback)
+
+    def _request(self, request_bytes, read_response, callback):
+        self.stream.write(request_bytes)
+        self.pending.append((read_response, callback))
+        if not self.reading:
+            self._read_responses()
+
+    @gen.engine
+    def _read_responses(self):
+        self.reading = True
+        while self.pending:
+            read_response, callback = self.pending[0]
+            response = yield gen.Task(read_response)
+            self.pending.popleft()
+            callback(response)
+        self.reading = False
+
+    @gen.engine
+    def _read_line(self, callback):
+        line = yield gen.Task(self.stream.read_until, self.EOL)
+        callback(line[:-len(self.EOL)])
+
+    @gen.engine
+    def _read_flags(self, callback):
+        line = yield gen.Task(self._read_line)
+        tokens = line.split(b' ')
+        flags = next((token[1:] for token in tokens[1:] if token.startswith(b'f')), None)
+        callback(int(flags) if tokens[0] == b'HD' and flags is not None else None)
+
+    @gen.engine
+    def _read_values(self, callback):
+        values = {}
+        while True:
+            line = yield gen.Task(self.stream.read_until, self.EOL)
+            if line == self.END or not line.startswith(b'VALUE '):
+                break
+            tokens = line[:-len(self.EOL)].split(b' ')
+            value = yield gen.Task(self.stream.read_bytes, int(tokens[3]) + len(self.EOL))
+            values[tokens[1]] = (int(tokens[2]), value[:-len(self.EOL)])
+        callback(values)
+
+    def _number(self, value):
+        return str(value).encode('ascii')
@@ -0,0 +1,108 @@
+from uuid import uuid4
+
+from tornado import gen
+
+
+class ValueChunker(object):
+    '''
+    Stores values too large for a single memcached item as many chunk items, spread over the backends by
+    the hash ring, plus a manifest item stored under the original key and marked with a bit in its flags.
+    Each store uses a fresh token to name the chunk keys, so that a reader never mixes chunks of two versions
+    and the manifest alone is enough to find them; The chunks of a manifest get deleted once the key is set
+    again.
+    '''
+
+    DEFAULT_FLAG = 1 << 14
+    DEFAULT_CHUNK_SIZE = 1000 * 1000
+    KEY_PREFIX = b'memcrashed:chunk'
+
+    def __init__(self, pool_repository, threshold, chunk_size=DEFAULT_CHUNK_SIZE, flag=DEFAULT_FLAG):
+        self.pool_repository = pool_repository
+        self.threshold = threshold
+        self.chunk_size = chunk_size
+        self.flag = flag
+
+    def should_split(self, value_length):
+        return value_length > self.threshold
+
+    def is_manifest(self, flags):
+        return bool(flags & self.flag)
+
+    def manifest_flags(self, flags):
+        return flags | self.flag
+
+    def value_flags(self, flags):
+        return flags & ~self.flag
+
+    def chunk_keys(self, token, count):
+        return [b':'.join([self.KEY_PREFIX, token, str(index).encode('ascii')]) for index in range(count)]
+
+    @gen.engine
+    def store(self, exptime, value, callback):
+        '''
+        Stores the chunks in parallel and calls back with the manifest to be stored under the key, or with
+        None if any of the chunks couldn't be stored.
+        '''
+        token = uuid4().hex.encode('ascii')
+        chunks = [value[start:start + self.chunk_size] for start in range(0, len(value), self.chunk_size)]
+        keys = self.chunk_keys(token, len(chunks))
+        responses = yield [
+            gen.Task(self.pool_repository.client_for_key(chunk_key).set, chunk_key, 0, exptime, chunk)
+            for chunk_key, chunk in zip(keys, chunks)
+        ]
+        if any(response != b'STORED' for response in responses):
+            callback(None)
+            return
+        callback(b' '.join([token, str(len(chunks)).encode('ascii'), str(len(value)).encode('ascii')]))
+
+    @gen.engine
+    def fetch(self, manifest, callback):
+        '''
+        Fetches the chunks listed in the manifest in parallel and calls back with the reassembled value, or
+        with None if any of them is gone.
+        '''
+        try:
+            keys, length = self._manifest_keys(manifest)
+        except ValueError:
+            callback(None)
+            return
+        results = yield [gen.Task(self.pool_repository.client_for_key(chunk_key).get, [chunk_key]) for chunk_key in keys]
+        chunks = []
+        for chunk_key, result in zip(keys, results):
+            if chunk_key not in result:
+                callback(None)
+                return
+            chunks.append(result[chunk_key][1])
+        value = b''.join(chunks)
+        callback(value if len(value) == length else None)
+
+    @gen.engine
+    def discard_previous(self, key, callback):
+        '''
+        Deletes the chunks of the value stored under the key, if it's chunked, as the key is about to be set
+        again; Only its flags get looked up, and its manifest if they mark one, calling back once they're
+        answered, so that the new value gets written only then.
+        '''
+        client = self.pool_repository.client_for_key(key)
+        flags = yield gen.Task(client.flags, key)
+        if flags is not None and self.is_manifest(flags):
+            values = yield gen.Task(client.get, [key])
+            flags, manifest = values.get(key, (0, None))
+            if self.is_manifest(flags):
+                self._discard(manifest)
+        callback()
+
+    def _discard(self, manifest):
+        try:
+            keys, length = self._manifest_keys(manifest)
+        except ValueError:
+            return
+        for chunk_key in keys:
+            self.pool_repository.client_for_key(chunk_key).delete(chunk_key, self._ignore)
+
+    def _manifest_keys(self, manifest):
+        token, count, length = manifest.split(b' ')
+        return self.chunk_keys(token, int(count)), int(length)
+
+    def _ignore(self, response):
+        pass
@@ -0,0 +1,65 @@
+import zlib
+
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:  # pragma: no cover
+    ThreadPoolExecutor = None
+
+
+class ValueCompressor(object):
+    '''
+    Compresses stored values above a size threshold and decompresses them on retrieval, marking them with
+    a bit in the memcached flags field. The work runs in a thread pool and the results are delivered back
+    in the IOLoop, so that large values don't block the other clients.
+    '''
+
+    DEFAULT_FLAG = 1 << 15
+    DEFAULT_LEVEL = 6
+
+    def __init__(self, io_loop, threshold, flag=DEFAULT_FLAG, level=DEFAULT_LEVEL, threads=2, executor=None):
+        if executor is None:
+            if ThreadPoolExecutor is None:
+                raise RuntimeError('Value compression needs the "futures" package in Python 2.')
+            executor = ThreadPoolExecutor(threads)
+        self.io_loop = io_loop
+        self.threshold = threshold
+        self.flag = flag
+        self.level = level
+        self.executor = executor
+
+    def should_compress(self, flags, value_length):
+        return value_length >= self.threshold and not self.is_compressed(flags)
+
+    def is_compressed(self, flags):
+        return bool(flags & self.flag)
+
+    def compressed_flags(self, flags):
+        return flags | self.flag
+
+    def decompressed_flags(self, flags):
+        return flags & ~self.flag
+
+    def compress(self, value, callback):
+        self._run(self._compress, value, callback)
+
+    def decompress(self, value, callback):
+        self._run(self._decompress, value, callback)
+
+    def _compress(self, value):
+        compressed = zlib.compress(value, self.level)
+        if len(compressed) >= len(value):
+            return None
+        return compressed
+
+    def _decompress(self, value):
+        try:
+            return zlib.decompress(value)
+        except zlib.error:
+            return None
+
+    def _run(self, function, value, callback):
+        future = self.executor.submit(function, value)
+        future.add_done_callback(lambda future: self.io_loop.add_callback(lambda: callback(future.result())))
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
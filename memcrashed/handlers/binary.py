@@ -1,10 +1,17 @@
 #!/usr/bin/env python
 
+from collections import defaultdict
+from functools import partial
 from io import BytesIO
+from struct import Struct
+import time
+from weakref import WeakKeyDictionary, WeakSet
 
 from tornado import gen
 
+from memcrashed import profiling
 from memcrashed.parser import BinaryParser
+from memcrashed.pipelining import OpaqueDemultiplexer, Pipeline
 from memcrashed.proxy import ProxyRepository
 
 
@@ -31,39 +38,939 @@ class BinaryProtocolHandler(object):
         0x3a,  # RIncrQ
         0x3c,  # RDecrQ
     )
+    QUIET_WRITE_OPS = (
+        0x11,  # SetQ
+        0x12,  # AddQ
+        0x13,  # ReplaceQ
+        0x14,  # DeleteQ
+        0x15,  # IncrementQ
+        0x16,  # DecrementQ
+        0x19,  # AppendQ
+        0x1a,  # PrependQ
+    )
     NO_OP = 0x0a
+    CONCATENATION_OPS = (
+        0x0e,  # Append
+        0x0f,  # Prepend
+        0x19,  # AppendQ
+        0x1a,  # PrependQ
+    )
+    STORAGE_OPS = (
+        0x01,  # Set
+        0x02,  # Add
+        0x03,  # Replace
+        0x11,  # SetQ
+        0x12,  # AddQ
+        0x13,  # ReplaceQ
+    )
+    SET_OPS = (
+        0x01,  # Set
+        0x11,  # SetQ
+    )
+    RETRIEVAL_OPS = (
+        0x00,  # Get
+        0x09,  # GetQ
+        0x0c,  # GetK
+        0x0d,  # GetKQ
+    )
+    REPLICATED_OPS = (
+        0x01,  # Set
+        0x04,  # Delete
+        0x11,  # SetQ
+        0x14,  # DeleteQ
+        0x1c,  # Touch
+    )
+    DELETE_QUIETLY = 0x14
+    GET_KEY_QUIETLY = 0x0d
+    KEYED_RETRIEVAL_OPS = (
+        0x0c,  # GetK
+        0x0d,  # GetKQ
+    )
+    SASL_OPS = (
+        0x20,  # SASL List Mechs
+        0x21,  # SASL Auth
+        0x22,  # SASL Step
+    )
+    SASL_LIST_MECHS = 0x20
+    SASL_AUTH = 0x21
+    flags_struct = Struct('! I')
+    BUSY_STATUS = 0x85
+    BUSY_MESSAGE = b'Backend busy'
+    THROTTLED_MESSAGE = b'Rate limited'
+    NOT_FOUND_STATUS = 0x01
+    NOT_FOUND_MESSAGE = b'Not found'
+    AUTH_ERROR_STATUS = 0x20
+    AUTH_ERROR_MESSAGE = b'Auth failure'
+    AUTHENTICATED_MESSAGE = b'Authenticated'
+    UNKNOWN_COMMAND_STATUS = 0x81
+    UNKNOWN_COMMAND_MESSAGE = b'Unknown command'
+    NOT_SUPPORTED_STATUS = 0x83
+    NOT_SUPPORTED_MESSAGE = b'Not supported'
 
     def __init__(self, io_loop):
         self.io_loop = io_loop
         self.parser = BinaryParser()
         self.pool_repository = ProxyRepository(self.io_loop)
+        self.busy_streams = set()
+        self.pipelines = WeakKeyDictionary()
+        self.opaque_rewriting = False
+        self.limits = None
+        self.compressor = None
+        self.chunker = None
+        self.negative_cache = None
+        self.shadow = None
+        self.hedging = None
+        self.leases = None
+        self.quotas = None
+        self.write_behind = None
+        self.analytics = None
+        self.authenticator = None
+        self.authenticated_streams = WeakSet()
+        self.tracer = None
+        self.traces = {}
 
     @gen.engine
     def process(self, client_stream, backend_stream, callback):
-        with BytesIO() as stream_data:
-            yield gen.Task(self._read_full_chunk, self.parser.unpack_request_header, stream_data, client_stream)
-            yield gen.Task(backend_stream.write, stream_data.getvalue())
+        if self.limits is not None:
+            yield gen.Task(self.limits.wait_writable)
+
+        messages = yield gen.Task(self._read_request, client_stream)
+        profiling.enter(profiling.PARSE)
+
+        if self.authenticator is not None or self._has_sasl_requests(messages):
+            messages, response_bytes = self._authenticate(client_stream, messages)
+            if response_bytes:
+                yield gen.Task(client_stream.write, response_bytes)
+            if not messages:
+                self.busy_streams.discard(client_stream)
+                callback()
+                return
+        headers = messages[-1][0]
+
+        tenant = None
+        if self.quotas is not None:
+            tenant = self._tenant(client_stream, messages)
+            operations = sum(1 for headers, message in messages if headers.opcode != self.NO_OP)
+            if not self.quotas.allow(tenant, max(1, operations), sum(len(message) for headers, message in messages)):
+                # Every message gets answered, as quiet writes would otherwise pass for done.
+                yield gen.Task(client_stream.write, b''.join(
+                    self._local_response(headers, self.BUSY_STATUS, self.THROTTLED_MESSAGE) for headers, message in messages))
+                self.busy_streams.discard(client_stream)
+                callback()
+                return
+
+        if self.compressor is not None or self.chunker is not None:
+            messages, response_bytes = self._refuse_concatenations(messages)
+            if response_bytes:
+                yield gen.Task(client_stream.write, response_bytes)
+            if not messages:
+                self.busy_streams.discard(client_stream)
+                callback()
+                return
+            headers = messages[-1][0]
+
+        trace = None
+        if self.tracer is not None:
+            trace = self._start_trace(client_stream, messages)
+
+        profiling.enter(profiling.ROUTE)
+        cache_versions = None
+        if self.negative_cache is not None:
+            messages, response_bytes = self._check_negative_cache(messages)
+            cache_versions = self.negative_cache.versions(
+                self._key_from_message(headers, message) for headers, message in messages if headers.opcode in self.RETRIEVAL_OPS)
+            if response_bytes is not None:
+                yield gen.Task(client_stream.write, response_bytes)
+                self._finish_trace(client_stream, trace)
+                self.busy_streams.discard(client_stream)
+                callback()
+                return
+
+        profiling.enter(profiling.BACKEND_WRITE)
+        if self.compressor is not None or self.chunker is not None:
+            messages = yield gen.Task(self._convert_messages, messages, self.parser.unpack_request_header)
 
+        if self.shadow is not None:
+            self._mirror(messages)
+
+        if self.pool_repository.is_migrating():
+            self._forget_previous_copies(messages)
+
+        if self.pool_repository.is_replicated():
+            self._replicate(messages)
+
+        profiling.enter(profiling.ROUTE)
+        node = self.pool_repository.default_node
+        messages_by_node = None
+        if self.pool_repository.is_sharded():
+            node, messages_by_node = self._route(messages)
+            if node is not None:
+                backend_stream = self.pool_repository.stream_for_node(node)
+
+        if self.analytics is not None:
+            self._record_accesses(messages, node, messages_by_node)
+
+        profiling.enter(profiling.BACKEND_WRITE)
+        responses = None
+        if self._writes_behind(messages):
+            responses = yield gen.Task(self._write_behind, messages, backend_stream, messages_by_node, client_stream)
+        elif messages_by_node is not None:
+            responses = yield gen.Task(self._forward_to_nodes, messages, messages_by_node, client_stream)
+        elif self.limits is None:
+            responses = yield gen.Task(self._relay_response, messages, client_stream, backend_stream, node)
+        else:
+            limiter = self.limits.limiter_for(node)
+            if trace is not None:
+                queued = self.tracer.clock()
+            admitted = yield gen.Task(limiter.acquire)
+            if trace is not None:
+                trace.queue_wait = self.tracer.clock() - queued
+            if admitted:
+                profiling.enter(profiling.BACKEND_WRITE)
+                responses = yield gen.Task(
+                    self._relay_response, messages, client_stream, backend_stream, node, limiter=limiter)
+            else:
+                yield gen.Task(client_stream.write, self._busy_response(headers))
+
+        if self.leases is not None:
+            self._release_leases(messages)
+
+        if self.negative_cache is not None and responses is not None:
+            missed_keys = self._missed_keys(messages, responses)
+            if self.leases is not None:
+                # Leased keys are about to be refilled, so they can't be answered as misses by the proxy.
+                missed_keys = [key for key in missed_keys if not self.leases.is_leased(key)]
+            self.negative_cache.add_misses(missed_keys, cache_versions)
+
+        if tenant is not None and responses is not None:
+            self.quotas.charge(tenant, sum(len(message) for headers, message in responses))
+
+        if trace is not None and responses is not None:
+            trace.response_bytes = sum(len(message) for headers, message in responses)
+        self._finish_trace(client_stream, trace)
+        self.busy_streams.discard(client_stream)
+        callback()
+
+    def _start_trace(self, client_stream, messages):
+        opcodes = sorted(set(headers.opcode for headers, message in messages))
+        command = ','.join('0x{:02x}'.format(opcode) for opcode in opcodes)
+        keys = [key for key in (self._key_from_message(*request) for request in messages) if key]
+        trace = self.tracer.start(command, keys, sum(len(message) for headers, message in messages))
+        if trace is not None:
+            self.traces[client_stream] = trace
+        return trace
+
+    def _finish_trace(self, client_stream, trace):
+        if trace is not None:
+            del self.traces[client_stream]
+            self.tracer.finish(trace, client_stream)
+
+    @gen.engine
+    def _read_request(self, client_stream, callback):
         with BytesIO() as stream_data:
-            yield gen.Task(self._read_full_chunk, self.parser.unpack_response_header, stream_data, backend_stream)
-            yield gen.Task(client_stream.write, stream_data.getvalue())
+            headers = yield gen.Task(self._read_chunk, client_stream, stream_data, self.parser.unpack_request_header)
+            self.busy_streams.add(client_stream)
+            messages = [(headers, stream_data.getvalue())]
+        if headers.opcode in self.QUIET_OPS:
+            remaining = yield gen.Task(self._read_messages, client_stream, self.parser.unpack_request_header)
+            messages.extend(remaining)
+        callback(messages)
+
+    def _has_sasl_requests(self, messages):
+        return any(headers.opcode in self.SASL_OPS for headers, message in messages)
+
+    def _authenticate(self, client_stream, messages):
+        '''
+        Answers the SASL requests at the proxy, as the backend connections are shared by the clients, and
+        answers the other requests with an authentication error until the client is authenticated. Returns
+        the requests left to forward, along with the response bytes for the ones answered.
+        '''
+        sasl_indexes = [index for index, (headers, message) in enumerate(messages) if headers.opcode in self.SASL_OPS]
+        answered = sasl_indexes[-1] + 1 if sasl_indexes else 0
+        responses = [self._sasl_response(client_stream, headers, message) for headers, message in messages[:answered]]
+        remaining = messages[answered:]
+        if remaining and self.authenticator is not None and client_stream not in self.authenticated_streams:
+            responses.extend(
+                self._local_response(headers, self.AUTH_ERROR_STATUS, self.AUTH_ERROR_MESSAGE) for headers, message in remaining)
+            remaining = []
+        return remaining, b''.join(responses)
+
+    def _refuse_concatenations(self, messages):
+        '''
+        Answers Append and Prepend as not supported, as the backend would join their bytes to a compressed
+        value or a manifest, corrupting the item; Their responses go ahead of the others, which the clients
+        tell apart by their opaque. Returns the requests left to forward, along with the response bytes.
+        '''
+        remaining = [(headers, message) for headers, message in messages if headers.opcode not in self.CONCATENATION_OPS]
+        if len(remaining) == len(messages):
+            return messages, b''
+        response_bytes = b''.join(
+            self._local_response(headers, self.NOT_SUPPORTED_STATUS, self.NOT_SUPPORTED_MESSAGE)
+            for headers, message in messages if headers.opcode in self.CONCATENATION_OPS)
+        return remaining, response_bytes
+
+    def _sasl_response(self, client_stream, headers, message):
+        # Without an authenticator, the proxy acts like a memcached built without SASL.
+        if self.authenticator is None:
+            return self._local_response(headers, self.UNKNOWN_COMMAND_STATUS, self.UNKNOWN_COMMAND_MESSAGE)
+        if headers.opcode == self.SASL_LIST_MECHS:
+            return self._local_response(headers, 0, self.authenticator.MECHANISMS)
+        if headers.opcode == self.SASL_AUTH:
+            mechanism = self._key_from_message(headers, message)
+            data = message[self.HEADER_BYTES + headers.extra_length + headers.key_length:]
+            if self.authenticator.authenticate(mechanism, data):
+                self.authenticated_streams.add(client_stream)
+                return self._local_response(headers, 0, self.AUTHENTICATED_MESSAGE)
+        # PLAIN never takes steps, so these are failures too.
+        self.authenticated_streams.discard(client_stream)
+        return self._local_response(headers, self.AUTH_ERROR_STATUS, self.AUTH_ERROR_MESSAGE)
+
+    def _pipeline(self, backend_stream):
+        pipeline = self.pipelines.get(backend_stream)
+        if pipeline is None:
+            if self.opaque_rewriting:
+                pipeline = OpaqueDemultiplexer(backend_stream, self.parser)
+            else:
+                pipeline = Pipeline(backend_stream)
+            self.pipelines[backend_stream] = pipeline
+        return pipeline
+
+    def _record_accesses(self, messages, node, messages_by_node):
+        groups = messages_by_node.items() if messages_by_node is not None else [(node, messages)]
+        for node, node_messages in groups:
+            keys = (self._key_from_message(headers, message) for headers, message in node_messages)
+            self.analytics.record([key for key in keys if key], node)
+
+    def _tenant(self, client_stream, messages):
+        keys = (self._key_from_message(headers, message) for headers, message in messages)
+        return self.quotas.tenant(client_stream, next((key for key in keys if key), b''))
+
+    def _local_response(self, headers, status, body_bytes):
+        header_bytes = self.parser.pack_response_header(
+            headers.opcode, status, opaque=headers.opaque, total_body_length=len(body_bytes))
+        return header_bytes + body_bytes
+
+    def _mirror(self, messages):
+        '''
+        Mirrors each keyed message to the shadow backend owning its key, with the reads sampled once for the
+        whole request.
+        '''
+        samples_read = None
+        for headers, message in messages:
+            key = self._key_from_message(headers, message)
+            if not key:
+                continue
+            if headers.opcode in self.RETRIEVAL_OPS:
+                if samples_read is None:
+                    samples_read = self.shadow.samples_read()
+                if not samples_read:
+                    continue
+            self.shadow.mirror(key, message)
+
+    def _check_negative_cache(self, messages):
+        '''
+        Leaves out of a request the quiet retrievals known to miss, which get no response anyway, and
+        invalidates the keys of anything else; Calls for a response from the proxy itself, instead of a
+        request, when what remains is a NoOp or a single retrieval known to miss.
+        '''
+        remaining = []
+        for headers, message in messages:
+            key = self._key_from_message(headers, message)
+            if headers.opcode not in self.RETRIEVAL_OPS:
+                if key:
+                    self.negative_cache.invalidate(key)
+            elif headers.opcode in self.QUIET_OPS and self.negative_cache.contains(key):
+                continue
+            remaining.append((headers, message))
+
+        if len(remaining) == 1:
+            headers, message = remaining[0]
+            key = self._key_from_message(headers, message)
+            if headers.opcode == self.NO_OP and len(messages) > 1:
+                return remaining, self.parser.pack_response_header(self.NO_OP, 0, opaque=headers.opaque)
+            if headers.opcode in self.RETRIEVAL_OPS and self.negative_cache.contains(key):
+                header_bytes, body_bytes = self._missing_value(headers, message[self.HEADER_BYTES:])
+                return remaining, header_bytes + body_bytes
+        return remaining, None
+
+    def _missed_keys(self, messages, responses):
+        return [self._key_from_message(headers, message) for headers, message in self._missed_retrievals(messages, responses)]
+
+    def _missed_retrievals(self, messages, responses):
+        '''
+        Finds the retrievals answered as misses, telling the responses apart by their opaque values; Quiet
+        misses have no response at all, so nothing can be told when the client repeats opaque values.
+        '''
+        opaques = [headers.opaque for headers, message in messages]
+        if len(set(opaques)) != len(opaques):
+            return []
+        statuses = dict((headers.opaque, headers.status) for headers, message in responses)
+        missed = []
+        for headers, message in messages:
+            if headers.opcode not in self.RETRIEVAL_OPS:
+                continue
+            status = statuses.get(headers.opaque)
+            if status == self.NOT_FOUND_STATUS or (status is None and headers.opcode in self.QUIET_OPS):
+                missed.append((headers, message))
+        return missed
+
+    def _forget_previous_copies(self, messages):
+        for headers, message in messages:
+            key = self._key_from_message(headers, message)
+            if key and headers.opcode not in self.RETRIEVAL_OPS:
+                self.pool_repository.migration.forget(key)
+
+    @gen.engine
+    def _read_from_owners(self, messages, responses, messages_by_node, callback):
+        '''
+        Looks the retrievals missed in replicas other than the owners of their keys up in the owners, as the
+        writes not repeated as they are, like Add or Increment, delete the copies in the other replicas.
+        '''
+        ring = self.pool_repository.ring
+        replica_reads = [
+            (headers, message) for node, node_messages in messages_by_node.items() for headers, message in node_messages
+            if headers.opcode in self.RETRIEVAL_OPS and ring.node_for_key(self._key_from_message(headers, message)) != node
+        ]
+        missed = [request for request in self._missed_retrievals(messages, responses) if request in replica_reads]
+        if not missed:
+            callback(responses)
+            return
+        keys_by_owner = ring.keys_by_node([self._key_from_message(*request) for request in missed])
+        owner_responses = yield [
+            gen.Task(self._exchange, owner, self._quiet_retrievals(keys)) for owner, keys in keys_by_owner.items()
+        ]
+        profiling.enter(profiling.BACKEND_READ)
+        values = dict(
+            (self._key_from_message(headers, message), self._retrieved_item(headers, message))
+            for owner_messages in owner_responses if owner_messages is not None
+            for headers, message in owner_messages if self._is_retrieved_value(headers)
+        )
+        responses = yield gen.Task(self._add_values, missed, responses, values)
+        callback(responses)
+
+    def _quiet_retrievals(self, keys):
+        '''
+        GetKQ messages for the keys, ended by a NoOp for the end of their responses to be known.
+        '''
+        messages = [
+            self.parser.pack_request_header(self.GET_KEY_QUIETLY, key_length=len(key), total_body_length=len(key)) + key
+            for key in keys
+        ]
+        return b''.join(messages) + self.parser.pack_request_header(self.NO_OP)
+
+    @gen.engine
+    def _read_from_previous_owners(self, messages, responses, callback):
+        '''
+        Looks the retrievals missed up in the backends owning their keys before a ring change, adding the
+        values found to the responses.
+        '''
+        missed = self._missed_retrievals(messages, responses)
+        values = yield gen.Task(self.pool_repository.migration.fetch, [self._key_from_message(*request) for request in missed])
+        profiling.enter(profiling.BACKEND_READ)
+        responses = yield gen.Task(self._add_values, missed, responses, values)
+        callback(responses)
+
+    @gen.engine
+    def _apply_leases(self, messages, responses, client_stream, callback):
+        '''
+        Remembers the values found for hot keys, and hands the retrievals missed to the leases; The values
+        they come up with are added like the ones from previous owners.
+        '''
+        self._remember_values(messages, responses)
+        missed = self._missed_retrievals(messages, responses)
+        if not missed:
+            callback(responses)
+            return
+        keys = [self._key_from_message(*request) for request in missed]
+        values = yield gen.Task(self.leases.fill, self.pool_repository, client_stream, keys)
+        profiling.enter(profiling.BACKEND_READ)
+        responses = yield gen.Task(self._add_values, missed, responses, values)
+        callback(responses)
 
+    def _remember_values(self, messages, responses):
+        retrievals = [(headers, message) for headers, message in messages if headers.opcode in self.RETRIEVAL_OPS]
+        keys = dict((headers.opaque, self._key_from_message(headers, message)) for headers, message in retrievals)
+        if len(keys) != len(retrievals):
+            return
+        for headers, message in responses:
+            key = keys.get(headers.opaque)
+            if key is None or not self._is_retrieved_value(headers) or not self.leases.is_hot(key):
+                continue
+            flags, value = self._retrieved_item(headers, message)
+            self.leases.remember(key, flags, value)
+
+    def _retrieved_item(self, headers, message):
+        flags = self.flags_struct.unpack_from(message, self.HEADER_BYTES)[0]
+        return flags, message[self.HEADER_BYTES + headers.extra_length + headers.key_length:]
+
+    def _release_leases(self, messages):
+        for headers, message in messages:
+            key = self._key_from_message(headers, message)
+            if key and headers.opcode not in self.RETRIEVAL_OPS:
+                self.leases.release(key)
+
+    @gen.engine
+    def _add_values(self, missed, responses, values, callback):
+        '''
+        Answers the retrievals missed with the values given for their keys; The values replace the "not
+        found" responses, or come before the final response for quiet retrievals.
+        '''
+        if not values:
+            callback(responses)
+            return
+
+        found = {}
+        for headers, message in missed:
+            key = self._key_from_message(headers, message)
+            if key in values:
+                flags, value = values[key]
+                found[headers.opaque] = yield gen.Task(self._value_response, headers, key, flags, value)
+
+        completed = [found.pop(headers.opaque, (headers, message)) for headers, message in responses]
+        quiet_responses = [found[headers.opaque] for headers, message in missed if headers.opaque in found]
+        callback(completed[:-1] + quiet_responses + completed[-1:])
+
+    @gen.engine
+    def _value_response(self, request_headers, key, flags, value, callback):
+        if request_headers.opcode not in self.KEYED_RETRIEVAL_OPS:
+            key = b''
+        body_bytes = self.flags_struct.pack(flags) + key + value
+        header_bytes = self.parser.pack_response_header(
+            request_headers.opcode, 0, opaque=request_headers.opaque, key_length=len(key),
+            extra_length=self.flags_struct.size, total_body_length=len(body_bytes))
+        headers = self.parser.unpack_response_header(header_bytes)
+        if self.compressor is not None or self.chunker is not None:
+            header_bytes, body_bytes = yield gen.Task(self._convert_value, headers, body_bytes)
+        callback((headers, header_bytes + body_bytes))
+
+    def _replicate(self, messages):
+        '''
+        Repeats the keyed writes on the other replicas of their keys. Only the ones leaving every replica with
+        the same item are repeated as they are; Any other one, including CAS updates, deletes the copies
+        instead, as it could succeed in some replica and fail in another.
+        '''
+        for headers, message in messages:
+            key = self._key_from_message(headers, message)
+            if not key or headers.opcode in self.RETRIEVAL_OPS:
+                continue
+            if headers.opcode not in self.REPLICATED_OPS or headers.cas:
+                message = self.parser.pack_request_header(
+                    self.DELETE_QUIETLY, key_length=len(key), total_body_length=len(key)) + key
+            self.pool_repository.replicate(key, message)
+
+    def _route(self, messages):
+        '''
+        Picks the node to serve the request, being the key owner for writes and a replica picked by the
+        selector for reads; Quiet batches with keys served by many nodes get their messages grouped by node
+        instead, to be fanned out.
+        '''
+        messages_by_node = defaultdict(list)
+        for headers, message in messages:
+            key = self._key_from_message(headers, message)
+            if not key:
+                node = self.pool_repository.default_node
+            elif headers.opcode in self.RETRIEVAL_OPS:
+                node = self.pool_repository.node_for_read(key)
+            else:
+                node = self.pool_repository.ring.node_for_key(key)
+            messages_by_node[node].append((headers, message))
+        if len(messages_by_node) > 1:
+            return None, messages_by_node
+        node, = messages_by_node
+        return node, None
+
+    @gen.engine
+    def _timed(self, node, task, callback, trace=None):
+        '''
+        Runs the task measuring the round trip to the node, so that the slow replicas can be avoided.
+        '''
+        selector = self.pool_repository.selector
+        started = selector.started(node)
+        try:
+            result = yield task
+        finally:
+            round_trip = selector.finished(node, started)
+            if self.hedging is not None:
+                self.hedging.record(round_trip)
+            if trace is not None:
+                trace.backend_answered(node, round_trip)
+        callback(result)
+
+    def _key_from_message(self, headers, message):
+        key_start = self.HEADER_BYTES + headers.extra_length
+        return message[key_start:key_start + headers.key_length]
+
+    def _join(self, messages):
+        return b''.join(message for headers, message in messages)
+
+    def _writes_behind(self, messages):
+        # The backend limits account for the writes until flushed, so they're left to wait for them.
+        if self.write_behind is None or self.limits is not None or len(messages) < 2:
+            return False
+        return messages[-1][0].opcode == self.NO_OP and all(
+            headers.opcode in self.QUIET_WRITE_OPS for headers, message in messages[:-1])
+
+    @gen.engine
+    def _write_behind(self, messages, backend_stream, messages_by_node, client_stream, callback):
+        '''
+        Hands a batch of quiet writes ended by a NoOp to the backends, each share with a NoOp of its own, and
+        answers the final NoOp right away instead of after the round trips; Failures of the writes get read
+        and thrown away. The messages of the shares dropped for their backends being full get answered as busy.
+        '''
+        if messages_by_node is None:
+            shares = [(backend_stream, messages[:-1])]
+        else:
+            shares = [
+                (self.pool_repository.stream_for_node(node), [request for request in node_messages if request[0].opcode != self.NO_OP])
+                for node, node_messages in messages_by_node.items()
+            ]
+            shares = [(stream, share) for stream, share in shares if share]
+        no_op_bytes = self.parser.pack_request_header(self.NO_OP)
+        taken = yield [
+            gen.Task(self.write_behind.write, stream, len(request_bytes), partial(self._send_behind, stream, request_bytes))
+            for stream, request_bytes in ((stream, self._join(share) + no_op_bytes) for stream, share in shares)
+        ]
+        profiling.enter(profiling.CLIENT_WRITE)
+
+        response_bytes = [
+            self._busy_response(headers)
+            for (stream, share), was_taken in zip(shares, taken) if not was_taken
+            for headers, message in share
+        ]
+        response_bytes.append(self._local_response(messages[-1][0], 0, b''))
+        yield gen.Task(client_stream.write, b''.join(response_bytes))
+        callback([self._response_message(response) for response in response_bytes])
+
+    @gen.engine
+    def _send_behind(self, backend_stream, request_bytes, callback):
+        turn = yield gen.Task(self._pipeline(backend_stream).write, request_bytes)
         callback()
+        yield gen.Task(self._read_turn_messages, turn)
+
+    @gen.engine
+    def _forward_to_nodes(self, messages, messages_by_node, client_stream, callback):
+        '''
+        Sends each backend its share of a quiet batch. The backends not owning the final message get a NoOp
+        appended, so that it's known when they're done, and its response is left out; The final response
+        comes last, as the client expects.
+        '''
+        final_node = next(node for node, node_messages in messages_by_node.items() if messages[-1] in node_messages)
+        nodes = sorted(messages_by_node, key=lambda node: node == final_node)
+        requests = []
+        for node in nodes:
+            request_bytes = self._join(messages_by_node[node])
+            if node != final_node:
+                request_bytes += self.parser.pack_request_header(self.NO_OP)
+            requests.append(request_bytes)
+
+        trace = self.traces.get(client_stream)
+        responses = yield [
+            gen.Task(self._timed, node, gen.Task(self._exchange, node, request_bytes), trace=trace)
+            for node, request_bytes in zip(nodes, requests)
+        ]
+
+        relayed = []
+        for node, response in zip(nodes, responses):
+            if response is None:
+                response = self._busy_messages(messages_by_node[node])
+            elif node != final_node:
+                response = response[:-1]
+            relayed.extend(response)
+        relayed = yield gen.Task(self._respond, messages, relayed, client_stream, messages_by_node=messages_by_node)
+        callback(relayed)
+
+    @gen.engine
+    def _exchange(self, node, request_bytes, callback):
+        '''
+        Sends the request messages to a node and reads their response, which is None if the node's limiter
+        turns them down.
+        '''
+        limiter = None
+        if self.limits is not None:
+            limiter = self.limits.limiter_for(node)
+            admitted = yield gen.Task(limiter.acquire)
+            if not admitted:
+                callback(None)
+                return
+            profiling.enter(profiling.BACKEND_WRITE)
+        responses = yield gen.Task(self._round_trip, request_bytes, self.pool_repository.stream_for_node(node), limiter=limiter)
+        callback(responses)
+
+    @gen.engine
+    def _relay_response(self, requests, client_stream, backend_stream, node, callback, limiter=None):
+        '''
+        Sends the request messages through the backend pipeline and relays their response, timing only the
+        round trip to the backend, which ends as soon as the response is read.
+        '''
+        if limiter is None and self._is_plain():
+            # Nothing is done around the round trip, so its layers get skipped, leaving just the pipelining.
+            turn = yield gen.Task(self._pipeline(backend_stream).write, self._join(requests))
+            messages = yield gen.Task(self._read_turn_messages, turn)
+            profiling.enter(profiling.CLIENT_WRITE)
+            yield gen.Task(client_stream.write, self._join(messages))
+            callback(messages)
+            return
+
+        if self._hedges(requests):
+            messages = yield gen.Task(self._relay_hedged_response, requests, client_stream, backend_stream, node, limiter)
+            callback(messages)
+            return
+
+        messages = yield gen.Task(self._timed, node, gen.Task(
+            self._round_trip, self._join(requests), backend_stream, limiter=limiter), trace=self.traces.get(client_stream))
+        messages = yield gen.Task(self._respond, requests, messages, client_stream, messages_by_node={node: requests})
+        callback(messages)
+
+    @gen.engine
+    def _round_trip(self, request_bytes, backend_stream, callback, limiter=None):
+        '''
+        Writes the request messages to the backend pipeline and reads their response from the turn handed
+        out, which gets finished as soon as it's read, so that the next clients' responses don't wait for this
+        one to be relayed; The limiter, if any, accounts for the messages until flushed, and gets its slot back
+        once the response is read, before the client is answered.
+        '''
+        try:
+            if limiter is not None:
+                limiter.wrote(len(request_bytes))
+            try:
+                turn = yield gen.Task(self._pipeline(backend_stream).write, request_bytes)
+            finally:
+                if limiter is not None:
+                    limiter.flushed(len(request_bytes))
+            messages = yield gen.Task(self._read_turn_messages, turn)
+        finally:
+            if limiter is not None:
+                limiter.release()
+        callback(messages)
+
+    @gen.engine
+    def _respond(self, requests, messages, client_stream, callback, messages_by_node=None):
+        '''
+        Answers the client with the response messages, once their turn is over and their round trip measured,
+        as converting their values may take a while; The request messages are given by the node they were
+        sent to, if they were read from replicas.
+        '''
+        if self.compressor is not None or self.chunker is not None:
+            messages = yield gen.Task(self._convert_messages, messages, self.parser.unpack_response_header)
+        if messages_by_node is not None and self.pool_repository.is_replicated():
+            messages = yield gen.Task(self._read_from_owners, requests, messages, messages_by_node)
+        if self.pool_repository.is_migrating():
+            messages = yield gen.Task(self._read_from_previous_owners, requests, messages)
+        if self.leases is not None:
+            messages = yield gen.Task(self._apply_leases, requests, messages, client_stream)
+        profiling.enter(profiling.CLIENT_WRITE)
+        yield gen.Task(client_stream.write, self._join(messages))
+        callback(messages)
+
+    def _is_plain(self):
+        '''
+        Whether the responses need none of the work done around the round trips: No replicas to time and
+        read from, no migration, hedging, tracing, leases or values to convert.
+        '''
+        return not (self.pool_repository.is_replicated() or self.pool_repository.is_migrating() or
+                    self.hedging is not None or self.tracer is not None or self.leases is not None or
+                    self.compressor is not None or self.chunker is not None)
+
+    def _hedges(self, requests):
+        if self.hedging is None or not self.pool_repository.is_replicated():
+            return False
+        if not any(headers.opcode in self.RETRIEVAL_OPS for headers, message in requests):
+            return False
+        return all(headers.opcode in self.RETRIEVAL_OPS or headers.opcode == self.NO_OP for headers, message in requests)
+
+    @gen.engine
+    def _relay_hedged_response(self, requests, client_stream, backend_stream, node, limiter, callback):
+        '''
+        Relays the response like _relay_response, but asks other replicas for the keys when the backend
+        takes longer than the hedging delay, answering with the first to find them all; The backend response
+        is read in full either way, to keep the stream in step, and thrown away if it lost.
+        '''
+        self.hedging.count_read()
+        first_answer = yield gen.Callback('first answer')
+        backend_read = yield gen.Callback('backend read')
+        keys = [self._key_from_message(headers, message) for headers, message in requests if headers.opcode != self.NO_OP]
+        answered = []
+
+        def answer(messages):
+            if not answered:
+                answered.append(messages)
+                first_answer(messages)
+
+        def hedge():
+            if not answered and self.hedging.allow():
+                self.hedging.fetch(self.pool_repository, node, keys, callback=hedged)
+
+        def hedged(values):
+            if len(values) == len(set(keys)) and not answered:
+                self._hedged_responses(requests, values, callback=answer)
+
+        def backend_answered(messages):
+            if timeout is not None:
+                self.io_loop.remove_timeout(timeout)
+            answer(messages)
+            backend_read()
+
+        delay = self.hedging.delay()
+        timeout = None if delay is None else self.io_loop.add_timeout(time.time() + delay, hedge)
+        self._timed(node, gen.Task(self._round_trip, self._join(requests), backend_stream, limiter=limiter),
+                    trace=self.traces.get(client_stream), callback=backend_answered)
+        messages = yield gen.Wait('first answer')
+        messages = yield gen.Task(self._respond, requests, messages, client_stream, messages_by_node={node: requests})
+        yield gen.Wait('backend read')
+        callback(messages)
+
+    @gen.engine
+    def _hedged_responses(self, requests, values, callback):
+        responses = []
+        for headers, message in requests:
+            if headers.opcode == self.NO_OP:
+                header_bytes = self.parser.pack_response_header(self.NO_OP, 0, opaque=headers.opaque)
+                responses.append((self.parser.unpack_response_header(header_bytes), header_bytes))
+            else:
+                key = self._key_from_message(headers, message)
+                flags, value = values[key]
+                response = yield gen.Task(self._value_response, headers, key, flags, value)
+                responses.append(response)
+        callback(responses)
+
+    def _busy_response(self, headers):
+        return self._local_response(headers, self.BUSY_STATUS, self.BUSY_MESSAGE)
+
+    def _busy_messages(self, requests):
+        # A NoOp still tells the client its batch is over, so only the other messages are answered as busy.
+        return [
+            self._response_message(self._local_response(headers, 0, b'') if headers.opcode == self.NO_OP else self._busy_response(headers))
+            for headers, message in requests
+        ]
+
+    def _response_message(self, response_bytes):
+        return self.parser.unpack_response_header(response_bytes[:self.HEADER_BYTES]), response_bytes
 
     @gen.engine
-    def _read_full_chunk(self, unpack, stream_data, stream, callback):
+    def _read_turn_messages(self, turn, callback):
+        '''
+        Reads the response messages from the turn of a request, finishing the turn even if they can't be
+        read, as the clients after it would otherwise wait for it forever.
+        '''
+        try:
+            messages = yield gen.Task(self._read_messages, turn, self.parser.unpack_response_header)
+        finally:
+            turn.finish()
+        callback(messages)
+
+    @gen.engine
+    def _read_messages(self, stream, unpack, callback):
+        messages = []
         while True:
-            headers = yield gen.Task(self._read_chunk, stream, stream_data, unpack)
+            with BytesIO() as stream_data:
+                headers = yield gen.Task(self._read_chunk, stream, stream_data, unpack)
+                messages.append((headers, stream_data.getvalue()))
             if headers.opcode not in self.QUIET_OPS:
                 break
-        callback()
+        callback(messages)
 
     @gen.engine
     def _read_chunk(self, stream, stream_data, unpack, callback):
+        '''
+        Reads a single message; Its bytes get handled in the stage of what they're read for, parsing a request
+        or reading a response.
+        '''
+        stage = profiling.PARSE if unpack == self.parser.unpack_request_header else profiling.BACKEND_READ
         header_bytes = yield gen.Task(stream.read_bytes, self.HEADER_BYTES)
-        stream_data.write(header_bytes)
+        profiling.enter(stage)
         headers = unpack(header_bytes)
+        body_bytes = b''
         if headers.total_body_length > 0:
             body_bytes = yield gen.Task(stream.read_bytes, headers.total_body_length)
-            stream_data.write(body_bytes)
+            profiling.enter(stage)
+        stream_data.write(header_bytes)
+        stream_data.write(body_bytes)
         callback(headers)
+
+    @gen.engine
+    def _convert_messages(self, messages, unpack, callback):
+        '''
+        Converts the values stored by request messages, or retrieved by response ones; The quiet retrievals
+        whose chunks are gone are left out, as misses get no response.
+        '''
+        converted = []
+        for headers, message in messages:
+            header_bytes, body_bytes = yield gen.Task(self._convert_value, headers, message[self.HEADER_BYTES:])
+            if not header_bytes:
+                continue
+            if header_bytes != headers.raw:
+                headers = unpack(header_bytes)
+            converted.append((headers, header_bytes + body_bytes))
+        callback(converted)
+
+    @gen.engine
+    def _convert_value(self, headers, body_bytes, callback):
+        if headers.extra_length < self.flags_struct.size:
+            callback((headers.raw, body_bytes))
+            return
+        value_offset = headers.extra_length + headers.key_length
+        original_flags = flags = self.flags_struct.unpack_from(body_bytes)[0]
+        value = body_bytes[value_offset:]
+
+        if self._is_storage(headers):
+            flags, value = yield gen.Task(self._convert_stored_value, headers, body_bytes, flags, value)
+        elif self._is_retrieved_value(headers):
+            flags, value = yield gen.Task(self._convert_retrieved_value, headers, body_bytes, flags, value)
+            if value is None:
+                callback(self._missing_value(headers, body_bytes))
+                return
+
+        if flags == original_flags:
+            callback((headers.raw, body_bytes))
+            return
+        body_bytes = self.flags_struct.pack(flags) + body_bytes[self.flags_struct.size:value_offset] + value
+        headers = headers._replace(total_body_length=len(body_bytes))
+        callback((self.parser.pack_header(headers), body_bytes))
+
+    @gen.engine
+    def _convert_stored_value(self, headers, body_bytes, flags, value, callback):
+        if self.compressor is not None and self.compressor.should_compress(flags, len(value)):
+            compressed = yield gen.Task(self.compressor.compress, value)
+            if compressed is not None:
+                flags, value = self.compressor.compressed_flags(flags), compressed
+
+        if self.chunker is not None and headers.opcode in self.SET_OPS:
+            yield gen.Task(self.chunker.discard_previous, body_bytes[headers.extra_length:headers.extra_length + headers.key_length])
+            if self.chunker.should_split(len(value)):
+                exptime = self.flags_struct.unpack_from(body_bytes, self.flags_struct.size)[0]
+                manifest = yield gen.Task(self.chunker.store, exptime, value)
+                if manifest is not None:
+                    flags, value = self.chunker.manifest_flags(flags), manifest
+
+        callback((flags, value))
+
+    @gen.engine
+    def _convert_retrieved_value(self, headers, body_bytes, flags, value, callback):
+        if self.chunker is not None and self.chunker.is_manifest(flags):
+            value = yield gen.Task(self.chunker.fetch, value)
+            flags = self.chunker.value_flags(flags)
+            if value is None:
+                callback((flags, None))
+                return
+
+        if self.compressor is not None and self.compressor.is_compressed(flags):
+            decompressed = yield gen.Task(self.compressor.decompress, value)
+            if decompressed is not None:
+                flags, value = self.compressor.decompressed_flags(flags), decompressed
+
+        callback((flags, value))
+
+    def _missing_value(self, headers, body_bytes):
+        if headers.opcode in self.QUIET_OPS:
+            return (b'', b'')
+        key = body_bytes[headers.extra_length:headers.extra_length + headers.key_length]
+        body_bytes = key + self.NOT_FOUND_MESSAGE
+        header_bytes = self.parser.pack_response_header(
+            headers.opcode, self.NOT_FOUND_STATUS, opaque=headers.opaque, key_length=len(key), total_body_length=len(body_bytes))
+        return (header_bytes, body_bytes)
+
+    def _is_storage(self, headers):
+        return headers.magic == self.parser.REQUEST_MAGIC and headers.opcode in self.STORAGE_OPS
+
+    def _is_retrieved_value(self, headers):
+        return headers.magic == self.parser.RESPONSE_MAGIC and headers.opcode in self.RETRIEVAL_OPS and headers.status == 0
@@ -1,66 +1,925 @@
 #!/usr/bin/env python
 
+from functools import partial
 from io import BytesIO
+import time
+from weakref import WeakKeyDictionary
 
 from tornado import gen
 
+from memcrashed import profiling
 from memcrashed.parser import TextParser
+from memcrashed.pipelining import Pipeline
 from memcrashed.proxy import ProxyRepository
 
 
 class TextProtocolHandler(object):
     EOL = b'\r\n'
     END = b'END' + EOL
+    OK = b'OK' + EOL
+    ERROR = b'ERROR' + EOL
+    BUSY_ERROR = b'SERVER_ERROR backend busy' + EOL
+    THROTTLED_ERROR = b'SERVER_ERROR rate limited' + EOL
+    NOT_SUPPORTED_ERROR = b'SERVER_ERROR not supported with compression or chunking' + EOL
+    ERROR_REPLIES = (b'ERROR', b'CLIENT_ERROR ', b'SERVER_ERROR ')
+    META_NO_OP = b'mn' + EOL
+    META_NO_OP_REPLY = b'MN' + EOL
+    META_VALUE = b'VA '
+    META_MISS = b'EN' + EOL
+    STATS_LINES = (b'STAT ', b'ITEM ', b'PREFIX ')
+    CONVERTIBLE_COMMANDS = (b'set', b'add', b'replace', b'cas')
+    CONCATENATION_COMMANDS = (b'append', b'prepend')
+    CONCATENATION_MODES = (b'MA', b'Ma', b'MP', b'Mp')
+    REPLICATED_COMMANDS = (b'set', b'delete', b'touch')
+    META_READ_COMMANDS = (b'mg', b'me')
+    OWNER_RETRIEVAL_COMMANDS = (b'gets', b'gat', b'gats')
+    BROADCAST_COMMANDS = (b'flush_all', b'verbosity', b'cache_memlimit')
+    LOCAL_COMMANDS = (b'quit', b'mn')
 
     def __init__(self, io_loop):
         self.io_loop = io_loop
         self.parser = TextParser()
         self.pool_repository = ProxyRepository(self.io_loop)
+        self.busy_streams = set()
+        self.pipelines = WeakKeyDictionary()
+        self.limits = None
+        self.compressor = None
+        self.chunker = None
+        self.negative_cache = None
+        self.shadow = None
+        self.hedging = None
+        self.leases = None
+        self.quotas = None
+        self.write_behind = None
+        self.analytics = None
+        self.tracer = None
+        self.traces = {}
 
     @gen.engine
     def process(self, client_stream, backend_stream, callback):
-        with BytesIO() as stream_data:
-            header = yield gen.Task(self._process_request, stream_data, client_stream, backend_stream)
+        if self.limits is not None:
+            yield gen.Task(self.limits.wait_writable)
 
         with BytesIO() as stream_data:
-            yield gen.Task(self._process_response, header, stream_data, backend_stream, client_stream)
+            header = yield gen.Task(self._process_request, stream_data, client_stream)
+            request_bytes = stream_data.getvalue()
+        profiling.enter(profiling.PARSE)
+
+        if header.command in self.LOCAL_COMMANDS or not self.parser.is_known_command(header.command):
+            yield gen.Task(self._answer_locally, header, client_stream)
+            self.busy_streams.discard(client_stream)
+            callback()
+            return
+
+        if self.quotas is not None and not self.quotas.allow(
+                self._tenant(header, client_stream), max(1, len(self._keys(header))), len(request_bytes)):
+            if not getattr(header, 'noreply', False):
+                yield gen.Task(client_stream.write, self.THROTTLED_ERROR)
+            self.busy_streams.discard(client_stream)
+            callback()
+            return
+
+        if self._converts_values() and self._concatenates(header):
+            # The backend would join the bytes to a compressed value or a manifest, corrupting the item.
+            if not getattr(header, 'noreply', False):
+                yield gen.Task(client_stream.write, self.NOT_SUPPORTED_ERROR)
+            self.busy_streams.discard(client_stream)
+            callback()
+            return
+
+        trace = None
+        if self.tracer is not None:
+            trace = self._start_trace(client_stream, header, request_bytes)
+
+        profiling.enter(profiling.ROUTE)
+        cache_versions = None
+        if self.negative_cache is not None:
+            header, request_bytes = self._check_negative_cache(header, request_bytes)
+            if header is None:
+                yield gen.Task(client_stream.write, self.END)
+                self._finish_trace(client_stream, trace)
+                self.busy_streams.discard(client_stream)
+                callback()
+                return
+            if self.parser.is_retrieval_command(header.command):
+                cache_versions = self.negative_cache.versions(header.keys)
+
+        profiling.enter(profiling.BACKEND_WRITE)
+        if self._converts_values() and header.command in self.CONVERTIBLE_COMMANDS:
+            request_bytes = yield gen.Task(self._convert_request, header, request_bytes)
+        elif self._converts_values() and self._reads_meta_value(header) and b'f' not in header.flags:
+            # The client flags tell the converted values apart, so they're asked for along with the value.
+            request_bytes = header.raw[:-len(self.EOL)] + b' f' + self.EOL
+
+        if self.shadow is not None:
+            self._mirror(header, request_bytes)
+
+        keys = self._keys(header)
+        if self.pool_repository.is_migrating() and keys and not self._is_read(header):
+            self.pool_repository.migration.forget(header.key)
+
+        if self.pool_repository.is_replicated() and keys and (
+                not self._is_read(header) or self.parser.is_touch_retrieval_command(header.command)):
+            self._replicate(header, request_bytes)
+
+        if self.parser.is_meta_command(header.command) and header.quiet:
+            # A quiet command that went fine gets no response, so a "mn" follows it to tell when it's done.
+            request_bytes += self.META_NO_OP
+
+        profiling.enter(profiling.ROUTE)
+        node = None
+        keys_by_node = None
+        if self.pool_repository.is_sharded():
+            node, keys_by_node = self._route(header)
+            if node is not None:
+                backend_stream = self.pool_repository.stream_for_node(node)
+        if node is None:
+            node = self.pool_repository.default_node
+
+        if self.analytics is not None:
+            self._record_accesses(keys, node, keys_by_node)
+
+        profiling.enter(profiling.BACKEND_WRITE)
+        found_keys = None
+        if keys_by_node is not None:
+            found_keys = yield gen.Task(self._forward_to_nodes, header, keys_by_node, client_stream)
+        elif header.command in self.BROADCAST_COMMANDS and self.pool_repository.is_sharded():
+            yield gen.Task(self._broadcast, header, request_bytes, client_stream)
+        elif self.limits is None:
+            found_keys = yield gen.Task(self._forward, header, request_bytes, client_stream, backend_stream, node)
+        else:
+            limiter = self.limits.limiter_for(node)
+            if trace is not None:
+                queued = self.tracer.clock()
+            admitted = yield gen.Task(limiter.acquire)
+            if trace is not None:
+                trace.queue_wait = self.tracer.clock() - queued
+            if admitted:
+                profiling.enter(profiling.BACKEND_WRITE)
+                found_keys = yield gen.Task(
+                    self._forward_limited, limiter, header, request_bytes, client_stream, backend_stream, node)
+            elif not getattr(header, 'noreply', False):
+                yield gen.Task(client_stream.write, self.BUSY_ERROR)
+
+        if self.leases is not None and keys and not self._is_read(header):
+            for key in keys:
+                self.leases.release(key)
+
+        if self.negative_cache is not None and found_keys is not None:
+            missed_keys = [key for key in header.keys if key not in found_keys]
+            if self.leases is not None:
+                # Leased keys are about to be refilled, so they can't be answered as misses by the proxy.
+                missed_keys = [key for key in missed_keys if not self.leases.is_leased(key)]
+            self.negative_cache.add_misses(missed_keys, cache_versions)
 
+        self._finish_trace(client_stream, trace)
+        self.busy_streams.discard(client_stream)
         callback()
 
+    def _start_trace(self, client_stream, header, request_bytes):
+        trace = self.tracer.start(header.command.decode('ascii', 'replace'), self._keys(header), len(request_bytes))
+        if trace is not None:
+            self.traces[client_stream] = trace
+        return trace
+
+    def _finish_trace(self, client_stream, trace):
+        if trace is not None:
+            del self.traces[client_stream]
+            self.tracer.finish(trace, client_stream)
+
     @gen.engine
-    def _process_request(self, stream_data, client_stream, backend_stream, callback):
+    def _process_request(self, stream_data, client_stream, callback):
         header_bytes = yield gen.Task(self._read_chunk_until_eol, client_stream, stream_data)
+        profiling.enter(profiling.PARSE)
+        self.busy_streams.add(client_stream)
         header = self.parser.unpack_request_header(header_bytes)
 
         if self.parser.is_storage_command(header.command):
             bytes_to_read = self._extract_bytes_quantity(header_bytes, bytes_index=4)
             yield gen.Task(self._read_chunk_bytes, client_stream, stream_data, bytes_to_read)
+        elif header.command == b'ms':
+            bytes_to_read = self._extract_bytes_quantity(header_bytes, bytes_index=2)
+            yield gen.Task(self._read_chunk_bytes, client_stream, stream_data, bytes_to_read)
 
-        yield gen.Task(backend_stream.write, stream_data.getvalue())
         callback(header)
 
     @gen.engine
-    def _process_response(self, header, stream_data, backend_stream, client_stream, callback):
+    def _answer_locally(self, header, client_stream, callback):
+        '''
+        Answers the commands never forwarded: "quit" closes only the client connection, as the backend ones
+        are shared, and "mn" is answered right away, as the quiet commands before it were already done;
+        Unknown commands get an error, like from memcached itself.
+        '''
+        if header.command == b'quit':
+            client_stream.close()
+        elif header.command == b'mn':
+            yield gen.Task(client_stream.write, self.META_NO_OP_REPLY)
+        else:
+            yield gen.Task(client_stream.write, self.ERROR)
+        callback()
+
+    def _keys(self, header):
         if self.parser.is_retrieval_command(header.command):
-            yield gen.Task(self._read_retrieval_values, backend_stream, stream_data)
+            return header.keys
+        if not self.parser.is_keyed_command(header.command):
+            return []
+        return [header.key]
+
+    def _pipeline(self, backend_stream):
+        pipeline = self.pipelines.get(backend_stream)
+        if pipeline is None:
+            pipeline = self.pipelines[backend_stream] = Pipeline(backend_stream)
+        return pipeline
+
+    def _record_accesses(self, keys, node, keys_by_node):
+        groups = keys_by_node.items() if keys_by_node is not None else [(node, keys)]
+        for node, node_keys in groups:
+            self.analytics.record(node_keys, node)
+
+    def _tenant(self, header, client_stream):
+        keys = self._keys(header)
+        return self.quotas.tenant(client_stream, keys[0] if keys else b'')
+
+    def _concatenates(self, header):
+        if header.command == b'ms':
+            return any(flag in self.CONCATENATION_MODES for flag in header.flags)
+        return header.command in self.CONCATENATION_COMMANDS
+
+    def _reads_meta_value(self, header):
+        return header.command == b'mg' and b'v' in header.flags
+
+    def _is_read(self, header):
+        return self.parser.is_retrieval_command(header.command) or header.command in self.META_READ_COMMANDS
+
+    def _retrieval_request(self, header, keys):
+        if self.parser.is_touch_retrieval_command(header.command):
+            return b' '.join([header.command, self._number(header.exptime)] + keys) + self.EOL
+        return b' '.join([header.command] + keys) + self.EOL
+
+    def _mirror(self, header, request_bytes):
+        if not self._is_read(header):
+            if self._keys(header):
+                self.shadow.mirror(header.key, request_bytes)
+        elif not self.shadow.samples_read():
+            return
+        elif self.parser.is_retrieval_command(header.command):
+            for node, keys in self.shadow.ring.keys_by_node(header.keys).items():
+                self.shadow.mirror_to_node(node, self._retrieval_request(header, keys))
+        else:
+            self.shadow.mirror(header.key, request_bytes)
+
+    def _check_negative_cache(self, header, request_bytes):
+        '''
+        Leaves out of a retrieval the keys known to be missing, or invalidates the keys of anything but a
+        read; Calls for no request at all, with a None header, when every key requested is missing.
+        '''
+        if not self._is_read(header):
+            for key in self._keys(header):
+                self.negative_cache.invalidate(key)
+            return header, request_bytes
+        if not self.parser.is_retrieval_command(header.command):
+            return header, request_bytes
+        keys = [key for key in header.keys if not self.negative_cache.contains(key)]
+        if len(keys) == len(header.keys):
+            return header, request_bytes
+        if not keys:
+            return None, None
+        request_bytes = self._retrieval_request(header, keys)
+        return self.parser.unpack_request_header(request_bytes), request_bytes
+
+    def _replicate(self, header, request_bytes):
+        '''
+        Repeats the writes on the other replicas of the key. Only the ones leaving every replica with the same
+        item are repeated as they are, and "gat" touches the copies of its keys; Any other one deletes the
+        copies instead, as it could succeed in some replica and fail in another.
+        '''
+        if self.parser.is_touch_retrieval_command(header.command):
+            for key in header.keys:
+                self.pool_repository.replicate(key, b' '.join([b'touch', key, self._number(header.exptime), b'noreply']) + self.EOL)
+            return
+        if self.parser.is_meta_command(header.command):
+            # The key goes as it was sent, as it may be in base64.
+            flags = [b'b', b'q'] if b'b' in header.flags else [b'q']
+            request_bytes = b' '.join([b'md', header.raw.split(b' ', 2)[1].strip()] + flags) + self.EOL
+        elif header.command not in self.REPLICATED_COMMANDS:
+            request_bytes = b'delete ' + header.key + b' noreply' + self.EOL
+        self.pool_repository.replicate(header.key, request_bytes)
+
+    def _route(self, header):
+        '''
+        Picks the node to serve the request, being the key owner for writes; Retrievals with keys served by
+        many nodes get their keys grouped by node instead, to be fanned out. "gets" always goes to the owners,
+        as their CAS values are the ones to be checked by "cas", and so do "gat" and "gats", touching the keys;
+        The commands without keys go to the default node.
+        '''
+        if not self.parser.is_keyed_command(header.command):
+            return None, None
+        if not self.parser.is_retrieval_command(header.command):
+            return self.pool_repository.ring.node_for_key(header.key), None
+        if header.command in self.OWNER_RETRIEVAL_COMMANDS:
+            keys_by_node = self.pool_repository.ring.keys_by_node(header.keys)
+        else:
+            keys_by_node = self.pool_repository.read_keys_by_node(header.keys)
+        if not keys_by_node:
+            return None, None
+        if len(keys_by_node) > 1:
+            return None, keys_by_node
+        node, = keys_by_node
+        return node, None
+
+    @gen.engine
+    def _timed(self, node, task, callback, trace=None):
+        '''
+        Runs the task measuring the round trip to the node, so that the slow replicas can be avoided.
+        '''
+        selector = self.pool_repository.selector
+        started = selector.started(node)
+        try:
+            result = yield task
+        finally:
+            round_trip = selector.finished(node, started)
+            if self.hedging is not None:
+                self.hedging.record(round_trip)
+            if trace is not None:
+                trace.backend_answered(node, round_trip)
+        callback(result)
+
+    @gen.engine
+    def _forward(self, header, request_bytes, client_stream, backend_stream, node, callback):
+        if getattr(header, 'noreply', False):
+            if self.write_behind is not None:
+                yield gen.Task(
+                    self.write_behind.write, backend_stream, len(request_bytes), partial(backend_stream.write, request_bytes))
+            else:
+                yield gen.Task(backend_stream.write, request_bytes)
+            callback(None)
+            return
+
+        if self._is_plain():
+            # Nothing is done around the round trip, so its layers get skipped, leaving just the pipelining.
+            turn = yield gen.Task(self._pipeline(backend_stream).write, request_bytes)
+            with BytesIO() as stream_data:
+                found_keys = yield gen.Task(self._read_turn_response, header, turn, stream_data)
+                response_bytes = stream_data.getvalue()
+            if response_bytes:
+                profiling.enter(profiling.CLIENT_WRITE)
+                yield gen.Task(client_stream.write, response_bytes)
+            callback(found_keys)
+            return
+
+        found_keys = yield gen.Task(self._process_response, header, request_bytes, backend_stream, client_stream, node)
+        callback(found_keys)
+
+    @gen.engine
+    def _forward_limited(self, limiter, header, request_bytes, client_stream, backend_stream, node, callback):
+        if getattr(header, 'noreply', False):
+            limiter.wrote(len(request_bytes))
+            try:
+                yield gen.Task(backend_stream.write, request_bytes)
+            finally:
+                limiter.flushed(len(request_bytes))
+                limiter.release()
+            callback(None)
+            return
+
+        found_keys = yield gen.Task(
+            self._process_response, header, request_bytes, backend_stream, client_stream, node, limiter=limiter)
+        callback(found_keys)
+
+    @gen.engine
+    def _forward_to_nodes(self, header, keys_by_node, client_stream, callback):
+        trace = self.traces.get(client_stream)
+        responses = yield [
+            gen.Task(self._timed, node, gen.Task(
+                self._read_node_values, node, self._retrieval_request(header, keys_by_node[node])), trace=trace)
+            for node in keys_by_node
+        ]
+        failed = [response for response, found_keys in responses if found_keys is None]
+        if failed:
+            yield gen.Task(self._respond, header, failed[0], client_stream)
+            callback(None)
+            return
+        response_bytes = self._ordered_response(header.keys, [response for response, found_keys in responses])
+        found_keys = set().union(*[found_keys for response, found_keys in responses])
+
+        found_keys = yield gen.Task(
+            self._finish_response, header, response_bytes, found_keys, client_stream, keys_by_node=keys_by_node)
+        callback(found_keys)
+
+    @gen.engine
+    def _broadcast(self, header, request_bytes, client_stream, callback):
+        '''
+        Sends a command changing every backend, like "flush_all", to all of them, answering with the first
+        failure if any.
+        '''
+        trace = self.traces.get(client_stream)
+        responses = yield [
+            gen.Task(self._exchange, header, node, request_bytes, trace) for node in self.pool_repository.backends
+        ]
+        if not header.noreply:
+            response_bytes = next((response for response in responses if response != self.OK), self.OK)
+            yield gen.Task(self._respond, header, response_bytes, client_stream)
+        callback(None)
+
+    @gen.engine
+    def _exchange(self, header, node, request_bytes, trace, callback):
+        backend_stream = self.pool_repository.stream_for_node(node)
+        limiter = None
+        if self.limits is not None:
+            limiter = self.limits.limiter_for(node)
+            admitted = yield gen.Task(limiter.acquire)
+            if not admitted:
+                callback(None if header.noreply else self.BUSY_ERROR)
+                return
+            profiling.enter(profiling.BACKEND_WRITE)
+        if header.noreply:
+            if limiter is not None:
+                limiter.wrote(len(request_bytes))
+            try:
+                yield gen.Task(backend_stream.write, request_bytes)
+            finally:
+                if limiter is not None:
+                    limiter.flushed(len(request_bytes))
+                    limiter.release()
+            callback(None)
+            return
+        with BytesIO() as stream_data:
+            yield gen.Task(self._timed, node, gen.Task(
+                self._round_trip, header, request_bytes, backend_stream, stream_data, limiter=limiter), trace=trace)
+            callback(stream_data.getvalue())
+
+    @gen.engine
+    def _read_node_values(self, node, request_bytes, callback):
+        '''
+        Reads the values of a retrieval from a node, answering with the response and the keys found in it, or
+        with a busy error and no keys if the node's limiter turns the retrieval down.
+        '''
+        limiter = None
+        if self.limits is not None:
+            limiter = self.limits.limiter_for(node)
+            admitted = yield gen.Task(limiter.acquire)
+            if not admitted:
+                callback((self.BUSY_ERROR, None))
+                return
+            profiling.enter(profiling.BACKEND_WRITE)
+        try:
+            if limiter is not None:
+                limiter.wrote(len(request_bytes))
+            try:
+                turn = yield gen.Task(self._pipeline(self.pool_repository.stream_for_node(node)).write, request_bytes)
+            finally:
+                if limiter is not None:
+                    limiter.flushed(len(request_bytes))
+            with BytesIO() as stream_data:
+                try:
+                    found_keys = yield gen.Task(self._read_retrieval_values, turn, stream_data)
+                finally:
+                    turn.finish()
+                response_bytes = stream_data.getvalue()
+        finally:
+            if limiter is not None:
+                limiter.release()
+        callback((response_bytes, found_keys))
+
+    @gen.engine
+    def _process_response(self, header, request_bytes, backend_stream, client_stream, node, callback, limiter=None):
+        '''
+        Sends the request through the backend pipeline and answers the client with its response, timing only
+        the round trip to the backend, which ends as soon as the response is read.
+        '''
+        if self._hedges(header):
+            found_keys = yield gen.Task(
+                self._process_hedged_response, header, request_bytes, backend_stream, client_stream, node, limiter)
+            callback(found_keys)
+            return
+
+        with BytesIO() as stream_data:
+            found_keys = yield gen.Task(self._timed, node, gen.Task(
+                self._round_trip, header, request_bytes, backend_stream, stream_data, limiter=limiter),
+                trace=self.traces.get(client_stream))
+            found_keys = yield gen.Task(
+                self._finish_response, header, stream_data.getvalue(), found_keys, client_stream, node=node)
+        callback(found_keys)
+
+    @gen.engine
+    def _round_trip(self, header, request_bytes, backend_stream, stream_data, callback, limiter=None):
+        '''
+        Writes the request to the backend pipeline and reads its response from the turn handed out, which gets
+        finished as soon as it's read, so that the next clients' responses don't wait for this one to be
+        answered; The limiter, if any, accounts for the request until flushed, and gets its slot back once the
+        response is read, before the client is answered.
+        '''
+        try:
+            if limiter is not None:
+                limiter.wrote(len(request_bytes))
+            try:
+                turn = yield gen.Task(self._pipeline(backend_stream).write, request_bytes)
+            finally:
+                if limiter is not None:
+                    limiter.flushed(len(request_bytes))
+            found_keys = yield gen.Task(self._read_turn_response, header, turn, stream_data)
+        finally:
+            if limiter is not None:
+                limiter.release()
+        callback(found_keys)
+
+    @gen.engine
+    def _read_turn_response(self, header, turn, stream_data, callback):
+        '''
+        Reads the response like _read_response, finishing the turn even if it can't be read, as the clients
+        after it would otherwise wait for it forever.
+        '''
+        try:
+            found_keys = yield gen.Task(self._read_response, header, turn, stream_data)
+        finally:
+            turn.finish()
+        callback(found_keys)
+
+    @gen.engine
+    def _read_response(self, header, backend_stream, stream_data, callback):
+        '''
+        Reads the whole response to the command, calling back with the keys found for retrievals, or None if
+        they failed.
+        '''
+        found_keys = None
+        if self.parser.is_retrieval_command(header.command):
+            found_keys = yield gen.Task(self._read_retrieval_values, backend_stream, stream_data)
+        elif self.parser.is_meta_command(header.command):
+            yield gen.Task(self._read_meta_response, header, backend_stream, stream_data)
+        elif header.command == b'stats':
+            yield gen.Task(self._read_stats, backend_stream, stream_data)
         else:
             yield gen.Task(self._read_chunk_until_eol, backend_stream, stream_data)
+            profiling.enter(profiling.BACKEND_READ)
+        callback(found_keys)
+
+    @gen.engine
+    def _read_meta_response(self, header, backend_stream, stream_data, callback):
+        '''
+        Reads the response to a meta command, along with its value if any; For quiet commands, it's read up to
+        the "MN" answering the "mn" sent after them, which is left out.
+        '''
+        while True:
+            with BytesIO() as response_data:
+                header_bytes = yield gen.Task(self._read_chunk_until_eol, backend_stream, response_data)
+                profiling.enter(profiling.BACKEND_READ)
+                if header_bytes.startswith(self.META_VALUE):
+                    bytes_to_read = self._extract_bytes_quantity(header_bytes, bytes_index=1)
+                    yield gen.Task(self._read_chunk_bytes, backend_stream, response_data, bytes_to_read)
+                if header.quiet and header_bytes == self.META_NO_OP_REPLY:
+                    break
+                stream_data.write(response_data.getvalue())
+            if not header.quiet:
+                break
+        callback()
+
+    @gen.engine
+    def _read_stats(self, backend_stream, stream_data, callback):
+        '''
+        Reads the lines of a "stats" response up to its END; The subcommands changing settings answer with a
+        single line instead.
+        '''
+        while True:
+            line = yield gen.Task(self._read_chunk_until_eol, backend_stream, stream_data)
+            profiling.enter(profiling.BACKEND_READ)
+            if not line.startswith(self.STATS_LINES):
+                break
+        callback()
+
+    @gen.engine
+    def _finish_response(self, header, response_bytes, found_keys, client_stream, callback, node=None, keys_by_node=None):
+        '''
+        Answers the client with the response read from the node, or from the nodes given along with the keys
+        they were asked for.
+        '''
+        if found_keys is None:
+            # The backend answered with an error, which is relayed as it is.
+            yield gen.Task(self._respond, header, response_bytes, client_stream)
+            callback(None)
+            return
+
+        if header.command == b'get' and self.pool_repository.is_replicated():
+            response_bytes, found_keys = yield gen.Task(
+                self._read_from_owners, header, response_bytes, found_keys, keys_by_node or {node: header.keys})
+
+        if header.command == b'get' and self.pool_repository.is_migrating():
+            response_bytes, found_keys = yield gen.Task(
+                self._read_from_previous_owners, header, response_bytes, found_keys)
+
+        if header.command == b'get' and self.leases is not None:
+            response_bytes, found_keys = yield gen.Task(
+                self._apply_leases, header, response_bytes, found_keys, client_stream)
+
+        yield gen.Task(self._respond, header, response_bytes, client_stream)
+
+        callback(found_keys)
+
+    def _hedges(self, header):
+        return (self.hedging is not None and header.command == b'get' and header.keys and
+                self.pool_repository.is_replicated())
+
+    @gen.engine
+    def _process_hedged_response(self, header, request_bytes, backend_stream, client_stream, node, limiter, callback):
+        '''
+        Reads the values like _process_response, but asks other replicas for the keys when the backend takes
+        longer than the hedging delay, answering with the first to find them all; The backend response is
+        read in full either way, to keep the stream in step, and thrown away if it lost. "gets" is never
+        hedged, as the CAS values of another backend would be meaningless.
+        '''
+        self.hedging.count_read()
+        first_answer = yield gen.Callback('first answer')
+        backend_read = yield gen.Callback('backend read')
+        answered = []
+
+        def answer(result):
+            if not answered:
+                answered.append(result)
+                first_answer(result)
+
+        def hedge():
+            if not answered and self.hedging.allow():
+                self.hedging.fetch(self.pool_repository, node, header.keys, callback=hedged)
+
+        def hedged(values):
+            if len(values) == len(set(header.keys)):
+                answer((self._values_response(header.keys, values, self.END), set(values)))
+
+        def backend_answered(found_keys):
+            if timeout is not None:
+                self.io_loop.remove_timeout(timeout)
+            answer((stream_data.getvalue(), found_keys))
+            backend_read()
+
+        delay = self.hedging.delay()
+        timeout = None if delay is None else self.io_loop.add_timeout(time.time() + delay, hedge)
+        with BytesIO() as stream_data:
+            self._timed(node, gen.Task(self._round_trip, header, request_bytes, backend_stream, stream_data, limiter=limiter),
+                        trace=self.traces.get(client_stream), callback=backend_answered)
+            response_bytes, found_keys = yield gen.Wait('first answer')
+            found_keys = yield gen.Task(
+                self._finish_response, header, response_bytes, found_keys, client_stream, node=node)
+            yield gen.Wait('backend read')
+        callback(found_keys)
+
+    @gen.engine
+    def _read_from_owners(self, header, response_bytes, found_keys, keys_by_node, callback):
+        '''
+        Looks the keys missed in replicas other than their owners up in the owners, as the writes not repeated
+        as they are, like "add" or "incr", delete the copies in the other replicas.
+        '''
+        ring = self.pool_repository.ring
+        missed_keys = [key for node, keys in keys_by_node.items() for key in keys
+                       if key not in found_keys and ring.node_for_key(key) != node]
+        if not missed_keys:
+            callback((response_bytes, found_keys))
+            return
+        responses = yield [
+            gen.Task(self._read_node_values, owner, self._retrieval_request(header, keys))
+            for owner, keys in ring.keys_by_node(missed_keys).items()
+        ]
+        profiling.enter(profiling.BACKEND_READ)
+        responses = [(response, owner_keys) for response, owner_keys in responses if owner_keys is not None]
+        response_bytes = self._ordered_response(header.keys, [response_bytes] + [response for response, owner_keys in responses])
+        callback((response_bytes, found_keys.union(*[owner_keys for response, owner_keys in responses])))
+
+    @gen.engine
+    def _read_from_previous_owners(self, header, response_bytes, found_keys, callback):
+        '''
+        Looks the keys missed up in the backends owning them before a ring change, adding the values found to
+        the response; "gets" is left alone, as the CAS values of another backend would be meaningless.
+        '''
+        missed_keys = [key for key in header.keys if key not in found_keys]
+        values = yield gen.Task(self.pool_repository.migration.fetch, missed_keys)
+        profiling.enter(profiling.BACKEND_READ)
+        if not values:
+            callback((response_bytes, found_keys))
+            return
+        response_bytes = self._values_response(missed_keys, values, response_bytes)
+        callback((response_bytes, found_keys | set(values)))
 
-        yield gen.Task(client_stream.write, stream_data.getvalue())
+    @gen.engine
+    def _apply_leases(self, header, response_bytes, found_keys, client_stream, callback):
+        '''
+        Remembers the values found for hot keys, and hands the keys missed to the leases, adding the values
+        they come up with to the response; "gets" is left alone, as the values served stale have no CAS.
+        '''
+        if any(self.leases.is_hot(key) for key in found_keys):
+            for key, flags, value in self._response_values(response_bytes):
+                self.leases.remember(key, flags, value)
+        missed_keys = [key for key in header.keys if key not in found_keys]
+        if not missed_keys:
+            callback((response_bytes, found_keys))
+            return
+        values = yield gen.Task(self.leases.fill, self.pool_repository, client_stream, missed_keys)
+        profiling.enter(profiling.BACKEND_READ)
+        if not values:
+            callback((response_bytes, found_keys))
+            return
+        response_bytes = self._values_response(missed_keys, values, response_bytes)
+        callback((response_bytes, found_keys | set(values)))
+
+    def _response_values(self, response_bytes):
+        '''
+        Yields the key, flags and value of each value in a retrieval response.
+        '''
+        position = 0
+        while True:
+            value_start = response_bytes.index(self.EOL, position) + len(self.EOL)
+            header_bytes = response_bytes[position:value_start]
+            if header_bytes == self.END:
+                return
+            position = value_start + self._extract_bytes_quantity(header_bytes, bytes_index=3)
+            tokens = header_bytes.split(b' ')
+            yield tokens[1], int(tokens[2]), response_bytes[value_start:position - len(self.EOL)]
+
+    def _ordered_response(self, keys, responses):
+        '''
+        Joins the values of many retrieval responses in the order of the keys asked for, like from a single
+        backend.
+        '''
+        blocks = {}
+        for response_bytes in responses:
+            blocks.update(self._value_blocks(response_bytes))
+        return b''.join(blocks[key] for key in keys if key in blocks) + self.END
+
+    def _value_blocks(self, response_bytes):
+        '''
+        Yields the key of each value in a retrieval response, along with the bytes of the whole value.
+        '''
+        position = 0
+        while True:
+            value_start = response_bytes.index(self.EOL, position) + len(self.EOL)
+            header_bytes = response_bytes[position:value_start]
+            if header_bytes == self.END:
+                return
+            value_end = value_start + self._extract_bytes_quantity(header_bytes, bytes_index=3)
+            yield header_bytes.split(b' ', 2)[1], response_bytes[position:value_end]
+            position = value_end
+
+    def _values_response(self, keys, values, response_bytes):
+        '''
+        Adds the values to a retrieval response, before its END, for the keys found among the given ones.
+        '''
+        with BytesIO() as stream_data:
+            stream_data.write(response_bytes[:-len(self.END)])
+            for key in keys:
+                if key in values:
+                    flags, value = values[key]
+                    stream_data.write(b' '.join([b'VALUE', key, self._number(flags), self._number(len(value))]) + self.EOL)
+                    stream_data.write(value + self.EOL)
+            stream_data.write(self.END)
+            return stream_data.getvalue()
+
+    @gen.engine
+    def _respond(self, header, response_bytes, client_stream, callback):
+        if (self._converts_values() and self.parser.is_retrieval_command(header.command) and
+                not response_bytes.startswith(self.ERROR_REPLIES)):
+            response_bytes = yield gen.Task(self._convert_values, response_bytes)
+        elif self._converts_values() and self._reads_meta_value(header) and response_bytes.startswith(self.META_VALUE):
+            response_bytes = yield gen.Task(self._convert_meta_value, header, response_bytes)
+
+        profiling.enter(profiling.CLIENT_WRITE)
+        trace = self.traces.get(client_stream)
+        if trace is not None:
+            trace.response_bytes += len(response_bytes)
+        if self.quotas is not None:
+            self.quotas.charge(self._tenant(header, client_stream), len(response_bytes))
+        if response_bytes:
+            yield gen.Task(client_stream.write, response_bytes)
 
         callback()
 
     @gen.engine
     def _read_retrieval_values(self, backend_stream, stream_data, callback):
+        '''
+        Calls back with the keys found, so that the missing ones can be told apart; A retrieval failing, like
+        for a key too long, gets a single error line instead, and calls back with None.
+        '''
+        found_keys = set()
         while True:
             header_bytes = yield gen.Task(self._read_chunk_until_eol, backend_stream, stream_data)
-            if header_bytes != self.END:
-                bytes_to_read = self._extract_bytes_quantity(header_bytes, bytes_index=3)
-                yield gen.Task(self._read_chunk_bytes, backend_stream, stream_data, bytes_to_read)
-            else:
+            profiling.enter(profiling.BACKEND_READ)
+            if header_bytes == self.END:
                 break
+            if header_bytes.startswith(self.ERROR_REPLIES):
+                found_keys = None
+                break
+            found_keys.add(header_bytes.split(b' ', 2)[1])
+            bytes_to_read = self._extract_bytes_quantity(header_bytes, bytes_index=3)
+            yield gen.Task(self._read_chunk_bytes, backend_stream, stream_data, bytes_to_read)
 
-        callback()
+        callback(found_keys)
+
+    def _converts_values(self):
+        return self.compressor is not None or self.chunker is not None
+
+    def _is_plain(self):
+        '''
+        Whether the responses need none of the work done around the round trips: No replicas to time and
+        read from, no migration, hedging, tracing, quotas, leases or values to convert.
+        '''
+        return not (self.pool_repository.is_replicated() or self.pool_repository.is_migrating() or
+                    self.hedging is not None or self.tracer is not None or self.quotas is not None or
+                    self.leases is not None or self._converts_values())
+
+    @gen.engine
+    def _convert_request(self, header, request_bytes, callback):
+        tokens = header.raw[:-len(self.EOL)].split(b' ')
+        flags = int(tokens[2])
+        value = request_bytes[len(header.raw):-len(self.EOL)]
+        converted = False
+
+        if self.compressor is not None and self.compressor.should_compress(flags, len(value)):
+            compressed = yield gen.Task(self.compressor.compress, value)
+            if compressed is not None:
+                flags, value, converted = self.compressor.compressed_flags(flags), compressed, True
+
+        if self.chunker is not None and header.command == b'set':
+            yield gen.Task(self.chunker.discard_previous, header.key)
+            if self.chunker.should_split(len(value)):
+                manifest = yield gen.Task(self.chunker.store, int(tokens[3]), value)
+                if manifest is not None:
+                    flags, value, converted = self.chunker.manifest_flags(flags), manifest, True
+
+        if not converted:
+            callback(request_bytes)
+            return
+        tokens[2] = self._number(flags)
+        tokens[4] = self._number(len(value))
+        callback(b' '.join(tokens) + self.EOL + value + self.EOL)
+
+    @gen.engine
+    def _convert_values(self, response_bytes, callback):
+        with BytesIO() as stream_data:
+            position = 0
+            while True:
+                value_start = response_bytes.index(self.EOL, position) + len(self.EOL)
+                header_bytes = response_bytes[position:value_start]
+                if header_bytes == self.END:
+                    stream_data.write(header_bytes)
+                    break
+                position = value_start + self._extract_bytes_quantity(header_bytes, bytes_index=3)
+                value = response_bytes[value_start:position - len(self.EOL)]
+                tokens = header_bytes[:-len(self.EOL)].split(b' ')
+                flags = int(tokens[2])
+                converted_flags, converted = yield gen.Task(self._convert_value, flags, value)
+                if converted is None:
+                    continue
+                if converted_flags != flags:
+                    tokens[2] = self._number(converted_flags)
+                    tokens[3] = self._number(len(converted))
+                    header_bytes = b' '.join(tokens) + self.EOL
+                stream_data.write(header_bytes)
+                stream_data.write(converted + self.EOL)
+            callback(stream_data.getvalue())
+
+    @gen.engine
+    def _convert_meta_value(self, header, response_bytes, callback):
+        '''
+        Converts the value of a "mg" response like the ones of "get", by the client flags returned along with
+        it, which are left out again if the client didn't ask for them; A value whose chunks are gone is
+        answered as a miss.
+        '''
+        value_start = response_bytes.index(self.EOL) + len(self.EOL)
+        tokens = response_bytes[:value_start - len(self.EOL)].split(b' ')
+        flags_index = next((index for index, token in enumerate(tokens[2:], 2) if token.startswith(b'f')), None)
+        if flags_index is None:
+            callback(response_bytes)
+            return
+        value = response_bytes[value_start:-len(self.EOL)]
+        flags, converted = yield gen.Task(self._convert_value, int(tokens[flags_index][1:]), value)
+        if converted is None:
+            callback(b'' if header.quiet else self.META_MISS)
+            return
+        if b'f' in header.flags:
+            tokens[flags_index] = b'f' + self._number(flags)
+        else:
+            del tokens[flags_index]
+        tokens[1] = self._number(len(converted))
+        callback(b' '.join(tokens) + self.EOL + converted + self.EOL)
+
+    @gen.engine
+    def _convert_value(self, flags, value, callback):
+        '''
+        Calls back with the flags and value to be sent to the client; A None value means it must be
+        answered as a miss.
+        '''
+        if self.chunker is not None and self.chunker.is_manifest(flags):
+            value = yield gen.Task(self.chunker.fetch, value)
+            flags = self.chunker.value_flags(flags)
+            if value is None:
+                callback((flags, None))
+                return
+
+        if self.compressor is not None and self.compressor.is_compressed(flags):
+            decompressed = yield gen.Task(self.compressor.decompress, value)
+            if decompressed is not None:
+                flags, value = self.compressor.decompressed_flags(flags), decompressed
+
+        callback((flags, value))
+
+    def _number(self, value):
+        return str(value).encode('ascii')
 
     @gen.engine
     def _read_chunk_until_eol(self, stream, stream_data, callback):
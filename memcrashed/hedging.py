@@ -0,0 +1,82 @@
+from collections import defaultdict, deque
+
+from tornado import gen
+
+
+class ReadHedging(object):
+    '''
+    Policy for hedged reads: When a backend takes longer than a percentile of the recent round trips to
+    answer a read, the keys get asked to other replicas too, and the first answer wins. Hedges are capped to
+    a fraction of the reads, the budget, so that a slow pool doesn't get its load multiplied.
+    '''
+
+    DEFAULT_PERCENTILE = 95
+    DEFAULT_BUDGET = 0.05
+    DEFAULT_SAMPLES = 1000
+    MIN_SAMPLES = 100
+
+    def __init__(self, percentile=DEFAULT_PERCENTILE, budget=DEFAULT_BUDGET, samples=DEFAULT_SAMPLES,
+                 min_samples=MIN_SAMPLES):
+        self.percentile = percentile
+        self.budget = budget
+        self.samples = samples
+        self.min_samples = min_samples
+        self.round_trips = deque(maxlen=samples)
+        self.recorded = 0
+        self.cached_delay = None
+        self.reads = 0
+        self.hedges = 0
+
+    def record(self, round_trip):
+        self.round_trips.append(round_trip)
+        self.recorded += 1
+        if self.recorded % max(self.samples // 10, 1) == 0:
+            self.cached_delay = None
+
+    def delay(self):
+        '''
+        Seconds to wait for the backend before hedging, or None while there are too few round trips measured.
+        '''
+        if len(self.round_trips) < self.min_samples:
+            return None
+        if self.cached_delay is None:
+            ordered = sorted(self.round_trips)
+            index = min(int(len(ordered) * self.percentile / 100.0), len(ordered) - 1)
+            self.cached_delay = ordered[index]
+        return self.cached_delay
+
+    def count_read(self):
+        self.reads += 1
+        if self.reads >= 2 * self.samples:
+            self.reads //= 2
+            self.hedges //= 2
+
+    def allow(self):
+        '''
+        Takes a hedge from the budget, if any is left.
+        '''
+        if self.hedges + 1 > self.budget * self.reads:
+            return False
+        self.hedges += 1
+        return True
+
+    @gen.engine
+    def fetch(self, repository, node, keys, callback):
+        '''
+        Gets the keys from replicas other than the node, calling back with a dict mapping each key found to a
+        (flags, value) tuple.
+        '''
+        groups = defaultdict(list)
+        for key in keys:
+            others = [replica for replica in repository.replica_nodes(key) if replica != node]
+            if others:
+                groups[repository.selector.choose(others)].append(key)
+        if not groups:
+            callback({})
+            return
+        nodes = list(groups)
+        results = yield [gen.Task(repository.client_for_node(other).get, groups[other]) for other in nodes]
+        values = {}
+        for result in results:
+            values.update(result)
+        callback(values)
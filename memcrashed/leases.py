@@ -0,0 +1,120 @@
+from collections import OrderedDict
+import time
+
+from tornado import gen
+
+
+class Lease(object):
+    def __init__(self, holder):
+        self.holder = holder
+        self.waiters = []
+        self.timeout = None
+
+
+class KeyLeases(object):
+    '''
+    Stops dogpiles on keys missing from the cache: The first client missing a key gets a lease on it, being
+    the one expected to recompute and set it, while the other clients missing it get the last value the
+    proxy saw for it, if not older than "max_stale" seconds, or wait for the refill. A lease ends when the
+    key gets written, or after "duration" seconds, and the waiting clients then look the key up again.
+
+    Values are only remembered for the keys that clients ever waited for, up to "size" of them, so that the
+    proxy keeps no copies of the keys that aren't contended.
+    '''
+
+    DEFAULT_DURATION = 2.0
+    DEFAULT_MAX_STALE = 60.0
+    DEFAULT_SIZE = 10000
+
+    def __init__(self, io_loop, duration=DEFAULT_DURATION, max_stale=DEFAULT_MAX_STALE, size=DEFAULT_SIZE,
+                 clock=time.time):
+        self.io_loop = io_loop
+        self.duration = duration
+        self.max_stale = max_stale
+        self.size = size
+        self.clock = clock
+        self.leases = {}
+        self.hot_keys = OrderedDict()
+
+    def is_leased(self, key):
+        return key in self.leases
+
+    def is_hot(self, key):
+        return key in self.hot_keys
+
+    def remember(self, key, flags, value):
+        '''
+        Keeps the value of a hot key, to be served while it's being refilled.
+        '''
+        if key in self.hot_keys:
+            self.hot_keys[key] = (self.clock(), flags, value)
+
+    def release(self, key):
+        '''
+        Ends the lease on a key just written, waking up the clients waiting for it; The value remembered is
+        forgotten, as it's older than the write.
+        '''
+        if key in self.hot_keys:
+            self.hot_keys[key] = None
+        lease = self.leases.pop(key, None)
+        if lease is not None:
+            self.io_loop.remove_timeout(lease.timeout)
+            self._wake_up(lease)
+
+    @gen.engine
+    def fill(self, repository, client, keys, callback):
+        '''
+        Handles the keys missed by a client, calling back with a dict mapping the ones it gets a value for
+        to a (flags, value) tuple; The keys left out are answered as misses, and leased to the client when
+        nobody else holds them.
+        '''
+        values = {}
+        waited = []
+        now = self.clock()
+        for key in keys:
+            lease = self.leases.get(key)
+            if lease is None:
+                self._grant(key, client)
+            elif lease.holder is not client:
+                remembered = self._make_hot(key)
+                if remembered is not None and now - remembered[0] <= self.max_stale:
+                    values[key] = remembered[1:]
+                elif key not in waited:
+                    waited.append(key)
+
+        if waited:
+            yield [gen.Task(self._wait, key) for key in waited]
+            results = yield [
+                gen.Task(repository.client_for_node(node).get, node_keys)
+                for node, node_keys in repository.read_keys_by_node(waited).items()
+            ]
+            for result in results:
+                values.update(result)
+        callback(values)
+
+    def _grant(self, key, client):
+        lease = self.leases[key] = Lease(client)
+        lease.timeout = self.io_loop.add_timeout(time.time() + self.duration, lambda: self._expire(key, lease))
+
+    def _expire(self, key, lease):
+        if self.leases.get(key) is lease:
+            del self.leases[key]
+            self._wake_up(lease)
+
+    def _wake_up(self, lease):
+        for waiter in lease.waiters:
+            self.io_loop.add_callback(waiter)
+
+    def _wait(self, key, callback):
+        lease = self.leases.get(key)
+        if lease is None:
+            callback()
+        else:
+            lease.waiters.append(callback)
+
+    def _make_hot(self, key):
+        if key not in self.hot_keys:
+            if len(self.hot_keys) >= self.size:
+                self.hot_keys.popitem(last=False)
+            self.hot_keys[key] = None
+        return self.hot_keys[key]
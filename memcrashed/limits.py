@@ -0,0 +1,97 @@
+from collections import deque
+import time
+
+
+class BackendLimiter(object):
+    '''
+    Caps the number of requests in flight to a single backend, queueing the exceeding ones for at most
+    "max_queue_wait" seconds, and tracks how many bytes were written to it but not yet flushed, so that
+    handlers can stop reading from their clients while the backend is congested.
+    '''
+
+    def __init__(self, io_loop, max_in_flight=None, max_queue_wait=None, high_watermark=None, low_watermark=None):
+        self.io_loop = io_loop
+        self.max_in_flight = max_in_flight
+        self.max_queue_wait = max_queue_wait
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark if low_watermark is not None else (high_watermark or 0) // 2
+        self.in_flight = 0
+        self.outstanding_bytes = 0
+        self.waiting = deque()
+        self.writable_waiters = []
+
+    def acquire(self, callback):
+        if self.max_in_flight is None or (self.in_flight < self.max_in_flight and not self.waiting):
+            self.in_flight += 1
+            callback(True)
+            return
+        entry = [callback, None]
+        if self.max_queue_wait is not None:
+            entry[1] = self.io_loop.add_timeout(time.time() + self.max_queue_wait, lambda: self._expire(entry))
+        self.waiting.append(entry)
+
+    def release(self):
+        self.in_flight -= 1
+        while self.waiting and self.in_flight < self.max_in_flight:
+            callback, timeout = self.waiting.popleft()
+            if timeout is not None:
+                self.io_loop.remove_timeout(timeout)
+            self.in_flight += 1
+            callback(True)
+
+    def _expire(self, entry):
+        try:
+            self.waiting.remove(entry)
+        except ValueError:
+            return
+        entry[0](False)
+
+    def is_congested(self):
+        return self.high_watermark is not None and self.outstanding_bytes > self.high_watermark
+
+    def wait_writable(self, callback):
+        if self.is_congested():
+            self.writable_waiters.append(callback)
+        else:
+            callback()
+
+    def wrote(self, byte_quantity):
+        self.outstanding_bytes += byte_quantity
+
+    def flushed(self, byte_quantity):
+        self.outstanding_bytes -= byte_quantity
+        if self.writable_waiters and self.outstanding_bytes <= self.low_watermark:
+            waiters, self.writable_waiters = self.writable_waiters, []
+            for callback in waiters:
+                callback()
+
+
+class BackendLimits(object):
+    '''
+    Keeps a limiter for each backend node, shared by all the connections to it, so that the caps hold
+    however many connections there are to each backend.
+    '''
+
+    def __init__(self, io_loop, max_in_flight=None, max_queue_wait=None, high_watermark=None):
+        self.io_loop = io_loop
+        self.max_in_flight = max_in_flight
+        self.max_queue_wait = max_queue_wait
+        self.high_watermark = high_watermark
+        self.limiters = {}
+
+    def limiter_for(self, node):
+        limiter = self.limiters.get(node)
+        if limiter is None:
+            limiter = BackendLimiter(self.io_loop, self.max_in_flight, self.max_queue_wait, self.high_watermark)
+            self.limiters[node] = limiter
+        return limiter
+
+    def wait_writable(self, callback):
+        '''
+        Calls back once no backend is congested, as which ones a request goes to is only known once read.
+        '''
+        congested = [limiter for limiter in self.limiters.values() if limiter.is_congested()]
+        if congested:
+            congested[0].wait_writable(lambda: self.wait_writable(callback))
+        else:
+            callback()
@@ -0,0 +1,82 @@
+from collections import defaultdict
+import time
+
+from tornado import gen
+
+
+class KeyMigration(object):
+    '''
+    Eases a change of the hash ring: For a while after it, the keys missed in their new owner get looked up
+    in the backend owning them before, and optionally copied forward with "add", so that a write reaching
+    the new owner in the meantime always wins. Writes going through the proxy delete the old copies, so that
+    they can't resurface in a later miss.
+    '''
+
+    def __init__(self, repository, previous_repository, window, copy_ttl=None, clock=time.time):
+        self.repository = repository
+        self.previous_repository = previous_repository
+        self.copy_ttl = copy_ttl
+        self.clock = clock
+        self.deadline = clock() + window
+
+    def is_active(self):
+        if self.previous_repository is not None and self.clock() >= self.deadline:
+            self.close()
+        return self.previous_repository is not None
+
+    def previous_node_for_key(self, key):
+        '''
+        Node owning the key before the ring change, or None if it's still the same or the window is over.
+        '''
+        if not self.is_active():
+            return None
+        node = self.previous_repository.ring.node_for_key(key)
+        if node == self.repository.ring.node_for_key(key):
+            return None
+        return node
+
+    def previous_owners(self, keys):
+        groups = defaultdict(list)
+        for key in keys:
+            node = self.previous_node_for_key(key)
+            if node is not None:
+                groups[node].append(key)
+        return groups
+
+    @gen.engine
+    def fetch(self, keys, callback):
+        '''
+        Calls back with a dict mapping each key found in its previous owner to a (flags, value) tuple.
+        '''
+        groups = self.previous_owners(keys)
+        if not groups:
+            callback({})
+            return
+        nodes = list(groups)
+        results = yield [gen.Task(self._client_for_node(node).get, groups[node]) for node in nodes]
+        values = {}
+        for result in results:
+            values.update(result)
+        if self.copy_ttl is not None:
+            for key, (flags, value) in values.items():
+                self.repository.client_for_key(key).set(key, flags, self.copy_ttl, value, self._ignore, command=b'add')
+        callback(values)
+
+    def forget(self, key):
+        node = self.previous_node_for_key(key)
+        if node is not None:
+            self._client_for_node(node).delete(key, self._ignore)
+
+    def _client_for_node(self, node):
+        # Nodes kept in the new ring are reached through its connections, instead of keeping two open.
+        if node in self.repository.backends:
+            return self.repository.client_for_node(node)
+        return self.previous_repository.client_for_node(node)
+
+    def _ignore(self, response):
+        pass
+
+    def close(self):
+        if self.previous_repository is not None:
+            self.previous_repository.close()
+            self.previous_repository = None
@@ -0,0 +1,70 @@
+from array import array
+from hashlib import md5
+from struct import Struct
+import time
+
+
+class NegativeCache(object):
+    '''
+    Remembers the keys recently answered as misses by the backends, so that repeated lookups for them can
+    be answered by the proxy itself. The keys are kept in a bloom filter whose slots hold the generation
+    they were set in instead of a bit; Generations advance every half TTL and only the current and previous
+    ones count, so the filter rotates without ever being cleared. Invalidating a key empties its slots,
+    which may make other keys sharing them be looked up again, but never the other way around; It also
+    bumps the version of those slots, so that misses read before the invalidation don't get added after it.
+
+    As with any bloom filter, a key may be taken for a miss while it was never added; The size must be
+    large enough for the misses seen in a TTL to keep that rate negligible.
+    '''
+
+    DEFAULT_SIZE = 1 << 20
+    DEFAULT_HASHES = 4
+    hash_struct = Struct('< Q Q')
+
+    def __init__(self, ttl, size=DEFAULT_SIZE, hashes=DEFAULT_HASHES, clock=time.time):
+        self.ttl = ttl
+        self.size = size
+        self.hashes = hashes
+        self.clock = clock
+        self.slots = array('I', [0]) * size
+        self.slot_versions = array('I', [0]) * size
+
+    def contains(self, key):
+        generation = self._generation()
+        return all(self.slots[index] in (generation, generation - 1) for index in self._indexes(key))
+
+    def versions(self, keys):
+        '''
+        Tells the versions of the slots of each key, to be given back along with the misses read for them.
+        '''
+        return dict((key, self._versions(self._indexes(key))) for key in keys)
+
+    def add_misses(self, keys, versions):
+        '''
+        Adds the keys answered as misses by a request issued when their slots were at the given versions;
+        Those of them whose slots got invalidated since then may have raced with a write, so they're ignored.
+        '''
+        generation = self._generation()
+        for key in keys:
+            indexes = self._indexes(key)
+            if versions.get(key) != self._versions(indexes):
+                continue
+            for index in indexes:
+                self.slots[index] = generation
+
+    def invalidate(self, key):
+        for index in self._indexes(key):
+            self.slots[index] = 0
+            self.slot_versions[index] = (self.slot_versions[index] + 1) & 0xffffffff
+
+    def _versions(self, indexes):
+        return tuple(self.slot_versions[index] for index in indexes)
+
+    def _generation(self):
+        return int(self.clock() * 2 / self.ttl) % 0xfffffffe + 2
+
+    def _indexes(self, key):
+        if not isinstance(key, bytes):
+            key = key.encode('utf-8')
+        first, second = self.hash_struct.unpack(md5(key).digest())
+        return [(first + index * second) % self.size for index in range(self.hashes)]
@@ -1,3 +1,4 @@
+import base64
 from collections import namedtuple
 from struct import Struct
 
@@ -7,10 +8,15 @@ class BinaryParser(object):
     REQUEST_BLOCKS = COMMON_BLOCKS % 'vbucket_id'
     RESPONSE_BLOCKS = COMMON_BLOCKS % 'status'
     HEADER_FORMAT = '! B B H B B H I I Q'
+    REQUEST_MAGIC = 0x80
+    RESPONSE_MAGIC = 0x81
+
+    OPAQUE_OFFSET = 12
 
     RequestHeader = namedtuple('RequestHeader', 'raw %s' % REQUEST_BLOCKS)
     ResponseHeader = namedtuple('ResponseHeader', 'raw %s' % RESPONSE_BLOCKS)
     header_struct = Struct(HEADER_FORMAT)
+    opaque_struct = Struct('! I')
 
     def unpack_request_header(self, header_bytes):
         fields = self.extract_fields_for_header(header_bytes)
@@ -20,6 +26,24 @@ class BinaryParser(object):
         fields = self.extract_fields_for_header(header_bytes)
         return self.ResponseHeader(*fields)
 
+    def pack_header(self, headers):
+        return self.header_struct.pack(*headers[1:])
+
+    def pack_request_header(self, opcode, opaque=0, key_length=0, extra_length=0, total_body_length=0, cas=0):
+        return self.header_struct.pack(
+            self.REQUEST_MAGIC, opcode, key_length, extra_length, 0, 0, total_body_length, opaque, cas)
+
+    def pack_response_header(self, opcode, status, opaque=0, key_length=0, extra_length=0, total_body_length=0, cas=0):
+        return self.header_struct.pack(
+            self.RESPONSE_MAGIC, opcode, key_length, extra_length, 0, status, total_body_length, opaque, cas)
+
+    def replace_opaque(self, message_bytes, opaque):
+        '''
+        Same message, request or response, with another opaque value, leaving the rest of it untouched.
+        '''
+        opaque_end = self.OPAQUE_OFFSET + self.opaque_struct.size
+        return message_bytes[:self.OPAQUE_OFFSET] + self.opaque_struct.pack(opaque) + message_bytes[opaque_end:]
+
     def extract_fields_for_header(self, header_bytes):
         tokens = self.header_struct.unpack(header_bytes)
         fields = (header_bytes, ) + tokens
@@ -31,11 +55,17 @@ class TextParser(object):
     DELETE_TOUCH_FIELDS = 'command key noreply'
     INCREASE_DECREASE_FIELDS = 'command key value noreply'
     RETRIEVAL_FIELDS = 'command keys'
+    TOUCH_RETRIEVAL_FIELDS = 'command exptime keys'
+    META_FIELDS = 'command key bytes flags quiet'
+    ADMIN_FIELDS = 'command arguments noreply'
 
     StorageRequestHeader = namedtuple('RequestHeader', 'raw %s' % STORAGE_FIELDS)
     DeleteTouchRequestHeader = namedtuple('DeleteTouchRequestHeader', 'raw %s' % DELETE_TOUCH_FIELDS)
     IncreaseDecreaseRequestHeader = namedtuple('IncreaseDecreaseRequestHeader', 'raw %s' % INCREASE_DECREASE_FIELDS)
     RetrievalRequestHeader = namedtuple('RetrievalRequestHeader', 'raw %s' % RETRIEVAL_FIELDS)
+    TouchRetrievalRequestHeader = namedtuple('TouchRetrievalRequestHeader', 'raw %s' % TOUCH_RETRIEVAL_FIELDS)
+    MetaRequestHeader = namedtuple('MetaRequestHeader', 'raw %s' % META_FIELDS)
+    AdminRequestHeader = namedtuple('AdminRequestHeader', 'raw %s' % ADMIN_FIELDS)
 
     def unpack_request_header(self, header_bytes):
         fields = self._fields_from_header(header_bytes)
@@ -46,8 +76,14 @@ class TextParser(object):
             request_header = self.IncreaseDecreaseRequestHeader(*fields)
         elif self.is_delete_touch_command(command):
             request_header = self.DeleteTouchRequestHeader(*fields)
-        else:
+        elif self.is_touch_retrieval_command(command):
+            request_header = self.TouchRetrievalRequestHeader(*fields)
+        elif self.is_retrieval_command(command):
             request_header = self.RetrievalRequestHeader(*fields)
+        elif self.is_meta_command(command):
+            request_header = self.MetaRequestHeader(*fields)
+        else:
+            request_header = self.AdminRequestHeader(*fields)
         return request_header
 
     def _fields_from_header(self, header_bytes):
@@ -58,7 +94,17 @@ class TextParser(object):
             header_bytes,
             command,
         ]
-        if self.is_retrieval_command(command):
+        if self.is_meta_command(command):
+            fields.extend(self._meta_fields(command, header_fields[1:]))
+            return fields
+        if not self.is_keyed_command(command):
+            fields.append(header_fields[1:])
+            fields.append(statement.endswith(b'noreply'))
+            return fields
+        if self.is_touch_retrieval_command(command):
+            fields.append(int(header_fields[1]))
+            fields.append(header_fields[2:])
+        elif self.is_retrieval_command(command):
             keys = header_fields[1:]
             fields.append(keys)
         else:
@@ -75,14 +121,52 @@ class TextParser(object):
             fields.append(noreply)
         return fields
 
+    def _meta_fields(self, command, tokens):
+        '''
+        Key, data length and flags of a meta command. The key is decoded when it comes in base64, with the "b"
+        flag, so that it gets hashed like the same key sent as it is.
+        '''
+        if command == b'mn':
+            return [None, None, tokens, False]
+        key = tokens[0]
+        bytes_ = None
+        if command == b'ms':
+            bytes_ = int(tokens[1])
+            flags = tokens[2:]
+        else:
+            flags = tokens[1:]
+        if b'b' in flags:
+            try:
+                key = base64.b64decode(key)
+            except (TypeError, ValueError):
+                pass
+        return [key, bytes_, flags, b'q' in flags]
+
     def is_storage_command(self, command):
         return command in (b'set', b'cas', b'add', b'replace', b'append', b'prepend')
 
     def is_retrieval_command(self, command):
-        return command in (b'get', b'gets')
+        return command in (b'get', b'gets', b'gat', b'gats')
+
+    def is_touch_retrieval_command(self, command):
+        return command in (b'gat', b'gats')
 
     def is_delete_touch_command(self, command):
         return command in (b'delete', b'touch')
 
     def is_increase_decrease_command(self, command):
         return command in (b'incr', b'decr')
+
+    def is_meta_command(self, command):
+        return command in (b'mg', b'ms', b'md', b'ma', b'mn', b'me')
+
+    def is_admin_command(self, command):
+        return command in (b'version', b'verbosity', b'flush_all', b'stats', b'cache_memlimit', b'quit')
+
+    def is_keyed_command(self, command):
+        return (self.is_storage_command(command) or self.is_retrieval_command(command) or
+                self.is_delete_touch_command(command) or self.is_increase_decrease_command(command) or
+                (self.is_meta_command(command) and command != b'mn'))
+
+    def is_known_command(self, command):
+        return self.is_keyed_command(command) or self.is_meta_command(command) or self.is_admin_command(command)
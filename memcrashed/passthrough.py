@@ -0,0 +1,141 @@
+import time
+
+
+class RelayedConnection(object):
+    '''
+    A client relayed to its backend connection, with the bytes written to each side and not flushed yet.
+    '''
+
+    def __init__(self, client_stream, backend_stream, last_relayed):
+        self.client_stream = client_stream
+        self.backend_stream = backend_stream
+        self.unflushed = {client_stream: 0, backend_stream: 0}
+        self.paused = set()
+        self.last_relayed = last_relayed
+        self.closing = False
+        self.timeout = None
+
+
+class PassthroughRelay(object):
+    '''
+    Relays the bytes between each client and a backend connection of its own as they come, without parsing
+    them, for deployments with a single backend where the proxy only pools connections; The bytes and
+    connections relayed still get counted.
+    '''
+
+    READ_CHUNK_SIZE = 64 * 1024
+    MAX_UNFLUSHED_BYTES = 1024 * 1024
+    QUIET_SECONDS = 0.1
+
+    def __init__(self, io_loop, clock=time.time):
+        self.io_loop = io_loop
+        self.clock = clock
+        self.connections = 0
+        self.total_connections = 0
+        self.client_bytes = 0
+        self.backend_bytes = 0
+        self.relayed = {}
+
+    def relay(self, client_stream, backend_stream, closed_callback=None):
+        '''
+        Copies each side to the other until one of them closes, closing the other one once the bytes
+        already read are flushed to it, and calling back once the client is gone; A side stops being read
+        while too many of its bytes are still unflushed to the other one.
+        '''
+        connection = RelayedConnection(client_stream, backend_stream, self.clock())
+        self.relayed[client_stream] = connection
+        self.connections += 1
+        self.total_connections += 1
+
+        def client_closed():
+            self._forget(connection)
+            if closed_callback is not None:
+                closed_callback()
+
+        self._copy(connection, client_stream, backend_stream, self._count_client_bytes, client_closed)
+        self._copy(connection, backend_stream, client_stream, self._count_backend_bytes)
+
+    def close_when_idle(self, client_stream):
+        '''
+        Closes the client connection once it's idle, for draining without cutting the bytes in flight: With
+        nothing left unflushed either way, and nothing relayed for a little while, since the responses can't be
+        told apart without parsing them.
+        '''
+        connection = self.relayed.get(client_stream)
+        if connection is None:
+            client_stream.close()
+            return
+        connection.closing = True
+        self._close_if_idle(connection)
+
+    def dump(self, output):
+        '''
+        Writes the counts of connections and bytes relayed.
+        '''
+        output.write('Passthrough: connections={} total_connections={} client_bytes={} backend_bytes={}\n'.format(
+            self.connections, self.total_connections, self.client_bytes, self.backend_bytes))
+        output.flush()
+
+    def _copy(self, connection, source, destination, count, closed_callback=None):
+        source.read_chunk_size = self.READ_CHUNK_SIZE
+
+        def read():
+            if not source.closed():
+                source.read_bytes(self.READ_CHUNK_SIZE, read_more, streaming_callback=forward)
+
+        def forward(data):
+            count(len(data))
+            connection.last_relayed = self.clock()
+            if not destination.closed():
+                connection.unflushed[destination] += len(data)
+                destination.write(data, flushed)
+
+        def read_more(data):
+            # Whatever was read got already forwarded; Reading stops until the destination catches up.
+            if connection.unflushed[destination] > self.MAX_UNFLUSHED_BYTES:
+                connection.paused.add(source)
+            else:
+                read()
+
+        def flushed():
+            connection.unflushed[destination] = 0
+            if source in connection.paused:
+                connection.paused.discard(source)
+                read()
+            self._close_if_idle(connection)
+
+        def finish():
+            if not destination.closed():
+                destination.write(b'', destination.close)
+            if closed_callback is not None:
+                closed_callback()
+
+        source.set_close_callback(finish)
+        read()
+
+    def _close_if_idle(self, connection):
+        if not connection.closing or connection.client_stream.closed():
+            return
+        if connection.timeout is not None:
+            self.io_loop.remove_timeout(connection.timeout)
+            connection.timeout = None
+        if any(connection.unflushed.values()):
+            return
+        quiet_until = connection.last_relayed + self.QUIET_SECONDS
+        if self.clock() >= quiet_until:
+            connection.client_stream.close()
+        else:
+            connection.timeout = self.io_loop.add_timeout(quiet_until, lambda: self._close_if_idle(connection))
+
+    def _forget(self, connection):
+        self.relayed.pop(connection.client_stream, None)
+        if connection.timeout is not None:
+            self.io_loop.remove_timeout(connection.timeout)
+            connection.timeout = None
+        self.connections -= 1
+
+    def _count_client_bytes(self, byte_quantity):
+        self.client_bytes += byte_quantity
+
+    def _count_backend_bytes(self, byte_quantity):
+        self.backend_bytes += byte_quantity
@@ -0,0 +1,178 @@
+from collections import deque
+
+from tornado import gen
+
+
+class Pipeline(object):
+    '''
+    Shares a backend connection among many clients: Requests get written as soon as they come, and as
+    memcached answers the requests of a connection in order, their responses get read back in the same
+    order, each by the client which sent the request.
+    '''
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.turns = deque()
+
+    def write(self, request_bytes, callback):
+        '''
+        Writes a request expecting a response, calling back with its turn, to read the response from, once
+        the request is flushed.
+        '''
+        turn = Turn(self)
+        self.turns.append(turn)
+        self.stream.write(request_bytes, lambda: callback(turn))
+
+    def _finish(self, turn):
+        if self.turns and self.turns[0] is turn:
+            self.turns.popleft()
+            if self.turns:
+                self.turns[0]._resume()
+        else:
+            self.turns.remove(turn)
+
+
+class Turn(object):
+    '''
+    Reads the response to a pipelined request, like the stream would, once the responses to the requests
+    written before it have been read; It has to be finished as soon as the response is read, for the next
+    responses to be read.
+    '''
+
+    def __init__(self, pipeline):
+        self.pipeline = pipeline
+        self.stream = pipeline.stream
+        self.waiting_read = None
+        self.finished = False
+
+    def read_until(self, delimiter, callback):
+        self._read(self.stream.read_until, delimiter, callback)
+
+    def read_bytes(self, num_bytes, callback):
+        self._read(self.stream.read_bytes, num_bytes, callback)
+
+    def finish(self):
+        if not self.finished:
+            self.finished = True
+            self.pipeline._finish(self)
+
+    def _read(self, read, argument, callback):
+        if self.pipeline.turns[0] is self:
+            read(argument, callback)
+        else:
+            self.waiting_read = (read, argument, callback)
+
+    def _resume(self):
+        if self.waiting_read is not None:
+            read, argument, callback = self.waiting_read
+            self.waiting_read = None
+            read(argument, callback)
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+class OpaqueDemultiplexer(object):
+    '''
+    Shares a backend connection among many binary protocol clients, telling the responses apart by their
+    opaque values instead of their order: Each request message gets an opaque unique to the connection on
+    its way to the backend, and its response gets the client's opaque back before being handed to the turn
+    of the request. Responses to requests whose turns were finished get thrown away.
+    '''
+
+    HEADER_BYTES = 24
+    MAX_OPAQUE = 0xffffffff
+
+    def __init__(self, stream, parser):
+        self.stream = stream
+        self.parser = parser
+        self.routes = {}
+        self.last_opaque = 0
+        self.reading = False
+
+    def write(self, request_bytes, callback):
+        '''
+        Writes the request messages with their opaques replaced, calling back with the turn to read their
+        responses from once flushed.
+        '''
+        turn = RoutedTurn(self)
+        messages = []
+        position = 0
+        while position < len(request_bytes):
+            headers = self.parser.unpack_request_header(request_bytes[position:position + self.HEADER_BYTES])
+            end = position + self.HEADER_BYTES + headers.total_body_length
+            opaque = self._next_opaque()
+            self.routes[opaque] = (turn, headers.opaque)
+            turn.opaques.append(opaque)
+            messages.append(self.parser.replace_opaque(request_bytes[position:end], opaque))
+            position = end
+        self.stream.write(b''.join(messages), lambda: callback(turn))
+        if not self.reading:
+            self._read_responses()
+
+    def _next_opaque(self):
+        opaque = self.last_opaque
+        while True:
+            opaque = opaque % self.MAX_OPAQUE + 1
+            if opaque not in self.routes:
+                self.last_opaque = opaque
+                return opaque
+
+    @gen.engine
+    def _read_responses(self):
+        self.reading = True
+        while self.routes:
+            header_bytes = yield gen.Task(self.stream.read_bytes, self.HEADER_BYTES)
+            headers = self.parser.unpack_response_header(header_bytes)
+            body_bytes = b''
+            if headers.total_body_length > 0:
+                body_bytes = yield gen.Task(self.stream.read_bytes, headers.total_body_length)
+            route = self.routes.get(headers.opaque)
+            if route is not None:
+                turn, client_opaque = route
+                turn._receive(self.parser.replace_opaque(header_bytes, client_opaque) + body_bytes)
+        self.reading = False
+
+    def _finish(self, turn):
+        for opaque in turn.opaques:
+            self.routes.pop(opaque, None)
+
+
+class RoutedTurn(object):
+    '''
+    Reads the responses routed to a request by an OpaqueDemultiplexer, like the stream would; Binary
+    responses are only ever read by size. It has to be finished once the response is read, for the opaques
+    to be reused.
+    '''
+
+    def __init__(self, demultiplexer):
+        self.demultiplexer = demultiplexer
+        self.stream = demultiplexer.stream
+        self.opaques = []
+        self.received = b''
+        self.waiting_read = None
+        self.finished = False
+
+    def read_bytes(self, num_bytes, callback):
+        self.waiting_read = (num_bytes, callback)
+        self._serve()
+
+    def finish(self):
+        if not self.finished:
+            self.finished = True
+            self.demultiplexer._finish(self)
+
+    def _receive(self, message_bytes):
+        self.received += message_bytes
+        self._serve()
+
+    def _serve(self):
+        if self.waiting_read is None or len(self.received) < self.waiting_read[0]:
+            return
+        num_bytes, callback = self.waiting_read
+        self.waiting_read = None
+        data, self.received = self.received[:num_bytes], self.received[num_bytes:]
+        callback(data)
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
@@ -0,0 +1,115 @@
+from collections import Counter
+import os
+import signal
+import sys
+import time
+
+try:
+    import tracemalloc
+except ImportError:  # Python 2
+    tracemalloc = None
+
+
+PARSE = 'parse'
+ROUTE = 'route'
+BACKEND_WRITE = 'backend_write'
+BACKEND_READ = 'backend_read'
+CLIENT_WRITE = 'client_write'
+OTHER = 'other'
+
+# The proxy runs on a single IOLoop, so the stage the handlers entered last is the one running when sampled.
+_current_stage = OTHER
+
+
+def enter(stage):
+    '''
+    Marks the handler code running from now on as belonging to "stage"; Handlers call it where a stage starts,
+    and again where they resume after waiting, since other requests may have entered theirs meanwhile.
+    '''
+    global _current_stage
+    _current_stage = stage
+
+
+def current_stage():
+    return _current_stage
+
+
+def frame_label(frame):
+    code = frame.f_code
+    return '{}:{}'.format(os.path.basename(code.co_filename), code.co_name)
+
+
+class Profiler(object):
+    '''
+    Samples the stacks of a running proxy for a while, every "interval" seconds of CPU time, writing them in
+    the collapsed format taken by flamegraph.pl, with the handler stage as the root frame; Where available,
+    tracemalloc runs meanwhile, and the top allocation sites get written next to the stacks.
+    '''
+
+    DEFAULT_INTERVAL = 0.005
+    DEFAULT_SECONDS = 30
+    ALLOCATION_SITES = 25
+
+    def __init__(self, io_loop, directory, interval=DEFAULT_INTERVAL, output=sys.stderr, clock=time.time):
+        self.io_loop = io_loop
+        self.directory = directory
+        self.interval = interval
+        self.output = output
+        self.clock = clock
+        self.samples = None
+        self.started = None
+        self._timeout = None
+
+    def is_running(self):
+        return self.samples is not None
+
+    def start(self, seconds=DEFAULT_SECONDS):
+        if self.is_running():
+            return False
+        self.samples = Counter()
+        self.started = self.clock()
+        if tracemalloc is not None:
+            tracemalloc.start(1)
+        signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        self._timeout = self.io_loop.add_timeout(time.time() + seconds, self.stop)
+        return True
+
+    def _sample(self, signum, frame):
+        frames = []
+        while frame is not None:
+            frames.append(frame)
+            frame = frame.f_back
+        stack = [current_stage()] + [frame_label(frame) for frame in reversed(frames)]
+        self.samples[';'.join(stack)] += 1
+
+    def stop(self):
+        '''
+        Stops sampling and writes the results, returning the paths written.
+        '''
+        if not self.is_running():
+            return []
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_DFL)
+        self.io_loop.remove_timeout(self._timeout)
+        samples, self.samples = self.samples, None
+
+        prefix = os.path.join(self.directory, 'memcrashed-{}-{}'.format(os.getpid(), int(self.started)))
+        paths = [prefix + '.collapsed']
+        with open(paths[0], 'w') as stacks_file:
+            for stack, count in sorted(samples.items()):
+                stacks_file.write('{} {}\n'.format(stack, count))
+
+        if tracemalloc is not None and tracemalloc.is_tracing():
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+            # The samples taken meanwhile are the profiler's own allocations.
+            snapshot = snapshot.filter_traces([tracemalloc.Filter(False, __file__)])
+            paths.append(prefix + '.allocations')
+            with open(paths[1], 'w') as allocations_file:
+                for statistic in snapshot.statistics('lineno')[:self.ALLOCATION_SITES]:
+                    allocations_file.write('{}\n'.format(statistic))
+
+        self.output.write('Profile written to {}\n'.format(', '.join(paths)))
+        self.output.flush()
+        return paths
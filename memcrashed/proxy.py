@@ -1,12 +1,286 @@
+from bisect import bisect
+from collections import defaultdict
+from hashlib import md5
+from operator import itemgetter
+import random
+from struct import Struct
+
+from memcrashed.backend import BackendClient
+from memcrashed.sasl import AuthenticatingStream
+from memcrashed.selection import BackendSelector
+from memcrashed.sockets import BatchingStream, FlushCallbackStream, create_stream
+
+
+class HashRing(object):
+    '''
+    Consistent hashing ring, with each node spread over many points so that adding or removing one only
+    moves its share of the keys. The ring positions of recently seen keys are remembered, up to "memo_size"
+    of them, sparing the hashing and bisecting of hot keys.
+    '''
+
+    POINTS_PER_NODE = 160
+    MEMO_SIZE = 100000
+    point_struct = Struct('< I')
+
+    def __init__(self, nodes, points_per_node=POINTS_PER_NODE, memo_size=MEMO_SIZE):
+        self.nodes = list(nodes)
+        points = []
+        for node in self.nodes:
+            name = node_name(node)
+            for index in range(points_per_node):
+                points.append((self.hash_key('{}-{}'.format(name, index).encode('utf-8')), node))
+        points.sort(key=itemgetter(0))
+        self.points = [point for point, node in points]
+        self.owners = [node for point, node in points]
+        self.memo_size = memo_size
+        self.memo = {}
+
+    def hash_key(self, key):
+        if not isinstance(key, bytes):
+            key = key.encode('utf-8')
+        return self.point_struct.unpack_from(md5(key).digest())[0]
+
+    def index_for_key(self, key):
+        '''
+        Position in the ring of the point owning the key.
+        '''
+        index = self.memo.get(key)
+        if index is None:
+            index = bisect(self.points, self.hash_key(key)) % len(self.points)
+            self._remember(key, index)
+        return index
+
+    def _remember(self, key, index):
+        # Starting over when full is much cheaper than tracking recency, and hot keys come right back.
+        if len(self.memo) >= self.memo_size:
+            self.memo.clear()
+        self.memo[key] = index
+
+    def node_for_key(self, key):
+        return self.owners[self.index_for_key(key)]
+
+    def nodes_for_key(self, key, count):
+        '''
+        The key owner followed by the next distinct nodes clockwise on the ring, up to "count" of them.
+        '''
+        count = min(count, len(self.nodes))
+        index = self.index_for_key(key)
+        nodes = []
+        while len(nodes) < count:
+            node = self.owners[index % len(self.owners)]
+            if node not in nodes:
+                nodes.append(node)
+            index += 1
+        return nodes
+
+    def keys_by_node(self, keys):
+        '''
+        Groups the keys by owner in a single pass, with the lookups inlined, as multi-gets may carry hundreds
+        of keys.
+        '''
+        groups = defaultdict(list)
+        memo, points, owners, hash_key = self.memo, self.points, self.owners, self.hash_key
+        point_count = len(points)
+        for key in keys:
+            index = memo.get(key)
+            if index is None:
+                index = bisect(points, hash_key(key)) % point_count
+                self._remember(key, index)
+            groups[owners[index]].append(key)
+        return groups
+
+
+def node_name(node):
+    if isinstance(node, tuple):
+        return '{}:{}'.format(*node)
+    return node
+
+
 class ProxyRepository(object):
-    def __init__(self, io_loop):
+    '''
+    Connections to the backends. With credentials, a (username, password) tuple, the streams shared by the
+    clients get authenticated with SASL as soon as they're opened. Each node gets up to "connections" streams,
+    handed out in turns, over which the requests of all the clients get pipelined.
+    '''
+
+    DEFAULT_BACKEND_ADDRESS = ('127.0.0.1', 11211)
+
+    def __init__(self, io_loop, backends=None, socket_options=None, write_batching=True, replicas=1, credentials=None,
+                 connections=1):
         self.io_loop = io_loop
+        self.backends = list(backends or [self.DEFAULT_BACKEND_ADDRESS])
+        self.socket_options = socket_options
+        self.write_batching = write_batching
+        self.replicas = replicas
+        self.credentials = credentials
+        self.connections = connections
+        self.ring = HashRing(self.backends)
+        self.selector = BackendSelector()
+        self.streams = {}
+        self.next_streams = {}
+        self.clients = {}
+        self.migration = None
+        self.replica_writer = None
+
+    @property
+    def default_node(self):
+        return self.backends[0]
+
+    def is_sharded(self):
+        return len(self.backends) > 1
+
+    def is_replicated(self):
+        return self.replicas > 1 and self.is_sharded()
+
+    def replica_nodes(self, key):
+        return self.ring.nodes_for_key(key, self.replicas)
+
+    def node_for_read(self, key):
+        '''
+        The replica picked by the selector to serve a read for the key; Just the key owner without replicas.
+        '''
+        if not self.is_replicated():
+            return self.ring.node_for_key(key)
+        return self.selector.choose(self.replica_nodes(key))
+
+    def read_keys_by_node(self, keys):
+        if not self.is_replicated():
+            return self.ring.keys_by_node(keys)
+        groups = defaultdict(list)
+        for key in keys:
+            groups[self.node_for_read(key)].append(key)
+        return groups
+
+    def replicate(self, key, request_bytes):
+        '''
+        Sends a write to the replicas of the key other than its owner, whose responses are thrown away.
+        '''
+        if self.replica_writer is None:
+            self.replica_writer = ShadowPool(self.io_loop, self.backends, read_fraction=0, socket_options=self.socket_options,
+                                             max_pending=None, credentials=self.credentials)
+        for node in self.replica_nodes(key)[1:]:
+            self.replica_writer.mirror_to_node(node, request_bytes)
+
+    def is_migrating(self):
+        return self.migration is not None and self.migration.is_active()
 
     def proxy_for_key(self, key):
-        return Proxy(key, self.io_loop)
+        previous_node = self.migration.previous_node_for_key(key) if self.migration is not None else None
+        return Proxy(key, self.io_loop, self.ring.node_for_key(key), previous_node)
+
+    def stream_for_node(self, node):
+        streams = self.streams.setdefault(node, [])
+        index = self.next_streams.get(node, 0) % self.connections
+        self.next_streams[node] = index + 1
+        if index < len(streams) and not streams[index].closed():
+            return streams[index]
+        stream = self._create_stream(node, self.credentials)
+        if index < len(streams):
+            streams[index] = stream
+        else:
+            streams.append(stream)
+        return stream
+
+    def stream_for_key(self, key):
+        return self.stream_for_node(self.ring.node_for_key(key))
+
+    def client_for_node(self, node):
+        '''
+        Clients for the commands issued by the proxy itself, kept apart from the streams shared by the
+        clients so that their responses never get mixed; They speak the text protocol, so they're never
+        authenticated, and the features needing them are refused along with backend credentials.
+        '''
+        client = self.clients.get(node)
+        if client is None or client.closed():
+            client = BackendClient(self._create_stream(node))
+            self.clients[node] = client
+        return client
+
+    def client_for_key(self, key):
+        return self.client_for_node(self.ring.node_for_key(key))
+
+    def _create_stream(self, node, credentials=None):
+        stream = create_stream(self.io_loop, node, self.socket_options)
+        if credentials is not None:
+            stream = AuthenticatingStream(stream, *credentials)
+        if self.write_batching:
+            return BatchingStream(stream, self.io_loop)
+        return FlushCallbackStream(stream)
+
+    def close(self):
+        for streams in self.streams.values():
+            for stream in streams:
+                stream.close()
+        for client in self.clients.values():
+            client.close()
+        if self.migration is not None:
+            self.migration.close()
+        if self.replica_writer is not None:
+            self.replica_writer.close()
+            self.replica_writer = None
+        self.streams = {}
+        self.clients = {}
+
+
+class ShadowPool(object):
+    '''
+    Pool of backends receiving a copy of the client requests, to warm them up before a cutover. Every write
+    gets mirrored and reads are sampled; Responses are read and thrown away, and the requests are dropped
+    instead of queued when a shadow backend falls behind, so that it never slows down the primary path.
+    Without a maximum pending, nothing gets dropped, as needed by the replica writes.
+    '''
+
+    DEFAULT_READ_FRACTION = 0.1
+    DEFAULT_MAX_PENDING = 1024 * 1024
+
+    def __init__(self, io_loop, backends, read_fraction=DEFAULT_READ_FRACTION, socket_options=None,
+                 max_pending=DEFAULT_MAX_PENDING, sample=random.random, credentials=None):
+        self.repository = ProxyRepository(io_loop, backends, socket_options, credentials=credentials)
+        self.read_fraction = read_fraction
+        self.max_pending = max_pending
+        self.sample = sample
+        self.pending = {}
+
+    @property
+    def ring(self):
+        return self.repository.ring
+
+    def samples_read(self):
+        return self.sample() < self.read_fraction
+
+    def mirror(self, key, request_bytes):
+        node = self.ring.node_for_key(key) if key else self.repository.default_node
+        self.mirror_to_node(node, request_bytes)
+
+    def mirror_to_node(self, node, request_bytes):
+        stream = self.repository.stream_for_node(node)
+        if stream not in self.pending:
+            self._discard_responses(stream)
+        if self.max_pending is not None and self.pending[stream] and self.pending[stream] + len(request_bytes) > self.max_pending:
+            return
+        self.pending[stream] += len(request_bytes)
+        stream.write(request_bytes, lambda: self._flushed(stream, len(request_bytes)))
+
+    def _discard_responses(self, stream):
+        self.pending[stream] = 0
+        stream.set_close_callback(lambda: self.pending.pop(stream, None))
+        stream.read_until_close(self._ignore, streaming_callback=self._ignore)
+
+    def _flushed(self, stream, byte_quantity):
+        if stream in self.pending:
+            self.pending[stream] -= byte_quantity
+
+    def _ignore(self, data):
+        pass
+
+    def close(self):
+        self.repository.close()
+        self.pending = {}
 
 
 class Proxy(object):
-    def __init__(self, key, io_loop):
+    def __init__(self, key, io_loop, node=None, previous_node=None):
         self.key = key
         self.io_loop = io_loop
+        self.node = node
+        self.previous_node = previous_node
@@ -0,0 +1,99 @@
+from collections import OrderedDict
+import time
+from weakref import WeakKeyDictionary
+
+
+class TokenBucket(object):
+    '''
+    Refills "rate" tokens a second, holding up to "burst" of them. Takes go through as long as the bucket
+    isn't in debt, and may leave it in debt, so that a cost above the burst still gets through once, paid for
+    by the takes that follow.
+    '''
+
+    def __init__(self, rate, burst, clock=time.time):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.tokens = burst
+        self.updated = clock()
+
+    def has_tokens(self):
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return self.tokens > 0
+
+    def take(self, amount):
+        self.tokens -= amount
+
+
+class TenantQuotas(object):
+    '''
+    Rate limits the operations and bytes of each tenant, being the client host, or the key prefix up to
+    "prefix_separator" when one is given; Keys without the separator, and keyless commands, share the empty
+    prefix. The buckets hold "burst" seconds worth of each rate, and are kept for up to "size" tenants, the
+    least recently seen being forgotten first.
+    '''
+
+    DEFAULT_BURST = 1.0
+    DEFAULT_SIZE = 10000
+
+    def __init__(self, ops_rate=None, bytes_rate=None, burst=DEFAULT_BURST, prefix_separator=None, size=DEFAULT_SIZE,
+                 clock=time.time):
+        self.ops_rate = ops_rate
+        self.bytes_rate = bytes_rate
+        self.burst = burst
+        self.prefix_separator = prefix_separator
+        self.size = size
+        self.clock = clock
+        self.buckets = OrderedDict()
+        self.client_hosts = WeakKeyDictionary()
+
+    def connect(self, client_stream, address):
+        '''
+        Remembers the host of a client connection; Unix socket clients have none, and share a tenant.
+        '''
+        self.client_hosts[client_stream] = address[0] if isinstance(address, tuple) else ''
+
+    def tenant(self, client_stream, key):
+        if self.prefix_separator is None:
+            return self.client_hosts.get(client_stream, '')
+        prefix, separator, rest = key.partition(self.prefix_separator)
+        return prefix if separator else b''
+
+    def allow(self, tenant, operations, byte_quantity):
+        '''
+        Takes the operations and bytes of a request from the tenant buckets, returning whether it's allowed;
+        Requests not allowed take nothing.
+        '''
+        ops_bucket, bytes_bucket = self._buckets_for(tenant)
+        if ops_bucket is not None and not ops_bucket.has_tokens():
+            return False
+        if bytes_bucket is not None and not bytes_bucket.has_tokens():
+            return False
+        if ops_bucket is not None:
+            ops_bucket.take(operations)
+        self.charge(tenant, byte_quantity)
+        return True
+
+    def charge(self, tenant, byte_quantity):
+        '''
+        Takes bytes already sent from the tenant, like the ones of a response, which can't be refused anymore.
+        '''
+        bytes_bucket = self._buckets_for(tenant)[1]
+        if bytes_bucket is not None:
+            bytes_bucket.take(byte_quantity)
+
+    def _buckets_for(self, tenant):
+        buckets = self.buckets.pop(tenant, None)
+        if buckets is None:
+            if len(self.buckets) >= self.size:
+                self.buckets.popitem(last=False)
+            buckets = (self._bucket(self.ops_rate), self._bucket(self.bytes_rate))
+        self.buckets[tenant] = buckets
+        return buckets
+
+    def _bucket(self, rate):
+        if rate is None:
+            return None
+        return TokenBucket(rate, rate * self.burst, self.clock)
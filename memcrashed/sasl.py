@@ -0,0 +1,102 @@
+import hmac
+
+from memcrashed.parser import BinaryParser
+
+
+PLAIN = b'PLAIN'
+SASL_AUTH = 0x21
+SUCCESS_STATUS = 0x00
+
+
+def read_credentials(path):
+    '''
+    Reads "username:password" lines from a file, skipping blank lines and the ones starting with "#".
+    '''
+    credentials = []
+    with open(path, 'rb') as credentials_file:
+        for line in credentials_file:
+            line = line.strip()
+            if not line or line.startswith(b'#'):
+                continue
+            username, password = line.split(b':', 1)
+            credentials.append((username, password))
+    return credentials
+
+
+def plain_auth_request(username, password):
+    body_bytes = PLAIN + b'\0' + username + b'\0' + password
+    header_bytes = BinaryParser().pack_request_header(SASL_AUTH, key_length=len(PLAIN), total_body_length=len(body_bytes))
+    return header_bytes + body_bytes
+
+
+class SaslAuthenticator(object):
+    '''
+    Checks the credentials of the clients with the PLAIN mechanism, the one supported by memcached clients.
+    '''
+
+    MECHANISMS = PLAIN
+
+    def __init__(self, credentials):
+        self.credentials = dict(credentials)
+
+    def authenticate(self, mechanism, data):
+        if mechanism != PLAIN:
+            return False
+        fields = data.split(b'\0')
+        if len(fields) != 3:
+            return False
+        authorization, username, password = fields
+        expected = self.credentials.get(username)
+        return expected is not None and hmac.compare_digest(expected, password)
+
+
+class AuthenticatingStream(object):
+    '''
+    Wraps a backend IOStream so that it authenticates with SASL PLAIN before anything else: The auth request
+    gets written first, and the reads are held until its response is read, so that the clients never see
+    it; A refused authentication closes the stream.
+    '''
+
+    HEADER_BYTES = 24
+
+    def __init__(self, stream, username, password):
+        self.stream = stream
+        self.parser = BinaryParser()
+        self.authenticated = False
+        self.held_reads = []
+        stream.write(plain_auth_request(username, password))
+        stream.read_bytes(self.HEADER_BYTES, self._read_auth_header)
+
+    def _read_auth_header(self, header_bytes):
+        headers = self.parser.unpack_response_header(header_bytes)
+        if headers.total_body_length > 0:
+            self.stream.read_bytes(headers.total_body_length, lambda body_bytes: self._finish_auth(headers))
+        else:
+            self._finish_auth(headers)
+
+    def _finish_auth(self, headers):
+        if headers.status != SUCCESS_STATUS:
+            self.stream.close()
+            return
+        self.authenticated = True
+        held_reads, self.held_reads = self.held_reads, []
+        for name, args, kwargs in held_reads:
+            getattr(self.stream, name)(*args, **kwargs)
+
+    def _read(self, name, args, kwargs):
+        if self.authenticated:
+            getattr(self.stream, name)(*args, **kwargs)
+        else:
+            self.held_reads.append((name, args, kwargs))
+
+    def read_bytes(self, *args, **kwargs):
+        self._read('read_bytes', args, kwargs)
+
+    def read_until(self, *args, **kwargs):
+        self._read('read_until', args, kwargs)
+
+    def read_until_close(self, *args, **kwargs):
+        self._read('read_until_close', args, kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
@@ -0,0 +1,50 @@
+from collections import defaultdict
+import random
+import time
+
+
+class BackendSelector(object):
+    '''
+    Picks among the backends able to serve a request with the power of two choices: Two of them are drawn at
+    random, and the one with the lowest score wins. The score is the exponentially weighted moving average
+    of the round trip times measured for a backend, times its requests in flight, so that a node slowed down
+    by a pause or a noisy neighbour quickly stops being picked, without all the load herding to one node.
+    '''
+
+    DEFAULT_DECAY = 0.3
+
+    def __init__(self, decay=DEFAULT_DECAY, clock=time.time, sample=random.sample):
+        self.decay = decay
+        self.clock = clock
+        self.sample = sample
+        self.latencies = {}
+        self.in_flight = defaultdict(int)
+
+    def choose(self, nodes):
+        if len(nodes) == 1:
+            return nodes[0]
+        first, second = self.sample(nodes, 2)
+        return second if self.score(second) < self.score(first) else first
+
+    def score(self, node):
+        return self.latencies.get(node, 0.0) * (self.in_flight[node] + 1)
+
+    def started(self, node):
+        '''
+        Marks a request sent to the node, returning what must be handed to "finished" once answered.
+        '''
+        self.in_flight[node] += 1
+        return self.clock()
+
+    def finished(self, node, started):
+        '''
+        Marks the request answered, returning its round trip.
+        '''
+        self.in_flight[node] = max(self.in_flight[node] - 1, 0)
+        round_trip = self.clock() - started
+        latency = self.latencies.get(node)
+        if latency is None:
+            self.latencies[node] = round_trip
+        else:
+            self.latencies[node] = latency + self.decay * (round_trip - latency)
+        return round_trip
@@ -1,15 +1,36 @@
 #!/usr/bin/env python
 
 import argparse
+import signal
 import socket
+import ssl
 import sys
+import time
 
-from tornado import gen, iostream
+from tornado import gen
 from tornado.ioloop import IOLoop
-from tornado.netutil import TCPServer
+from tornado.iostream import SSLIOStream
+from tornado.netutil import TCPServer, bind_unix_socket
 
+from memcrashed.analytics import KeySpaceAnalytics, MissRatioCurve
+from memcrashed.chunking import ValueChunker
+from memcrashed.compression import ValueCompressor
 from memcrashed.handlers.binary import BinaryProtocolHandler
 from memcrashed.handlers.text import TextProtocolHandler
+from memcrashed.hedging import ReadHedging
+from memcrashed.leases import KeyLeases
+from memcrashed.limits import BackendLimits
+from memcrashed.migration import KeyMigration
+from memcrashed.negative_cache import NegativeCache
+from memcrashed.passthrough import PassthroughRelay
+from memcrashed.profiling import Profiler
+from memcrashed.proxy import ProxyRepository, ShadowPool
+from memcrashed.quotas import TenantQuotas
+from memcrashed.sasl import SaslAuthenticator, read_credentials
+from memcrashed.sockets import SocketOptions, create_stream, parse_address
+from memcrashed.tls import DEFAULT_MINIMUM_VERSION, TLS_VERSIONS, create_server_context
+from memcrashed.tracing import RequestTracer
+from memcrashed.write_behind import WriteBehind
 
 
 class Server(TCPServer):
@@ -17,27 +38,322 @@ class Server(TCPServer):
         super(Server, self).__init__(io_loop, ssl_options)
         self.handler = BinaryProtocolHandler(self.io_loop)
         self.backend = None
+        self.pool_repository = ProxyRepository(self.io_loop)
+        self.client_socket_options = SocketOptions()
+        self.limits = None
+        self.compressor = None
+        self.chunker = None
+        self.negative_cache = None
+        self.shadow = None
+        self.hedging = None
+        self.leases = None
+        self.quotas = None
+        self.write_behind = None
+        self.analytics = None
+        self.authenticator = None
+        self.tracer = None
+        self.replicas = 1
+        self.backend_connections = 1
+        self.opaque_rewriting = False
+        self.passthrough = None
+        self.backend_credentials = None
+        self.tls_context = None
+        self.max_clients = None
+        self.streams = set()
+        self.draining = False
+        self._drain_callback = None
+        self._drain_timeout = None
+        self._configure_handler()
+
+    def _handle_connection(self, connection, address):
+        # TCPServer wraps each connection with its own context from the ssl_options, which rules session
+        # resumption out, so the TLS connections get wrapped here with the shared context instead.
+        if self.tls_context is None:
+            super(Server, self)._handle_connection(connection, address)
+            return
+        try:
+            connection = self.tls_context.wrap_socket(connection, server_side=True, do_handshake_on_connect=False)
+        except (ssl.SSLError, socket.error):
+            connection.close()
+            return
+        self.handle_stream(SSLIOStream(connection, io_loop=self.io_loop), address)
 
     def handle_stream(self, stream, address):
+        if self.draining or self._is_full():
+            stream.close()
+            return
+        if stream.socket is not None:
+            self.client_socket_options.apply(stream.socket)
+        if self.passthrough is not None:
+            self.streams.add(stream)
+            self.passthrough.relay(stream, self.create_passthrough_backend(), lambda: self._forget_stream(stream))
+            return
         self.ensure_backend()
+        if self.quotas is not None:
+            self.quotas.connect(stream, address)
+        self.streams.add(stream)
+        stream.set_close_callback(lambda: self._forget_stream(stream))
         self._start_interaction(stream)
 
     @gen.engine
     def _start_interaction(self, stream):
-        while not stream.closed():
-            yield gen.Task(self.handler.process, stream, self.backend)
+        while not stream.closed() and not self.draining:
+            yield gen.Task(self.handler.process, stream, self._backend_for_request())
+        if self.draining:
+            stream.close()
+
+    def _backend_for_request(self):
+        # With many connections to each backend, the requests get spread over the ones to the default node.
+        if self.pool_repository.connections > 1:
+            return self.pool_repository.stream_for_node(self.pool_repository.default_node)
+        return self.backend
+
+    def _is_full(self):
+        return self.max_clients is not None and len(self.streams) >= self.max_clients
+
+    def _forget_stream(self, stream):
+        self.streams.discard(stream)
+        if self.draining:
+            self._check_drained()
+
+    def drain(self, timeout, callback):
+        '''
+        Stops accepting new clients and waits for the in-flight requests to be answered, or for the relayed
+        connections to go idle in passthrough, and for the writes acknowledged ahead of the backends to be
+        flushed, before closing the backend connection and calling back. Gives up waiting after "timeout"
+        seconds.
+        '''
+        self.stop()
+        self.draining = True
+        self._drain_callback = callback
+        self._drain_timeout = self.io_loop.add_timeout(time.time() + timeout, self._finish_drain)
+        for stream in list(self.streams):
+            if self.passthrough is not None:
+                self.passthrough.close_when_idle(stream)
+            elif stream not in self.handler.busy_streams:
+                stream.close()
+        self._check_drained()
+
+    def _check_drained(self):
+        if self.streams:
+            return
+        if self.write_behind is not None:
+            self.write_behind.wait_flushed(self._finish_drain)
+        else:
+            self._finish_drain()
+
+    def _finish_drain(self):
+        if self._drain_callback is None:
+            return
+        callback, self._drain_callback = self._drain_callback, None
+        self.io_loop.remove_timeout(self._drain_timeout)
+        for stream in list(self.streams):
+            stream.close()
+        if self.backend is not None:
+            self.backend.close()
+            self.backend = None
+        self.pool_repository.close()
+        if self.shadow is not None:
+            self.shadow.close()
+        callback()
 
     def set_handler(self, handler_type):
         if handler_type == 'text':
             self.handler = TextProtocolHandler(self.io_loop)
         else:
             self.handler = BinaryProtocolHandler(self.io_loop)
+        self._configure_handler()
+
+    def _configure_handler(self):
+        self.handler.pool_repository = self.pool_repository
+        self.handler.limits = self.limits
+        self.handler.compressor = self.compressor
+        self.handler.chunker = self.chunker
+        self.handler.negative_cache = self.negative_cache
+        self.handler.shadow = self.shadow
+        self.handler.hedging = self.hedging
+        self.handler.leases = self.leases
+        self.handler.quotas = self.quotas
+        self.handler.write_behind = self.write_behind
+        self.handler.analytics = self.analytics
+        self.handler.authenticator = self.authenticator
+        self.handler.tracer = self.tracer
+        self.handler.opaque_rewriting = self.opaque_rewriting
+
+    def set_backends(self, addresses, socket_options=None, write_batching=True, migration_window=None, migration_copy_ttl=None):
+        '''
+        Replaces the backends; With a migration window, the keys missed in their new owners keep being
+        looked up in the previous ones for that many seconds.
+        '''
+        previous_repository = self.pool_repository
+        self.backend = None
+        self.pool_repository = ProxyRepository(
+            self.io_loop, addresses, socket_options, write_batching, self.replicas, self.backend_credentials,
+            self.backend_connections)
+        if migration_window:
+            if previous_repository.migration is not None:
+                previous_repository.migration.close()
+                previous_repository.migration = None
+            self.pool_repository.migration = KeyMigration(
+                self.pool_repository, previous_repository, migration_window, migration_copy_ttl)
+        else:
+            previous_repository.close()
+        if self.chunker is not None:
+            self.chunker.pool_repository = self.pool_repository
+        self._configure_handler()
+
+    def set_replicas(self, replicas):
+        '''
+        Keeps each key in this many backends, with the writes sent to all of them and the reads served by the
+        fastest ones.
+        '''
+        self.replicas = replicas
+        self.pool_repository.replicas = replicas
+
+    def set_backend_connections(self, connections):
+        '''
+        Keeps this many connections to each backend, over which the requests of all the clients get pipelined,
+        their responses being read back in order.
+        '''
+        self.backend_connections = connections
+        self.pool_repository.connections = connections
+
+    def set_opaque_rewriting(self, enabled):
+        '''
+        Tells the binary responses apart by opaque values unique to each backend connection, instead of by
+        their order, restoring the clients' opaques on the way back.
+        '''
+        self.opaque_rewriting = enabled
+        self._configure_handler()
+
+    def set_passthrough(self, enabled):
+        '''
+        Relays the raw bytes between each client and a connection of its own to the default backend, without
+        parsing them; Everything else done to the requests gets bypassed, client authentication and limits
+        included, so it's only meant for a single backend and none of those.
+        '''
+        self.passthrough = PassthroughRelay(self.io_loop) if enabled else None
+
+    def set_tls(self, certfile, keyfile=None, minimum_version=DEFAULT_MINIMUM_VERSION, ciphers=None):
+        '''
+        Serves the clients over TLS, while the backends keep being reached in plain text.
+        '''
+        self.tls_context = create_server_context(certfile, keyfile, minimum_version, ciphers)
+
+    def set_backend_credentials(self, username, password):
+        '''
+        Authenticates the backend connections with SASL as they're opened, so that the clients never need to
+        get to the backends themselves; The binary authentication ties the connections to the binary protocol.
+        '''
+        self.backend_credentials = (username, password)
+        self.pool_repository.credentials = self.backend_credentials
+
+    def set_authentication(self, credentials):
+        '''
+        Makes the binary protocol clients authenticate with SASL PLAIN against the given (username,
+        password) pairs, at the proxy itself; Any request before that is answered with an auth error.
+        '''
+        self.authenticator = SaslAuthenticator(credentials) if credentials else None
+        self._configure_handler()
+
+    def set_tracing(self, sample_rate, buffer_size=RequestTracer.DEFAULT_BUFFER_SIZE, slow_threshold=None, output=sys.stderr):
+        '''
+        Keeps the traces of a sample of the requests, and writes the ones slower than the threshold, in
+        seconds, to the output.
+        '''
+        if sample_rate or slow_threshold is not None:
+            self.tracer = RequestTracer(sample_rate, buffer_size, slow_threshold, output)
+        else:
+            self.tracer = None
+        self._configure_handler()
+
+    def set_analytics(self, sample_rate, prefix_separator=None, max_keys=MissRatioCurve.DEFAULT_MAX_KEYS):
+        '''
+        Samples this fraction of the keys accessed, estimating the miss ratio curves and working set of the
+        whole key space, of each backend, and of each key prefix up to the separator if given.
+        '''
+        self.analytics = KeySpaceAnalytics(sample_rate, prefix_separator, max_keys) if sample_rate else None
+        self._configure_handler()
+
+    def set_hedging(self, percentile, budget=ReadHedging.DEFAULT_BUDGET):
+        '''
+        Asks other replicas for the keys of reads taking longer than this percentile of the recent round
+        trips, for up to the budget fraction of the reads; Only useful with more than one replica.
+        '''
+        self.hedging = ReadHedging(percentile, budget) if percentile else None
+        self._configure_handler()
+
+    def set_leases(self, duration, max_stale=KeyLeases.DEFAULT_MAX_STALE, size=KeyLeases.DEFAULT_SIZE):
+        '''
+        Leases each missed key to the first client missing it for this many seconds, the other clients
+        getting a stale value, if one is at most "max_stale" seconds old, or waiting for the refill.
+        '''
+        self.leases = KeyLeases(self.io_loop, duration, max_stale, size) if duration else None
+        self._configure_handler()
+
+    def set_quotas(self, ops_rate, bytes_rate=None, burst=TenantQuotas.DEFAULT_BURST, prefix_separator=None):
+        '''
+        Rate limits the operations and bytes a second of each client host, or of each key prefix up to the
+        separator if given, allowing bursts of this many seconds worth of them; The requests exceeding them
+        get answered as throttled, without reaching the backends.
+        '''
+        if ops_rate is None and bytes_rate is None:
+            self.quotas = None
+        else:
+            self.quotas = TenantQuotas(ops_rate, bytes_rate, burst, prefix_separator)
+        self._configure_handler()
+
+    def set_write_behind(self, max_pending, policy=WriteBehind.DROP):
+        '''
+        Acknowledges the text "noreply" writes, and the binary batches of quiet writes ended by a NoOp, as soon
+        as they're handed to the backends, with up to "max_pending" bytes of them unflushed for each backend;
+        Above that, the next ones get dropped, or wait with the "block" policy. Not used with backend limits.
+        '''
+        self.write_behind = WriteBehind(max_pending, policy) if max_pending else None
+        self._configure_handler()
+
+    def set_limits(self, max_clients=None, max_in_flight=None, max_queue_wait=None, high_watermark=None):
+        self.max_clients = max_clients
+        if max_in_flight is None and high_watermark is None:
+            self.limits = None
+        else:
+            self.limits = BackendLimits(self.io_loop, max_in_flight, max_queue_wait, high_watermark)
+        self._configure_handler()
+
+    def set_compression(self, threshold, threads=2):
+        if self.compressor is not None:
+            self.compressor.shutdown()
+        self.compressor = ValueCompressor(self.io_loop, threshold, threads=threads) if threshold else None
+        self._configure_handler()
+
+    def set_chunking(self, threshold, chunk_size=ValueChunker.DEFAULT_CHUNK_SIZE):
+        self.chunker = ValueChunker(self.pool_repository, threshold, chunk_size) if threshold else None
+        self._configure_handler()
+
+    def set_negative_cache(self, ttl, size=NegativeCache.DEFAULT_SIZE):
+        self.negative_cache = NegativeCache(ttl, size) if ttl else None
+        self._configure_handler()
+
+    def set_shadow(self, addresses, read_fraction=ShadowPool.DEFAULT_READ_FRACTION, socket_options=None):
+        if self.shadow is not None:
+            self.shadow.close()
+        if addresses:
+            self.shadow = ShadowPool(
+                self.io_loop, addresses, read_fraction, socket_options, credentials=self.backend_credentials)
+        else:
+            self.shadow = None
+        self._configure_handler()
 
     def create_backend(self):
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        backend = iostream.IOStream(s, io_loop=self.io_loop)
-        backend.connect(("127.0.0.1", 11211))
-        return backend
+        return self.pool_repository.stream_for_node(self.pool_repository.default_node)
+
+    def create_passthrough_backend(self):
+        # Unlike the shared streams, these are neither authenticated nor batched: The clients authenticate
+        # themselves, and their writes already come in chunks.
+        return create_stream(self.io_loop, self.pool_repository.default_node, self.pool_repository.socket_options)
+
+    def listen_unix(self, path):
+        self.add_socket(bind_unix_socket(path))
 
     def ensure_backend(self):
         if self.backend is None:
@@ -47,14 +363,168 @@ class Server(TCPServer):
 def create_options_from_arguments(args):
     default_port = 22322
     default_address = 'localhost'
+    default_shutdown_timeout = 10.0
+    default_backend = '127.0.0.1:11211'
+    default_compression_threads = 2
+    default_chunk_size = ValueChunker.DEFAULT_CHUNK_SIZE
+    default_negative_cache_size = NegativeCache.DEFAULT_SIZE
+    default_shadow_read_fraction = ShadowPool.DEFAULT_READ_FRACTION
+    default_hedge_budget = ReadHedging.DEFAULT_BUDGET
+    default_lease_max_stale = KeyLeases.DEFAULT_MAX_STALE
+    default_lease_hot_keys = KeyLeases.DEFAULT_SIZE
+    default_rate_limit_burst = TenantQuotas.DEFAULT_BURST
+    default_trace_buffer_size = RequestTracer.DEFAULT_BUFFER_SIZE
+    default_key_sample_max_keys = MissRatioCurve.DEFAULT_MAX_KEYS
+    default_profile_seconds = Profiler.DEFAULT_SECONDS
     parser = argparse.ArgumentParser(description="A Memcached sharding and failover proxy")
     parser.add_argument('-p', '--port', action='store', dest='port', default=22322, type=int,
                         help='Port in which the proxy will run. "{}" by default.'.format(default_port))
     parser.add_argument('-a', '--address', action='store', dest='address', default='localhost',
                         help='Address to which the proxy will be bound. "{}" by default.'.format(default_address))
+    parser.add_argument('-s', '--unix-socket', action='store', dest='unix_socket', default=None,
+                        help='Path of a Unix domain socket in which the proxy will run, instead of the TCP port.')
+    parser.add_argument('--tls-cert', action='store', dest='tls_cert', default=None,
+                        help='Path to a PEM certificate chain; If provided, clients get served over TLS, with session resumption.')
+    parser.add_argument('--tls-key', action='store', dest='tls_key', default=None,
+                        help='Path to the PEM private key of the certificate, if not in the --tls-cert file.')
+    parser.add_argument('--tls-min-version', action='store', dest='tls_min_version', default=DEFAULT_MINIMUM_VERSION, choices=TLS_VERSIONS,
+                        help='Lowest TLS version accepted from clients. "{}" by default.'.format(DEFAULT_MINIMUM_VERSION))
+    parser.add_argument('--tls-ciphers', action='store', dest='tls_ciphers', default=None,
+                        help='OpenSSL cipher list for TLS 1.2 connections; OpenSSL default if not provided.')
+    parser.add_argument('-b', '--backend', action='append', dest='backends', default=None,
+                        help='Memcached backend, as "host:port" or the path to a Unix domain socket; Repeat it to shard keys among many backends. "{}" by default.'.format(default_backend))
+    parser.add_argument('--replicas', action='store', dest='replicas', default=1, type=int,
+                        help='Backends keeping each key, with reads served by the fastest of them; CAS only works reliably with text "gets". "1" by default.')
+    parser.add_argument('--backend-connections', action='store', dest='backend_connections', default=1, type=int,
+                        help='Connections kept to each backend, shared by all the clients with their requests pipelined. "1" by default.')
+    parser.add_argument('--rewrite-opaques', action='store_true', dest='rewrite_opaques', default=False,
+                        help='If provided, the binary responses get routed back to their clients by opaque values unique to each backend connection, instead of by their order. Binary protocol only.')
+    parser.add_argument('--passthrough', action='store_true', dest='passthrough', default=False,
+                        help='If provided, the bytes get relayed between each client and its own connection to the only backend, without being parsed, their counts being written to stderr on SIGUSR1; Not available with the options acting on the requests, like authentication or rate limits.')
+    parser.add_argument('--hedge-percentile', action='store', dest='hedge_percentile', default=None, type=float,
+                        help='If provided, reads taking longer than this percentile of the recent round trips are also sent to another replica, answering with the first response; Needs --replicas.')
+    parser.add_argument('--hedge-budget', action='store', dest='hedge_budget', default=default_hedge_budget, type=float,
+                        help='Maximum fraction of the reads that may be hedged. "{}" by default.'.format(default_hedge_budget))
+    parser.add_argument('--previous-backend', action='append', dest='previous_backends', default=None,
+                        help='Memcached backend of the ring used before the current one; Repeat it for each previous backend.')
+    parser.add_argument('--migration-window', action='store', dest='migration_window', default=None, type=float,
+                        help='Seconds during which keys missed in their owners get looked up in their previous ones; Only used with --previous-backend.')
+    parser.add_argument('--migration-copy-ttl', action='store', dest='migration_copy_ttl', default=None, type=int,
+                        help='If provided, values found in the previous owners get copied to the current ones, expiring in this many seconds.')
+    parser.add_argument('--sasl-credentials', action='store', dest='sasl_credentials', default=None,
+                        help='Path to a file of "username:password" lines; If provided, clients must authenticate at the proxy with SASL PLAIN. Binary protocol only.')
+    parser.add_argument('--backend-sasl-credentials', action='store', dest='backend_sasl_credentials', default=None,
+                        help='Path to a file with a "username:password" line, used to authenticate the backend connections with SASL as they get opened; Binary protocol only, and not available with chunking, migrations, hedging or leases, whose own backend commands can\'t authenticate.')
+    parser.add_argument('--shadow-backend', action='append', dest='shadow_backends', default=None,
+                        help='Memcached backend receiving a copy of the requests, to be warmed up; Repeat it for a sharded shadow pool.')
+    parser.add_argument('--shadow-read-fraction', action='store', dest='shadow_read_fraction', default=default_shadow_read_fraction, type=float,
+                        help='Fraction of the reads copied to the shadow backends; Writes are always copied. "{}" by default.'.format(default_shadow_read_fraction))
+    parser.add_argument('--socket-buffer-size', action='store', dest='socket_buffer_size', default=None, type=int,
+                        help='Send and receive buffer size, in bytes, for client connections; System default if not provided.')
+    parser.add_argument('--backend-socket-buffer-size', action='store', dest='backend_socket_buffer_size', default=None, type=int,
+                        help='Send and receive buffer size, in bytes, for backend connections; System default if not provided.')
+    parser.add_argument('--keepalive', action='store', dest='keepalive', default=None, type=int,
+                        help='TCP keepalive idle seconds for client connections, 0 to disable; System default if not provided.')
+    parser.add_argument('--backend-keepalive', action='store', dest='backend_keepalive', default=None, type=int,
+                        help='TCP keepalive idle seconds for backend connections, 0 to disable; System default if not provided.')
+    parser.add_argument('--no-write-batching', action='store_false', dest='write_batching', default=True,
+                        help='If provided, sends each backend write on its own instead of joining the ones issued in the same loop iteration.')
+    parser.add_argument('--compression-threshold', action='store', dest='compression_threshold', default=None, type=int,
+                        help='If provided, values stored with at least this many bytes get compressed by the proxy.')
+    parser.add_argument('--compression-threads', action='store', dest='compression_threads', default=default_compression_threads, type=int,
+                        help='Threads used to compress and decompress values. "{}" by default.'.format(default_compression_threads))
+    parser.add_argument('--chunk-threshold', action='store', dest='chunk_threshold', default=None, type=int,
+                        help='If provided, values set with more than this many bytes get split into chunks spread among the backends.')
+    parser.add_argument('--chunk-size', action='store', dest='chunk_size', default=default_chunk_size, type=int,
+                        help='Size, in bytes, of each chunk of a split value. "{}" by default.'.format(default_chunk_size))
+    parser.add_argument('--negative-cache-ttl', action='store', dest='negative_cache_ttl', default=None, type=float,
+                        help='If provided, keys missed in the backends are answered as misses by the proxy for up to this many seconds, unless written through it.')
+    parser.add_argument('--negative-cache-size', action='store', dest='negative_cache_size', default=default_negative_cache_size, type=int,
+                        help='Slots in the filter remembering the missed keys; More slots mean fewer keys wrongly taken as missing. "{}" by default.'.format(default_negative_cache_size))
+    parser.add_argument('--lease-duration', action='store', dest='lease_duration', default=None, type=float,
+                        help='If provided, the first client missing a key gets to refill it alone for up to this many seconds, the others getting a stale value or waiting.')
+    parser.add_argument('--lease-max-stale', action='store', dest='lease_max_stale', default=default_lease_max_stale, type=float,
+                        help='Seconds a value may be served stale while its key gets refilled. "{}" by default.'.format(default_lease_max_stale))
+    parser.add_argument('--lease-hot-keys', action='store', dest='lease_hot_keys', default=default_lease_hot_keys, type=int,
+                        help='Contended keys whose last value is kept to be served stale. "{}" by default.'.format(default_lease_hot_keys))
+    parser.add_argument('--rate-limit-ops', action='store', dest='rate_limit_ops', default=None, type=float,
+                        help='If provided, each client host may send up to this many operations a second, the others being answered as throttled.')
+    parser.add_argument('--rate-limit-bytes', action='store', dest='rate_limit_bytes', default=None, type=float,
+                        help='If provided, each client host may send and receive up to this many bytes a second, the other requests being answered as throttled.')
+    parser.add_argument('--rate-limit-burst', action='store', dest='rate_limit_burst', default=default_rate_limit_burst, type=float,
+                        help='Seconds worth of the rate limits that may be used at once. "{}" by default.'.format(default_rate_limit_burst))
+    parser.add_argument('--rate-limit-prefix', action='store', dest='rate_limit_prefix', default=None,
+                        help='If provided, the rate limits apply to each key prefix up to this separator, instead of each client host.')
+    parser.add_argument('--write-behind-max-pending', action='store', dest='write_behind_max_pending', default=None, type=int,
+                        help='If provided, writes getting no response are acknowledged as soon as handed to the backends, with up to this many bytes of them unflushed for each backend; The writes dropped get counted to stderr on SIGUSR1.')
+    parser.add_argument('--write-behind-policy', action='store', dest='write_behind_policy', default=WriteBehind.DROP, choices=WriteBehind.POLICIES,
+                        help='What happens to the writes behind once a backend has too many pending: "drop" them, or "block" until there is room. "{}" by default.'.format(WriteBehind.DROP))
+    parser.add_argument('--trace-sample-rate', action='store', dest='trace_sample_rate', default=None, type=float,
+                        help='If provided, this fraction of the requests gets traced, with the last traces written to stderr on SIGUSR1.')
+    parser.add_argument('--trace-buffer-size', action='store', dest='trace_buffer_size', default=default_trace_buffer_size, type=int,
+                        help='Number of request traces kept. "{}" by default.'.format(default_trace_buffer_size))
+    parser.add_argument('--slow-request-threshold', action='store', dest='slow_request_threshold', default=None, type=float,
+                        help='If provided, requests taking at least this many seconds get logged with their trace.')
+    parser.add_argument('--slow-log', action='store', dest='slow_log', default=None,
+                        help='Path of the file to which slow requests get appended; stderr if not provided.')
+    parser.add_argument('--key-sample-rate', action='store', dest='key_sample_rate', default=None, type=float,
+                        help='If provided, this fraction of the keys gets sampled to estimate miss ratio curves and working sets, written to stderr on SIGUSR1.')
+    parser.add_argument('--key-sample-max-keys', action='store', dest='key_sample_max_keys', default=default_key_sample_max_keys, type=int,
+                        help='Sampled keys tracked for each curve; Caches larger than this many keys over the sample rate are not estimated. "{}" by default.'.format(default_key_sample_max_keys))
+    parser.add_argument('--key-sample-prefix', action='store', dest='key_sample_prefix', default=None,
+                        help='If provided, a curve is also estimated for each key prefix up to this separator.')
+    parser.add_argument('--profile-dir', action='store', dest='profile_dir', default=None,
+                        help='If provided, SIGUSR2 profiles the CPU and allocations for a while, writing the results to this directory.')
+    parser.add_argument('--profile-seconds', action='store', dest='profile_seconds', default=default_profile_seconds, type=float,
+                        help='Seconds each profile started by SIGUSR2 lasts. "{}" by default.'.format(default_profile_seconds))
     parser.add_argument('-t', '--text-protocol', action='store_true', dest='is_text_protocol', default=False,
                         help='If provided, will run over Memcache text protocol; Otherwise, runs over binary protocol (faster and more robust).')
+    parser.add_argument('--shutdown-timeout', action='store', dest='shutdown_timeout', default=default_shutdown_timeout, type=float,
+                        help='Seconds to wait for in-flight requests when stopping on SIGTERM. "{}" by default.'.format(default_shutdown_timeout))
+    parser.add_argument('--max-clients', action='store', dest='max_clients', default=None, type=int,
+                        help='Maximum number of simultaneous client connections; Unlimited by default.')
+    parser.add_argument('--max-in-flight', action='store', dest='max_in_flight', default=None, type=int,
+                        help='Maximum number of requests in flight to each backend, queueing the others; Unlimited by default.')
+    parser.add_argument('--queue-timeout', action='store', dest='queue_timeout', default=None, type=float,
+                        help='Seconds a request may wait for a backend slot before being answered as busy; Unlimited by default.')
+    parser.add_argument('--backend-high-watermark', action='store', dest='backend_high_watermark', default=None, type=int,
+                        help='Bytes pending to a backend above which clients stop being read from; Unlimited by default.')
     options = parser.parse_args(args)
+    if options.tls_key and not options.tls_cert:
+        parser.error('--tls-key needs --tls-cert.')
+    if options.sasl_credentials and options.is_text_protocol:
+        parser.error('SASL authentication is only available with the binary protocol.')
+    if options.rewrite_opaques and options.is_text_protocol:
+        parser.error('Opaque rewriting is only available with the binary protocol.')
+    if options.backend_sasl_credentials and options.is_text_protocol:
+        # Memcached sticks to the protocol of the first bytes of a connection, being the binary SASL ones.
+        parser.error('Backend SASL authentication is only available with the binary protocol.')
+    if not options.backends:
+        options.backends = [default_backend]
+    if options.passthrough and len(options.backends) > 1:
+        parser.error('Passthrough is only available with a single backend.')
+    if options.passthrough:
+        # The relayed bytes never get parsed, so these would be silently bypassed, client authentication included.
+        for name, value in [('--sasl-credentials', options.sasl_credentials), ('--backend-sasl-credentials', options.backend_sasl_credentials),
+                            ('--rate-limit-ops', options.rate_limit_ops), ('--rate-limit-bytes', options.rate_limit_bytes),
+                            ('--max-in-flight', options.max_in_flight), ('--queue-timeout', options.queue_timeout),
+                            ('--backend-high-watermark', options.backend_high_watermark), ('--replicas', options.replicas > 1),
+                            ('--rewrite-opaques', options.rewrite_opaques), ('--hedge-percentile', options.hedge_percentile),
+                            ('--previous-backend', options.previous_backends), ('--shadow-backend', options.shadow_backends),
+                            ('--compression-threshold', options.compression_threshold), ('--chunk-threshold', options.chunk_threshold),
+                            ('--negative-cache-ttl', options.negative_cache_ttl), ('--lease-duration', options.lease_duration),
+                            ('--write-behind-max-pending', options.write_behind_max_pending),
+                            ('--trace-sample-rate', options.trace_sample_rate),
+                            ('--slow-request-threshold', options.slow_request_threshold is not None),
+                            ('--key-sample-rate', options.key_sample_rate)]:
+            if value:
+                parser.error('{} is not available with --passthrough.'.format(name))
+    if options.backend_sasl_credentials:
+        # The proxy's own backend commands speak the text protocol, which SASL backends refuse.
+        for name, value in [('--chunk-threshold', options.chunk_threshold), ('--previous-backend', options.previous_backends),
+                            ('--hedge-percentile', options.hedge_percentile), ('--lease-duration', options.lease_duration)]:
+            if value:
+                parser.error('{} is not available with --backend-sasl-credentials.'.format(name))
     return options
 
 
@@ -63,10 +533,109 @@ def start_server(options):
     server = Server(io_loop=io_loop)
     if options.is_text_protocol:
         server.set_handler('text')
-    server.listen(options.port, options.address)
+    server.set_limits(options.max_clients, options.max_in_flight, options.queue_timeout, options.backend_high_watermark)
+    server.client_socket_options = SocketOptions(
+        send_buffer=options.socket_buffer_size, receive_buffer=options.socket_buffer_size, keepalive=options.keepalive)
+    backend_socket_options = SocketOptions(
+        send_buffer=options.backend_socket_buffer_size, receive_buffer=options.backend_socket_buffer_size, keepalive=options.backend_keepalive)
+    if options.tls_cert:
+        server.set_tls(options.tls_cert, options.tls_key, options.tls_min_version, options.tls_ciphers)
+    server.set_replicas(options.replicas)
+    server.set_backend_connections(options.backend_connections)
+    if options.rewrite_opaques:
+        server.set_opaque_rewriting(True)
+    if options.passthrough:
+        server.set_passthrough(True)
+    if options.backend_sasl_credentials:
+        server.set_backend_credentials(*read_credentials(options.backend_sasl_credentials)[0])
+    if options.sasl_credentials:
+        server.set_authentication(read_credentials(options.sasl_credentials))
+    if options.previous_backends and options.migration_window:
+        server.set_backends(
+            [parse_address(backend) for backend in options.previous_backends], backend_socket_options, options.write_batching)
+        server.set_backends(
+            [parse_address(backend) for backend in options.backends], backend_socket_options, options.write_batching,
+            options.migration_window, options.migration_copy_ttl)
+    else:
+        server.set_backends([parse_address(backend) for backend in options.backends], backend_socket_options, options.write_batching)
+    if options.hedge_percentile:
+        server.set_hedging(options.hedge_percentile, options.hedge_budget)
+    if options.shadow_backends:
+        server.set_shadow(
+            [parse_address(backend) for backend in options.shadow_backends], options.shadow_read_fraction, backend_socket_options)
+    if options.compression_threshold:
+        server.set_compression(options.compression_threshold, options.compression_threads)
+    if options.chunk_threshold:
+        server.set_chunking(options.chunk_threshold, options.chunk_size)
+    if options.negative_cache_ttl:
+        server.set_negative_cache(options.negative_cache_ttl, options.negative_cache_size)
+    if options.rate_limit_ops or options.rate_limit_bytes:
+        prefix_separator = options.rate_limit_prefix.encode('utf-8') if options.rate_limit_prefix else None
+        server.set_quotas(options.rate_limit_ops, options.rate_limit_bytes, options.rate_limit_burst, prefix_separator)
+    if options.write_behind_max_pending:
+        server.set_write_behind(options.write_behind_max_pending, options.write_behind_policy)
+    if options.lease_duration:
+        server.set_leases(options.lease_duration, options.lease_max_stale, options.lease_hot_keys)
+    if options.trace_sample_rate or options.slow_request_threshold is not None:
+        output = open(options.slow_log, 'a') if options.slow_log else sys.stderr
+        server.set_tracing(options.trace_sample_rate, options.trace_buffer_size, options.slow_request_threshold, output)
+    if options.key_sample_rate:
+        prefix_separator = options.key_sample_prefix.encode('utf-8') if options.key_sample_prefix else None
+        server.set_analytics(options.key_sample_rate, prefix_separator, options.key_sample_max_keys)
+    if (options.trace_sample_rate or options.slow_request_threshold is not None or options.key_sample_rate or
+            options.passthrough or options.write_behind_max_pending):
+        install_dump_handler(server)
+    if options.profile_dir:
+        install_profile_handler(server, options.profile_dir, options.profile_seconds)
+    if options.unix_socket:
+        server.listen_unix(options.unix_socket)
+    else:
+        server.listen(options.port, options.address)
+    install_shutdown_handler(server, options.shutdown_timeout)
     io_loop.start()
 
 
+def install_shutdown_handler(server, timeout):
+    io_loop = server.io_loop
+
+    def shutdown():
+        server.drain(timeout, io_loop.stop)
+
+    def handle_signal(signum, frame):
+        io_loop.add_callback(shutdown)
+
+    signal.signal(signal.SIGTERM, handle_signal)
+
+
+def install_dump_handler(server, output=sys.stderr):
+    io_loop = server.io_loop
+
+    def dump():
+        if server.tracer is not None:
+            server.tracer.dump(output)
+        if server.analytics is not None:
+            server.analytics.dump(output)
+        if server.passthrough is not None:
+            server.passthrough.dump(output)
+        if server.write_behind is not None:
+            server.write_behind.dump(output)
+
+    def handle_signal(signum, frame):
+        io_loop.add_callback(dump)
+
+    signal.signal(signal.SIGUSR1, handle_signal)
+
+
+def install_profile_handler(server, directory, seconds=Profiler.DEFAULT_SECONDS):
+    profiler = Profiler(server.io_loop, directory)
+
+    def handle_signal(signum, frame):
+        server.io_loop.add_callback(lambda: profiler.start(seconds))
+
+    signal.signal(signal.SIGUSR2, handle_signal)
+    return profiler
+
+
 def main():
     options = create_options_from_arguments(sys.argv[1:])
     start_server(options)
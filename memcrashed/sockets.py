@@ -0,0 +1,113 @@
+import socket
+
+from tornado import iostream
+
+
+def parse_address(address):
+    '''
+    Turns a "host:port" string into a TCP address tuple; Anything containing a slash is taken as the path
+    to a Unix domain socket.
+    '''
+    if '/' in address:
+        return address
+    host, port = address.rsplit(':', 1)
+    return (host, int(port))
+
+
+def is_unix_address(address):
+    return not isinstance(address, tuple)
+
+
+def create_stream(io_loop, address, socket_options=None):
+    if is_unix_address(address):
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    else:
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    if socket_options is not None:
+        socket_options.apply(s)
+    stream = iostream.IOStream(s, io_loop=io_loop)
+    stream.connect(address)
+    return stream
+
+
+class SocketOptions(object):
+    '''
+    Socket tuning applied to every connection of a listener or of a backend pool. Buffer sizes and
+    keepalive are left to the system when None; A keepalive of 0 disables it, and a positive one enables
+    it with that many idle seconds before probing.
+    '''
+
+    TCP_FAMILIES = (socket.AF_INET, socket.AF_INET6)
+
+    def __init__(self, nodelay=True, send_buffer=None, receive_buffer=None, keepalive=None):
+        self.nodelay = nodelay
+        self.send_buffer = send_buffer
+        self.receive_buffer = receive_buffer
+        self.keepalive = keepalive
+
+    def apply(self, s):
+        if self.send_buffer is not None:
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.send_buffer)
+        if self.receive_buffer is not None:
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.receive_buffer)
+        if s.family not in self.TCP_FAMILIES:
+            return
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, int(self.nodelay))
+        if self.keepalive is not None:
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, int(self.keepalive > 0))
+            if self.keepalive > 0 and hasattr(socket, 'TCP_KEEPIDLE'):
+                s.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, self.keepalive)
+
+
+class FlushCallbackStream(object):
+    '''
+    Wraps an IOStream so that every write calls back once flushed: IOStream keeps a single write callback,
+    replaced by each write, so the earlier writes still in its buffer would never call back.
+    '''
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.unflushed_callbacks = []
+
+    def write(self, data, callback=None):
+        if callback is not None:
+            self.unflushed_callbacks.append(callback)
+        self.stream.write(data, self._flushed)
+
+    def _flushed(self):
+        # IOStream only calls back when its whole buffer is gone, so everything written so far was flushed.
+        callbacks, self.unflushed_callbacks = self.unflushed_callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+class BatchingStream(FlushCallbackStream):
+    '''
+    Wraps an IOStream so that all the writes issued during the same IOLoop iteration are joined and sent
+    with a single call, which matters for backend connections shared by many clients.
+    '''
+
+    def __init__(self, stream, io_loop):
+        super(BatchingStream, self).__init__(stream)
+        self.io_loop = io_loop
+        self.pending = []
+        self.pending_callbacks = []
+
+    def write(self, data, callback=None):
+        if not self.pending:
+            self.io_loop.add_callback(self._flush)
+        self.pending.append(data)
+        if callback is not None:
+            self.pending_callbacks.append(callback)
+
+    def _flush(self):
+        data = b''.join(self.pending)
+        self.unflushed_callbacks.extend(self.pending_callbacks)
+        self.pending = []
+        self.pending_callbacks = []
+        if self.stream.closed():
+            return
+        self.stream.write(data, self._flushed)
@@ -0,0 +1,29 @@
+import ssl
+
+
+TLS_VERSIONS = ('1.2', '1.3')
+DEFAULT_MINIMUM_VERSION = '1.2'
+
+
+def create_server_context(certfile, keyfile=None, minimum_version=DEFAULT_MINIMUM_VERSION, ciphers=None):
+    '''
+    SSL context for the client listener. The highest TLS version supported by both sides gets negotiated,
+    down to the minimum one; The context is shared by all the connections, so that the session tickets it
+    issues let reconnecting clients resume their sessions instead of going through a full handshake.
+    '''
+    if minimum_version not in TLS_VERSIONS:
+        raise ValueError('Unknown TLS version: {}'.format(minimum_version))
+    if minimum_version == '1.3' and not getattr(ssl, 'HAS_TLSv1_3', False):
+        raise ValueError('TLS 1.3 is not supported by the OpenSSL in use')
+
+    context = ssl.SSLContext(getattr(ssl, 'PROTOCOL_TLS_SERVER', ssl.PROTOCOL_SSLv23))
+    disabled = ['OP_NO_SSLv2', 'OP_NO_SSLv3', 'OP_NO_TLSv1', 'OP_NO_TLSv1_1']
+    if minimum_version == '1.3':
+        disabled.append('OP_NO_TLSv1_2')
+    for option in disabled:
+        context.options |= getattr(ssl, option, 0)
+    context.options &= ~getattr(ssl, 'OP_NO_TICKET', 0)
+    context.load_cert_chain(certfile, keyfile)
+    if ciphers is not None:
+        context.set_ciphers(ciphers)
+    return context
@@ -0,0 +1,101 @@
+from collections import deque
+import random
+import socket
+import sys
+import time
+
+from memcrashed.proxy import node_name
+
+
+class Trace(object):
+    '''
+    What happened to a single request: the client, the command and its keys, the backends chosen, the
+    bytes in each direction and where the time went, in seconds.
+    '''
+
+    __slots__ = ('started', 'sampled', 'client', 'command', 'keys', 'nodes', 'request_bytes', 'response_bytes',
+                 'queue_wait', 'round_trip', 'total')
+
+    MAX_KEYS_SHOWN = 3
+
+    def __init__(self, started, sampled, command, keys, request_bytes):
+        self.started = started
+        self.sampled = sampled
+        self.client = None
+        self.command = command
+        self.keys = keys
+        self.nodes = []
+        self.request_bytes = request_bytes
+        self.response_bytes = 0
+        self.queue_wait = 0.0
+        self.round_trip = 0.0
+        self.total = None
+
+    def backend_answered(self, node, round_trip):
+        self.nodes.append(node)
+        self.round_trip = max(self.round_trip, round_trip)
+
+    def describe(self):
+        # Keys may hold any byte but spaces and control characters, so the others get escaped.
+        keys = b' '.join(self.keys[:self.MAX_KEYS_SHOWN]).decode('latin-1').encode('ascii', 'backslashreplace').decode('ascii')
+        if len(self.keys) > self.MAX_KEYS_SHOWN:
+            keys += ' (+{} keys)'.format(len(self.keys) - self.MAX_KEYS_SHOWN)
+        return 'client={} command={} keys=[{}] nodes={} request_bytes={} response_bytes={} queue_wait={:.6f} round_trip={:.6f} total={:.6f}'.format(
+            self.client, self.command, keys, ','.join(node_name(node) for node in self.nodes), self.request_bytes,
+            self.response_bytes, self.queue_wait, self.round_trip, self.total)
+
+
+class RequestTracer(object):
+    '''
+    Keeps the traces of a sample of the requests in a ring buffer, and logs the ones taking longer than the
+    slow threshold. Requests neither sampled nor timed for the slow log get no trace at all, and the handlers
+    skip all the bookkeeping for them.
+    '''
+
+    DEFAULT_SAMPLE_RATE = 0.01
+    DEFAULT_BUFFER_SIZE = 1000
+
+    def __init__(self, sample_rate=DEFAULT_SAMPLE_RATE, buffer_size=DEFAULT_BUFFER_SIZE, slow_threshold=None,
+                 output=sys.stderr, clock=time.time, sample=random.random):
+        self.sample_rate = sample_rate
+        self.slow_threshold = slow_threshold
+        self.output = output
+        self.clock = clock
+        self.sample = sample
+        self.records = deque(maxlen=buffer_size)
+
+    def start(self, command, keys, request_bytes):
+        '''
+        Starts the trace of a request, or returns None when it's not to be traced.
+        '''
+        sampled = bool(self.sample_rate) and self.sample() < self.sample_rate
+        if not sampled and self.slow_threshold is None:
+            return None
+        return Trace(self.clock(), sampled, command, keys, request_bytes)
+
+    def finish(self, trace, client_stream):
+        trace.total = self.clock() - trace.started
+        is_slow = self.slow_threshold is not None and trace.total >= self.slow_threshold
+        if not trace.sampled and not is_slow:
+            return
+        trace.client = self._client_address(client_stream)
+        if trace.sampled:
+            self.records.append(trace)
+        if is_slow:
+            self.output.write('Slow request: {}\n'.format(trace.describe()))
+            self.output.flush()
+
+    def _client_address(self, client_stream):
+        try:
+            address = client_stream.socket.getpeername()
+        except (AttributeError, socket.error):
+            return None
+        return node_name(address) if isinstance(address, tuple) else (address or 'unix')
+
+    def dump(self, output):
+        '''
+        Writes the buffered traces, oldest first.
+        '''
+        for trace in list(self.records):
+            output.write('Trace: {}\n'.format(trace.describe()))
+        output.flush()
@@ -0,0 +1,82 @@
+from collections import deque
+from weakref import WeakKeyDictionary
+
+
+class WriteBehind(object):
+    '''
+    Acknowledges the writes nobody waits a response for, like text "noreply" ones, as soon as they're handed
+    to their backend stream, instead of once flushed; They still get joined with the other writes of the
+    same loop iteration by the stream, and keep their order with them. Each backend may have up to
+    "max_pending" bytes of them unflushed, above which the next ones get dropped, or wait for room with the
+    "block" policy.
+    '''
+
+    DROP = 'drop'
+    BLOCK = 'block'
+    POLICIES = (DROP, BLOCK)
+
+    def __init__(self, max_pending, policy=DROP):
+        self.max_pending = max_pending
+        self.policy = policy
+        self.pending = WeakKeyDictionary()
+        self.blocked = WeakKeyDictionary()
+        self.dropped = 0
+        self.flushed_waiters = []
+
+    def write(self, backend_stream, byte_quantity, send, callback):
+        '''
+        Sends a write with "send", which calls back once it's flushed, calling back with whether it was
+        taken: Right away, unless the backend is full and the policy blocks, in which case once there's room.
+        '''
+        if not self.blocked.get(backend_stream) and self._fits(backend_stream, byte_quantity):
+            self._send(backend_stream, byte_quantity, send)
+            callback(True)
+        elif self.policy == self.BLOCK:
+            self.blocked.setdefault(backend_stream, deque()).append((byte_quantity, send, callback))
+        else:
+            self.dropped += 1
+            callback(False)
+
+    def pending_bytes(self, backend_stream):
+        return self.pending.get(backend_stream, 0)
+
+    def is_flushed(self):
+        return not any(self.pending.values()) and not any(self.blocked.values())
+
+    def wait_flushed(self, callback):
+        '''
+        Calls back once the writes taken so far, and the ones blocked, are flushed to every backend.
+        '''
+        if self.is_flushed():
+            callback()
+        else:
+            self.flushed_waiters.append(callback)
+
+    def dump(self, output):
+        '''
+        Writes the count of writes dropped, along with the bytes pending and the writes blocked.
+        '''
+        output.write('Write behind: dropped={} pending_bytes={} blocked={}\n'.format(
+            self.dropped, sum(self.pending.values()), sum(len(blocked) for blocked in self.blocked.values())))
+        output.flush()
+
+    def _fits(self, backend_stream, byte_quantity):
+        pending = self.pending_bytes(backend_stream)
+        # A write bigger than the limit still gets through once nothing else is pending.
+        return pending == 0 or pending + byte_quantity <= self.max_pending
+
+    def _send(self, backend_stream, byte_quantity, send):
+        self.pending[backend_stream] = self.pending_bytes(backend_stream) + byte_quantity
+        send(lambda *args: self._flushed(backend_stream, byte_quantity))
+
+    def _flushed(self, backend_stream, byte_quantity):
+        self.pending[backend_stream] -= byte_quantity
+        blocked = self.blocked.get(backend_stream)
+        while blocked and self._fits(backend_stream, blocked[0][0]):
+            byte_quantity, send, callback = blocked.popleft()
+            self._send(backend_stream, byte_quantity, send)
+            callback(True)
+        if self.flushed_waiters and self.is_flushed():
+            waiters, self.flushed_waiters = self.flushed_waiters, []
+            for callback in waiters:
+                callback()
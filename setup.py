@@ -15,7 +15,7 @@ A Memcached sharding and failover proxy""",
       author_email='contato@diogobaeder.com.br',
       url='https://github.com/diogobaeder/memcrashed',
       license='BSD 2-Clause',
-      packages=find_packages(exclude=['ez_setup', 'examples', 'tests']),
+      packages=find_packages(exclude=['ez_setup', 'examples', 'tests', 'benchmarks']),
       include_package_data=True,
       zip_safe=False,
       install_requires=[
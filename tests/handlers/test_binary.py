@@ -1,13 +1,32 @@
 import binascii
+from itertools import groupby
+from struct import error as StructError, pack
 from unittest import skipUnless
+import zlib
 
-from mock import MagicMock
+from mock import MagicMock, patch
 from nose.tools import istest
 from tornado import iostream
 
+from memcrashed import profiling
+from memcrashed.analytics import KeySpaceAnalytics
+from memcrashed.chunking import ValueChunker
+from memcrashed.compression import ValueCompressor
 from memcrashed.handlers.binary import BinaryProtocolHandler
-from memcrashed.proxy import ProxyRepository
-from ..utils import pylibmc, PYLIBMC_EXISTS, PYLIBMC_SKIP_REASON, server_running, ServerTestCase
+from memcrashed.hedging import ReadHedging
+from memcrashed.leases import KeyLeases
+from memcrashed.limits import BackendLimits
+from memcrashed.migration import KeyMigration
+from memcrashed.negative_cache import NegativeCache
+from memcrashed.proxy import ProxyRepository, ShadowPool
+from memcrashed.quotas import TenantQuotas
+from memcrashed.sasl import SaslAuthenticator
+from memcrashed.selection import BackendSelector
+from memcrashed.tracing import RequestTracer
+from memcrashed.write_behind import WriteBehind
+from ..utils import (
+    pylibmc, PYLIBMC_EXISTS, PYLIBMC_SKIP_REASON, server_running, ServerTestCase, HeldStream, ScriptedStream,
+    SynchronousExecutor, UnflushedStream, immediate_io_loop)
 
 
 class BinaryProtocolHandlerTest(ServerTestCase):
@@ -153,6 +172,143 @@ class BinaryProtocolHandlerTest(ServerTestCase):
         protocol.process(client_stream, backend_stream, finish_test)
         self.wait(timeout=1)
 
+    @istest
+    @patch('memcrashed.profiling.enter')
+    def enters_the_stages_of_a_round_trip(self, enter):
+        protocol = BinaryProtocolHandler('some ioloop')
+
+        overall_calls = []
+        client_stream = MockStream(overall_calls, 'client_stream')
+        backend_stream = MockStream(overall_calls, 'backend_stream')
+        client_stream.mock_stream.read_bytes.return_value = binascii.unhexlify(b'800a00000000000000000000000000000000000000000000')
+        backend_stream.mock_stream.read_bytes.return_value = binascii.unhexlify(b'810a00000000000000000000000000000000000000000000')
+
+        protocol.process(client_stream, backend_stream, self.stop)
+        self.wait(timeout=1)
+
+        stages = [stage for stage, calls in groupby(call[0][0] for call in enter.call_args_list)]
+        self.assertEqual(stages, [
+            profiling.PARSE, profiling.ROUTE, profiling.BACKEND_WRITE, profiling.ROUTE, profiling.BACKEND_WRITE,
+            profiling.BACKEND_READ, profiling.CLIENT_WRITE])
+
+    @istest
+    def answers_busy_when_backend_queue_times_out(self):
+        protocol = BinaryProtocolHandler('some ioloop')
+        protocol.limits = MagicMock()
+        limiter = protocol.limits.limiter_for.return_value
+        protocol.limits.wait_writable.side_effect = lambda callback: callback()
+        limiter.acquire.side_effect = lambda callback: callback(False)
+
+        overall_calls = []
+        client_stream = MockStream(overall_calls, 'client_stream')
+        backend_stream = MockStream(overall_calls, 'backend_stream')
+        client_request_hex = b'800a00000000000000000000000000070000000000000000'
+        client_stream.mock_stream.read_bytes.return_value = binascii.unhexlify(client_request_hex)
+        busy_response_hex = b'810a0000000000850000000c000000070000000000000000' + binascii.hexlify(b'Backend busy')
+
+        expected_overall_calls = [
+            (client_stream, 'read_bytes', client_request_hex),
+            (client_stream, 'write', busy_response_hex),
+        ]
+
+        def finish_test():
+            try:
+                self.assertEqual(overall_calls, expected_overall_calls)
+                self.assertFalse(limiter.release.called)
+            finally:
+                self.stop()
+
+        protocol.process(client_stream, backend_stream, finish_test)
+        self.wait(timeout=1)
+
+    @istest
+    def releases_the_backend_slot_after_forwarding(self):
+        protocol = BinaryProtocolHandler('some ioloop')
+        protocol.limits = MagicMock()
+        limiter = protocol.limits.limiter_for.return_value
+        protocol.limits.wait_writable.side_effect = lambda callback: callback()
+        limiter.acquire.side_effect = lambda callback: callback(True)
+
+        overall_calls = []
+        client_stream = MockStream(overall_calls, 'client_stream')
+        backend_stream = MockStream(overall_calls, 'backend_stream')
+        client_stream.mock_stream.read_bytes.return_value = binascii.unhexlify(b'800a00000000000000000000000000000000000000000000')
+        backend_stream.mock_stream.read_bytes.return_value = binascii.unhexlify(b'810a00000000000000000000000000000000000000000000')
+
+        def finish_test():
+            try:
+                protocol.limits.limiter_for.assert_called_with(protocol.pool_repository.default_node)
+                limiter.wrote.assert_called_with(24)
+                limiter.flushed.assert_called_with(24)
+                limiter.release.assert_called_with()
+                self.assertEqual(len(overall_calls), 4)
+            finally:
+                self.stop()
+
+        protocol.process(client_stream, backend_stream, finish_test)
+        self.wait(timeout=1)
+
+    @istest
+    def compresses_stored_values(self):
+        protocol = BinaryProtocolHandler('some ioloop')
+        protocol.compressor = ValueCompressor(immediate_io_loop(), threshold=10, executor=SynchronousExecutor())
+
+        overall_calls = []
+        client_stream = MockStream(overall_calls, 'client_stream')
+        backend_stream = MockStream(overall_calls, 'backend_stream')
+        value = b'bar' * 100
+        compressed = zlib.compress(value, ValueCompressor.DEFAULT_LEVEL)
+        client_stream.mock_stream.read_bytes.side_effect = [
+            pack('! B B H B B H I I Q', 0x80, 0x01, 3, 8, 0, 0, 8 + 3 + len(value), 0, 0),
+            pack('! I I', 1, 0) + b'foo' + value,
+        ]
+        backend_stream.mock_stream.read_bytes.return_value = binascii.unhexlify(b'810100000000000000000000000000000000000000000001')
+
+        expected_request = (
+            pack('! B B H B B H I I Q', 0x80, 0x01, 3, 8, 0, 0, 8 + 3 + len(compressed), 0, 0) +
+            pack('! I I', 1 | ValueCompressor.DEFAULT_FLAG, 0) + b'foo' + compressed)
+
+        def finish_test():
+            try:
+                self.assertIn((backend_stream, 'write', binascii.hexlify(expected_request)), overall_calls)
+            finally:
+                self.stop()
+
+        protocol.process(client_stream, backend_stream, finish_test)
+        self.wait(timeout=1)
+
+    @istest
+    def decompresses_retrieved_values(self):
+        protocol = BinaryProtocolHandler('some ioloop')
+        protocol.compressor = ValueCompressor(immediate_io_loop(), threshold=10, executor=SynchronousExecutor())
+
+        overall_calls = []
+        client_stream = MockStream(overall_calls, 'client_stream')
+        backend_stream = MockStream(overall_calls, 'backend_stream')
+        value = b'bar' * 100
+        compressed = zlib.compress(value)
+        client_stream.mock_stream.read_bytes.side_effect = [
+            pack('! B B H B B H I I Q', 0x80, 0x00, 3, 0, 0, 0, 3, 0, 0),
+            b'foo',
+        ]
+        backend_stream.mock_stream.read_bytes.side_effect = [
+            pack('! B B H B B H I I Q', 0x81, 0x00, 0, 4, 0, 0, 4 + len(compressed), 0, 1),
+            pack('! I', 1 | ValueCompressor.DEFAULT_FLAG) + compressed,
+        ]
+
+        expected_response = (
+            pack('! B B H B B H I I Q', 0x81, 0x00, 0, 4, 0, 0, 4 + len(value), 0, 1) +
+            pack('! I', 1) + value)
+
+        def finish_test():
+            try:
+                self.assertEqual(overall_calls[-1], (client_stream, 'write', binascii.hexlify(expected_response)))
+            finally:
+                self.stop()
+
+        protocol.process(client_stream, backend_stream, finish_test)
+        self.wait(timeout=1)
+
     @istest
     def starts_with_pool_repository(self):
         handler = BinaryProtocolHandler(self.io_loop)
@@ -160,6 +316,815 @@ class BinaryProtocolHandlerTest(ServerTestCase):
         self.assertIsInstance(handler.pool_repository, ProxyRepository)
 
 
+class BinaryChunkingTest(ServerTestCase):
+    def setUp(self):
+        super(BinaryChunkingTest, self).setUp()
+        self.handler = BinaryProtocolHandler(self.io_loop)
+        self.handler.chunker = ValueChunker(MagicMock(ProxyRepository), threshold=10)
+
+    @istest
+    def stores_a_manifest_for_large_values(self):
+        self.handler.chunker.store = lambda exptime, value, callback: callback(b'token 2 20')
+        self.handler.chunker.discard_previous = MagicMock(side_effect=lambda key, callback: callback())
+        body_bytes = pack('! I I', 1, 60) + b'foo' + b'x' * 20
+        header_bytes = self.handler.parser.pack_request_header(0x01, key_length=3, extra_length=8, total_body_length=len(body_bytes))
+        headers = self.handler.parser.unpack_request_header(header_bytes)
+
+        self.handler._convert_value(headers, body_bytes, self.stop)
+        header_bytes, body_bytes = self.wait()
+
+        self.assertEqual(body_bytes, pack('! I I', 1 | ValueChunker.DEFAULT_FLAG, 60) + b'foo' + b'token 2 20')
+        self.assertEqual(self.handler.parser.unpack_request_header(header_bytes).total_body_length, len(body_bytes))
+        self.assertEqual(self.handler.chunker.discard_previous.call_args[0][0], b'foo')
+
+    @istest
+    def refuses_appends_and_prepends(self):
+        parser = self.handler.parser
+        client_stream = ScriptedStream(
+            parser.pack_request_header(0x19, opaque=1, key_length=3, total_body_length=4) + b'foox' +
+            parser.pack_request_header(0x0f, opaque=2, key_length=3, total_body_length=4) + b'barx')
+        backend_stream = ScriptedStream()
+
+        self.handler.process(client_stream, backend_stream, self.stop)
+        self.wait()
+
+        self.assertEqual(backend_stream.written, [])
+        self.assertEqual(client_stream.written, [
+            parser.pack_response_header(0x19, 0x83, opaque=1, total_body_length=13) + b'Not supported' +
+            parser.pack_response_header(0x0f, 0x83, opaque=2, total_body_length=13) + b'Not supported'])
+
+    @istest
+    def forwards_the_rest_of_a_batch_with_appends(self):
+        parser = self.handler.parser
+        client_stream = ScriptedStream(
+            parser.pack_request_header(0x19, opaque=1, key_length=3, total_body_length=4) + b'foox' +
+            parser.pack_request_header(0x0a, opaque=2))
+        backend_stream = ScriptedStream(parser.pack_response_header(0x0a, 0, opaque=2))
+
+        self.handler.process(client_stream, backend_stream, self.stop)
+        self.wait()
+
+        self.assertEqual(backend_stream.written, [parser.pack_request_header(0x0a, opaque=2)])
+        self.assertEqual(client_stream.written, [
+            parser.pack_response_header(0x19, 0x83, opaque=1, total_body_length=13) + b'Not supported',
+            parser.pack_response_header(0x0a, 0, opaque=2)])
+
+    @istest
+    def answers_not_found_when_chunks_are_gone(self):
+        self.handler.chunker.fetch = lambda manifest, callback: callback(None)
+        body_bytes = pack('! I', ValueChunker.DEFAULT_FLAG) + b'token 2 20'
+        header_bytes = self.handler.parser.pack_response_header(0x00, 0, opaque=7, extra_length=4, total_body_length=len(body_bytes))
+        headers = self.handler.parser.unpack_response_header(header_bytes)
+
+        self.handler._convert_value(headers, body_bytes, self.stop)
+        header_bytes, body_bytes = self.wait()
+
+        headers = self.handler.parser.unpack_response_header(header_bytes)
+        self.assertEqual(headers.status, BinaryProtocolHandler.NOT_FOUND_STATUS)
+        self.assertEqual(headers.opaque, 7)
+        self.assertEqual(body_bytes, BinaryProtocolHandler.NOT_FOUND_MESSAGE)
+
+    @istest
+    def fetches_the_chunks_once_the_backend_round_trip_is_over(self):
+        selector = self.handler.pool_repository.selector
+        body_bytes = pack('! I', ValueChunker.DEFAULT_FLAG) + b'token 2 20'
+        backend_stream = ScriptedStream(
+            self.handler.parser.pack_response_header(0x00, 0, extra_length=4, total_body_length=len(body_bytes)) + body_bytes)
+        client_stream = ScriptedStream(self.handler.parser.pack_request_header(0x00, key_length=3, total_body_length=3) + b'foo')
+        fetched = []
+
+        def fetch(manifest, callback):
+            fetched.append((len(self.handler.pipelines[backend_stream].turns), sum(selector.in_flight.values())))
+            callback(b'x' * 20)
+
+        self.handler.chunker.fetch = fetch
+        self.handler.process(client_stream, backend_stream, self.stop)
+        self.wait()
+
+        self.assertEqual(fetched, [(0, 0)])
+        self.assertEqual(client_stream.written, [
+            self.handler.parser.pack_response_header(0x00, 0, extra_length=4, total_body_length=24) + pack('! I', 0) + b'x' * 20])
+
+
+class BinaryMessagesTestCase(ServerTestCase):
+    def setUp(self):
+        super(BinaryMessagesTestCase, self).setUp()
+        self.handler = BinaryProtocolHandler(self.io_loop)
+        self.parser = self.handler.parser
+
+    def request(self, opcode, key=b'', opaque=0, extras=b'', value=b''):
+        body_bytes = extras + key + value
+        return self.parser.pack_request_header(
+            opcode, opaque=opaque, key_length=len(key), extra_length=len(extras), total_body_length=len(body_bytes)) + body_bytes
+
+    def response(self, opcode, status=0, key=b'', opaque=0, extras=b'', value=b''):
+        body_bytes = extras + key + value
+        return self.parser.pack_response_header(
+            opcode, status, opaque=opaque, key_length=len(key), extra_length=len(extras), total_body_length=len(body_bytes)) + body_bytes
+
+
+class BinaryTracingTest(BinaryMessagesTestCase):
+    def setUp(self):
+        super(BinaryTracingTest, self).setUp()
+        self.handler.tracer = RequestTracer(sample_rate=1, output=MagicMock())
+
+    @istest
+    def traces_requests(self):
+        request = self.request(0x0d, b'foo', opaque=1) + self.request(0x0a, opaque=2)
+        response = self.response(0x0d, key=b'foo', opaque=1, extras=pack('! I', 0), value=b'x') + self.response(0x0a, opaque=2)
+        client_stream = ScriptedStream(request)
+        backend_stream = ScriptedStream(response)
+
+        self.handler.process(client_stream, backend_stream, self.stop)
+        self.wait()
+
+        trace, = self.handler.tracer.records
+        self.assertEqual(trace.command, '0x0a,0x0d')
+        self.assertEqual(trace.keys, [b'foo'])
+        self.assertEqual(trace.nodes, [self.handler.pool_repository.default_node])
+        self.assertEqual(trace.request_bytes, len(request))
+        self.assertEqual(trace.response_bytes, len(response))
+        self.assertEqual(self.handler.traces, {})
+
+
+class BinaryNegativeCacheTest(BinaryMessagesTestCase):
+    def setUp(self):
+        super(BinaryNegativeCacheTest, self).setUp()
+        self.handler.negative_cache = NegativeCache(ttl=60, size=4096)
+
+    @istest
+    def remembers_quiet_misses(self):
+        client_stream = ScriptedStream(
+            self.request(0x0d, b'foo', opaque=1) + self.request(0x0d, b'bar', opaque=2) + self.request(0x0a, opaque=3))
+        backend_stream = ScriptedStream(
+            self.response(0x0d, key=b'foo', opaque=1, extras=pack('! I', 0), value=b'x') + self.response(0x0a, opaque=3))
+
+        self.handler.process(client_stream, backend_stream, self.stop)
+        self.wait()
+
+        self.assertTrue(self.handler.negative_cache.contains(b'bar'))
+        self.assertFalse(self.handler.negative_cache.contains(b'foo'))
+
+    @istest
+    def remembers_misses_answered_as_not_found(self):
+        client_stream = ScriptedStream(self.request(0x00, b'bar', opaque=5))
+        backend_stream = ScriptedStream(self.response(0x00, status=0x01, opaque=5, value=b'Not found'))
+
+        self.handler.process(client_stream, backend_stream, self.stop)
+        self.wait()
+
+        self.assertTrue(self.handler.negative_cache.contains(b'bar'))
+
+    @istest
+    def leaves_known_quiet_misses_out_of_requests(self):
+        self.handler.negative_cache.add_misses([b'bar'], self.handler.negative_cache.versions([b'bar']))
+        client_stream = ScriptedStream(
+            self.request(0x0d, b'foo', opaque=1) + self.request(0x0d, b'bar', opaque=2) + self.request(0x0a, opaque=3))
+        backend_stream = ScriptedStream(self.response(0x0a, opaque=3))
+
+        self.handler.process(client_stream, backend_stream, self.stop)
+        self.wait()
+
+        self.assertEqual(backend_stream.written, [self.request(0x0d, b'foo', opaque=1) + self.request(0x0a, opaque=3)])
+
+    @istest
+    def answers_known_misses_without_the_backend(self):
+        self.handler.negative_cache.add_misses([b'bar'], self.handler.negative_cache.versions([b'bar']))
+        client_stream = ScriptedStream(self.request(0x00, b'bar', opaque=5))
+        backend_stream = ScriptedStream()
+
+        self.handler.process(client_stream, backend_stream, self.stop)
+        self.wait()
+
+        self.assertEqual(backend_stream.written, [])
+        headers = self.parser.unpack_response_header(client_stream.written[0][:24])
+        self.assertEqual(headers.status, BinaryProtocolHandler.NOT_FOUND_STATUS)
+        self.assertEqual(headers.opaque, 5)
+
+    @istest
+    def answers_noop_when_every_quiet_retrieval_is_known_to_miss(self):
+        self.handler.negative_cache.add_misses([b'bar'], self.handler.negative_cache.versions([b'bar']))
+        client_stream = ScriptedStream(self.request(0x0d, b'bar', opaque=2) + self.request(0x0a, opaque=3))
+        backend_stream = ScriptedStream()
+
+        self.handler.process(client_stream, backend_stream, self.stop)
+        self.wait()
+
+        self.assertEqual(backend_stream.written, [])
+        self.assertEqual(client_stream.written, [self.response(0x0a, opaque=3)])
+
+    @istest
+    def forgets_keys_written_through_the_proxy(self):
+        self.handler.negative_cache.add_misses([b'bar'], self.handler.negative_cache.versions([b'bar']))
+        client_stream = ScriptedStream(self.request(0x01, b'bar', extras=pack('! I I', 0, 0), value=b'x'))
+        backend_stream = ScriptedStream(self.response(0x01))
+
+        self.handler.process(client_stream, backend_stream, self.stop)
+        self.wait()
+
+        self.assertFalse(self.handler.negative_cache.contains(b'bar'))
+
+
+class BinaryMirroringTest(BinaryMessagesTestCase):
+    def setUp(self):
+        super(BinaryMirroringTest, self).setUp()
+        self.handler.shadow = MagicMock(ShadowPool)
+
+    @istest
+    def mirrors_keyed_writes(self):
+        set_request = self.request(0x11, b'foo', extras=pack('! I I', 0, 0), value=b'x')
+        client_stream = ScriptedStream(set_request + self.request(0x0a))
+        backend_stream = ScriptedStream(self.response(0x0a))
+
+        self.handler.process(client_stream, backend_stream, self.stop)
+        self.wait()
+
+        self.handler.shadow.mirror.assert_called_once_with(b'foo', set_request)
+
+    @istest
+    def mirrors_sampled_reads(self):
+        self.handler.shadow.samples_read.return_value = True
+        get_request = self.request(0x00, b'foo')
+        client_stream = ScriptedStream(get_request)
+        backend_stream = ScriptedStream(self.response(0x00, status=0x01))
+
+        self.handler.process(client_stream, backend_stream, self.stop)
+        self.wait()
+
+        self.handler.shadow.mirror.assert_called_once_with(b'foo', get_request)
+
+    @istest
+    def skips_reads_not_sampled(self):
+        self.handler.shadow.samples_read.return_value = False
+        client_stream = ScriptedStream(self.request(0x0d, b'foo') + self.request(0x0d, b'bar') + self.request(0x0a))
+        backend_stream = ScriptedStream(self.response(0x0a))
+
+        self.handler.process(client_stream, backend_stream, self.stop)
+        self.wait()
+
+        self.assertFalse(self.handler.shadow.mirror.called)
+        self.assertEqual(self.handler.shadow.samples_read.call_count, 1)
+
+
+class BinaryMigrationTest(BinaryMessagesTestCase):
+    def setUp(self):
+        super(BinaryMigrationTest, self).setUp()
+        self.migration = MagicMock(KeyMigration)
+        self.migration.fetch.side_effect = lambda keys, callback: callback(
+            dict((key, (2, b'old')) for key in keys if key == b'bar'))
+        self.handler.pool_repository = MagicMock(ProxyRepository)
+        self.handler.pool_repository.is_sharded.return_value = False
+        self.handler.pool_repository.is_migrating.return_value = True
+        self.handler.pool_repository.is_replicated.return_value = False
+        self.handler.pool_repository.selector = BackendSelector()
+        self.handler.pool_repository.migration = self.migration
+
+    @istest
+    def replaces_not_found_with_values_from_previous_owners(self):
+        client_stream = ScriptedStream(self.request(0x0c, b'bar', opaque=5))
+        backend_stream = ScriptedStream(self.response(0x0c, status=0x01, opaque=5, value=b'Not found'))
+
+        self.handler.process(client_stream, backend_stream, self.stop)
+        self.wait()
+
+        self.assertEqual(client_stream.written, [self.response(0x0c, key=b'bar', opaque=5, extras=pack('! I', 2), value=b'old')])
+
+    @istest
+    def adds_quiet_values_before_the_final_response(self):
+        client_stream = ScriptedStream(
+            self.request(0x09, b'foo', opaque=1) + self.request(0x09, b'bar', opaque=2) + self.request(0x0a, opaque=3))
+        backend_stream = ScriptedStream(
+            self.response(0x09, opaque=1, extras=pack('! I', 0), value=b'x') + self.response(0x0a, opaque=3))
+
+        self.handler.process(client_stream, backend_stream, self.stop)
+        self.wait()
+
+        self.assertEqual(self.migration.fetch.call_args[0][0], [b'bar'])
+        self.assertEqual(client_stream.written, [
+            self.response(0x09, opaque=1, extras=pack('! I', 0), value=b'x') +
+            self.response(0x09, opaque=2, extras=pack('! I', 2), value=b'old') +
+            self.response(0x0a, opaque=3)
+        ])
+
+    @istest
+    def forgets_previous_copies_of_written_keys(self):
+        client_stream = ScriptedStream(self.request(0x04, b'bar'))
+        backend_stream = ScriptedStream(self.response(0x04))
+
+        self.handler.process(client_stream, backend_stream, self.stop)
+        self.wait()
+
+        self.migration.forget.assert_called_with(b'bar')
+
+
+class BinaryLeasesTest(BinaryMessagesTestCase):
+    def setUp(self):
+        super(BinaryLeasesTest, self).setUp()
+        self.handler.leases = MagicMock(KeyLeases)
+        self.handler.leases.is_hot.return_value = False
+        self.handler.leases.fill.side_effect = lambda repository, client, keys, callback: callback(
+            dict((key, (2, b'stale')) for key in keys if key == b'bar'))
+
+    @istest
+    def replaces_not_found_with_the_values_the_leases_come_up_with(self):
+        client_stream = ScriptedStream(self.request(0x0c, b'bar', opaque=5))
+        backend_stream = ScriptedStream(self.response(0x0c, status=0x01, opaque=5, value=b'Not found'))
+
+        self.handler.process(client_stream, backend_stream, self.stop)
+        self.wait()
+
+        fill_args = self.handler.leases.fill.call_args[0]
+        self.assertIs(fill_args[1], client_stream)
+        self.assertEqual(fill_args[2], [b'bar'])
+        self.assertEqual(client_stream.written, [self.response(0x0c, key=b'bar', opaque=5, extras=pack('! I', 2), value=b'stale')])
+
+    @istest
+    def gives_the_backend_slot_back_before_filling_the_leases(self):
+        self.handler.limits = BackendLimits(self.io_loop, max_in_flight=1)
+        client_stream = ScriptedStream(self.request(0x0c, b'bar', opaque=5))
+        backend_stream = ScriptedStream(self.response(0x0c, status=0x01, opaque=5, value=b'Not found'))
+        limiter = self.handler.limits.limiter_for(self.handler.pool_repository.default_node)
+        in_flight = []
+
+        def fill(repository, client, keys, callback):
+            in_flight.append((limiter.in_flight, sum(self.handler.pool_repository.selector.in_flight.values())))
+            callback({})
+
+        self.handler.leases.fill.side_effect = fill
+
+        self.handler.process(client_stream, backend_stream, self.stop)
+        self.wait()
+
+        self.assertEqual(in_flight, [(0, 0)])
+
+    @istest
+    def remembers_the_values_of_hot_keys(self):
+        self.handler.leases.is_hot.return_value = True
+        client_stream = ScriptedStream(
+            self.request(0x09, b'foo', opaque=1) + self.request(0x09, b'baz', opaque=2) + self.request(0x0a, opaque=3))
+        backend_stream = ScriptedStream(
+            self.response(0x09, opaque=1, extras=pack('! I', 3), value=b'x') + self.response(0x0a, opaque=3))
+
+        self.handler.process(client_stream, backend_stream, self.stop)
+        self.wait()
+
+        self.handler.leases.remember.assert_called_once_with(b'foo', 3, b'x')
+        self.assertEqual(self.handler.leases.fill.call_args[0][2], [b'baz'])
+
+    @istest
+    def releases_written_keys(self):
+        client_stream = ScriptedStream(self.request(0x04, b'bar'))
+        backend_stream = ScriptedStream(self.response(0x04))
+
+        self.handler.process(client_stream, backend_stream, self.stop)
+        self.wait()
+
+        self.handler.leases.release.assert_called_with(b'bar')
+        self.assertFalse(self.handler.leases.fill.called)
+
+
+class BinaryPipeliningTest(BinaryMessagesTestCase):
+    @istest
+    def relays_to_each_client_sharing_the_backend_its_own_response(self):
+        backend_stream = HeldStream(
+            self.response(0x0c, key=b'foo', opaque=1, extras=pack('! I', 0), value=b'x') + self.response(0x01, opaque=1))
+        first_client = ScriptedStream(self.request(0x0c, b'foo', opaque=1))
+        second_client = ScriptedStream(self.request(0x01, b'bar', opaque=1, extras=pack('! I I', 0, 0), value=b'y'))
+
+        self.handler.process(first_client, backend_stream, MagicMock())
+        self.handler.process(second_client, backend_stream, MagicMock())
+        backend_stream.release()
+
+        self.assertEqual(first_client.written, [self.response(0x0c, key=b'foo', opaque=1, extras=pack('! I', 0), value=b'x')])
+        self.assertEqual(second_client.written, [self.response(0x01, opaque=1)])
+
+    @istest
+    def skips_timing_the_round_trips_without_replicas(self):
+        backend_stream = ScriptedStream(self.response(0x0c, key=b'foo', opaque=1, extras=pack('! I', 0), value=b'x'))
+        client_stream = ScriptedStream(self.request(0x0c, b'foo', opaque=1))
+
+        self.handler.process(client_stream, backend_stream, self.stop)
+        self.wait()
+
+        self.assertEqual(client_stream.written, [self.response(0x0c, key=b'foo', opaque=1, extras=pack('! I', 0), value=b'x')])
+        self.assertEqual(self.handler.pool_repository.selector.latencies, {})
+
+    @istest
+    def relays_responses_out_of_order_when_rewriting_opaques(self):
+        self.handler.opaque_rewriting = True
+        backend_stream = HeldStream(
+            self.response(0x01, opaque=2) + self.response(0x0c, key=b'foo', opaque=1, extras=pack('! I', 0), value=b'x'))
+        first_client = ScriptedStream(self.request(0x0c, b'foo', opaque=1))
+        second_client = ScriptedStream(self.request(0x01, b'bar', opaque=1, extras=pack('! I I', 0, 0), value=b'y'))
+
+        self.handler.process(first_client, backend_stream, MagicMock())
+        self.handler.process(second_client, backend_stream, MagicMock())
+        backend_stream.release()
+
+        self.assertEqual(backend_stream.written, [
+            self.request(0x0c, b'foo', opaque=1),
+            self.request(0x01, b'bar', opaque=2, extras=pack('! I I', 0, 0), value=b'y'),
+        ])
+        self.assertEqual(first_client.written, [self.response(0x0c, key=b'foo', opaque=1, extras=pack('! I', 0), value=b'x')])
+        self.assertEqual(second_client.written, [self.response(0x01, opaque=1)])
+
+    @istest
+    def finishes_the_turn_of_a_response_failing_to_be_read(self):
+        backend_stream = ScriptedStream(self.response(0x0c, key=b'foo', opaque=1)[:10])
+        client_stream = ScriptedStream(self.request(0x0c, b'foo', opaque=1))
+
+        self.assertRaises(StructError, self.handler.process, client_stream, backend_stream, MagicMock())
+
+        self.assertEqual(len(self.handler.pipelines[backend_stream].turns), 0)
+
+
+class BinaryQuotasTest(BinaryMessagesTestCase):
+    def setUp(self):
+        super(BinaryQuotasTest, self).setUp()
+        self.handler.quotas = MagicMock(TenantQuotas)
+        self.handler.quotas.tenant.return_value = 'tenant'
+        self.handler.quotas.allow.return_value = True
+
+    @istest
+    def charges_requests_and_responses_to_the_tenant(self):
+        request_bytes = self.request(0x09, b'foo', opaque=1) + self.request(0x09, b'bar', opaque=2) + self.request(0x0a, opaque=3)
+        response_bytes = self.response(0x09, opaque=1, extras=pack('! I', 0), value=b'x') + self.response(0x0a, opaque=3)
+        client_stream = ScriptedStream(request_bytes)
+        backend_stream = ScriptedStream(response_bytes)
+
+        self.handler.process(client_stream, backend_stream, self.stop)
+        self.wait()
+
+        self.handler.quotas.tenant.assert_called_with(client_stream, b'foo')
+        self.handler.quotas.allow.assert_called_with('tenant', 2, len(request_bytes))
+        self.handler.quotas.charge.assert_called_with('tenant', len(response_bytes))
+
+    @istest
+    def answers_every_throttled_message_as_busy(self):
+        self.handler.quotas.allow.return_value = False
+        client_stream = ScriptedStream(self.request(0x11, b'foo', opaque=1) + self.request(0x0a, opaque=2))
+        backend_stream = ScriptedStream()
+
+        self.handler.process(client_stream, backend_stream, self.stop)
+        self.wait()
+
+        self.assertEqual(backend_stream.written, [])
+        self.assertEqual(client_stream.written, [
+            self.response(0x11, status=0x85, opaque=1, value=b'Rate limited') +
+            self.response(0x0a, status=0x85, opaque=2, value=b'Rate limited')
+        ])
+
+    @istest
+    def stores_no_chunks_for_throttled_sets(self):
+        self.handler.quotas.allow.return_value = False
+        self.handler.chunker = ValueChunker(MagicMock(ProxyRepository), threshold=10)
+        client_stream = ScriptedStream(self.request(0x01, b'foo', opaque=1, extras=pack('! I I', 0, 0), value=b'x' * 20))
+        backend_stream = ScriptedStream()
+
+        self.handler.process(client_stream, backend_stream, self.stop)
+        self.wait()
+
+        self.assertEqual(backend_stream.written, [])
+        self.assertFalse(self.handler.chunker.pool_repository.client_for_key.called)
+        self.assertEqual(client_stream.written, [self.response(0x01, status=0x85, opaque=1, value=b'Rate limited')])
+
+
+class BinaryWriteBehindTest(BinaryMessagesTestCase):
+    def setUp(self):
+        super(BinaryWriteBehindTest, self).setUp()
+        self.handler.write_behind = WriteBehind(1024)
+
+    def quiet_writes(self):
+        return (self.request(0x11, b'foo', opaque=1, extras=pack('! I I', 0, 0), value=b'x') +
+                self.request(0x14, b'bar', opaque=2))
+
+    @istest
+    def answers_batches_of_quiet_writes_before_they_are_flushed(self):
+        client_stream = ScriptedStream(self.quiet_writes() + self.request(0x0a, opaque=3))
+        backend_stream = UnflushedStream(self.response(0x14, status=0x01, opaque=2, value=b'Not found') + self.response(0x0a))
+
+        self.handler.process(client_stream, backend_stream, self.stop)
+        self.wait()
+
+        self.assertEqual(backend_stream.written, [self.quiet_writes() + self.request(0x0a)])
+        self.assertEqual(client_stream.written, [self.response(0x0a, opaque=3)])
+
+    @istest
+    def throws_away_the_failures_of_the_writes_behind(self):
+        client_stream = ScriptedStream(self.quiet_writes() + self.request(0x0a, opaque=3))
+        backend_stream = UnflushedStream(self.response(0x14, status=0x01, opaque=2, value=b'Not found') + self.response(0x0a))
+        self.handler.process(client_stream, backend_stream, self.stop)
+        self.wait()
+
+        backend_stream.flush()
+
+        self.assertEqual(backend_stream.incoming, b'')
+        self.assertEqual(client_stream.written, [self.response(0x0a, opaque=3)])
+        self.assertEqual(self.handler.write_behind.pending_bytes(backend_stream), 0)
+
+    @istest
+    def answers_dropped_writes_as_busy(self):
+        backend_stream = UnflushedStream()
+        self.handler.write_behind.pending[backend_stream] = 1024
+        client_stream = ScriptedStream(self.quiet_writes() + self.request(0x0a, opaque=3))
+
+        self.handler.process(client_stream, backend_stream, self.stop)
+        self.wait()
+
+        self.assertEqual(backend_stream.written, [])
+        self.assertEqual(client_stream.written, [
+            self.response(0x11, status=0x85, opaque=1, value=b'Backend busy') +
+            self.response(0x14, status=0x85, opaque=2, value=b'Backend busy') +
+            self.response(0x0a, opaque=3)
+        ])
+
+    @istest
+    def leaves_batches_with_reads_to_their_round_trips(self):
+        request_bytes = self.request(0x11, b'foo', opaque=1, extras=pack('! I I', 0, 0), value=b'x') + self.request(0x0d, b'bar', opaque=2) + self.request(0x0a, opaque=3)
+        client_stream = ScriptedStream(request_bytes)
+        backend_stream = ScriptedStream(self.response(0x0a, opaque=3))
+
+        self.handler.process(client_stream, backend_stream, self.stop)
+        self.wait()
+
+        self.assertEqual(backend_stream.written, [request_bytes])
+        self.assertEqual(client_stream.written, [self.response(0x0a, opaque=3)])
+        self.assertEqual(self.handler.write_behind.pending_bytes(backend_stream), 0)
+
+
+class BinaryAnalyticsTest(BinaryMessagesTestCase):
+    @istest
+    def records_the_keys_accessed_with_their_backend(self):
+        self.handler.analytics = MagicMock(KeySpaceAnalytics)
+        client_stream = ScriptedStream(self.request(0x0d, b'foo', opaque=1) + self.request(0x0d, b'bar', opaque=2) + self.request(0x0a, opaque=3))
+        backend_stream = ScriptedStream(self.response(0x0a, opaque=3))
+
+        self.handler.process(client_stream, backend_stream, self.stop)
+        self.wait()
+
+        self.handler.analytics.record.assert_called_with([b'foo', b'bar'], ('127.0.0.1', 11211))
+
+
+class BinaryShardedLimitsTest(BinaryMessagesTestCase):
+    nodes = [('10.0.0.1', 11211), ('10.0.0.2', 11211)]
+
+    def setUp(self):
+        super(BinaryShardedLimitsTest, self).setUp()
+        self.backend_streams = dict((node, ScriptedStream()) for node in self.nodes)
+        self.handler.pool_repository = ProxyRepository(self.io_loop, self.nodes)
+        self.handler.pool_repository.stream_for_node = lambda node: self.backend_streams[node]
+        self.handler.limits = BackendLimits(self.io_loop, max_in_flight=1, max_queue_wait=0.01)
+        self.busy_node, self.free_node = self.nodes
+        self.handler.limits.limiter_for(self.busy_node).in_flight = 1
+
+    def key_for_node(self, node):
+        ring = self.handler.pool_repository.ring
+        return next(key for key in (str(index).encode('ascii') for index in range(100)) if ring.node_for_key(key) == node)
+
+    @istest
+    def applies_the_node_limits_to_fanned_out_batches(self):
+        busy_key, free_key = self.key_for_node(self.busy_node), self.key_for_node(self.free_node)
+        client_stream = ScriptedStream(
+            self.request(0x0d, busy_key, opaque=1) + self.request(0x0d, free_key, opaque=2) + self.request(0x0a, opaque=3))
+        self.backend_streams[self.free_node].incoming = self.response(0x0a)
+
+        self.handler.process(client_stream, 'some backend', self.stop)
+        self.wait()
+
+        self.assertEqual(self.backend_streams[self.busy_node].written, [])
+        self.assertEqual(client_stream.written, [
+            self.response(0x0d, status=0x85, opaque=1, value=b'Backend busy') + self.response(0x0a, opaque=3)])
+        self.assertEqual(self.handler.limits.limiter_for(self.free_node).in_flight, 0)
+
+
+class BinaryReplicationTest(BinaryMessagesTestCase):
+    nodes = [('10.0.0.1', 11211), ('10.0.0.2', 11211)]
+
+    def setUp(self):
+        super(BinaryReplicationTest, self).setUp()
+        self.backend_streams = dict((node, ScriptedStream()) for node in self.nodes)
+        self.handler.pool_repository = ProxyRepository(self.io_loop, self.nodes, replicas=2)
+        self.handler.pool_repository.stream_for_node = lambda node: self.backend_streams[node]
+        self.handler.pool_repository.replicate = MagicMock()
+        self.owner = self.handler.pool_repository.ring.node_for_key(b'foo')
+        self.replica, = [node for node in self.nodes if node != self.owner]
+
+    @istest
+    def repeats_sets_on_the_replicas(self):
+        set_request = self.request(0x01, b'foo', extras=pack('! I I', 0, 0), value=b'x')
+        client_stream = ScriptedStream(set_request)
+        self.backend_streams[self.owner].incoming = self.response(0x01)
+
+        self.handler.process(client_stream, 'some backend', self.stop)
+        self.wait()
+
+        self.assertEqual(self.backend_streams[self.owner].written, [set_request])
+        self.handler.pool_repository.replicate.assert_called_with(b'foo', set_request)
+
+    @istest
+    def deletes_replica_copies_on_cas_updates(self):
+        set_request = self.parser.pack_request_header(0x01, key_length=3, extra_length=8, total_body_length=12, cas=7)
+        client_stream = ScriptedStream(set_request + pack('! I I', 0, 0) + b'foo' + b'x')
+        self.backend_streams[self.owner].incoming = self.response(0x01)
+
+        self.handler.process(client_stream, 'some backend', self.stop)
+        self.wait()
+
+        self.handler.pool_repository.replicate.assert_called_with(b'foo', self.request(0x14, b'foo'))
+
+    @istest
+    def reads_from_the_fastest_replica(self):
+        self.handler.pool_repository.selector.latencies = {self.owner: 0.5, self.replica: 0.001}
+        get_request = self.request(0x00, b'foo')
+        client_stream = ScriptedStream(get_request)
+        self.backend_streams[self.replica].incoming = self.response(0x00, extras=pack('! I', 0), value=b'x')
+
+        self.handler.process(client_stream, 'some backend', self.stop)
+        self.wait()
+
+        self.assertEqual(self.backend_streams[self.replica].written, [get_request])
+        self.assertEqual(self.backend_streams[self.owner].written, [])
+        self.assertEqual(self.handler.pool_repository.selector.in_flight[self.replica], 0)
+        self.assertIn(self.replica, self.handler.pool_repository.selector.latencies)
+
+    @istest
+    def reads_the_keys_missed_in_a_replica_from_their_owner(self):
+        self.handler.pool_repository.selector.latencies = {self.owner: 0.5, self.replica: 0.001}
+        client_stream = ScriptedStream(self.request(0x0c, b'foo', opaque=1))
+        self.backend_streams[self.replica].incoming = self.response(0x0c, status=0x01, opaque=1)
+        self.backend_streams[self.owner].incoming = (
+            self.response(0x0d, key=b'foo', extras=pack('! I', 3), value=b'1') + self.response(0x0a))
+
+        self.handler.process(client_stream, 'some backend', self.stop)
+        self.wait()
+
+        self.assertEqual(self.backend_streams[self.owner].written, [self.request(0x0d, b'foo') + self.request(0x0a)])
+        self.assertEqual(client_stream.written, [self.response(0x0c, key=b'foo', opaque=1, extras=pack('! I', 3), value=b'1')])
+
+    @istest
+    def stops_measuring_the_round_trip_before_answering_the_client(self):
+        selector = self.handler.pool_repository.selector
+        client_stream = ScriptedStream(self.request(0x00, b'foo'))
+        in_flight = []
+
+        def write(data, callback=None):
+            in_flight.append(sum(selector.in_flight.values()))
+            callback()
+
+        client_stream.write = write
+        for stream in self.backend_streams.values():
+            stream.incoming = self.response(0x00, status=0x01)
+
+        self.handler.process(client_stream, 'some backend', self.stop)
+        self.wait()
+
+        self.assertEqual(in_flight, [0])
+        self.assertEqual(len(selector.latencies), 1)
+
+
+class BinaryHedgingTest(BinaryMessagesTestCase):
+    nodes = [('10.0.0.1', 11211), ('10.0.0.2', 11211)]
+
+    def setUp(self):
+        super(BinaryHedgingTest, self).setUp()
+        self.handler.pool_repository = ProxyRepository(self.io_loop, self.nodes, replicas=2)
+        self.handler.pool_repository.client_for_node = MagicMock()
+        self.handler.hedging = ReadHedging(percentile=50, budget=1, samples=10, min_samples=1)
+        self.handler.hedging.record(0.0)
+        self.owner = self.handler.pool_repository.ring.node_for_key(b'foo')
+        self.replica, = [node for node in self.nodes if node != self.owner]
+        self.handler.pool_repository.selector.latencies = {self.owner: 0.5, self.replica: 0.001}
+        self.hedge_client = self.handler.pool_repository.client_for_node.return_value
+
+    def slow_replica(self, incoming, hedged_values):
+        backend_stream = HeldStream(incoming)
+        self.handler.pool_repository.stream_for_node = lambda node: backend_stream
+
+        def get(keys, callback):
+            callback(hedged_values)
+            self.io_loop.add_callback(backend_stream.release)
+
+        self.hedge_client.get.side_effect = get
+        return backend_stream
+
+    @istest
+    def answers_with_the_hedge_when_the_replica_is_slow(self):
+        old_value = self.response(0x0c, key=b'foo', opaque=1, extras=pack('! I', 0), value=b'old')
+        backend_stream = self.slow_replica(old_value, {b'foo': (3, b'new')})
+        client_stream = ScriptedStream(self.request(0x0c, b'foo', opaque=1))
+
+        self.handler.process(client_stream, 'some backend', self.stop)
+        self.wait()
+
+        new_value = self.response(0x0c, key=b'foo', opaque=1, extras=pack('! I', 3), value=b'new')
+        self.assertEqual(client_stream.written, [new_value])
+        self.assertEqual(backend_stream.incoming, b'')
+
+    @istest
+    def ignores_hedges_missing_keys(self):
+        missed = self.response(0x00, status=0x01, opaque=1)
+        # The key owner gets asked for the key missed in the replica, missing it too.
+        self.slow_replica(missed + self.response(0x0a), {})
+        client_stream = ScriptedStream(self.request(0x00, b'foo', opaque=1))
+
+        self.handler.process(client_stream, 'some backend', self.stop)
+        self.wait()
+
+        self.assertEqual(client_stream.written, [missed])
+
+    @istest
+    def never_hedges_writes(self):
+        backend_stream = ScriptedStream(self.response(0x01))
+        self.handler.pool_repository.stream_for_node = lambda node: backend_stream
+        self.handler.pool_repository.replicate = MagicMock()
+        client_stream = ScriptedStream(self.request(0x01, b'foo', extras=pack('! I I', 0, 0), value=b'x'))
+
+        self.handler.process(client_stream, 'some backend', self.stop)
+        self.wait()
+
+        self.assertEqual(self.handler.hedging.reads, 0)
+        self.assertFalse(self.hedge_client.get.called)
+
+
+class BinarySaslTest(BinaryMessagesTestCase):
+    def setUp(self):
+        super(BinarySaslTest, self).setUp()
+        self.handler.authenticator = SaslAuthenticator([(b'user', b'secret')])
+
+    def auth_request(self, password, opaque=0):
+        return self.request(0x21, b'PLAIN', opaque=opaque, value=b'\0user\0' + password)
+
+    @istest
+    def lists_the_mechanisms(self):
+        client_stream = ScriptedStream(self.request(0x20, opaque=3))
+
+        self.handler.process(client_stream, ScriptedStream(), self.stop)
+        self.wait()
+
+        self.assertEqual(client_stream.written, [self.response(0x20, opaque=3, value=b'PLAIN')])
+
+    @istest
+    def authenticates_clients_at_the_proxy(self):
+        client_stream = ScriptedStream(self.auth_request(b'secret', opaque=1) + self.request(0x00, b'foo', opaque=2))
+        backend_stream = ScriptedStream(self.response(0x00, status=0x01, opaque=2))
+
+        self.handler.process(client_stream, backend_stream, self.stop)
+        self.wait()
+        self.handler.process(client_stream, backend_stream, self.stop)
+        self.wait()
+
+        self.assertEqual(client_stream.written, [
+            self.response(0x21, opaque=1, value=b'Authenticated'),
+            self.response(0x00, status=0x01, opaque=2),
+        ])
+        self.assertEqual(backend_stream.written, [self.request(0x00, b'foo', opaque=2)])
+
+    @istest
+    def refuses_wrong_credentials(self):
+        client_stream = ScriptedStream(self.auth_request(b'wrong'))
+
+        self.handler.process(client_stream, ScriptedStream(), self.stop)
+        self.wait()
+
+        self.assertEqual(client_stream.written, [self.response(0x21, status=0x20, value=b'Auth failure')])
+        self.assertNotIn(client_stream, self.handler.authenticated_streams)
+
+    @istest
+    def refuses_requests_before_authentication(self):
+        client_stream = ScriptedStream(self.request(0x00, b'foo', opaque=2))
+        backend_stream = ScriptedStream()
+
+        self.handler.process(client_stream, backend_stream, self.stop)
+        self.wait()
+
+        self.assertEqual(client_stream.written, [self.response(0x00, status=0x20, opaque=2, value=b'Auth failure')])
+        self.assertEqual(backend_stream.written, [])
+
+    @istest
+    def stores_no_chunks_before_authentication(self):
+        self.handler.chunker = ValueChunker(MagicMock(ProxyRepository), threshold=10)
+        client_stream = ScriptedStream(self.request(0x01, b'foo', opaque=2, extras=pack('! I I', 0, 0), value=b'x' * 20))
+        backend_stream = ScriptedStream()
+
+        self.handler.process(client_stream, backend_stream, self.stop)
+        self.wait()
+
+        self.assertEqual(client_stream.written, [self.response(0x01, status=0x20, opaque=2, value=b'Auth failure')])
+        self.assertFalse(self.handler.chunker.pool_repository.client_for_key.called)
+
+    @istest
+    def never_forwards_sasl_requests_without_an_authenticator(self):
+        self.handler.authenticator = None
+        client_stream = ScriptedStream(self.auth_request(b'secret'))
+        backend_stream = ScriptedStream()
+
+        self.handler.process(client_stream, backend_stream, self.stop)
+        self.wait()
+
+        self.assertEqual(client_stream.written, [self.response(0x21, status=0x81, value=b'Unknown command')])
+        self.assertEqual(backend_stream.written, [])
+
+
 class MockStream(object):
     def __init__(self, overall_calls, name):
         self.mock_stream = MagicMock(iostream.IOStream)
@@ -173,7 +1138,8 @@ class MockStream(object):
 
     def write(self, bytes_, callback):
         self.overall_calls.append((self, 'write', binascii.hexlify(bytes_)))
-        callback(self.mock_stream.write(bytes_))
+        self.mock_stream.write(bytes_)
+        callback()
 
     def __repr__(self):
         return self.name
@@ -1,12 +1,30 @@
+from itertools import groupby
 import socket
+import zlib
 
 import memcache
 from nose.tools import istest
 from tornado import iostream
 
-from memcrashed.proxy import ProxyRepository
+from mock import MagicMock, patch
+from memcrashed import profiling
+from memcrashed.chunking import ValueChunker
+from memcrashed.analytics import KeySpaceAnalytics
+from memcrashed.compression import ValueCompressor
+from memcrashed.hedging import ReadHedging
+from memcrashed.leases import KeyLeases
+from memcrashed.limits import BackendLimits
+from memcrashed.migration import KeyMigration
+from memcrashed.negative_cache import NegativeCache
+from memcrashed.proxy import HashRing, ProxyRepository, ShadowPool
+from memcrashed.quotas import TenantQuotas
+from memcrashed.selection import BackendSelector
 from memcrashed.server import Server, TextProtocolHandler
-from ..utils import command_for_lines, proxy_memcached, server_running, ServerTestCase
+from memcrashed.tracing import RequestTracer
+from memcrashed.write_behind import WriteBehind
+from ..utils import (
+    command_for_lines, proxy_memcached, server_running, ServerTestCase, HeldStream, ScriptedStream, SynchronousExecutor,
+    UnflushedStream, immediate_io_loop)
 
 
 class TextProtocolHandlerTest(ServerTestCase):
@@ -203,3 +221,1169 @@ class TextProtocolHandlerTest(ServerTestCase):
         handler = TextProtocolHandler(self.io_loop)
 
         self.assertIsInstance(handler.pool_repository, ProxyRepository)
+
+
+class TextCompressionTest(ServerTestCase):
+    def setUp(self):
+        super(TextCompressionTest, self).setUp()
+        self.handler = TextProtocolHandler(self.io_loop)
+        self.handler.compressor = ValueCompressor(immediate_io_loop(), threshold=10, executor=SynchronousExecutor())
+
+    @istest
+    def compresses_stored_values(self):
+        value = b'bar' * 100
+        header = self.handler.parser.unpack_request_header(b'set foo 1 0 300 noreply\r\n')
+        request_bytes = header.raw + value + b'\r\n'
+
+        self.handler._convert_request(header, request_bytes, self.stop)
+        result = self.wait()
+
+        compressed = zlib.compress(value, ValueCompressor.DEFAULT_LEVEL)
+        expected = 'set foo {} 0 {} noreply\r\n'.format(1 | ValueCompressor.DEFAULT_FLAG, len(compressed)).encode('ascii')
+        self.assertEqual(result, expected + compressed + b'\r\n')
+
+    @istest
+    def keeps_small_values_untouched(self):
+        header = self.handler.parser.unpack_request_header(b'set foo 1 0 3\r\n')
+        request_bytes = header.raw + b'bar\r\n'
+
+        self.handler._convert_request(header, request_bytes, self.stop)
+
+        self.assertEqual(self.wait(), request_bytes)
+
+    @istest
+    def decompresses_retrieved_values(self):
+        value = b'bar' * 100
+        compressed = zlib.compress(value)
+        response_bytes = (
+            'VALUE foo {} {}\r\n'.format(1 | ValueCompressor.DEFAULT_FLAG, len(compressed)).encode('ascii') + compressed + b'\r\n' +
+            b'VALUE foo2 0 4\r\nbar2\r\n' +
+            b'END\r\n')
+
+        self.handler._convert_values(response_bytes, self.stop)
+
+        self.assertEqual(self.wait(), command_for_lines([
+            'VALUE foo 1 {}'.format(len(value)).encode('ascii'),
+            value,
+            b'VALUE foo2 0 4',
+            b'bar2',
+            b'END',
+        ]))
+
+    @istest
+    def decompresses_meta_values_asking_for_their_flags(self):
+        value = b'bar' * 100
+        compressed = zlib.compress(value)
+        client_stream = ScriptedStream(b'mg foo v\r\n')
+        backend_stream = ScriptedStream(
+            'VA {} f{}\r\n'.format(len(compressed), 1 | ValueCompressor.DEFAULT_FLAG).encode('ascii') + compressed + b'\r\n')
+
+        self.handler.process(client_stream, backend_stream, self.stop)
+        self.wait()
+
+        self.assertEqual(backend_stream.written, [b'mg foo v f\r\n'])
+        self.assertEqual(client_stream.written, ['VA {}\r\n'.format(len(value)).encode('ascii') + value + b'\r\n'])
+
+    @istest
+    def keeps_the_meta_flags_the_client_asked_for(self):
+        value = b'bar' * 100
+        compressed = zlib.compress(value)
+        client_stream = ScriptedStream(b'mg foo f v t\r\n')
+        backend_stream = ScriptedStream(
+            'VA {} f{} t-1\r\n'.format(len(compressed), 1 | ValueCompressor.DEFAULT_FLAG).encode('ascii') + compressed + b'\r\n')
+
+        self.handler.process(client_stream, backend_stream, self.stop)
+        self.wait()
+
+        self.assertEqual(backend_stream.written, [b'mg foo f v t\r\n'])
+        self.assertEqual(client_stream.written, ['VA {} f1 t-1\r\n'.format(len(value)).encode('ascii') + value + b'\r\n'])
+
+
+class TextShardingTest(ServerTestCase):
+    nodes = [('10.0.0.1', 11211), ('10.0.0.2', 11211)]
+
+    def setUp(self):
+        super(TextShardingTest, self).setUp()
+        self.handler = TextProtocolHandler(self.io_loop)
+        self.backend_streams = dict((node, ScriptedStream()) for node in self.nodes)
+        self.handler.pool_repository = MagicMock(ProxyRepository)
+        self.handler.pool_repository.is_sharded.return_value = True
+        self.handler.pool_repository.is_migrating.return_value = False
+        self.handler.pool_repository.is_replicated.return_value = False
+        self.handler.pool_repository.selector = BackendSelector()
+        self.handler.pool_repository.ring = HashRing(self.nodes)
+        self.handler.pool_repository.read_keys_by_node.side_effect = self.handler.pool_repository.ring.keys_by_node
+        self.handler.pool_repository.stream_for_node.side_effect = lambda node: self.backend_streams[node]
+        self.handler.pool_repository.stream_for_key.side_effect = lambda key: self.backend_streams[self.node_for_key(key)]
+
+    def node_for_key(self, key):
+        return self.handler.pool_repository.ring.node_for_key(key)
+
+    def keys_for_each_node(self):
+        keys = {}
+        index = 0
+        while len(keys) < len(self.nodes):
+            key = 'key-{}'.format(index).encode('ascii')
+            keys.setdefault(self.node_for_key(key), key)
+            index += 1
+        return [keys[node] for node in self.nodes]
+
+    @istest
+    def sends_keyed_commands_to_the_owner(self):
+        key = self.keys_for_each_node()[1]
+        client_stream = ScriptedStream(b'delete ' + key + b'\r\n')
+        self.backend_streams[self.nodes[1]].incoming = b'DELETED\r\n'
+
+        self.handler.process(client_stream, 'some backend', self.stop)
+        self.wait()
+
+        self.assertEqual(self.backend_streams[self.nodes[1]].written, [b'delete ' + key + b'\r\n'])
+        self.assertEqual(self.backend_streams[self.nodes[0]].written, [])
+        self.assertEqual(client_stream.written, [b'DELETED\r\n'])
+
+    @istest
+    def fans_multiple_gets_out_to_the_owners(self):
+        first_key, second_key = self.keys_for_each_node()
+        client_stream = ScriptedStream(b'get ' + first_key + b' ' + second_key + b'\r\n')
+        self.backend_streams[self.nodes[0]].incoming = b'VALUE ' + first_key + b' 0 3\r\nfoo\r\nEND\r\n'
+        self.backend_streams[self.nodes[1]].incoming = b'VALUE ' + second_key + b' 0 3\r\nbar\r\nEND\r\n'
+
+        self.handler.process(client_stream, 'some backend', self.stop)
+        self.wait()
+
+        self.assertEqual(self.backend_streams[self.nodes[0]].written, [b'get ' + first_key + b'\r\n'])
+        self.assertEqual(self.backend_streams[self.nodes[1]].written, [b'get ' + second_key + b'\r\n'])
+        self.assertEqual(client_stream.written, [
+            b'VALUE ' + first_key + b' 0 3\r\nfoo\r\nVALUE ' + second_key + b' 0 3\r\nbar\r\nEND\r\n',
+        ])
+
+    @istest
+    def answers_fanned_out_gets_in_the_order_of_the_keys(self):
+        first_key, second_key = self.keys_for_each_node()
+        client_stream = ScriptedStream(b'gets ' + second_key + b' ' + first_key + b' ' + second_key + b'\r\n')
+        self.backend_streams[self.nodes[0]].incoming = b'VALUE ' + first_key + b' 0 3 7\r\nfoo\r\nEND\r\n'
+        self.backend_streams[self.nodes[1]].incoming = (
+            b'VALUE ' + second_key + b' 0 3 8\r\nbar\r\nVALUE ' + second_key + b' 0 3 8\r\nbar\r\nEND\r\n')
+
+        self.handler.process(client_stream, 'some backend', self.stop)
+        self.wait()
+
+        self.assertEqual(client_stream.written, [
+            b'VALUE ' + second_key + b' 0 3 8\r\nbar\r\nVALUE ' + first_key + b' 0 3 7\r\nfoo\r\n' +
+            b'VALUE ' + second_key + b' 0 3 8\r\nbar\r\nEND\r\n',
+        ])
+
+    @istest
+    def applies_the_node_limits_to_fanned_out_gets(self):
+        first_key, second_key = self.keys_for_each_node()
+        self.handler.limits = BackendLimits(self.io_loop, max_in_flight=1, max_queue_wait=0.01)
+        self.handler.limits.limiter_for(self.nodes[1]).in_flight = 1
+        client_stream = ScriptedStream(b'get ' + first_key + b' ' + second_key + b'\r\n')
+        self.backend_streams[self.nodes[0]].incoming = b'VALUE ' + first_key + b' 0 3\r\nfoo\r\nEND\r\n'
+
+        self.handler.process(client_stream, 'some backend', self.stop)
+        self.wait()
+
+        self.assertEqual(self.backend_streams[self.nodes[1]].written, [])
+        self.assertEqual(client_stream.written, [b'SERVER_ERROR backend busy\r\n'])
+        self.assertEqual(self.handler.limits.limiter_for(self.nodes[0]).in_flight, 0)
+
+    @istest
+    def applies_the_node_limits_to_broadcasts(self):
+        self.handler.limits = BackendLimits(self.io_loop, max_in_flight=1, max_queue_wait=0.01)
+        self.handler.limits.limiter_for(self.nodes[1]).in_flight = 1
+        client_stream = ScriptedStream(b'flush_all\r\n')
+        self.backend_streams[self.nodes[0]].incoming = b'OK\r\n'
+        self.handler.pool_repository.backends = self.nodes
+
+        self.handler.process(client_stream, 'some backend', self.stop)
+        self.wait()
+
+        self.assertEqual(self.backend_streams[self.nodes[0]].written, [b'flush_all\r\n'])
+        self.assertEqual(self.backend_streams[self.nodes[1]].written, [])
+        self.assertEqual(client_stream.written, [b'SERVER_ERROR backend busy\r\n'])
+
+    @istest
+    def sends_keyless_commands_to_the_default_backend(self):
+        client_stream = ScriptedStream(b'get\r\n')
+        default_backend = ScriptedStream(b'END\r\n')
+
+        self.handler.process(client_stream, default_backend, self.stop)
+        self.wait()
+
+        self.assertEqual(default_backend.written, [b'get\r\n'])
+
+
+class TextChunkingTest(ServerTestCase):
+    def setUp(self):
+        super(TextChunkingTest, self).setUp()
+        self.handler = TextProtocolHandler(self.io_loop)
+        self.handler.chunker = MagicMock(ValueChunker)
+        self.handler.chunker.should_split.side_effect = lambda length: length > 10
+        self.handler.chunker.manifest_flags.side_effect = lambda flags: flags | ValueChunker.DEFAULT_FLAG
+        self.handler.chunker.is_manifest.side_effect = lambda flags: bool(flags & ValueChunker.DEFAULT_FLAG)
+        self.handler.chunker.value_flags.side_effect = lambda flags: flags & ~ValueChunker.DEFAULT_FLAG
+        self.handler.chunker.discard_previous.side_effect = lambda key, callback: callback()
+
+    @istest
+    def refuses_appends(self):
+        client_stream = ScriptedStream(b'append foo 0 0 1\r\nx\r\n')
+        backend_stream = ScriptedStream()
+
+        self.handler.process(client_stream, backend_stream, self.stop)
+        self.wait()
+
+        self.assertEqual(backend_stream.written, [])
+        self.assertEqual(client_stream.written, [b'SERVER_ERROR not supported with compression or chunking\r\n'])
+
+    @istest
+    def refuses_prepends_silently_without_reply(self):
+        client_stream = ScriptedStream(b'prepend foo 0 0 1 noreply\r\nx\r\n')
+        backend_stream = ScriptedStream()
+
+        self.handler.process(client_stream, backend_stream, self.stop)
+        self.wait()
+
+        self.assertEqual(backend_stream.written, [])
+        self.assertEqual(client_stream.written, [])
+
+    @istest
+    def refuses_meta_appends(self):
+        client_stream = ScriptedStream(b'ms foo 1 MA q\r\nx\r\n')
+        backend_stream = ScriptedStream()
+
+        self.handler.process(client_stream, backend_stream, self.stop)
+        self.wait()
+
+        self.assertEqual(backend_stream.written, [])
+        self.assertEqual(client_stream.written, [b'SERVER_ERROR not supported with compression or chunking\r\n'])
+
+    @istest
+    def stores_a_manifest_for_large_values(self):
+        self.handler.chunker.store.side_effect = lambda exptime, value, callback: callback(b'token 2 20')
+        header = self.handler.parser.unpack_request_header(b'set foo 1 60 20\r\n')
+
+        self.handler._convert_request(header, header.raw + b'x' * 20 + b'\r\n', self.stop)
+
+        self.assertEqual(self.wait(), 'set foo {} 60 10\r\ntoken 2 20\r\n'.format(1 | ValueChunker.DEFAULT_FLAG).encode('ascii'))
+        self.assertEqual(self.handler.chunker.store.call_args[0][:2], (60, b'x' * 20))
+        self.assertEqual(self.handler.chunker.discard_previous.call_args[0][0], b'foo')
+
+    @istest
+    def discards_the_previous_chunks_on_small_sets(self):
+        header = self.handler.parser.unpack_request_header(b'set foo 1 60 2\r\n')
+
+        self.handler._convert_request(header, header.raw + b'xx\r\n', self.stop)
+        self.wait()
+
+        self.assertEqual(self.handler.chunker.discard_previous.call_args[0][0], b'foo')
+
+    @istest
+    def forwards_the_value_if_chunks_cannot_be_stored(self):
+        self.handler.chunker.store.side_effect = lambda exptime, value, callback: callback(None)
+        header = self.handler.parser.unpack_request_header(b'set foo 1 60 20\r\n')
+        request_bytes = header.raw + b'x' * 20 + b'\r\n'
+
+        self.handler._convert_request(header, request_bytes, self.stop)
+
+        self.assertEqual(self.wait(), request_bytes)
+
+    @istest
+    def splits_only_set_commands(self):
+        header = self.handler.parser.unpack_request_header(b'add foo 1 60 20\r\n')
+        request_bytes = header.raw + b'x' * 20 + b'\r\n'
+
+        self.handler._convert_request(header, request_bytes, self.stop)
+
+        self.assertEqual(self.wait(), request_bytes)
+        self.assertFalse(self.handler.chunker.store.called)
+
+    @istest
+    def reassembles_chunked_values(self):
+        self.handler.chunker.fetch.side_effect = lambda manifest, callback: callback(b'x' * 20)
+        response_bytes = 'VALUE foo {} 10\r\ntoken 2 20\r\nEND\r\n'.format(1 | ValueChunker.DEFAULT_FLAG).encode('ascii')
+
+        self.handler._convert_values(response_bytes, self.stop)
+
+        self.assertEqual(self.wait(), b'VALUE foo 1 20\r\n' + b'x' * 20 + b'\r\nEND\r\n')
+
+    @istest
+    def answers_a_miss_when_chunks_are_gone(self):
+        self.handler.chunker.fetch.side_effect = lambda manifest, callback: callback(None)
+        response_bytes = 'VALUE foo {} 10\r\ntoken 2 20\r\nVALUE bar 0 1\r\nx\r\nEND\r\n'.format(ValueChunker.DEFAULT_FLAG).encode('ascii')
+
+        self.handler._convert_values(response_bytes, self.stop)
+
+        self.assertEqual(self.wait(), b'VALUE bar 0 1\r\nx\r\nEND\r\n')
+
+    @istest
+    def reassembles_chunked_meta_values(self):
+        self.handler.chunker.fetch.side_effect = lambda manifest, callback: callback(b'x' * 20)
+        client_stream = ScriptedStream(b'mg foo v\r\n')
+        backend_stream = ScriptedStream('VA 10 f{}\r\ntoken 2 20\r\n'.format(1 | ValueChunker.DEFAULT_FLAG).encode('ascii'))
+
+        self.handler.process(client_stream, backend_stream, self.stop)
+        self.wait()
+
+        self.assertEqual(client_stream.written, [b'VA 20\r\n' + b'x' * 20 + b'\r\n'])
+
+    @istest
+    def answers_a_meta_miss_when_chunks_are_gone(self):
+        self.handler.chunker.fetch.side_effect = lambda manifest, callback: callback(None)
+        client_stream = ScriptedStream(b'mg foo v\r\n')
+        backend_stream = ScriptedStream('VA 10 f{}\r\ntoken 2 20\r\n'.format(ValueChunker.DEFAULT_FLAG).encode('ascii'))
+
+        self.handler.process(client_stream, backend_stream, self.stop)
+        self.wait()
+
+        self.assertEqual(client_stream.written, [b'EN\r\n'])
+
+
+class TextTracingTest(ServerTestCase):
+    def setUp(self):
+        super(TextTracingTest, self).setUp()
+        self.handler = TextProtocolHandler(self.io_loop)
+        self.output = MagicMock()
+        self.handler.tracer = RequestTracer(sample_rate=1, output=self.output)
+
+    @istest
+    def traces_requests(self):
+        client_stream = ScriptedStream(b'get foo bar\r\n')
+        backend_stream = ScriptedStream(b'VALUE foo 0 1\r\nx\r\nEND\r\n')
+
+        self.handler.process(client_stream, backend_stream, self.stop)
+        self.wait()
+
+        trace, = self.handler.tracer.records
+        self.assertEqual(trace.command, 'get')
+        self.assertEqual(trace.keys, [b'foo', b'bar'])
+        self.assertEqual(trace.nodes, [self.handler.pool_repository.default_node])
+        self.assertEqual(trace.request_bytes, 13)
+        self.assertEqual(trace.response_bytes, 23)
+        self.assertEqual(self.handler.traces, {})
+
+    @istest
+    def logs_slow_requests(self):
+        self.handler.tracer = RequestTracer(sample_rate=0, slow_threshold=0, output=self.output)
+        client_stream = ScriptedStream(b'delete foo\r\n')
+        backend_stream = ScriptedStream(b'DELETED\r\n')
+
+        self.handler.process(client_stream, backend_stream, self.stop)
+        self.wait()
+
+        self.assertEqual(len(self.handler.tracer.records), 0)
+        self.assertIn('command=delete keys=[foo]', self.output.write.call_args[0][0])
+
+
+class TextNegativeCacheTest(ServerTestCase):
+    def setUp(self):
+        super(TextNegativeCacheTest, self).setUp()
+        self.handler = TextProtocolHandler(self.io_loop)
+        self.handler.negative_cache = NegativeCache(ttl=60, size=4096)
+
+    @istest
+    def remembers_keys_missed_in_the_backend(self):
+        client_stream = ScriptedStream(b'get foo bar\r\n')
+        backend_stream = ScriptedStream(b'VALUE foo 0 1\r\nx\r\nEND\r\n')
+
+        self.handler.process(client_stream, backend_stream, self.stop)
+        self.wait()
+
+        self.assertTrue(self.handler.negative_cache.contains(b'bar'))
+        self.assertFalse(self.handler.negative_cache.contains(b'foo'))
+
+    @istest
+    def answers_known_misses_without_the_backend(self):
+        self.handler.negative_cache.add_misses([b'bar'], self.handler.negative_cache.versions([b'bar']))
+        client_stream = ScriptedStream(b'get bar\r\n')
+        backend_stream = ScriptedStream()
+
+        self.handler.process(client_stream, backend_stream, self.stop)
+        self.wait()
+
+        self.assertEqual(backend_stream.written, [])
+        self.assertEqual(client_stream.written, [b'END\r\n'])
+
+    @istest
+    def leaves_known_misses_out_of_retrievals(self):
+        self.handler.negative_cache.add_misses([b'bar'], self.handler.negative_cache.versions([b'bar']))
+        client_stream = ScriptedStream(b'gets foo bar\r\n')
+        backend_stream = ScriptedStream(b'VALUE foo 0 1 10\r\nx\r\nEND\r\n')
+
+        self.handler.process(client_stream, backend_stream, self.stop)
+        self.wait()
+
+        self.assertEqual(backend_stream.written, [b'gets foo\r\n'])
+        self.assertEqual(client_stream.written, [b'VALUE foo 0 1 10\r\nx\r\nEND\r\n'])
+
+    @istest
+    def forgets_keys_written_through_the_proxy(self):
+        self.handler.negative_cache.add_misses([b'bar'], self.handler.negative_cache.versions([b'bar']))
+        client_stream = ScriptedStream(b'set bar 0 0 1\r\nx\r\n')
+        backend_stream = ScriptedStream(b'STORED\r\n')
+
+        self.handler.process(client_stream, backend_stream, self.stop)
+        self.wait()
+
+        self.assertFalse(self.handler.negative_cache.contains(b'bar'))
+
+    @istest
+    def keeps_known_misses_on_meta_reads(self):
+        self.handler.negative_cache.add_misses([b'bar'], self.handler.negative_cache.versions([b'bar']))
+        client_stream = ScriptedStream(b'mg bar v\r\n')
+        backend_stream = ScriptedStream(b'EN\r\n')
+
+        self.handler.process(client_stream, backend_stream, self.stop)
+        self.wait()
+
+        self.assertTrue(self.handler.negative_cache.contains(b'bar'))
+
+
+class TextMirroringTest(ServerTestCase):
+    def setUp(self):
+        super(TextMirroringTest, self).setUp()
+        self.handler = TextProtocolHandler(self.io_loop)
+        self.handler.shadow = MagicMock(ShadowPool)
+        self.handler.shadow.ring = HashRing(['shadow node'])
+
+    @istest
+    def mirrors_writes(self):
+        client_stream = ScriptedStream(b'set foo 0 0 1\r\nx\r\n')
+        backend_stream = ScriptedStream(b'STORED\r\n')
+
+        self.handler.process(client_stream, backend_stream, self.stop)
+        self.wait()
+
+        self.handler.shadow.mirror.assert_called_with(b'foo', b'set foo 0 0 1\r\nx\r\n')
+        self.assertEqual(client_stream.written, [b'STORED\r\n'])
+
+    @istest
+    def mirrors_sampled_reads(self):
+        self.handler.shadow.samples_read.return_value = True
+        client_stream = ScriptedStream(b'get foo bar\r\n')
+        backend_stream = ScriptedStream(b'END\r\n')
+
+        self.handler.process(client_stream, backend_stream, self.stop)
+        self.wait()
+
+        self.handler.shadow.mirror_to_node.assert_called_with('shadow node', b'get foo bar\r\n')
+
+    @istest
+    def skips_reads_not_sampled(self):
+        self.handler.shadow.samples_read.return_value = False
+        client_stream = ScriptedStream(b'get foo\r\n')
+        backend_stream = ScriptedStream(b'END\r\n')
+
+        self.handler.process(client_stream, backend_stream, self.stop)
+        self.wait()
+
+        self.assertFalse(self.handler.shadow.mirror_to_node.called)
+        self.assertEqual(client_stream.written, [b'END\r\n'])
+
+
+class TextMigrationTest(ServerTestCase):
+    def setUp(self):
+        super(TextMigrationTest, self).setUp()
+        self.handler = TextProtocolHandler(self.io_loop)
+        self.migration = MagicMock(KeyMigration)
+        self.handler.pool_repository = MagicMock(ProxyRepository)
+        self.handler.pool_repository.is_sharded.return_value = False
+        self.handler.pool_repository.is_migrating.return_value = True
+        self.handler.pool_repository.is_replicated.return_value = False
+        self.handler.pool_repository.selector = BackendSelector()
+        self.handler.pool_repository.migration = self.migration
+
+    @istest
+    def reads_missed_keys_from_previous_owners(self):
+        self.migration.fetch.side_effect = lambda keys, callback: callback({b'bar': (2, b'yy')})
+        client_stream = ScriptedStream(b'get foo bar baz\r\n')
+        backend_stream = ScriptedStream(b'VALUE foo 0 1\r\nx\r\nEND\r\n')
+
+        self.handler.process(client_stream, backend_stream, self.stop)
+        self.wait()
+
+        self.assertEqual(self.migration.fetch.call_args[0][0], [b'bar', b'baz'])
+        self.assertEqual(client_stream.written, [b'VALUE foo 0 1\r\nx\r\nVALUE bar 2 2\r\nyy\r\nEND\r\n'])
+
+    @istest
+    def leaves_gets_alone(self):
+        client_stream = ScriptedStream(b'gets foo\r\n')
+        backend_stream = ScriptedStream(b'END\r\n')
+
+        self.handler.process(client_stream, backend_stream, self.stop)
+        self.wait()
+
+        self.assertFalse(self.migration.fetch.called)
+        self.assertEqual(client_stream.written, [b'END\r\n'])
+
+    @istest
+    def forgets_previous_copies_of_written_keys(self):
+        client_stream = ScriptedStream(b'delete foo\r\n')
+        backend_stream = ScriptedStream(b'DELETED\r\n')
+
+        self.handler.process(client_stream, backend_stream, self.stop)
+        self.wait()
+
+        self.migration.forget.assert_called_with(b'foo')
+
+
+class TextLeasesTest(ServerTestCase):
+    def setUp(self):
+        super(TextLeasesTest, self).setUp()
+        self.handler = TextProtocolHandler(self.io_loop)
+        self.handler.leases = MagicMock(KeyLeases)
+        self.handler.leases.is_hot.return_value = False
+        self.handler.leases.fill.side_effect = lambda repository, client, keys, callback: callback({})
+
+    @istest
+    def adds_the_values_the_leases_come_up_with(self):
+        self.handler.leases.fill.side_effect = lambda repository, client, keys, callback: callback({b'bar': (2, b'yy')})
+        client_stream = ScriptedStream(b'get foo bar baz\r\n')
+        backend_stream = ScriptedStream(b'VALUE foo 0 1\r\nx\r\nEND\r\n')
+
+        self.handler.process(client_stream, backend_stream, self.stop)
+        self.wait()
+
+        fill_args = self.handler.leases.fill.call_args[0]
+        self.assertIs(fill_args[0], self.handler.pool_repository)
+        self.assertIs(fill_args[1], client_stream)
+        self.assertEqual(fill_args[2], [b'bar', b'baz'])
+        self.assertEqual(client_stream.written, [b'VALUE foo 0 1\r\nx\r\nVALUE bar 2 2\r\nyy\r\nEND\r\n'])
+
+    @istest
+    def gives_the_backend_slot_back_before_filling_the_leases(self):
+        self.handler.limits = BackendLimits(self.io_loop, max_in_flight=1)
+        client_stream = ScriptedStream(b'get foo\r\n')
+        backend_stream = ScriptedStream(b'END\r\n')
+        limiter = self.handler.limits.limiter_for(self.handler.pool_repository.default_node)
+        in_flight = []
+
+        def fill(repository, client, keys, callback):
+            in_flight.append((limiter.in_flight, sum(self.handler.pool_repository.selector.in_flight.values())))
+            callback({})
+
+        self.handler.leases.fill.side_effect = fill
+
+        self.handler.process(client_stream, backend_stream, self.stop)
+        self.wait()
+
+        self.assertEqual(in_flight, [(0, 0)])
+
+    @istest
+    def remembers_the_values_of_hot_keys(self):
+        self.handler.leases.is_hot.side_effect = lambda key: key == b'bar'
+        client_stream = ScriptedStream(b'get foo bar\r\n')
+        backend_stream = ScriptedStream(b'VALUE foo 0 1\r\nx\r\nVALUE bar 3 2\r\nyy\r\nEND\r\n')
+
+        self.handler.process(client_stream, backend_stream, self.stop)
+        self.wait()
+
+        self.handler.leases.remember.assert_any_call(b'bar', 3, b'yy')
+        self.assertFalse(self.handler.leases.fill.called)
+
+    @istest
+    def leaves_gets_alone(self):
+        client_stream = ScriptedStream(b'gets foo\r\n')
+        backend_stream = ScriptedStream(b'END\r\n')
+
+        self.handler.process(client_stream, backend_stream, self.stop)
+        self.wait()
+
+        self.assertFalse(self.handler.leases.fill.called)
+        self.assertEqual(client_stream.written, [b'END\r\n'])
+
+    @istest
+    def releases_written_keys(self):
+        client_stream = ScriptedStream(b'set foo 0 0 1\r\nx\r\n')
+        backend_stream = ScriptedStream(b'STORED\r\n')
+
+        self.handler.process(client_stream, backend_stream, self.stop)
+        self.wait()
+
+        self.handler.leases.release.assert_called_with(b'foo')
+        self.assertEqual(client_stream.written, [b'STORED\r\n'])
+
+
+class TextPipeliningTest(ServerTestCase):
+    def setUp(self):
+        super(TextPipeliningTest, self).setUp()
+        self.handler = TextProtocolHandler(self.io_loop)
+
+    @istest
+    def answers_each_client_sharing_the_backend_with_its_own_response(self):
+        backend_stream = HeldStream(b'VALUE foo 0 1\r\nx\r\nEND\r\nSTORED\r\n')
+        first_client = ScriptedStream(b'get foo\r\n')
+        second_client = ScriptedStream(b'set bar 0 0 1\r\ny\r\n')
+        callbacks = [MagicMock(), MagicMock()]
+
+        self.handler.process(first_client, backend_stream, callbacks[0])
+        self.handler.process(second_client, backend_stream, callbacks[1])
+        backend_stream.release()
+
+        self.assertEqual(backend_stream.written, [b'get foo\r\n', b'set bar 0 0 1\r\ny\r\n'])
+        self.assertEqual(first_client.written, [b'VALUE foo 0 1\r\nx\r\nEND\r\n'])
+        self.assertEqual(second_client.written, [b'STORED\r\n'])
+        self.assertTrue(all(callback.called for callback in callbacks))
+
+    @istest
+    def skips_timing_the_round_trips_without_replicas(self):
+        backend_stream = ScriptedStream(b'VALUE foo 0 1\r\nx\r\nEND\r\n')
+        client_stream = ScriptedStream(b'get foo\r\n')
+
+        self.handler.process(client_stream, backend_stream, self.stop)
+        self.wait()
+
+        self.assertEqual(client_stream.written, [b'VALUE foo 0 1\r\nx\r\nEND\r\n'])
+        self.assertEqual(self.handler.pool_repository.selector.latencies, {})
+
+    @istest
+    @patch('memcrashed.profiling.enter')
+    def enters_the_stages_of_a_round_trip(self, enter):
+        backend_stream = ScriptedStream(b'VALUE foo 0 1\r\nx\r\nEND\r\n')
+        client_stream = ScriptedStream(b'get foo\r\n')
+
+        self.handler.process(client_stream, backend_stream, self.stop)
+        self.wait()
+
+        stages = [stage for stage, calls in groupby(call[0][0] for call in enter.call_args_list)]
+        self.assertEqual(stages, [
+            profiling.PARSE, profiling.ROUTE, profiling.BACKEND_WRITE, profiling.ROUTE, profiling.BACKEND_WRITE,
+            profiling.BACKEND_READ, profiling.CLIENT_WRITE])
+
+    @istest
+    def lets_the_next_client_read_while_answering_the_previous_one(self):
+        self.handler.leases = MagicMock(KeyLeases)
+        self.handler.leases.is_hot.return_value = False
+        backend_stream = ScriptedStream(b'END\r\nSTORED\r\n')
+        first_client = ScriptedStream(b'get foo\r\n')
+        second_client = ScriptedStream(b'set bar 0 0 1\r\ny\r\n')
+
+        self.handler.process(first_client, backend_stream, MagicMock())
+        self.handler.process(second_client, backend_stream, MagicMock())
+
+        self.assertEqual(first_client.written, [])
+        self.assertEqual(second_client.written, [b'STORED\r\n'])
+
+    @istest
+    def answers_the_next_client_after_a_failed_retrieval(self):
+        backend_stream = HeldStream(b'CLIENT_ERROR bad command line format\r\nSTORED\r\n')
+        first_client = ScriptedStream(b'get ' + b'k' * 300 + b'\r\n')
+        second_client = ScriptedStream(b'set bar 0 0 1\r\ny\r\n')
+
+        self.handler.process(first_client, backend_stream, MagicMock())
+        self.handler.process(second_client, backend_stream, MagicMock())
+        backend_stream.release()
+
+        self.assertEqual(first_client.written, [b'CLIENT_ERROR bad command line format\r\n'])
+        self.assertEqual(second_client.written, [b'STORED\r\n'])
+
+    @istest
+    def finishes_the_turn_of_a_response_failing_to_be_read(self):
+        backend_stream = ScriptedStream(b'VALUE foo 0 x\r\n')
+        client_stream = ScriptedStream(b'get foo\r\n')
+
+        self.assertRaises(ValueError, self.handler.process, client_stream, backend_stream, MagicMock())
+
+        self.assertEqual(len(self.handler.pipelines[backend_stream].turns), 0)
+
+
+class TextQuotasTest(ServerTestCase):
+    def setUp(self):
+        super(TextQuotasTest, self).setUp()
+        self.handler = TextProtocolHandler(self.io_loop)
+        self.handler.quotas = MagicMock(TenantQuotas)
+        self.handler.quotas.tenant.return_value = 'tenant'
+        self.handler.quotas.allow.return_value = True
+
+    @istest
+    def charges_requests_and_responses_to_the_tenant(self):
+        client_stream = ScriptedStream(b'get foo bar\r\n')
+        backend_stream = ScriptedStream(b'VALUE foo 0 1\r\nx\r\nEND\r\n')
+
+        self.handler.process(client_stream, backend_stream, self.stop)
+        self.wait()
+
+        self.handler.quotas.tenant.assert_called_with(client_stream, b'foo')
+        self.handler.quotas.allow.assert_called_with('tenant', 2, len(b'get foo bar\r\n'))
+        self.handler.quotas.charge.assert_called_with('tenant', len(b'VALUE foo 0 1\r\nx\r\nEND\r\n'))
+
+    @istest
+    def answers_throttled_requests_without_the_backend(self):
+        self.handler.quotas.allow.return_value = False
+        client_stream = ScriptedStream(b'set foo 0 0 1\r\nx\r\n')
+        backend_stream = ScriptedStream()
+
+        self.handler.process(client_stream, backend_stream, self.stop)
+        self.wait()
+
+        self.assertEqual(backend_stream.written, [])
+        self.assertEqual(client_stream.written, [b'SERVER_ERROR rate limited\r\n'])
+
+    @istest
+    def keeps_quiet_on_throttled_noreply_requests(self):
+        self.handler.quotas.allow.return_value = False
+        client_stream = ScriptedStream(b'set foo 0 0 1 noreply\r\nx\r\n')
+        backend_stream = ScriptedStream()
+
+        self.handler.process(client_stream, backend_stream, self.stop)
+        self.wait()
+
+        self.assertEqual(backend_stream.written, [])
+        self.assertEqual(client_stream.written, [])
+
+
+class TextWriteBehindTest(ServerTestCase):
+    def setUp(self):
+        super(TextWriteBehindTest, self).setUp()
+        self.handler = TextProtocolHandler(self.io_loop)
+        self.handler.write_behind = WriteBehind(1024)
+
+    @istest
+    def acknowledges_noreply_writes_before_they_are_flushed(self):
+        client_stream = ScriptedStream(b'set foo 0 0 1 noreply\r\nx\r\n')
+        backend_stream = UnflushedStream()
+        callback = MagicMock()
+
+        self.handler.process(client_stream, backend_stream, callback)
+
+        self.assertTrue(callback.called)
+        self.assertEqual(backend_stream.written, [b'set foo 0 0 1 noreply\r\nx\r\n'])
+        self.assertEqual(self.handler.write_behind.pending_bytes(backend_stream), 26)
+
+    @istest
+    def waits_for_the_flush_without_write_behind(self):
+        self.handler.write_behind = None
+        client_stream = ScriptedStream(b'set foo 0 0 1 noreply\r\nx\r\n')
+        backend_stream = UnflushedStream()
+        callback = MagicMock()
+
+        self.handler.process(client_stream, backend_stream, callback)
+
+        self.assertFalse(callback.called)
+
+        backend_stream.flush()
+
+        self.assertTrue(callback.called)
+
+    @istest
+    def drops_noreply_writes_when_the_backend_is_full(self):
+        backend_stream = UnflushedStream()
+        self.handler.write_behind.pending[backend_stream] = 1024
+        client_stream = ScriptedStream(b'delete foo noreply\r\n')
+
+        self.handler.process(client_stream, backend_stream, self.stop)
+        self.wait()
+
+        self.assertEqual(backend_stream.written, [])
+        self.assertEqual(client_stream.written, [])
+        self.assertEqual(self.handler.write_behind.dropped, 1)
+
+
+class TextAnalyticsTest(ServerTestCase):
+    def setUp(self):
+        super(TextAnalyticsTest, self).setUp()
+        self.handler = TextProtocolHandler(self.io_loop)
+        self.handler.analytics = MagicMock(KeySpaceAnalytics)
+
+    @istest
+    def records_the_keys_accessed_with_their_backend(self):
+        client_stream = ScriptedStream(b'get foo bar\r\n')
+        backend_stream = ScriptedStream(b'END\r\n')
+
+        self.handler.process(client_stream, backend_stream, self.stop)
+        self.wait()
+
+        self.handler.analytics.record.assert_called_with([b'foo', b'bar'], ('127.0.0.1', 11211))
+
+    @istest
+    def records_the_keys_of_each_backend_fanned_out_to(self):
+        nodes = [('10.0.0.1', 11211), ('10.0.0.2', 11211)]
+        self.handler.pool_repository = ProxyRepository(self.io_loop, nodes)
+        self.handler.pool_repository.stream_for_node = lambda node: ScriptedStream(b'END\r\n')
+        keys = [b'foo', b'bar', b'baz', b'qux']
+
+        self.handler.process(ScriptedStream(b'get ' + b' '.join(keys) + b'\r\n'), 'some backend', self.stop)
+        self.wait()
+
+        recorded = dict((node, node_keys) for (node_keys, node), kwargs in self.handler.analytics.record.call_args_list)
+        self.assertEqual(recorded, self.handler.pool_repository.ring.keys_by_node(keys))
+
+
+class TextFramingTest(ServerTestCase):
+    def setUp(self):
+        super(TextFramingTest, self).setUp()
+        self.handler = TextProtocolHandler(self.io_loop)
+
+    def exchange(self, request_bytes, response_bytes):
+        client_stream = ScriptedStream(request_bytes)
+        backend_stream = ScriptedStream(response_bytes)
+
+        self.handler.process(client_stream, backend_stream, self.stop)
+        self.wait()
+
+        return client_stream, backend_stream
+
+    @istest
+    def relays_gat_values(self):
+        response_bytes = b'VALUE foo 0 1 12\r\nx\r\nEND\r\n'
+
+        client_stream, backend_stream = self.exchange(b'gats 60 foo\r\n', response_bytes)
+
+        self.assertEqual(backend_stream.written, [b'gats 60 foo\r\n'])
+        self.assertEqual(client_stream.written, [response_bytes])
+
+    @istest
+    def sends_noreply_commands_without_waiting(self):
+        client_stream, backend_stream = self.exchange(b'set foo 0 0 1 noreply\r\nx\r\n', b'')
+
+        self.assertEqual(backend_stream.written, [b'set foo 0 0 1 noreply\r\nx\r\n'])
+        self.assertEqual(client_stream.written, [])
+
+    @istest
+    def relays_stats_up_to_the_end(self):
+        response_bytes = b'STAT pid 1\r\nSTAT uptime 2\r\nEND\r\n'
+
+        client_stream, backend_stream = self.exchange(b'stats\r\n', response_bytes + b'VERSION 1.6\r\n')
+
+        self.assertEqual(client_stream.written, [response_bytes])
+        self.assertEqual(backend_stream.incoming, b'VERSION 1.6\r\n')
+
+    @istest
+    def relays_single_line_admin_responses(self):
+        client_stream, backend_stream = self.exchange(b'version\r\n', b'VERSION 1.6.21\r\n')
+
+        self.assertEqual(client_stream.written, [b'VERSION 1.6.21\r\n'])
+
+    @istest
+    def relays_meta_values(self):
+        response_bytes = b'VA 3 f0 Oabc\r\nbar\r\n'
+
+        client_stream, backend_stream = self.exchange(b'mg foo v f Oabc\r\n', response_bytes)
+
+        self.assertEqual(client_stream.written, [response_bytes])
+
+    @istest
+    def reads_meta_set_values(self):
+        client_stream, backend_stream = self.exchange(b'ms foo 3 T60\r\nbar\r\n', b'HD\r\n')
+
+        self.assertEqual(backend_stream.written, [b'ms foo 3 T60\r\nbar\r\n'])
+        self.assertEqual(client_stream.written, [b'HD\r\n'])
+
+    @istest
+    def follows_quiet_meta_commands_with_a_no_op(self):
+        client_stream, backend_stream = self.exchange(b'mg foo v q\r\n', b'VA 3\r\nbar\r\nMN\r\n')
+
+        self.assertEqual(backend_stream.written, [b'mg foo v q\r\nmn\r\n'])
+        self.assertEqual(client_stream.written, [b'VA 3\r\nbar\r\n'])
+        self.assertEqual(backend_stream.incoming, b'')
+
+    @istest
+    def answers_nothing_for_quiet_meta_commands_that_went_fine(self):
+        client_stream, backend_stream = self.exchange(b'ms foo 3 q\r\nbar\r\n', b'MN\r\n')
+
+        self.assertEqual(client_stream.written, [])
+        self.assertEqual(backend_stream.incoming, b'')
+
+    @istest
+    def answers_meta_no_ops_at_the_proxy(self):
+        client_stream, backend_stream = self.exchange(b'mn\r\n', b'')
+
+        self.assertEqual(backend_stream.written, [])
+        self.assertEqual(client_stream.written, [b'MN\r\n'])
+
+    @istest
+    def closes_only_the_client_on_quit(self):
+        client_stream, backend_stream = self.exchange(b'quit\r\n', b'')
+
+        self.assertTrue(client_stream.closed())
+        self.assertFalse(backend_stream.closed())
+        self.assertEqual(backend_stream.written, [])
+
+    @istest
+    def answers_unknown_commands_with_an_error(self):
+        client_stream, backend_stream = self.exchange(b'shutdown\r\n', b'')
+
+        self.assertEqual(backend_stream.written, [])
+        self.assertEqual(client_stream.written, [b'ERROR\r\n'])
+
+
+class TextShardedFramingTest(ServerTestCase):
+    nodes = [('10.0.0.1', 11211), ('10.0.0.2', 11211)]
+
+    def setUp(self):
+        super(TextShardedFramingTest, self).setUp()
+        self.handler = TextProtocolHandler(self.io_loop)
+        self.backend_streams = dict((node, ScriptedStream()) for node in self.nodes)
+        self.handler.pool_repository = ProxyRepository(self.io_loop, self.nodes)
+        self.handler.pool_repository.stream_for_node = lambda node: self.backend_streams[node]
+
+    @istest
+    def broadcasts_flush_all(self):
+        client_stream = ScriptedStream(b'flush_all\r\n')
+        for stream in self.backend_streams.values():
+            stream.incoming = b'OK\r\n'
+
+        self.handler.process(client_stream, 'some backend', self.stop)
+        self.wait()
+
+        for stream in self.backend_streams.values():
+            self.assertEqual(stream.written, [b'flush_all\r\n'])
+        self.assertEqual(client_stream.written, [b'OK\r\n'])
+
+    @istest
+    def answers_broadcasts_with_the_first_failure(self):
+        client_stream = ScriptedStream(b'verbosity 1\r\n')
+        self.backend_streams[self.nodes[0]].incoming = b'OK\r\n'
+        self.backend_streams[self.nodes[1]].incoming = b'ERROR\r\n'
+
+        self.handler.process(client_stream, 'some backend', self.stop)
+        self.wait()
+
+        self.assertEqual(client_stream.written, [b'ERROR\r\n'])
+
+    @istest
+    def fans_gat_out_keeping_the_expiration(self):
+        ring = self.handler.pool_repository.ring
+        keys = [key for key in (b'foo', b'bar', b'baz', b'qux', b'quux') if ring.node_for_key(key) == self.nodes[0]][:1]
+        keys += [key for key in (b'foo', b'bar', b'baz', b'qux', b'quux') if ring.node_for_key(key) == self.nodes[1]][:1]
+        client_stream = ScriptedStream(b'gat 60 ' + b' '.join(keys) + b'\r\n')
+        for stream in self.backend_streams.values():
+            stream.incoming = b'END\r\n'
+
+        self.handler.process(client_stream, 'some backend', self.stop)
+        self.wait()
+
+        self.assertEqual(self.backend_streams[self.nodes[0]].written, [b'gat 60 ' + keys[0] + b'\r\n'])
+        self.assertEqual(self.backend_streams[self.nodes[1]].written, [b'gat 60 ' + keys[1] + b'\r\n'])
+        self.assertEqual(client_stream.written, [b'END\r\n'])
+
+    @istest
+    def answers_fanned_out_retrievals_with_the_first_failure(self):
+        client_stream = ScriptedStream(b'get foo bar baz qux quux\r\n')
+        for stream in self.backend_streams.values():
+            stream.incoming = b'SERVER_ERROR out of memory\r\n'
+
+        self.handler.process(client_stream, 'some backend', self.stop)
+        self.wait()
+
+        self.assertEqual(client_stream.written, [b'SERVER_ERROR out of memory\r\n'])
+
+
+class TextReplicationTest(ServerTestCase):
+    nodes = [('10.0.0.1', 11211), ('10.0.0.2', 11211)]
+
+    def setUp(self):
+        super(TextReplicationTest, self).setUp()
+        self.handler = TextProtocolHandler(self.io_loop)
+        self.backend_streams = dict((node, ScriptedStream()) for node in self.nodes)
+        self.handler.pool_repository = ProxyRepository(self.io_loop, self.nodes, replicas=2)
+        self.handler.pool_repository.stream_for_node = lambda node: self.backend_streams[node]
+        self.handler.pool_repository.replicate = MagicMock()
+        self.owner = self.handler.pool_repository.ring.node_for_key(b'foo')
+        self.replica, = [node for node in self.nodes if node != self.owner]
+
+    @istest
+    def repeats_sets_on_the_replicas(self):
+        client_stream = ScriptedStream(b'set foo 0 0 1\r\nx\r\n')
+        self.backend_streams[self.owner].incoming = b'STORED\r\n'
+
+        self.handler.process(client_stream, 'some backend', self.stop)
+        self.wait()
+
+        self.assertEqual(self.backend_streams[self.owner].written, [b'set foo 0 0 1\r\nx\r\n'])
+        self.handler.pool_repository.replicate.assert_called_with(b'foo', b'set foo 0 0 1\r\nx\r\n')
+
+    @istest
+    def deletes_replica_copies_on_other_writes(self):
+        client_stream = ScriptedStream(b'incr foo 1\r\n')
+        self.backend_streams[self.owner].incoming = b'2\r\n'
+
+        self.handler.process(client_stream, 'some backend', self.stop)
+        self.wait()
+
+        self.handler.pool_repository.replicate.assert_called_with(b'foo', b'delete foo noreply\r\n')
+
+    @istest
+    def deletes_replica_copies_on_meta_writes(self):
+        client_stream = ScriptedStream(b'ma foo\r\n')
+        self.backend_streams[self.owner].incoming = b'HD\r\n'
+
+        self.handler.process(client_stream, 'some backend', self.stop)
+        self.wait()
+
+        self.handler.pool_repository.replicate.assert_called_with(b'foo', b'md foo q\r\n')
+
+    @istest
+    def touches_replica_copies_on_gat(self):
+        client_stream = ScriptedStream(b'gat 60 foo\r\n')
+        self.backend_streams[self.owner].incoming = b'END\r\n'
+
+        self.handler.process(client_stream, 'some backend', self.stop)
+        self.wait()
+
+        self.assertEqual(self.backend_streams[self.owner].written, [b'gat 60 foo\r\n'])
+        self.handler.pool_repository.replicate.assert_called_with(b'foo', b'touch foo 60 noreply\r\n')
+
+    @istest
+    def reads_from_the_fastest_replica(self):
+        self.handler.pool_repository.selector.latencies = {self.owner: 0.5, self.replica: 0.001}
+        client_stream = ScriptedStream(b'get foo\r\n')
+        self.backend_streams[self.replica].incoming = b'VALUE foo 0 1\r\nx\r\nEND\r\n'
+
+        self.handler.process(client_stream, 'some backend', self.stop)
+        self.wait()
+
+        self.assertEqual(self.backend_streams[self.replica].written, [b'get foo\r\n'])
+        self.assertEqual(self.backend_streams[self.owner].written, [])
+
+    @istest
+    def reads_the_keys_missed_in_a_replica_from_their_owner(self):
+        self.handler.pool_repository.selector.latencies = {self.owner: 0.5, self.replica: 0.001}
+        client_stream = ScriptedStream(b'get foo\r\n')
+        self.backend_streams[self.replica].incoming = b'END\r\n'
+        self.backend_streams[self.owner].incoming = b'VALUE foo 0 1\r\n1\r\nEND\r\n'
+
+        self.handler.process(client_stream, 'some backend', self.stop)
+        self.wait()
+
+        self.assertEqual(self.backend_streams[self.owner].written, [b'get foo\r\n'])
+        self.assertEqual(client_stream.written, [b'VALUE foo 0 1\r\n1\r\nEND\r\n'])
+
+    @istest
+    def never_reads_the_keys_missed_in_their_owner_again(self):
+        self.handler.pool_repository.selector.latencies = {self.owner: 0.001, self.replica: 0.5}
+        client_stream = ScriptedStream(b'get foo\r\n')
+        self.backend_streams[self.owner].incoming = b'END\r\n'
+
+        self.handler.process(client_stream, 'some backend', self.stop)
+        self.wait()
+
+        self.assertEqual(self.backend_streams[self.owner].written, [b'get foo\r\n'])
+        self.assertEqual(self.backend_streams[self.replica].written, [])
+        self.assertEqual(client_stream.written, [b'END\r\n'])
+
+    @istest
+    def reads_gets_from_the_owner(self):
+        self.handler.pool_repository.selector.latencies = {self.owner: 0.5, self.replica: 0.001}
+        client_stream = ScriptedStream(b'gets foo\r\n')
+        self.backend_streams[self.owner].incoming = b'END\r\n'
+
+        self.handler.process(client_stream, 'some backend', self.stop)
+        self.wait()
+
+        self.assertEqual(self.backend_streams[self.owner].written, [b'gets foo\r\n'])
+
+    @istest
+    def measures_round_trips(self):
+        client_stream = ScriptedStream(b'get foo\r\n')
+        for stream in self.backend_streams.values():
+            stream.incoming = b'END\r\n'
+
+        self.handler.process(client_stream, 'some backend', self.stop)
+        self.wait()
+
+        selector = self.handler.pool_repository.selector
+        self.assertEqual(len(selector.latencies), 1)
+        self.assertEqual(sum(selector.in_flight.values()), 0)
+
+    @istest
+    def stops_measuring_the_round_trip_before_answering_the_client(self):
+        selector = self.handler.pool_repository.selector
+        client_stream = ScriptedStream(b'get foo\r\n')
+        in_flight = []
+
+        def write(data, callback=None):
+            in_flight.append(sum(selector.in_flight.values()))
+            callback()
+
+        client_stream.write = write
+        for stream in self.backend_streams.values():
+            stream.incoming = b'END\r\n'
+
+        self.handler.process(client_stream, 'some backend', self.stop)
+        self.wait()
+
+        self.assertEqual(in_flight, [0])
+        self.assertEqual(len(selector.latencies), 1)
+
+    @istest
+    def measures_no_round_trip_for_noreply_writes(self):
+        client_stream = ScriptedStream(b'set foo 0 0 1 noreply\r\nx\r\n')
+
+        self.handler.process(client_stream, 'some backend', self.stop)
+        self.wait()
+
+        self.assertEqual(self.backend_streams[self.owner].written, [b'set foo 0 0 1 noreply\r\nx\r\n'])
+        self.assertEqual(self.handler.pool_repository.selector.latencies, {})
+
+
+class TextHedgingTest(ServerTestCase):
+    nodes = [('10.0.0.1', 11211), ('10.0.0.2', 11211)]
+
+    def setUp(self):
+        super(TextHedgingTest, self).setUp()
+        self.handler = TextProtocolHandler(self.io_loop)
+        self.handler.pool_repository = ProxyRepository(self.io_loop, self.nodes, replicas=2)
+        self.handler.pool_repository.client_for_node = MagicMock()
+        self.handler.hedging = ReadHedging(percentile=50, budget=1, samples=10, min_samples=1)
+        self.handler.hedging.record(0.0)
+        self.owner = self.handler.pool_repository.ring.node_for_key(b'foo')
+        self.replica, = [node for node in self.nodes if node != self.owner]
+        self.handler.pool_repository.selector.latencies = {self.owner: 0.5, self.replica: 0.001}
+        self.hedge_client = self.handler.pool_repository.client_for_node.return_value
+
+    def slow_replica(self, incoming, hedged_values):
+        backend_stream = HeldStream(incoming)
+        self.handler.pool_repository.stream_for_node = lambda node: backend_stream
+
+        def get(keys, callback):
+            callback(hedged_values)
+            self.io_loop.add_callback(backend_stream.release)
+
+        self.hedge_client.get.side_effect = get
+        return backend_stream
+
+    @istest
+    def answers_with_the_hedge_when_the_replica_is_slow(self):
+        backend_stream = self.slow_replica(b'VALUE foo 0 3\r\nold\r\nEND\r\n', {b'foo': (0, b'new')})
+        client_stream = ScriptedStream(b'get foo\r\n')
+
+        self.handler.process(client_stream, 'some backend', self.stop)
+        self.wait()
+
+        self.handler.pool_repository.client_for_node.assert_called_with(self.owner)
+        self.assertEqual(client_stream.written, [b'VALUE foo 0 3\r\nnew\r\nEND\r\n'])
+        self.assertEqual(backend_stream.incoming, b'')
+
+    @istest
+    def ignores_hedges_missing_keys(self):
+        self.slow_replica(b'VALUE foo 0 3\r\nold\r\nEND\r\n', {})
+        client_stream = ScriptedStream(b'get foo\r\n')
+
+        self.handler.process(client_stream, 'some backend', self.stop)
+        self.wait()
+
+        self.assertEqual(client_stream.written, [b'VALUE foo 0 3\r\nold\r\nEND\r\n'])
+
+    @istest
+    def skips_the_hedge_when_the_replica_answers_in_time(self):
+        backend_stream = ScriptedStream(b'VALUE foo 0 1\r\nx\r\nEND\r\n')
+        self.handler.pool_repository.stream_for_node = lambda node: backend_stream
+        client_stream = ScriptedStream(b'get foo\r\n')
+
+        self.handler.process(client_stream, 'some backend', self.stop)
+        self.wait()
+
+        self.assertEqual(client_stream.written, [b'VALUE foo 0 1\r\nx\r\nEND\r\n'])
+        self.assertFalse(self.hedge_client.get.called)
+
+    @istest
+    def never_hedges_gets(self):
+        backend_stream = ScriptedStream(b'END\r\n')
+        self.handler.pool_repository.stream_for_node = lambda node: backend_stream
+        client_stream = ScriptedStream(b'gets foo\r\n')
+
+        self.handler.process(client_stream, 'some backend', self.stop)
+        self.wait()
+
+        self.assertEqual(self.handler.hedging.reads, 0)
@@ -0,0 +1,124 @@
+from unittest import TestCase
+
+from mock import MagicMock, call
+from nose.tools import istest
+
+from memcrashed.analytics import AccessCounts, KeySpaceAnalytics, MissRatioCurve
+
+
+class AccessCountsTest(TestCase):
+    @istest
+    def counts_up_to_a_time(self):
+        counts = AccessCounts(8)
+        for time in (1, 3, 4, 8):
+            counts.add(time, 1)
+        counts.add(3, -1)
+
+        self.assertEqual([counts.count_up_to(time) for time in range(9)], [0, 1, 1, 1, 2, 2, 2, 2, 3])
+
+
+class MissRatioCurveTest(TestCase):
+    def rounded(self, points):
+        return [(size, round(ratio, 4)) for size, ratio in points]
+
+    @istest
+    def misses_every_first_access(self):
+        curve = MissRatioCurve(rate=1)
+
+        for key in (b'a', b'b', b'c'):
+            curve.access(key)
+
+        self.assertEqual(curve.cold_misses, 3)
+        self.assertEqual(curve.points(), [(1, 1.0)])
+
+    @istest
+    def hits_at_the_sizes_above_the_reuse_distances(self):
+        curve = MissRatioCurve(rate=1)
+
+        for key in (b'a', b'b', b'c', b'a', b'a', b'c'):
+            curve.access(key)
+
+        self.assertEqual(self.rounded(curve.points()), [(1, 0.8333), (2, 0.6667), (4, 0.5)])
+
+    @istest
+    def scales_the_distances_up_by_the_sampling_rate(self):
+        curve = MissRatioCurve(rate=0.25)
+
+        for key in (b'a', b'b', b'a'):
+            curve.access(key)
+
+        self.assertEqual(self.rounded(curve.points())[-1], (8, 0.6667))
+        self.assertEqual(curve.working_set(), 8)
+
+    @istest
+    def forgets_the_least_recently_accessed_keys(self):
+        curve = MissRatioCurve(rate=1, max_keys=2)
+
+        for key in (b'a', b'b', b'c', b'a'):
+            curve.access(key)
+
+        self.assertEqual(curve.cold_misses, 4)
+        self.assertEqual(list(curve.last_access), [b'c', b'a'])
+
+    @istest
+    def keeps_the_distances_when_numbering_the_keys_again(self):
+        curve = MissRatioCurve(rate=1, max_keys=3)
+
+        for index in range(20):
+            curve.access((b'a', b'b', b'c')[index % 3])
+
+        self.assertEqual(curve.histogram, {2: 17})
+
+
+class KeySpaceAnalyticsTest(TestCase):
+    @istest
+    def samples_about_the_rate_of_the_keys(self):
+        analytics = KeySpaceAnalytics(sample_rate=0.1)
+
+        sampled = sum(1 for index in range(10000) if analytics.is_sampled('user:{}'.format(index).encode('ascii')))
+
+        self.assertTrue(800 < sampled < 1200, sampled)
+
+    @istest
+    def keeps_curves_for_each_backend_and_prefix(self):
+        analytics = KeySpaceAnalytics(sample_rate=1, prefix_separator=b':')
+
+        analytics.record([b'user:1', b'session:1'], ('10.0.0.1', 11211))
+        analytics.record([b'user:2', b'plain'], ('10.0.0.2', 11211))
+
+        self.assertEqual(analytics.curve.accesses, 4)
+        self.assertEqual(analytics.node_curves[('10.0.0.1', 11211)].accesses, 2)
+        self.assertEqual(analytics.node_curves[('10.0.0.2', 11211)].accesses, 2)
+        self.assertEqual(analytics.prefix_curves[b'user'].accesses, 2)
+        self.assertEqual(list(analytics.prefix_curves), [b'session', b'user', b''])
+
+    @istest
+    def keeps_a_bounded_number_of_prefixes(self):
+        analytics = KeySpaceAnalytics(sample_rate=1, prefix_separator=b':', max_prefixes=2)
+
+        analytics.record([b'user:1', b'session:1', b'user:2', b'cart:1'], ('10.0.0.1', 11211))
+
+        self.assertEqual(list(analytics.prefix_curves), [b'user', b'cart'])
+
+    @istest
+    def leaves_the_keys_not_sampled_out(self):
+        analytics = KeySpaceAnalytics(sample_rate=0)
+
+        analytics.record([b'user:1'], ('10.0.0.1', 11211))
+
+        self.assertEqual(analytics.curve.accesses, 0)
+        self.assertEqual(analytics.node_curves, {})
+
+    @istest
+    def dumps_the_curves(self):
+        analytics = KeySpaceAnalytics(sample_rate=1, prefix_separator=b':')
+        analytics.record([b'user:1', b'user:1'], ('10.0.0.1', 11211))
+        output = MagicMock()
+
+        analytics.dump(output)
+
+        self.assertEqual(output.write.call_args_list, [
+            call('Key space: accesses=2 working_set=1 miss_ratios=1:0.5000\n'),
+            call('Key space: backend=10.0.0.1:11211 accesses=2 working_set=1 miss_ratios=1:0.5000\n'),
+            call('Key space: prefix=user accesses=2 working_set=1 miss_ratios=1:0.5000\n'),
+        ])
@@ -0,0 +1,85 @@
+from unittest import TestCase
+
+from mock import MagicMock
+from nose.tools import istest
+
+from memcrashed.backend import BackendClient
+from .utils import ScriptedStream
+
+
+class BackendClientTest(TestCase):
+    @istest
+    def gets_values(self):
+        stream = ScriptedStream(b'VALUE foo 3 3\r\nbar\r\nVALUE foo2 0 4\r\nb\r\nz\r\nEND\r\n')
+        client = BackendClient(stream)
+        callback = MagicMock()
+
+        client.get([b'foo', b'foo2', b'foo3'], callback)
+
+        self.assertEqual(stream.written, [b'get foo foo2 foo3\r\n'])
+        callback.assert_called_with({
+            b'foo': (3, b'bar'),
+            b'foo2': (0, b'b\r\nz'),
+        })
+
+    @istest
+    def sets_a_value(self):
+        stream = ScriptedStream(b'STORED\r\n')
+        client = BackendClient(stream)
+        callback = MagicMock()
+
+        client.set(b'foo', 1, 60, b'bar', callback)
+
+        self.assertEqual(stream.written, [b'set foo 1 60 3\r\nbar\r\n'])
+        callback.assert_called_with(b'STORED')
+
+    @istest
+    def looks_the_flags_of_a_key_up(self):
+        stream = ScriptedStream(b'HD f16385\r\n')
+        client = BackendClient(stream)
+        callback = MagicMock()
+
+        client.flags(b'foo', callback)
+
+        self.assertEqual(stream.written, [b'mg foo f\r\n'])
+        callback.assert_called_with(16385)
+
+    @istest
+    def looks_the_flags_of_a_missing_key_up(self):
+        stream = ScriptedStream(b'EN\r\n')
+        client = BackendClient(stream)
+        callback = MagicMock()
+
+        client.flags(b'foo', callback)
+
+        callback.assert_called_with(None)
+
+    @istest
+    def deletes_a_value(self):
+        stream = ScriptedStream(b'DELETED\r\n')
+        client = BackendClient(stream)
+        callback = MagicMock()
+
+        client.delete(b'foo', callback)
+
+        self.assertEqual(stream.written, [b'delete foo\r\n'])
+        callback.assert_called_with(b'DELETED')
+
+    @istest
+    def reads_pipelined_responses_in_order(self):
+        stream = ScriptedStream()
+        client = BackendClient(stream)
+        calls = []
+        stream.read_until = MagicMock()
+
+        client.set(b'foo', 0, 0, b'bar', lambda response: calls.append(('set', response)))
+        client.get([b'foo'], lambda values: calls.append(('get', values)))
+
+        self.assertEqual(stream.written, [b'set foo 0 0 3\r\nbar\r\n', b'get foo\r\n'])
+        self.assertEqual(stream.read_until.call_count, 1)
+
+        stream.read_until.call_args[1]['callback'](b'STORED\r\n')
+        stream.read_until.call_args[1]['callback'](b'END\r\n')
+
+        self.assertEqual(calls, [('set', b'STORED'), ('get', {})])
+        self.assertFalse(client.reading)
@@ -0,0 +1,144 @@
+from unittest import TestCase
+
+from mock import MagicMock
+from nose.tools import istest
+
+from memcrashed.chunking import ValueChunker
+
+
+class FakeClient(object):
+    def __init__(self, items):
+        self.items = items
+
+    def set(self, key, flags, exptime, value, callback):
+        self.items[key] = (flags, value)
+        callback(b'STORED')
+
+    def get(self, keys, callback):
+        callback(dict((key, self.items[key]) for key in keys if key in self.items))
+
+    def flags(self, key, callback):
+        callback(self.items[key][0] if key in self.items else None)
+
+    def delete(self, key, callback):
+        callback(b'DELETED' if self.items.pop(key, None) is not None else b'NOT_FOUND')
+
+
+class ValueChunkerTest(TestCase):
+    def setUp(self):
+        self.items = {}
+        self.repository = MagicMock()
+        self.repository.client_for_key.return_value = FakeClient(self.items)
+        self.chunker = ValueChunker(self.repository, threshold=10, chunk_size=4)
+
+    @istest
+    def splits_only_values_above_threshold(self):
+        self.assertTrue(self.chunker.should_split(11))
+        self.assertFalse(self.chunker.should_split(10))
+
+    @istest
+    def marks_and_unmarks_flags(self):
+        flags = self.chunker.manifest_flags(3)
+
+        self.assertTrue(self.chunker.is_manifest(flags))
+        self.assertEqual(self.chunker.value_flags(flags), 3)
+
+    @istest
+    def stores_chunks_spread_by_key(self):
+        callback = MagicMock()
+
+        self.chunker.store(60, b'0123456789', callback)
+
+        manifest = callback.call_args[0][0]
+        token, count, length = manifest.split(b' ')
+        keys = self.chunker.chunk_keys(token, 3)
+        self.assertEqual(count, b'3')
+        self.assertEqual(length, b'10')
+        self.assertEqual([self.items[key][1] for key in keys], [b'0123', b'4567', b'89'])
+        for key in keys:
+            self.repository.client_for_key.assert_any_call(key)
+
+    @istest
+    def fails_storing_when_a_chunk_is_not_stored(self):
+        client = MagicMock()
+        client.set.side_effect = lambda key, flags, exptime, value, callback: callback(b'SERVER_ERROR out of memory')
+        self.repository.client_for_key.return_value = client
+        callback = MagicMock()
+
+        self.chunker.store(0, b'0123456789', callback)
+
+        callback.assert_called_with(None)
+
+    @istest
+    def fetches_stored_chunks(self):
+        store_callback = MagicMock()
+        fetch_callback = MagicMock()
+        self.chunker.store(0, b'0123456789', store_callback)
+
+        self.chunker.fetch(store_callback.call_args[0][0], fetch_callback)
+
+        fetch_callback.assert_called_with(b'0123456789')
+
+    @istest
+    def fails_fetching_when_a_chunk_is_gone(self):
+        store_callback = MagicMock()
+        fetch_callback = MagicMock()
+        self.chunker.store(0, b'0123456789', store_callback)
+        token = store_callback.call_args[0][0].split(b' ')[0]
+        del self.items[self.chunker.chunk_keys(token, 3)[1]]
+
+        self.chunker.fetch(store_callback.call_args[0][0], fetch_callback)
+
+        fetch_callback.assert_called_with(None)
+
+    @istest
+    def fails_fetching_from_corrupt_manifest(self):
+        callback = MagicMock()
+
+        self.chunker.fetch(b'corrupt', callback)
+
+        callback.assert_called_with(None)
+
+    def store_under_key(self, key, value):
+        callback = MagicMock()
+        self.chunker.store(0, value, callback)
+        manifest = callback.call_args[0][0]
+        self.items[key] = (self.chunker.manifest_flags(0), manifest)
+        return manifest
+
+    def chunks_of(self, manifest):
+        token, count, length = manifest.split(b' ')
+        return self.chunker.chunk_keys(token, int(count))
+
+    @istest
+    def deletes_the_previous_chunks_when_the_key_is_set_again(self):
+        previous = self.store_under_key(b'foo', b'0123456789')
+        callback = MagicMock()
+
+        self.chunker.discard_previous(b'foo', callback)
+
+        self.assertFalse(any(key in self.items for key in self.chunks_of(previous)))
+        callback.assert_called_with()
+
+    @istest
+    def looks_up_only_the_flags_of_values_not_chunked(self):
+        self.items[b'foo'] = (0, b'1 2 3')
+        self.repository.client_for_key.return_value = client = MagicMock(wraps=FakeClient(self.items))
+        callback = MagicMock()
+
+        self.chunker.discard_previous(b'foo', callback)
+
+        self.assertEqual(client.flags.call_args[0][0], b'foo')
+        self.assertFalse(client.get.called)
+        self.assertFalse(client.delete.called)
+        callback.assert_called_with()
+
+    @istest
+    def discards_nothing_for_missing_keys(self):
+        self.repository.client_for_key.return_value = client = MagicMock(wraps=FakeClient(self.items))
+        callback = MagicMock()
+
+        self.chunker.discard_previous(b'foo', callback)
+
+        self.assertFalse(client.delete.called)
+        callback.assert_called_with()
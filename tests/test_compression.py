@@ -0,0 +1,66 @@
+import zlib
+from unittest import TestCase
+
+from mock import MagicMock
+from nose.tools import istest
+
+from memcrashed.compression import ValueCompressor
+from .utils import SynchronousExecutor, immediate_io_loop
+
+
+class ValueCompressorTest(TestCase):
+    def setUp(self):
+        self.io_loop = immediate_io_loop()
+        self.compressor = ValueCompressor(self.io_loop, threshold=10, executor=SynchronousExecutor())
+
+    @istest
+    def compresses_only_values_above_threshold(self):
+        self.assertTrue(self.compressor.should_compress(0, 10))
+        self.assertFalse(self.compressor.should_compress(0, 9))
+
+    @istest
+    def does_not_compress_twice(self):
+        self.assertFalse(self.compressor.should_compress(ValueCompressor.DEFAULT_FLAG, 100))
+
+    @istest
+    def marks_and_unmarks_flags(self):
+        flags = self.compressor.compressed_flags(3)
+
+        self.assertTrue(self.compressor.is_compressed(flags))
+        self.assertEqual(self.compressor.decompressed_flags(flags), 3)
+
+    @istest
+    def compresses_a_value(self):
+        callback = MagicMock()
+        value = b'foo' * 100
+
+        self.compressor.compress(value, callback)
+
+        compressed = callback.call_args[0][0]
+        self.assertEqual(zlib.decompress(compressed), value)
+        self.io_loop.add_callback.assert_called_once()
+
+    @istest
+    def gives_up_compressing_incompressible_values(self):
+        callback = MagicMock()
+
+        self.compressor.compress(b'ab', callback)
+
+        callback.assert_called_with(None)
+
+    @istest
+    def decompresses_a_value(self):
+        callback = MagicMock()
+        value = b'foo' * 100
+
+        self.compressor.decompress(zlib.compress(value), callback)
+
+        callback.assert_called_with(value)
+
+    @istest
+    def gives_up_decompressing_corrupt_values(self):
+        callback = MagicMock()
+
+        self.compressor.decompress(b'not compressed', callback)
+
+        callback.assert_called_with(None)
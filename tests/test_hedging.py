@@ -0,0 +1,70 @@
+from unittest import TestCase
+
+from mock import ANY, MagicMock
+from nose.tools import istest
+
+from memcrashed.hedging import ReadHedging
+from memcrashed.proxy import HashRing, ProxyRepository
+from memcrashed.selection import BackendSelector
+
+
+class ReadHedgingTest(TestCase):
+    nodes = [('10.0.0.1', 11211), ('10.0.0.2', 11211), ('10.0.0.3', 11211)]
+
+    def setUp(self):
+        self.hedging = ReadHedging(percentile=90, budget=0.1, samples=100, min_samples=10)
+
+    def create_repository(self):
+        repository = MagicMock(ProxyRepository)
+        repository.ring = HashRing(self.nodes)
+        repository.replica_nodes.side_effect = lambda key: repository.ring.nodes_for_key(key, 2)
+        repository.selector = BackendSelector(sample=lambda nodes, count: nodes[:count])
+        clients = dict((node, MagicMock()) for node in self.nodes)
+        repository.client_for_node.side_effect = lambda node: clients[node]
+        return repository
+
+    @istest
+    def waits_for_enough_round_trips_before_hedging(self):
+        for index in range(9):
+            self.hedging.record(0.001)
+
+        self.assertIsNone(self.hedging.delay())
+
+    @istest
+    def delays_hedges_by_a_percentile_of_the_round_trips(self):
+        for index in range(100):
+            self.hedging.record(index / 1000.0)
+
+        self.assertEqual(self.hedging.delay(), 0.09)
+
+    @istest
+    def keeps_hedges_within_the_budget(self):
+        for index in range(20):
+            self.hedging.count_read()
+
+        self.assertTrue(self.hedging.allow())
+        self.assertTrue(self.hedging.allow())
+        self.assertFalse(self.hedging.allow())
+
+    @istest
+    def fetches_keys_from_replicas_other_than_the_slow_node(self):
+        repository = self.create_repository()
+        slow_node, other_node = repository.ring.nodes_for_key(b'foo', 2)
+        client = repository.client_for_node(other_node)
+        client.get.side_effect = lambda keys, callback: callback({b'foo': (3, b'value')})
+        callback = MagicMock()
+
+        self.hedging.fetch(repository, slow_node, [b'foo'], callback)
+
+        client.get.assert_called_with([b'foo'], callback=ANY)
+        callback.assert_called_with({b'foo': (3, b'value')})
+
+    @istest
+    def fetches_nothing_without_other_replicas(self):
+        repository = self.create_repository()
+        repository.replica_nodes.side_effect = lambda key: repository.ring.nodes_for_key(key, 1)
+        callback = MagicMock()
+
+        self.hedging.fetch(repository, repository.ring.node_for_key(b'foo'), [b'foo'], callback)
+
+        callback.assert_called_with({})
@@ -0,0 +1,125 @@
+from unittest import TestCase
+
+from mock import ANY, MagicMock
+from nose.tools import istest
+
+from memcrashed.leases import KeyLeases
+from memcrashed.proxy import ProxyRepository
+
+
+class KeyLeasesTest(TestCase):
+    node = ('127.0.0.1', 11211)
+
+    def setUp(self):
+        self.now = 1000
+        self.io_loop = MagicMock()
+        self.io_loop.add_callback.side_effect = lambda callback: callback()
+        self.leases = KeyLeases(self.io_loop, duration=2, max_stale=10, size=2, clock=lambda: self.now)
+        self.repository = MagicMock(ProxyRepository)
+        self.repository.read_keys_by_node.side_effect = lambda keys: {self.node: keys}
+        self.client = self.repository.client_for_node.return_value
+
+    def fill(self, client, keys):
+        callback = MagicMock()
+        self.leases.fill(self.repository, client, keys, callback)
+        return callback
+
+    @istest
+    def leases_a_missed_key_to_the_first_client(self):
+        callback = self.fill('first client', [b'foo'])
+
+        callback.assert_called_with({})
+        self.assertTrue(self.leases.is_leased(b'foo'))
+        self.io_loop.add_timeout.assert_called_with(ANY, ANY)
+
+    @istest
+    def does_not_make_the_holder_wait_for_itself(self):
+        self.fill('first client', [b'foo'])
+
+        callback = self.fill('first client', [b'foo'])
+
+        callback.assert_called_with({})
+        self.assertFalse(self.leases.is_hot(b'foo'))
+
+    @istest
+    def makes_other_clients_wait_for_the_refill(self):
+        self.client.get.side_effect = lambda keys, callback: callback({b'foo': (3, b'value')})
+        self.fill('first client', [b'foo'])
+
+        callback = self.fill('other client', [b'foo'])
+
+        self.assertFalse(callback.called)
+        self.assertTrue(self.leases.is_hot(b'foo'))
+
+        self.leases.release(b'foo')
+
+        self.client.get.assert_called_with([b'foo'], callback=ANY)
+        callback.assert_called_with({b'foo': (3, b'value')})
+        self.io_loop.remove_timeout.assert_called_with(self.io_loop.add_timeout.return_value)
+        self.assertFalse(self.leases.is_leased(b'foo'))
+
+    @istest
+    def serves_the_stale_value_of_a_hot_key_while_refilled(self):
+        self.fill('first client', [b'foo'])
+        self.fill('other client', [b'foo'])
+        self.leases.release(b'foo')
+        self.leases.remember(b'foo', 3, b'value')
+        self.now += 5
+
+        self.fill('first client', [b'foo'])
+        callback = self.fill('other client', [b'foo'])
+
+        callback.assert_called_with({b'foo': (3, b'value')})
+
+    @istest
+    def does_not_serve_values_too_old(self):
+        self.fill('first client', [b'foo'])
+        self.fill('other client', [b'foo'])
+        self.leases.release(b'foo')
+        self.leases.remember(b'foo', 3, b'value')
+        self.now += 11
+
+        self.fill('first client', [b'foo'])
+        callback = self.fill('other client', [b'foo'])
+
+        self.assertFalse(callback.called)
+
+    @istest
+    def forgets_the_value_when_the_key_gets_written(self):
+        self.fill('first client', [b'foo'])
+        self.fill('other client', [b'foo'])
+        self.leases.remember(b'foo', 3, b'value')
+
+        self.leases.release(b'foo')
+        self.fill('first client', [b'foo'])
+        callback = self.fill('other client', [b'foo'])
+
+        self.assertFalse(callback.called)
+
+    @istest
+    def does_not_remember_values_of_keys_not_contended(self):
+        self.leases.remember(b'foo', 3, b'value')
+
+        self.assertFalse(self.leases.is_hot(b'foo'))
+
+    @istest
+    def wakes_the_waiting_clients_when_the_lease_expires(self):
+        self.client.get.side_effect = lambda keys, callback: callback({})
+        self.fill('first client', [b'foo'])
+        callback = self.fill('other client', [b'foo'])
+
+        expire = self.io_loop.add_timeout.call_args[0][1]
+        expire()
+
+        callback.assert_called_with({})
+        self.assertFalse(self.leases.is_leased(b'foo'))
+
+    @istest
+    def keeps_a_bounded_number_of_hot_keys(self):
+        for key in [b'foo', b'bar', b'baz']:
+            self.fill('first client', [key])
+            self.fill('other client', [key])
+
+        self.assertFalse(self.leases.is_hot(b'foo'))
+        self.assertTrue(self.leases.is_hot(b'bar'))
+        self.assertTrue(self.leases.is_hot(b'baz'))
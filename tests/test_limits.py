@@ -0,0 +1,133 @@
+from unittest import TestCase
+
+from mock import MagicMock, ANY
+from nose.tools import istest
+
+from memcrashed.limits import BackendLimiter, BackendLimits
+
+
+class BackendLimiterTest(TestCase):
+    def setUp(self):
+        self.io_loop = MagicMock()
+
+    @istest
+    def admits_everything_without_a_cap(self):
+        limiter = BackendLimiter(self.io_loop)
+        callback = MagicMock()
+
+        limiter.acquire(callback)
+        limiter.acquire(callback)
+
+        self.assertEqual(callback.call_count, 2)
+        callback.assert_called_with(True)
+
+    @istest
+    def queues_requests_above_the_cap(self):
+        limiter = BackendLimiter(self.io_loop, max_in_flight=1)
+        first = MagicMock()
+        second = MagicMock()
+
+        limiter.acquire(first)
+        limiter.acquire(second)
+
+        first.assert_called_with(True)
+        self.assertFalse(second.called)
+
+        limiter.release()
+
+        second.assert_called_with(True)
+        self.assertEqual(limiter.in_flight, 1)
+
+    @istest
+    def rejects_requests_waiting_for_too_long(self):
+        limiter = BackendLimiter(self.io_loop, max_in_flight=1, max_queue_wait=0.5)
+        callback = MagicMock()
+
+        limiter.acquire(MagicMock())
+        limiter.acquire(callback)
+
+        self.io_loop.add_timeout.assert_called_with(ANY, ANY)
+        expire = self.io_loop.add_timeout.call_args[0][1]
+        expire()
+
+        callback.assert_called_with(False)
+        self.assertEqual(len(limiter.waiting), 0)
+
+    @istest
+    def cancels_the_timeout_when_admitted(self):
+        limiter = BackendLimiter(self.io_loop, max_in_flight=1, max_queue_wait=0.5)
+
+        limiter.acquire(MagicMock())
+        limiter.acquire(MagicMock())
+        limiter.release()
+
+        self.io_loop.remove_timeout.assert_called_with(self.io_loop.add_timeout.return_value)
+
+    @istest
+    def holds_readers_while_congested(self):
+        limiter = BackendLimiter(self.io_loop, high_watermark=10)
+        callback = MagicMock()
+
+        limiter.wrote(11)
+        limiter.wait_writable(callback)
+
+        self.assertTrue(limiter.is_congested())
+        self.assertFalse(callback.called)
+
+        limiter.flushed(11)
+
+        self.assertFalse(limiter.is_congested())
+        callback.assert_called_with()
+
+    @istest
+    def keeps_readers_held_above_low_watermark(self):
+        limiter = BackendLimiter(self.io_loop, high_watermark=10, low_watermark=2)
+        callback = MagicMock()
+
+        limiter.wrote(12)
+        limiter.wait_writable(callback)
+        limiter.flushed(5)
+
+        self.assertFalse(callback.called)
+
+
+class BackendLimitsTest(TestCase):
+    @istest
+    def keeps_one_limiter_per_backend(self):
+        limits = BackendLimits('some ioloop', max_in_flight=2, max_queue_wait=1, high_watermark=100)
+
+        limiter = limits.limiter_for('some backend')
+
+        self.assertIs(limits.limiter_for('some backend'), limiter)
+        self.assertIsNot(limits.limiter_for('other backend'), limiter)
+        self.assertEqual(limiter.max_in_flight, 2)
+        self.assertEqual(limiter.max_queue_wait, 1)
+        self.assertEqual(limiter.high_watermark, 100)
+
+    @istest
+    def waits_for_every_congested_backend_to_be_writable(self):
+        limits = BackendLimits('some ioloop', high_watermark=100)
+        first = limits.limiter_for('some backend')
+        second = limits.limiter_for('other backend')
+        first.wrote(101)
+        second.wrote(101)
+        callback = MagicMock()
+
+        limits.wait_writable(callback)
+        first.flushed(101)
+
+        self.assertFalse(callback.called)
+
+        second.flushed(101)
+
+        callback.assert_called_once_with()
+
+    @istest
+    def is_writable_at_once_without_congested_backends(self):
+        limits = BackendLimits('some ioloop', high_watermark=100)
+        limits.limiter_for('some backend').wrote(100)
+        callback = MagicMock()
+
+        limits.wait_writable(callback)
+
+        callback.assert_called_once_with()
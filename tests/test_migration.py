@@ -0,0 +1,93 @@
+from unittest import TestCase
+
+from mock import ANY, MagicMock
+from nose.tools import istest
+
+from memcrashed.migration import KeyMigration
+from memcrashed.proxy import HashRing, ProxyRepository
+
+
+class KeyMigrationTest(TestCase):
+    old_nodes = [('10.0.0.1', 11211)]
+    new_nodes = [('10.0.0.1', 11211), ('10.0.0.2', 11211)]
+
+    def setUp(self):
+        self.now = 1000.0
+        self.repository = self.create_repository(self.new_nodes)
+        self.previous_repository = self.create_repository(self.old_nodes)
+        self.migration = KeyMigration(self.repository, self.previous_repository, 60, clock=lambda: self.now)
+        self.moved_key = self.key_owned_by(self.new_nodes[1])
+        self.kept_key = self.key_owned_by(self.new_nodes[0])
+
+    def create_repository(self, nodes):
+        repository = MagicMock(ProxyRepository)
+        repository.backends = nodes
+        repository.ring = HashRing(nodes)
+        clients = dict((node, MagicMock()) for node in nodes)
+        repository.client_for_node.side_effect = lambda node: clients[node]
+        repository.client_for_key.side_effect = lambda key: clients[repository.ring.node_for_key(key)]
+        return repository
+
+    def key_owned_by(self, node):
+        index = 0
+        while self.repository.ring.node_for_key('key-{}'.format(index)) != node:
+            index += 1
+        return 'key-{}'.format(index).encode('ascii')
+
+    @istest
+    def finds_the_previous_owner_of_moved_keys(self):
+        self.assertEqual(self.migration.previous_node_for_key(self.moved_key), self.old_nodes[0])
+        self.assertIsNone(self.migration.previous_node_for_key(self.kept_key))
+
+    @istest
+    def ends_after_the_window(self):
+        self.now += 60
+
+        self.assertFalse(self.migration.is_active())
+        self.assertIsNone(self.migration.previous_node_for_key(self.moved_key))
+        self.previous_repository.close.assert_called_with()
+
+    @istest
+    def fetches_moved_keys_from_their_previous_owners(self):
+        client = self.repository.client_for_node(self.old_nodes[0])
+        client.get.side_effect = lambda keys, callback: callback({self.moved_key: (3, b'value')})
+        callback = MagicMock()
+
+        self.migration.fetch([self.moved_key, self.kept_key], callback)
+
+        client.get.assert_called_with([self.moved_key], callback=ANY)
+        callback.assert_called_with({self.moved_key: (3, b'value')})
+        self.assertFalse(self.repository.client_for_node(self.new_nodes[1]).set.called)
+
+    @istest
+    def copies_values_forward_without_overwriting(self):
+        self.migration.copy_ttl = 300
+        client = self.repository.client_for_node(self.old_nodes[0])
+        client.get.side_effect = lambda keys, callback: callback({self.moved_key: (3, b'value')})
+
+        self.migration.fetch([self.moved_key], MagicMock())
+
+        self.repository.client_for_node(self.new_nodes[1]).set.assert_called_with(
+            self.moved_key, 3, 300, b'value', ANY, command=b'add')
+
+    @istest
+    def skips_fetching_keys_that_did_not_move(self):
+        callback = MagicMock()
+
+        self.migration.fetch([self.kept_key], callback)
+
+        callback.assert_called_with({})
+
+    @istest
+    def deletes_previous_copies_of_written_keys(self):
+        self.migration.forget(self.moved_key)
+        self.migration.forget(self.kept_key)
+
+        client = self.repository.client_for_node(self.old_nodes[0])
+        client.delete.assert_called_once_with(self.moved_key, ANY)
+
+    @istest
+    def reaches_kept_nodes_through_the_current_repository(self):
+        self.migration.forget(self.moved_key)
+
+        self.assertFalse(self.previous_repository.client_for_node.called)
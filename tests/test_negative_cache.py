@@ -0,0 +1,81 @@
+from unittest import TestCase
+
+from nose.tools import istest
+
+from memcrashed.negative_cache import NegativeCache
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class NegativeCacheTest(TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.cache = NegativeCache(ttl=10, size=4096, clock=self.clock)
+
+    @istest
+    def remembers_missed_keys(self):
+        self.cache.add_misses([b'foo', b'bar'], self.cache.versions([b'foo', b'bar']))
+
+        self.assertTrue(self.cache.contains(b'foo'))
+        self.assertTrue(self.cache.contains(b'bar'))
+        self.assertFalse(self.cache.contains(b'baz'))
+
+    @istest
+    def forgets_invalidated_keys(self):
+        self.cache.add_misses([b'foo'], self.cache.versions([b'foo']))
+
+        self.cache.invalidate(b'foo')
+
+        self.assertFalse(self.cache.contains(b'foo'))
+
+    @istest
+    def ignores_misses_raced_by_an_invalidation(self):
+        versions = self.cache.versions([b'foo'])
+
+        self.cache.invalidate(b'foo')
+        self.cache.add_misses([b'foo'], versions)
+
+        self.assertFalse(self.cache.contains(b'foo'))
+
+    @istest
+    def keeps_misses_raced_by_the_invalidation_of_other_keys(self):
+        versions = self.cache.versions([b'foo'])
+
+        self.cache.invalidate(b'bar')
+        self.cache.add_misses([b'foo'], versions)
+
+        self.assertTrue(self.cache.contains(b'foo'))
+
+    @istest
+    def ignores_misses_of_keys_not_looked_up(self):
+        self.cache.add_misses([b'foo'], self.cache.versions([b'bar']))
+
+        self.assertFalse(self.cache.contains(b'foo'))
+
+    @istest
+    def keeps_keys_for_the_previous_generation(self):
+        self.cache.add_misses([b'foo'], self.cache.versions([b'foo']))
+
+        self.clock.now += 5
+
+        self.assertTrue(self.cache.contains(b'foo'))
+
+    @istest
+    def rotates_keys_out_after_the_ttl(self):
+        self.cache.add_misses([b'foo'], self.cache.versions([b'foo']))
+
+        self.clock.now += 10
+
+        self.assertFalse(self.cache.contains(b'foo'))
+
+    @istest
+    def accepts_text_keys(self):
+        self.cache.add_misses(['foo'], self.cache.versions(['foo']))
+
+        self.assertTrue(self.cache.contains(b'foo'))
@@ -58,6 +58,34 @@ class BinaryParserTest(TestCase):
         self.assertEqual(header.opaque, 0x00000000)
         self.assertEqual(header.cas, 0x0000000000000000)
 
+    @istest
+    def packs_response_header(self):
+        parser = BinaryParser()
+
+        header_bytes = parser.pack_response_header(0x0a, 0x85, opaque=7, total_body_length=12)
+
+        header = parser.unpack_response_header(header_bytes)
+        self.assertEqual(header.magic, 0x81)
+        self.assertEqual(header.opcode, 0x0a)
+        self.assertEqual(header.status, 0x85)
+        self.assertEqual(header.total_body_length, 12)
+        self.assertEqual(header.opaque, 7)
+        self.assertEqual(header.cas, 0)
+
+    @istest
+    def replaces_the_opaque_of_a_message(self):
+        parser = BinaryParser()
+        message_bytes = parser.pack_request_header(0x00, opaque=7, key_length=3, total_body_length=3, cas=5) + b'foo'
+
+        replaced_bytes = parser.replace_opaque(message_bytes, 0xdeadbeef)
+
+        header = parser.unpack_request_header(replaced_bytes[:24])
+        self.assertEqual(header.opaque, 0xdeadbeef)
+        self.assertEqual(header.opcode, 0x00)
+        self.assertEqual(header.total_body_length, 3)
+        self.assertEqual(header.cas, 5)
+        self.assertEqual(replaced_bytes[24:], b'foo')
+
 
 class TextParserTest(TestCase):
     @istest
@@ -327,3 +355,97 @@ class TextParserTest(TestCase):
         self.assertEqual(header.key, b'foo')
         self.assertTrue(header.noreply)
         self.assertTrue(parser.is_delete_touch_command(header.command))
+
+    @istest
+    def unpacks_gat_header(self):
+        parser = TextParser()
+        request_bytes = b'gat 300 foo bar\r\n'
+
+        header = parser.unpack_request_header(request_bytes)
+
+        self.assertEqual(header.raw, request_bytes)
+        self.assertEqual(header.command, b'gat')
+        self.assertEqual(header.exptime, 300)
+        self.assertEqual(header.keys, [b'foo', b'bar'])
+        self.assertTrue(parser.is_retrieval_command(header.command))
+        self.assertTrue(parser.is_touch_retrieval_command(header.command))
+
+    @istest
+    def unpacks_gats_header(self):
+        parser = TextParser()
+        request_bytes = b'gats 0 foo\r\n'
+
+        header = parser.unpack_request_header(request_bytes)
+
+        self.assertEqual(header.command, b'gats')
+        self.assertEqual(header.exptime, 0)
+        self.assertEqual(header.keys, [b'foo'])
+
+    @istest
+    def unpacks_meta_get_header(self):
+        parser = TextParser()
+        request_bytes = b'mg foo v f O123\r\n'
+
+        header = parser.unpack_request_header(request_bytes)
+
+        self.assertEqual(header.raw, request_bytes)
+        self.assertEqual(header.command, b'mg')
+        self.assertEqual(header.key, b'foo')
+        self.assertIsNone(header.bytes)
+        self.assertEqual(header.flags, [b'v', b'f', b'O123'])
+        self.assertFalse(header.quiet)
+        self.assertTrue(parser.is_meta_command(header.command))
+
+    @istest
+    def unpacks_quiet_meta_set_header(self):
+        parser = TextParser()
+        request_bytes = b'ms foo 2 T60 q\r\n'
+
+        header = parser.unpack_request_header(request_bytes)
+
+        self.assertEqual(header.command, b'ms')
+        self.assertEqual(header.key, b'foo')
+        self.assertEqual(header.bytes, 2)
+        self.assertEqual(header.flags, [b'T60', b'q'])
+        self.assertTrue(header.quiet)
+
+    @istest
+    def decodes_base64_meta_keys(self):
+        parser = TextParser()
+
+        header = parser.unpack_request_header(b'md Zm9v b\r\n')
+
+        self.assertEqual(header.key, b'foo')
+
+    @istest
+    def unpacks_meta_no_op_header(self):
+        parser = TextParser()
+
+        header = parser.unpack_request_header(b'mn\r\n')
+
+        self.assertEqual(header.command, b'mn')
+        self.assertIsNone(header.key)
+        self.assertFalse(parser.is_keyed_command(header.command))
+
+    @istest
+    def unpacks_admin_header(self):
+        parser = TextParser()
+        request_bytes = b'verbosity 1 noreply\r\n'
+
+        header = parser.unpack_request_header(request_bytes)
+
+        self.assertEqual(header.raw, request_bytes)
+        self.assertEqual(header.command, b'verbosity')
+        self.assertEqual(header.arguments, [b'1', b'noreply'])
+        self.assertTrue(header.noreply)
+        self.assertTrue(parser.is_admin_command(header.command))
+        self.assertFalse(parser.is_keyed_command(header.command))
+
+    @istest
+    def unpacks_unknown_commands_without_failing(self):
+        parser = TextParser()
+
+        header = parser.unpack_request_header(b'lru_crawler metadump all\r\n')
+
+        self.assertEqual(header.command, b'lru_crawler')
+        self.assertFalse(parser.is_known_command(header.command))
@@ -0,0 +1,186 @@
+from unittest import TestCase
+
+from mock import ANY, MagicMock
+from nose.tools import istest
+
+from memcrashed.passthrough import PassthroughRelay
+from .utils import ScriptedStream
+
+
+class RelayedStream(ScriptedStream):
+    '''
+    ScriptedStream whose bytes get streamed to the reader as they come, the way an IOStream does when reading
+    with a streaming callback; Its writes get flushed at once unless held.
+    '''
+
+    def __init__(self):
+        super(RelayedStream, self).__init__()
+        self.read_callback = None
+        self.close_callback = None
+        self.held = False
+        self.flush_callback = None
+
+    def read_bytes(self, byte_quantity, callback, streaming_callback=None):
+        self.remaining = byte_quantity
+        self.read_callback = callback
+        self.streaming_callback = streaming_callback
+
+    def set_close_callback(self, callback):
+        self.close_callback = callback
+
+    def receive(self, data):
+        self.remaining -= len(data)
+        self.streaming_callback(data)
+        if self.remaining == 0:
+            callback, self.read_callback = self.read_callback, None
+            callback(b'')
+
+    def write(self, data, callback=None):
+        if data:
+            self.written.append(data)
+        self.flush_callback = callback
+        if not self.held:
+            self.flush()
+
+    def flush(self):
+        callback, self.flush_callback = self.flush_callback, None
+        if callback is not None:
+            callback()
+
+    def close(self):
+        if not self.is_closed:
+            self.is_closed = True
+            self.close_callback()
+
+
+class PassthroughRelayTest(TestCase):
+    def setUp(self):
+        self.io_loop = MagicMock()
+        self.now = 100.0
+        self.relay = PassthroughRelay(self.io_loop, clock=lambda: self.now)
+        self.client_stream = RelayedStream()
+        self.backend_stream = RelayedStream()
+        self.closed_callback = MagicMock()
+        self.relay.relay(self.client_stream, self.backend_stream, self.closed_callback)
+
+    @istest
+    def copies_the_bytes_both_ways_as_they_come(self):
+        self.client_stream.receive(b'get fo')
+        self.client_stream.receive(b'o\r\n')
+        self.backend_stream.receive(b'END\r\n')
+
+        self.assertEqual(self.backend_stream.written, [b'get fo', b'o\r\n'])
+        self.assertEqual(self.client_stream.written, [b'END\r\n'])
+
+    @istest
+    def counts_the_bytes_and_connections(self):
+        self.relay.relay(RelayedStream(), RelayedStream())
+        self.client_stream.receive(b'get foo\r\n')
+        self.backend_stream.receive(b'END\r\n')
+
+        self.assertEqual(self.relay.client_bytes, 9)
+        self.assertEqual(self.relay.backend_bytes, 5)
+        self.assertEqual(self.relay.connections, 2)
+        self.assertEqual(self.relay.total_connections, 2)
+
+    @istest
+    def reads_in_large_chunks(self):
+        self.assertEqual(self.client_stream.read_chunk_size, PassthroughRelay.READ_CHUNK_SIZE)
+        self.assertEqual(self.backend_stream.read_chunk_size, PassthroughRelay.READ_CHUNK_SIZE)
+        self.assertEqual(self.client_stream.remaining, PassthroughRelay.READ_CHUNK_SIZE)
+
+    @istest
+    def keeps_reading_while_the_other_side_catches_up(self):
+        self.backend_stream.held = True
+
+        self.client_stream.receive(b'x' * PassthroughRelay.READ_CHUNK_SIZE)
+
+        self.assertIsNotNone(self.client_stream.read_callback)
+
+    @istest
+    def stops_reading_while_too_many_bytes_are_unflushed_to_the_other_side(self):
+        self.client_stream.held = True
+        chunks = PassthroughRelay.MAX_UNFLUSHED_BYTES // PassthroughRelay.READ_CHUNK_SIZE + 1
+
+        for _ in range(chunks):
+            self.backend_stream.receive(b'x' * PassthroughRelay.READ_CHUNK_SIZE)
+
+        self.assertIsNone(self.backend_stream.read_callback)
+
+        self.client_stream.flush()
+
+        self.assertIsNotNone(self.backend_stream.read_callback)
+        self.assertEqual(self.relay.backend_bytes, chunks * PassthroughRelay.READ_CHUNK_SIZE)
+
+    @istest
+    def closes_the_backend_when_the_client_leaves(self):
+        self.client_stream.close()
+
+        self.assertTrue(self.backend_stream.closed())
+        self.assertEqual(self.relay.connections, 0)
+        self.assertEqual(self.relay.total_connections, 1)
+        self.closed_callback.assert_called_once_with()
+
+    @istest
+    def closes_the_client_once_the_last_backend_bytes_are_flushed(self):
+        self.client_stream.held = True
+        self.backend_stream.receive(b'VALUE foo 0 1\r\nx\r\nEND\r\n')
+        self.backend_stream.close()
+
+        self.assertFalse(self.client_stream.closed())
+
+        self.client_stream.flush()
+
+        self.assertEqual(self.client_stream.written, [b'VALUE foo 0 1\r\nx\r\nEND\r\n'])
+        self.assertTrue(self.client_stream.closed())
+        self.assertEqual(self.relay.connections, 0)
+
+    @istest
+    def closes_quiet_connections_when_idle_at_once(self):
+        self.client_stream.receive(b'get foo\r\n')
+        self.backend_stream.receive(b'END\r\n')
+        self.now += PassthroughRelay.QUIET_SECONDS
+
+        self.relay.close_when_idle(self.client_stream)
+
+        self.assertTrue(self.client_stream.closed())
+        self.assertTrue(self.backend_stream.closed())
+
+    @istest
+    def waits_for_the_unflushed_bytes_before_closing_when_idle(self):
+        self.client_stream.held = True
+        self.backend_stream.receive(b'VALUE foo 0 1\r\n')
+        self.now += PassthroughRelay.QUIET_SECONDS
+
+        self.relay.close_when_idle(self.client_stream)
+
+        self.assertFalse(self.client_stream.closed())
+
+        self.client_stream.flush()
+
+        self.assertTrue(self.client_stream.closed())
+
+    @istest
+    def waits_for_the_connection_to_go_quiet_before_closing_when_idle(self):
+        self.client_stream.receive(b'get foo\r\n')
+
+        self.relay.close_when_idle(self.client_stream)
+
+        self.assertFalse(self.client_stream.closed())
+        self.io_loop.add_timeout.assert_called_once_with(100.0 + PassthroughRelay.QUIET_SECONDS, ANY)
+
+        self.backend_stream.receive(b'VALUE foo 0 1\r\nx\r\nEND\r\n')
+        self.now += PassthroughRelay.QUIET_SECONDS
+        self.io_loop.add_timeout.call_args[0][1]()
+
+        self.assertTrue(self.client_stream.closed())
+
+    @istest
+    def dumps_the_counts(self):
+        self.client_stream.receive(b'get foo\r\n')
+        self.backend_stream.receive(b'END\r\n')
+        output = MagicMock()
+
+        self.relay.dump(output)
+
+        output.write.assert_called_once_with('Passthrough: connections=1 total_connections=1 client_bytes=9 backend_bytes=5\n')
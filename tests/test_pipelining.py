@@ -0,0 +1,143 @@
+from unittest import TestCase
+
+from mock import MagicMock
+from nose.tools import istest
+
+from memcrashed.parser import BinaryParser
+from memcrashed.pipelining import OpaqueDemultiplexer, Pipeline
+from .utils import HeldStream
+
+
+class PipelineTest(TestCase):
+    def setUp(self):
+        self.stream = HeldStream(b'first\r\nsecond\r\n')
+        self.pipeline = Pipeline(self.stream)
+
+    def write(self, request_bytes):
+        callback = MagicMock()
+        self.pipeline.write(request_bytes, callback)
+        return callback.call_args[0][0]
+
+    @istest
+    def writes_requests_right_away(self):
+        self.write(b'get first\r\n')
+        self.write(b'get second\r\n')
+
+        self.assertEqual(self.stream.written, [b'get first\r\n', b'get second\r\n'])
+
+    @istest
+    def reads_the_responses_in_the_order_of_the_requests(self):
+        first_turn = self.write(b'get first\r\n')
+        second_turn = self.write(b'get second\r\n')
+        first_callback, second_callback = MagicMock(), MagicMock()
+
+        second_turn.read_until(b'\r\n', second_callback)
+        first_turn.read_until(b'\r\n', first_callback)
+        self.stream.release()
+
+        first_callback.assert_called_with(b'first\r\n')
+        self.assertFalse(second_callback.called)
+
+        first_turn.finish()
+
+        second_callback.assert_called_with(b'second\r\n')
+
+    @istest
+    def lets_the_next_turn_read_right_away_once_finished(self):
+        self.stream.release()
+        first_turn = self.write(b'get first\r\n')
+        second_turn = self.write(b'get second\r\n')
+        first_turn.read_bytes(7, MagicMock())
+        first_turn.finish()
+        callback = MagicMock()
+
+        second_turn.read_bytes(8, callback)
+
+        callback.assert_called_with(b'second\r\n')
+        self.assertEqual(list(self.pipeline.turns), [second_turn])
+
+    @istest
+    def finishes_turns_only_once(self):
+        first_turn = self.write(b'get first\r\n')
+        second_turn = self.write(b'get second\r\n')
+
+        first_turn.finish()
+        first_turn.finish()
+
+        self.assertEqual(list(self.pipeline.turns), [second_turn])
+
+    @istest
+    def delegates_the_rest_to_the_stream(self):
+        turn = self.write(b'get first\r\n')
+
+        self.assertFalse(turn.closed())
+
+
+class OpaqueDemultiplexerTest(TestCase):
+    def setUp(self):
+        self.parser = BinaryParser()
+        self.stream = HeldStream()
+        self.demultiplexer = OpaqueDemultiplexer(self.stream, self.parser)
+
+    def request(self, opcode, opaque, key=b''):
+        return self.parser.pack_request_header(opcode, opaque=opaque, key_length=len(key), total_body_length=len(key)) + key
+
+    def response(self, opcode, opaque, value=b''):
+        return self.parser.pack_response_header(opcode, 0, opaque=opaque, total_body_length=len(value)) + value
+
+    def write(self, request_bytes):
+        callback = MagicMock()
+        self.demultiplexer.write(request_bytes, callback)
+        return callback.call_args[0][0]
+
+    def read(self, turn, num_bytes):
+        callback = MagicMock(side_effect=lambda data: turn.finish())
+        turn.read_bytes(num_bytes, callback)
+        return callback
+
+    @istest
+    def replaces_the_opaques_of_the_requests(self):
+        self.write(self.request(0x09, 7, b'foo') + self.request(0x0a, 8))
+        self.write(self.request(0x0a, 7))
+
+        self.assertEqual(self.stream.written, [
+            self.request(0x09, 1, b'foo') + self.request(0x0a, 2),
+            self.request(0x0a, 3),
+        ])
+
+    @istest
+    def routes_the_responses_back_in_any_order(self):
+        first_turn = self.write(self.request(0x00, 7, b'foo'))
+        second_turn = self.write(self.request(0x00, 7, b'bar'))
+        first_read = self.read(first_turn, 25)
+        second_read = self.read(second_turn, 25)
+
+        self.stream.incoming = self.response(0x00, 2, b'y') + self.response(0x00, 1, b'x')
+        self.stream.release()
+
+        first_read.assert_called_with(self.response(0x00, 7, b'x'))
+        second_read.assert_called_with(self.response(0x00, 7, b'y'))
+
+    @istest
+    def throws_away_responses_of_finished_turns(self):
+        first_turn = self.write(self.request(0x09, 7, b'foo') + self.request(0x0a, 8))
+        second_turn = self.write(self.request(0x0a, 9))
+        first_turn.finish()
+        second_read = self.read(second_turn, 24)
+
+        self.stream.incoming = self.response(0x09, 1, b'x') + self.response(0x0a, 2) + self.response(0x0a, 3)
+        self.stream.release()
+
+        second_read.assert_called_with(self.response(0x0a, 9))
+        self.assertEqual(first_turn.received, b'')
+
+    @istest
+    def skips_opaques_still_in_use_when_wrapping_around(self):
+        self.demultiplexer.last_opaque = OpaqueDemultiplexer.MAX_OPAQUE - 1
+        self.demultiplexer.routes[1] = 'turn in flight'
+
+        self.write(self.request(0x0a, 7) + self.request(0x0a, 8))
+
+        self.assertEqual(self.stream.written, [
+            self.request(0x0a, OpaqueDemultiplexer.MAX_OPAQUE) + self.request(0x0a, 2),
+        ])
@@ -0,0 +1,120 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from mock import MagicMock, patch
+from nose.tools import istest
+
+from memcrashed import profiling
+from memcrashed.profiling import Profiler
+
+
+class FakeCode(object):
+    def __init__(self, co_filename, co_name):
+        self.co_filename = co_filename
+        self.co_name = co_name
+
+
+class FakeFrame(object):
+    def __init__(self, name, f_back=None, module='/src/memcrashed/handlers/text.py'):
+        self.f_code = FakeCode(module, name)
+        self.f_back = f_back
+
+
+class StageTest(TestCase):
+    def tearDown(self):
+        profiling.enter(profiling.OTHER)
+
+    @istest
+    def keeps_the_stage_entered_last(self):
+        profiling.enter(profiling.ROUTE)
+        profiling.enter(profiling.BACKEND_WRITE)
+
+        self.assertEqual(profiling.current_stage(), profiling.BACKEND_WRITE)
+
+
+class ProfilerTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.io_loop = MagicMock()
+        self.output = MagicMock()
+        self.profiler = Profiler(self.io_loop, self.directory, interval=0.01, output=self.output, clock=lambda: 1000)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        profiling.enter(profiling.OTHER)
+
+    def read(self, path):
+        with open(path) as profile_file:
+            return profile_file.read()
+
+    @istest
+    @patch('memcrashed.profiling.tracemalloc', None)
+    @patch('memcrashed.profiling.signal')
+    def starts_the_cpu_timer_for_a_while(self, signal_module):
+        self.assertTrue(self.profiler.start(10))
+
+        signal_module.signal.assert_called_with(signal_module.SIGPROF, self.profiler._sample)
+        signal_module.setitimer.assert_called_with(signal_module.ITIMER_PROF, 0.01, 0.01)
+        self.assertEqual(self.io_loop.add_timeout.call_args[0][1], self.profiler.stop)
+        self.assertTrue(self.profiler.is_running())
+
+    @istest
+    @patch('memcrashed.profiling.tracemalloc', None)
+    @patch('memcrashed.profiling.signal')
+    def does_not_start_twice(self, signal_module):
+        self.profiler.start(10)
+
+        self.assertFalse(self.profiler.start(10))
+        self.assertEqual(self.io_loop.add_timeout.call_count, 1)
+
+    @istest
+    @patch('memcrashed.profiling.tracemalloc', None)
+    @patch('memcrashed.profiling.signal')
+    def writes_the_collapsed_stacks_by_stage(self, signal_module):
+        self.profiler.start(10)
+        main = FakeFrame('main', module='/usr/lib/python/tornado/iostream.py')
+        process = FakeFrame('_process_request', main)
+        route = FakeFrame('_route', process)
+        profiling.enter(profiling.ROUTE)
+        self.profiler._sample(signal_module.SIGPROF, route)
+        self.profiler._sample(signal_module.SIGPROF, route)
+        profiling.enter(profiling.PARSE)
+        self.profiler._sample(signal_module.SIGPROF, process)
+
+        paths = self.profiler.stop()
+
+        signal_module.setitimer.assert_called_with(signal_module.ITIMER_PROF, 0, 0)
+        signal_module.signal.assert_called_with(signal_module.SIGPROF, signal_module.SIG_DFL)
+        self.io_loop.remove_timeout.assert_called_with(self.io_loop.add_timeout.return_value)
+        self.assertEqual(paths, [os.path.join(self.directory, 'memcrashed-{}-1000.collapsed'.format(os.getpid()))])
+        self.assertEqual(self.read(paths[0]), (
+            'parse;iostream.py:main;text.py:_process_request 1\n'
+            'route;iostream.py:main;text.py:_process_request;text.py:_route 2\n'
+        ))
+        self.output.write.assert_called_with('Profile written to {}\n'.format(paths[0]))
+        self.assertFalse(self.profiler.is_running())
+
+    @istest
+    @patch('memcrashed.profiling.tracemalloc')
+    @patch('memcrashed.profiling.signal')
+    def writes_the_top_allocation_sites(self, signal_module, tracemalloc):
+        tracemalloc.is_tracing.return_value = True
+        snapshot = tracemalloc.take_snapshot.return_value.filter_traces.return_value
+        snapshot.statistics.return_value = ['proxy.py:10: size=2 KiB', 'text.py:20: size=1 KiB']
+
+        self.profiler.start(10)
+        paths = self.profiler.stop()
+
+        tracemalloc.start.assert_called_with(1)
+        tracemalloc.stop.assert_called_with()
+        snapshot.statistics.assert_called_with('lineno')
+        self.assertEqual(len(paths), 2)
+        self.assertTrue(paths[1].endswith('.allocations'))
+        self.assertEqual(self.read(paths[1]), 'proxy.py:10: size=2 KiB\ntext.py:20: size=1 KiB\n')
+
+    @istest
+    def does_nothing_when_stopped_without_running(self):
+        self.assertEqual(self.profiler.stop(), [])
+        self.assertFalse(self.output.write.called)
@@ -1,6 +1,13 @@
+from unittest import TestCase
+
+from mock import ANY, MagicMock, patch
 from nose.tools import istest
 
-from memcrashed.proxy import Proxy, ProxyRepository
+from memcrashed.backend import BackendClient
+from memcrashed.migration import KeyMigration
+from memcrashed.proxy import HashRing, Proxy, ProxyRepository, ShadowPool
+from memcrashed.sasl import AuthenticatingStream, plain_auth_request
+from memcrashed.sockets import BatchingStream, FlushCallbackStream
 from .utils import ServerTestCase
 
 
@@ -14,3 +21,305 @@ class ProxyRepositoryTest(ServerTestCase):
         self.assertIsInstance(proxy, Proxy)
         self.assertEqual(proxy.key, 'foo')
         self.assertEqual(proxy.io_loop, self.io_loop)
+
+    @istest
+    def defaults_to_local_memcached(self):
+        repository = ProxyRepository(self.io_loop)
+
+        self.assertEqual(repository.default_node, ('127.0.0.1', 11211))
+        self.assertFalse(repository.is_sharded())
+
+    @istest
+    def gets_proxy_with_node_owning_the_key(self):
+        repository = ProxyRepository(self.io_loop, [('127.0.0.1', 11211), ('127.0.0.1', 11212)])
+
+        proxy = repository.proxy_for_key(b'foo')
+
+        self.assertTrue(repository.is_sharded())
+        self.assertEqual(proxy.node, repository.ring.node_for_key(b'foo'))
+
+    @istest
+    def gets_proxy_with_previous_node_while_migrating(self):
+        previous_repository = ProxyRepository(self.io_loop, [('10.0.0.1', 11211)])
+        repository = ProxyRepository(self.io_loop, [('10.0.0.2', 11211)])
+        repository.migration = KeyMigration(repository, previous_repository, 60)
+
+        proxy = repository.proxy_for_key(b'foo')
+
+        self.assertTrue(repository.is_migrating())
+        self.assertEqual(proxy.node, ('10.0.0.2', 11211))
+        self.assertEqual(proxy.previous_node, ('10.0.0.1', 11211))
+
+    @istest
+    def reads_from_replicas_picked_by_the_selector(self):
+        repository = ProxyRepository(self.io_loop, [('10.0.0.1', 11211), ('10.0.0.2', 11211)], replicas=2)
+        repository.selector = MagicMock()
+        repository.selector.choose.return_value = ('10.0.0.2', 11211)
+
+        node = repository.node_for_read(b'foo')
+
+        self.assertTrue(repository.is_replicated())
+        self.assertEqual(node, ('10.0.0.2', 11211))
+        repository.selector.choose.assert_called_with(repository.ring.nodes_for_key(b'foo', 2))
+
+    @istest
+    def reads_from_owners_without_replicas(self):
+        repository = ProxyRepository(self.io_loop, [('10.0.0.1', 11211), ('10.0.0.2', 11211)])
+
+        self.assertFalse(repository.is_replicated())
+        self.assertEqual(repository.node_for_read(b'foo'), repository.ring.node_for_key(b'foo'))
+
+    @istest
+    def sends_writes_to_the_other_replicas(self):
+        repository = ProxyRepository(self.io_loop, [('10.0.0.1', 11211), ('10.0.0.2', 11211), ('10.0.0.3', 11211)], replicas=2)
+        repository.replica_writer = MagicMock(ShadowPool)
+
+        repository.replicate(b'foo', b'some request')
+
+        repository.replica_writer.mirror_to_node.assert_called_once_with(repository.replica_nodes(b'foo')[1], b'some request')
+
+    @istest
+    @patch('memcrashed.proxy.create_stream')
+    def never_drops_replica_writes(self, create_stream):
+        repository = ProxyRepository(self.io_loop, [('10.0.0.1', 11211), ('10.0.0.2', 11211)], replicas=2)
+
+        repository.replicate(b'foo', b'some request')
+
+        self.assertIsNone(repository.replica_writer.max_pending)
+        self.assertEqual(repository.replica_writer.read_fraction, 0)
+
+    @istest
+    @patch('memcrashed.proxy.create_stream')
+    def keeps_one_stream_per_node(self, create_stream):
+        repository = ProxyRepository(self.io_loop, write_batching=False)
+        create_stream.return_value.closed.return_value = False
+
+        stream = repository.stream_for_node(('127.0.0.1', 11211))
+
+        self.assertIsInstance(stream, FlushCallbackStream)
+        self.assertIs(stream.stream, create_stream.return_value)
+        self.assertIs(repository.stream_for_node(('127.0.0.1', 11211)), stream)
+        self.assertEqual(create_stream.call_count, 1)
+
+    @istest
+    @patch('memcrashed.proxy.create_stream')
+    def hands_the_streams_of_a_node_out_in_turns(self, create_stream):
+        repository = ProxyRepository(self.io_loop, write_batching=False, connections=2)
+        create_stream.side_effect = lambda *args: MagicMock(**{'closed.return_value': False})
+
+        streams = [repository.stream_for_node(('127.0.0.1', 11211)) for index in range(4)]
+
+        self.assertIsNot(streams[0], streams[1])
+        self.assertEqual(streams[2:], streams[:2])
+        self.assertEqual(create_stream.call_count, 2)
+
+    @istest
+    @patch('memcrashed.proxy.create_stream')
+    def authenticates_shared_streams(self, create_stream):
+        repository = ProxyRepository(self.io_loop, write_batching=False, credentials=(b'user', b'secret'))
+        create_stream.return_value.closed.return_value = False
+
+        stream = repository.stream_for_node(('127.0.0.1', 11211))
+
+        self.assertIsInstance(stream.stream, AuthenticatingStream)
+        self.assertIs(stream.stream.stream, create_stream.return_value)
+        create_stream.return_value.write.assert_called_with(plain_auth_request(b'user', b'secret'))
+        self.assertIs(repository.client_for_node(('127.0.0.1', 11211)).stream.stream, create_stream.return_value)
+
+    @istest
+    @patch('memcrashed.proxy.create_stream')
+    def reconnects_closed_streams(self, create_stream):
+        repository = ProxyRepository(self.io_loop, write_batching=False)
+        create_stream.return_value.closed.return_value = True
+
+        repository.stream_for_node(('127.0.0.1', 11211))
+        repository.stream_for_node(('127.0.0.1', 11211))
+
+        self.assertEqual(create_stream.call_count, 2)
+
+    @istest
+    @patch('memcrashed.proxy.create_stream')
+    def batches_writes_by_default(self, create_stream):
+        repository = ProxyRepository(self.io_loop)
+
+        self.assertIsInstance(repository.stream_for_key(b'foo'), BatchingStream)
+
+    @istest
+    @patch('memcrashed.proxy.create_stream')
+    def keeps_clients_apart_from_streams(self, create_stream):
+        repository = ProxyRepository(self.io_loop, write_batching=False)
+        create_stream.side_effect = lambda *args: MagicMock()
+
+        client = repository.client_for_node(('127.0.0.1', 11211))
+        stream = repository.stream_for_node(('127.0.0.1', 11211))
+
+        self.assertIsInstance(client, BackendClient)
+        self.assertIsNot(client.stream, stream)
+
+    @istest
+    @patch('memcrashed.proxy.create_stream')
+    def closes_everything(self, create_stream):
+        repository = ProxyRepository(self.io_loop, write_batching=False)
+        create_stream.side_effect = lambda *args: MagicMock()
+        client = repository.client_for_key(b'foo')
+        stream = repository.stream_for_key(b'foo')
+
+        repository.close()
+
+        client.stream.close.assert_called_with()
+        stream.close.assert_called_with()
+        self.assertEqual(repository.streams, {})
+        self.assertEqual(repository.clients, {})
+
+
+class ShadowPoolTest(TestCase):
+    nodes = [('10.0.0.1', 11211), ('10.0.0.2', 11211)]
+
+    def setUp(self):
+        self.streams = dict((node, MagicMock()) for node in self.nodes)
+        for stream in self.streams.values():
+            stream.closed.return_value = False
+        self.shadow = ShadowPool('some ioloop', self.nodes, read_fraction=0.25, max_pending=10, sample=lambda: 0.5)
+        self.shadow.repository = MagicMock(ProxyRepository)
+        self.shadow.repository.ring = HashRing(self.nodes)
+        self.shadow.repository.default_node = self.nodes[0]
+        self.shadow.repository.stream_for_node.side_effect = lambda node: self.streams[node]
+
+    @istest
+    def mirrors_requests_to_the_node_owning_the_key(self):
+        node = self.shadow.ring.node_for_key(b'foo')
+
+        self.shadow.mirror(b'foo', b'some request')
+
+        self.streams[node].write.assert_called_with(b'some request', ANY)
+
+    @istest
+    def discards_the_responses(self):
+        self.shadow.mirror(None, b'request')
+        self.shadow.mirror(None, b'request')
+
+        stream = self.streams[self.nodes[0]]
+        self.assertEqual(stream.read_until_close.call_count, 1)
+        self.assertIn('streaming_callback', stream.read_until_close.call_args[1])
+
+    @istest
+    def drops_requests_while_the_node_is_behind(self):
+        stream = self.streams[self.nodes[0]]
+
+        self.shadow.mirror(None, b'123456')
+        self.shadow.mirror(None, b'123456')
+
+        self.assertEqual(stream.write.call_count, 1)
+
+        flushed = stream.write.call_args[0][1]
+        flushed()
+        self.shadow.mirror(None, b'123456')
+
+        self.assertEqual(stream.write.call_count, 2)
+
+    @istest
+    def forgets_closed_streams(self):
+        stream = self.streams[self.nodes[0]]
+        self.shadow.mirror(None, b'123456')
+
+        close_callback = stream.set_close_callback.call_args[0][0]
+        close_callback()
+
+        self.assertNotIn(stream, self.shadow.pending)
+
+    @istest
+    def samples_reads(self):
+        self.assertFalse(self.shadow.samples_read())
+
+        self.shadow.sample = lambda: 0.1
+
+        self.assertTrue(self.shadow.samples_read())
+
+
+class HashRingTest(TestCase):
+    nodes = [('10.0.0.1', 11211), ('10.0.0.2', 11211), '/var/run/memcached.sock']
+
+    @istest
+    def maps_keys_to_nodes_consistently(self):
+        ring = HashRing(self.nodes)
+        other_ring = HashRing(list(reversed(self.nodes)))
+
+        for index in range(100):
+            key = 'key-{}'.format(index).encode('ascii')
+            self.assertIn(ring.node_for_key(key), self.nodes)
+            self.assertEqual(ring.node_for_key(key), other_ring.node_for_key(key))
+
+    @istest
+    def spreads_keys_among_nodes(self):
+        ring = HashRing(self.nodes)
+
+        owners = set(ring.node_for_key('key-{}'.format(index).encode('ascii')) for index in range(100))
+
+        self.assertEqual(len(owners), len(self.nodes))
+
+    @istest
+    def moves_only_the_keys_of_a_removed_node(self):
+        ring = HashRing(self.nodes)
+        smaller_ring = HashRing(self.nodes[:2])
+
+        for index in range(100):
+            key = 'key-{}'.format(index).encode('ascii')
+            if ring.node_for_key(key) != self.nodes[2]:
+                self.assertEqual(smaller_ring.node_for_key(key), ring.node_for_key(key))
+
+    @istest
+    def groups_keys_by_node(self):
+        ring = HashRing(self.nodes)
+        keys = ['key-{}'.format(index).encode('ascii') for index in range(20)]
+
+        groups = ring.keys_by_node(keys)
+
+        self.assertEqual(sorted(key for node_keys in groups.values() for key in node_keys), sorted(keys))
+        for node, node_keys in groups.items():
+            for key in node_keys:
+                self.assertEqual(ring.node_for_key(key), node)
+
+    @istest
+    def groups_keys_like_single_lookups(self):
+        keys = ['key-{}'.format(index).encode('ascii') for index in range(200)]
+
+        groups = HashRing(self.nodes).keys_by_node(keys)
+
+        ring = HashRing(self.nodes)
+        for node, node_keys in groups.items():
+            for key in node_keys:
+                self.assertEqual(ring.node_for_key(key), node)
+
+    @istest
+    def remembers_recent_keys(self):
+        ring = HashRing(self.nodes)
+        node = ring.node_for_key(b'foo')
+        ring.hash_key = MagicMock()
+
+        self.assertEqual(ring.node_for_key(b'foo'), node)
+        self.assertEqual(ring.keys_by_node([b'foo']), {node: [b'foo']})
+        self.assertFalse(ring.hash_key.called)
+
+    @istest
+    def bounds_the_remembered_keys(self):
+        ring = HashRing(self.nodes, memo_size=10)
+
+        ring.keys_by_node(['key-{}'.format(index).encode('ascii') for index in range(25)])
+
+        self.assertLessEqual(len(ring.memo), 10)
+
+    @istest
+    def lists_distinct_replicas_starting_with_the_owner(self):
+        ring = HashRing(self.nodes)
+
+        for index in range(20):
+            key = 'key-{}'.format(index).encode('ascii')
+            replicas = ring.nodes_for_key(key, 2)
+            self.assertEqual(replicas[0], ring.node_for_key(key))
+            self.assertEqual(len(set(replicas)), 2)
+
+    @istest
+    def lists_at_most_every_node_as_replicas(self):
+        ring = HashRing(self.nodes)
+
+        self.assertEqual(sorted(ring.nodes_for_key(b'foo', 5), key=str), sorted(self.nodes, key=str))
@@ -0,0 +1,135 @@
+from unittest import TestCase
+
+from nose.tools import istest
+
+from memcrashed.quotas import TenantQuotas, TokenBucket
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeStream(object):
+    pass
+
+
+class TokenBucketTest(TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.bucket = TokenBucket(rate=10, burst=20, clock=self.clock)
+
+    @istest
+    def starts_full(self):
+        self.bucket.take(19)
+
+        self.assertTrue(self.bucket.has_tokens())
+
+    @istest
+    def runs_out_of_tokens(self):
+        self.bucket.take(20)
+
+        self.assertFalse(self.bucket.has_tokens())
+
+    @istest
+    def refills_with_time(self):
+        self.bucket.take(20)
+        self.clock.now += 0.5
+
+        self.assertTrue(self.bucket.has_tokens())
+        self.assertEqual(self.bucket.tokens, 5)
+
+    @istest
+    def refills_up_to_the_burst(self):
+        self.clock.now += 100
+
+        self.bucket.has_tokens()
+
+        self.assertEqual(self.bucket.tokens, 20)
+
+    @istest
+    def pays_debts_before_allowing_more(self):
+        self.bucket.take(50)
+        self.clock.now += 2
+
+        self.assertFalse(self.bucket.has_tokens())
+
+        self.clock.now += 1.5
+
+        self.assertTrue(self.bucket.has_tokens())
+
+
+class TenantQuotasTest(TestCase):
+    def setUp(self):
+        self.clock = Clock()
+
+    @istest
+    def limits_operations_per_tenant(self):
+        quotas = TenantQuotas(ops_rate=2, clock=self.clock)
+
+        self.assertTrue(quotas.allow('10.0.0.1', 1, 100))
+        self.assertTrue(quotas.allow('10.0.0.1', 1, 100))
+        self.assertFalse(quotas.allow('10.0.0.1', 1, 100))
+        self.assertTrue(quotas.allow('10.0.0.2', 1, 100))
+
+    @istest
+    def limits_bytes_per_tenant(self):
+        quotas = TenantQuotas(bytes_rate=1000, clock=self.clock)
+
+        self.assertTrue(quotas.allow('10.0.0.1', 100, 600))
+        quotas.charge('10.0.0.1', 500)
+
+        self.assertFalse(quotas.allow('10.0.0.1', 1, 10))
+
+        self.clock.now += 0.2
+
+        self.assertTrue(quotas.allow('10.0.0.1', 1, 10))
+
+    @istest
+    def takes_nothing_from_requests_not_allowed(self):
+        quotas = TenantQuotas(ops_rate=1, bytes_rate=1000, clock=self.clock)
+        quotas.allow('10.0.0.1', 1, 100)
+
+        self.assertFalse(quotas.allow('10.0.0.1', 1, 100))
+        self.assertEqual(quotas.buckets['10.0.0.1'][1].tokens, 900)
+
+    @istest
+    def allows_bursts_of_some_seconds(self):
+        quotas = TenantQuotas(ops_rate=2, burst=3, clock=self.clock)
+
+        allowed = [quotas.allow('10.0.0.1', 1, 0) for index in range(7)]
+
+        self.assertEqual(allowed, [True] * 6 + [False])
+
+    @istest
+    def tells_tenants_by_client_host(self):
+        quotas = TenantQuotas(ops_rate=2)
+        client, unix_client = FakeStream(), FakeStream()
+
+        quotas.connect(client, ('10.0.0.1', 43210))
+        quotas.connect(unix_client, '')
+
+        self.assertEqual(quotas.tenant(client, b'user:1'), '10.0.0.1')
+        self.assertEqual(quotas.tenant(unix_client, b'user:1'), '')
+
+    @istest
+    def tells_tenants_by_key_prefix(self):
+        quotas = TenantQuotas(ops_rate=2, prefix_separator=b':')
+
+        self.assertEqual(quotas.tenant(None, b'user:1'), b'user')
+        self.assertEqual(quotas.tenant(None, b'session:1:2'), b'session')
+        self.assertEqual(quotas.tenant(None, b'plain'), b'')
+
+    @istest
+    def keeps_a_bounded_number_of_tenants(self):
+        quotas = TenantQuotas(ops_rate=2, size=2, clock=self.clock)
+
+        quotas.allow('10.0.0.1', 1, 0)
+        quotas.allow('10.0.0.2', 1, 0)
+        quotas.allow('10.0.0.1', 1, 0)
+        quotas.allow('10.0.0.3', 1, 0)
+
+        self.assertEqual(list(quotas.buckets), ['10.0.0.1', '10.0.0.3'])
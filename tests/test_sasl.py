@@ -0,0 +1,87 @@
+import os
+import tempfile
+from unittest import TestCase
+
+from mock import MagicMock
+from nose.tools import istest
+
+from memcrashed.parser import BinaryParser
+from memcrashed.sasl import AuthenticatingStream, SaslAuthenticator, plain_auth_request, read_credentials
+from .utils import HeldStream, ScriptedStream
+
+
+class CredentialsTest(TestCase):
+    @istest
+    def reads_credentials_from_a_file(self):
+        path = os.path.join(tempfile.mkdtemp(), 'credentials')
+        with open(path, 'wb') as credentials_file:
+            credentials_file.write(b'# clients\nuser:secret\n\nother:with:colons\n')
+
+        self.assertEqual(read_credentials(path), [(b'user', b'secret'), (b'other', b'with:colons')])
+
+    @istest
+    def builds_plain_auth_requests(self):
+        request = plain_auth_request(b'user', b'secret')
+
+        headers = BinaryParser().unpack_request_header(request[:24])
+        self.assertEqual(headers.opcode, 0x21)
+        self.assertEqual(headers.key_length, 5)
+        self.assertEqual(request[24:], b'PLAIN\0user\0secret')
+
+
+class SaslAuthenticatorTest(TestCase):
+    def setUp(self):
+        self.authenticator = SaslAuthenticator([(b'user', b'secret')])
+
+    @istest
+    def accepts_known_credentials(self):
+        self.assertTrue(self.authenticator.authenticate(b'PLAIN', b'\0user\0secret'))
+
+    @istest
+    def refuses_wrong_passwords(self):
+        self.assertFalse(self.authenticator.authenticate(b'PLAIN', b'\0user\0wrong'))
+        self.assertFalse(self.authenticator.authenticate(b'PLAIN', b'\0nobody\0secret'))
+
+    @istest
+    def refuses_other_mechanisms(self):
+        self.assertFalse(self.authenticator.authenticate(b'CRAM-MD5', b'\0user\0secret'))
+        self.assertFalse(self.authenticator.authenticate(b'PLAIN', b'user\0secret'))
+
+
+class AuthenticatingStreamTest(TestCase):
+    def auth_response(self, status):
+        body_bytes = b'Authenticated' if status == 0 else b'Auth failure'
+        return BinaryParser().pack_response_header(0x21, status, total_body_length=len(body_bytes)) + body_bytes
+
+    @istest
+    def authenticates_before_anything_else(self):
+        backend_stream = ScriptedStream(self.auth_response(0) + b'payload')
+        stream = AuthenticatingStream(backend_stream, b'user', b'secret')
+        callback = MagicMock()
+
+        stream.write(b'request')
+        stream.read_bytes(7, callback)
+
+        self.assertEqual(backend_stream.written, [plain_auth_request(b'user', b'secret'), b'request'])
+        callback.assert_called_with(b'payload')
+
+    @istest
+    def holds_reads_until_authenticated(self):
+        backend_stream = HeldStream(self.auth_response(0) + b'payload')
+        stream = AuthenticatingStream(backend_stream, b'user', b'secret')
+        callback = MagicMock()
+
+        stream.read_bytes(7, callback)
+        self.assertFalse(callback.called)
+        backend_stream.release()
+
+        callback.assert_called_with(b'payload')
+
+    @istest
+    def closes_when_refused(self):
+        backend_stream = ScriptedStream(self.auth_response(0x20))
+
+        stream = AuthenticatingStream(backend_stream, b'user', b'wrong')
+
+        self.assertTrue(stream.closed())
+        self.assertFalse(stream.authenticated)
@@ -0,0 +1,47 @@
+from unittest import TestCase
+
+from nose.tools import istest
+
+from memcrashed.selection import BackendSelector
+
+
+class BackendSelectorTest(TestCase):
+    def setUp(self):
+        self.now = 100.0
+        self.selector = BackendSelector(decay=0.5, clock=lambda: self.now, sample=lambda nodes, count: nodes[:count])
+
+    def measure(self, node, round_trip):
+        started = self.selector.started(node)
+        self.now += round_trip
+        self.selector.finished(node, started)
+
+    @istest
+    def picks_the_only_node(self):
+        self.assertEqual(self.selector.choose(['a']), 'a')
+
+    @istest
+    def picks_the_faster_of_two_sampled_nodes(self):
+        self.measure('a', 0.010)
+        self.measure('b', 0.001)
+
+        self.assertEqual(self.selector.choose(['a', 'b', 'c']), 'b')
+
+    @istest
+    def prefers_the_first_sampled_node_on_ties(self):
+        self.assertEqual(self.selector.choose(['a', 'b']), 'a')
+
+    @istest
+    def averages_round_trips(self):
+        self.measure('a', 0.010)
+        self.measure('a', 0.020)
+
+        self.assertAlmostEqual(self.selector.latencies['a'], 0.015)
+
+    @istest
+    def weighs_latency_by_requests_in_flight(self):
+        self.measure('a', 0.002)
+        self.measure('b', 0.003)
+        self.selector.started('a')
+
+        self.assertEqual(self.selector.choose(['a', 'b']), 'b')
+        self.assertEqual(self.selector.in_flight['a'], 1)
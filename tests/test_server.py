@@ -1,6 +1,9 @@
 import binascii
+import os
 import socket
+import ssl
 import sys
+import tempfile
 from unittest import TestCase
 
 import memcache
@@ -9,10 +12,27 @@ from nose.tools import istest
 from tornado import iostream
 from tornado.testing import AsyncTestCase
 
-from memcrashed.server import Server, create_options_from_arguments, start_server, main
+from memcrashed.server import (
+    Server, create_options_from_arguments, install_shutdown_handler, install_dump_handler,
+    install_profile_handler, start_server, main)
+from memcrashed.analytics import KeySpaceAnalytics
+from memcrashed.chunking import ValueChunker
+from memcrashed.compression import ValueCompressor
 from memcrashed.handlers.binary import BinaryProtocolHandler
 from memcrashed.handlers.text import TextProtocolHandler
-from .utils import ServerTestCase
+from memcrashed.hedging import ReadHedging
+from memcrashed.leases import KeyLeases
+from memcrashed.limits import BackendLimits
+from memcrashed.migration import KeyMigration
+from memcrashed.negative_cache import NegativeCache
+from memcrashed.passthrough import PassthroughRelay
+from memcrashed.proxy import ProxyRepository, ShadowPool
+from memcrashed.quotas import TenantQuotas
+from memcrashed.sasl import SaslAuthenticator
+from memcrashed.tracing import RequestTracer
+from memcrashed.write_behind import WriteBehind
+from memcrashed.sockets import BatchingStream, FlushCallbackStream, SocketOptions
+from .utils import ServerTestCase, UnflushedStream
 
 
 class SmokeTest(AsyncTestCase):
@@ -67,6 +87,296 @@ class ServerTest(ServerTestCase):
 
         self.wait()
 
+    @istest
+    def reads_back_a_written_value_over_unix_socket(self):
+        path = os.path.join(tempfile.mkdtemp(), 'memcrashed.sock')
+
+        request_bytes = binascii.unhexlify(b'80010003080000000000000e0000000000000000000000000000000000000000666f6f626172')
+        response_bytes = binascii.unhexlify(b'81010000000000000000000000000000000000000000012b')
+
+        server = Server(io_loop=self.io_loop)
+        server.listen_unix(path)
+
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stream = iostream.IOStream(s, io_loop=self.io_loop)
+
+        def send_request():
+            stream.write(request_bytes, write_finished)
+
+        def write_finished(*args, **kwargs):
+            stream.read_bytes(len(response_bytes), receive_response)
+
+        def receive_response(data):
+            self.assertEqual(self.response_without_cas(data), self.response_without_cas(response_bytes))
+            stream.close()
+            self.stop()
+
+        self.io_loop.add_callback(lambda: stream.connect(path, send_request))
+
+        self.wait()
+
+    @istest
+    @patch('memcrashed.proxy.create_stream')
+    def connects_to_configured_backend(self, create_stream):
+        server = Server(io_loop=self.io_loop)
+        socket_options = SocketOptions()
+        server.set_backends(['/var/run/memcached.sock', ('127.0.0.1', 11211)], socket_options)
+
+        server.ensure_backend()
+
+        create_stream.assert_called_with(self.io_loop, '/var/run/memcached.sock', socket_options)
+        self.assertIsInstance(server.backend, BatchingStream)
+        self.assertIs(server.backend.stream, create_stream.return_value)
+
+    @istest
+    @patch('memcrashed.proxy.create_stream')
+    def connects_to_backend_without_write_batching(self, create_stream):
+        server = Server(io_loop=self.io_loop)
+        server.set_backends([('127.0.0.1', 11211)], write_batching=False)
+
+        server.ensure_backend()
+
+        self.assertIsInstance(server.backend, FlushCallbackStream)
+        self.assertIs(server.backend.stream, create_stream.return_value)
+
+    @istest
+    def keeps_replicas_when_replacing_backends(self):
+        server = Server(io_loop=self.io_loop)
+
+        server.set_replicas(2)
+        server.set_backends([('127.0.0.1', 11211), ('127.0.0.1', 11212)])
+
+        self.assertEqual(server.pool_repository.replicas, 2)
+        self.assertTrue(server.pool_repository.is_replicated())
+
+    @istest
+    def keeps_previous_backends_during_a_migration(self):
+        server = Server(io_loop=self.io_loop)
+        server.set_backends([('127.0.0.1', 11211)])
+        previous_repository = server.pool_repository
+
+        server.set_backends([('127.0.0.1', 11211), ('127.0.0.1', 11212)], migration_window=60, migration_copy_ttl=300)
+
+        self.assertIsInstance(server.pool_repository.migration, KeyMigration)
+        self.assertIs(server.pool_repository.migration.previous_repository, previous_repository)
+        self.assertEqual(server.pool_repository.migration.copy_ttl, 300)
+        self.assertTrue(server.pool_repository.is_migrating())
+        self.assertIs(server.handler.pool_repository, server.pool_repository)
+
+    @istest
+    def shares_the_pool_repository_with_handlers(self):
+        server = Server(io_loop=self.io_loop)
+
+        server.set_backends([('127.0.0.1', 11211), ('127.0.0.1', 11212)])
+        server.set_handler('text')
+
+        self.assertIs(server.handler.pool_repository, server.pool_repository)
+        self.assertTrue(server.pool_repository.is_sharded())
+
+    @istest
+    def passes_chunker_to_handlers(self):
+        server = Server(io_loop=self.io_loop)
+
+        server.set_chunking(2000000, 500000)
+        server.set_backends([('127.0.0.1', 11211), ('127.0.0.1', 11212)])
+
+        self.assertIsInstance(server.handler.chunker, ValueChunker)
+        self.assertIs(server.chunker.pool_repository, server.pool_repository)
+        self.assertEqual(server.chunker.threshold, 2000000)
+        self.assertEqual(server.chunker.chunk_size, 500000)
+
+    @istest
+    def passes_negative_cache_to_handlers(self):
+        server = Server(io_loop=self.io_loop)
+
+        server.set_negative_cache(2.5, 1024)
+        server.set_handler('text')
+
+        self.assertIsInstance(server.handler.negative_cache, NegativeCache)
+        self.assertEqual(server.negative_cache.ttl, 2.5)
+        self.assertEqual(server.negative_cache.size, 1024)
+
+    @istest
+    def passes_leases_to_handlers(self):
+        server = Server(io_loop=self.io_loop)
+
+        server.set_leases(2.5, 30, 100)
+        server.set_handler('text')
+
+        self.assertIsInstance(server.handler.leases, KeyLeases)
+        self.assertEqual(server.leases.duration, 2.5)
+        self.assertEqual(server.leases.max_stale, 30)
+        self.assertEqual(server.leases.size, 100)
+
+        server.set_leases(None)
+
+        self.assertIsNone(server.handler.leases)
+
+    @istest
+    def passes_quotas_to_handlers(self):
+        server = Server(io_loop=self.io_loop)
+
+        server.set_quotas(100, 65536, 2, b':')
+        server.set_handler('text')
+
+        self.assertIsInstance(server.handler.quotas, TenantQuotas)
+        self.assertEqual(server.quotas.ops_rate, 100)
+        self.assertEqual(server.quotas.bytes_rate, 65536)
+        self.assertEqual(server.quotas.burst, 2)
+        self.assertEqual(server.quotas.prefix_separator, b':')
+
+        server.set_quotas(None)
+
+        self.assertIsNone(server.handler.quotas)
+
+    @istest
+    def passes_write_behind_to_handlers(self):
+        server = Server(io_loop=self.io_loop)
+
+        server.set_write_behind(65536, 'block')
+        server.set_handler('text')
+
+        self.assertIsInstance(server.handler.write_behind, WriteBehind)
+        self.assertEqual(server.write_behind.max_pending, 65536)
+        self.assertEqual(server.write_behind.policy, 'block')
+
+        server.set_write_behind(None)
+
+        self.assertIsNone(server.handler.write_behind)
+
+    @istest
+    def passes_key_space_analytics_to_handlers(self):
+        server = Server(io_loop=self.io_loop)
+
+        server.set_analytics(0.05, b':', 5000)
+        server.set_handler('text')
+
+        self.assertIsInstance(server.handler.analytics, KeySpaceAnalytics)
+        self.assertEqual(server.analytics.sample_rate, 0.05)
+        self.assertEqual(server.analytics.prefix_separator, b':')
+        self.assertEqual(server.analytics.max_keys, 5000)
+
+        server.set_analytics(None)
+
+        self.assertIsNone(server.handler.analytics)
+
+    @istest
+    def tells_the_quotas_about_client_hosts(self):
+        server = Server(io_loop=self.io_loop)
+        server.set_quotas(100)
+        server.backend = 'some backend'
+        stream = MagicMock(iostream.IOStream)
+        stream.socket = MagicMock()
+        stream.closed.return_value = True
+
+        server.handle_stream(stream, ('10.0.0.5', 43210))
+
+        self.assertEqual(server.quotas.tenant(stream, b'foo'), '10.0.0.5')
+
+    @istest
+    def passes_shadow_pool_to_handlers(self):
+        server = Server(io_loop=self.io_loop)
+
+        server.set_shadow([('127.0.0.1', 11311)], 0.5)
+        server.set_handler('text')
+
+        self.assertIsInstance(server.handler.shadow, ShadowPool)
+        self.assertEqual(server.shadow.read_fraction, 0.5)
+        self.assertEqual(server.shadow.repository.backends, [('127.0.0.1', 11311)])
+
+    @istest
+    def passes_read_hedging_to_handlers(self):
+        server = Server(io_loop=self.io_loop)
+
+        server.set_hedging(99, 0.1)
+        server.set_handler('text')
+
+        self.assertIsInstance(server.handler.hedging, ReadHedging)
+        self.assertEqual(server.hedging.percentile, 99)
+        self.assertEqual(server.hedging.budget, 0.1)
+
+    @istest
+    def passes_authenticator_to_handlers(self):
+        server = Server(io_loop=self.io_loop)
+
+        server.set_authentication([(b'user', b'secret')])
+
+        self.assertIsInstance(server.handler.authenticator, SaslAuthenticator)
+        self.assertEqual(server.authenticator.credentials, {b'user': b'secret'})
+
+    @istest
+    def authenticates_backends_with_the_credentials(self):
+        server = Server(io_loop=self.io_loop)
+
+        server.set_backend_credentials(b'proxy', b'secret')
+        server.set_backends([('127.0.0.1', 11211), ('127.0.0.1', 11212)])
+        server.set_shadow([('127.0.0.1', 11311)])
+
+        self.assertEqual(server.pool_repository.credentials, (b'proxy', b'secret'))
+        self.assertEqual(server.shadow.repository.credentials, (b'proxy', b'secret'))
+
+    @istest
+    def passes_tracer_to_handlers(self):
+        server = Server(io_loop=self.io_loop)
+
+        server.set_tracing(0.5, 100, 0.25)
+        server.set_handler('text')
+
+        self.assertIsInstance(server.handler.tracer, RequestTracer)
+        self.assertEqual(server.tracer.sample_rate, 0.5)
+        self.assertEqual(server.tracer.records.maxlen, 100)
+        self.assertEqual(server.tracer.slow_threshold, 0.25)
+
+    @istest
+    def applies_socket_options_to_clients(self):
+        server = Server(io_loop=self.io_loop)
+        server.client_socket_options = MagicMock(SocketOptions)
+        server.backend = 'some backend'
+        stream = MagicMock(iostream.IOStream)
+        stream.socket = MagicMock()
+        stream.closed.return_value = True
+
+        server.handle_stream(stream, 'some address')
+
+        server.client_socket_options.apply.assert_called_with(stream.socket)
+
+    @istest
+    @patch('memcrashed.server.create_server_context')
+    def keeps_the_tls_context(self, create_server_context):
+        server = Server(io_loop=self.io_loop)
+
+        server.set_tls('/etc/memcrashed/cert.pem', '/etc/memcrashed/key.pem', '1.3', 'ECDHE+AESGCM')
+
+        self.assertIs(server.tls_context, create_server_context.return_value)
+        create_server_context.assert_called_with('/etc/memcrashed/cert.pem', '/etc/memcrashed/key.pem', '1.3', 'ECDHE+AESGCM')
+
+    @istest
+    @patch('memcrashed.server.SSLIOStream')
+    def wraps_client_connections_with_the_shared_tls_context(self, SSLIOStream):
+        server = Server(io_loop=self.io_loop)
+        server.tls_context = MagicMock()
+        server.handle_stream = MagicMock()
+        connection = MagicMock()
+
+        server._handle_connection(connection, 'some address')
+
+        server.tls_context.wrap_socket.assert_called_with(connection, server_side=True, do_handshake_on_connect=False)
+        SSLIOStream.assert_called_with(server.tls_context.wrap_socket.return_value, io_loop=self.io_loop)
+        server.handle_stream.assert_called_with(SSLIOStream.return_value, 'some address')
+
+    @istest
+    def drops_connections_failing_to_start_tls(self):
+        server = Server(io_loop=self.io_loop)
+        server.tls_context = MagicMock()
+        server.tls_context.wrap_socket.side_effect = ssl.SSLError('bad handshake')
+        server.handle_stream = MagicMock()
+        connection = MagicMock()
+
+        server._handle_connection(connection, 'some address')
+
+        connection.close.assert_called_with()
+        self.assertFalse(server.handle_stream.called)
+
     @istest
     def starts_with_binary_protocol_handler_by_default(self):
         server = Server(io_loop=self.io_loop)
@@ -77,11 +387,67 @@ class ServerTest(ServerTestCase):
         server = Server(io_loop=self.io_loop)
         self.assertIs(server.io_loop, server.handler.io_loop)
 
+    @istest
+    def keeps_backend_connections_when_replacing_backends(self):
+        server = Server(io_loop=self.io_loop)
+
+        server.set_backend_connections(4)
+        server.set_backends([('127.0.0.1', 11211)])
+
+        self.assertEqual(server.pool_repository.connections, 4)
+
+    @istest
+    def passes_opaque_rewriting_to_handlers(self):
+        server = Server(io_loop=self.io_loop)
+
+        server.set_opaque_rewriting(True)
+
+        self.assertTrue(server.handler.opaque_rewriting)
+
+    @istest
+    @patch('memcrashed.server.create_stream')
+    def relays_clients_to_their_own_backend_connections_in_passthrough(self, create_stream):
+        server = Server(io_loop=self.io_loop)
+        socket_options = SocketOptions()
+        server.set_backends(['/var/run/memcached.sock'], socket_options)
+        server.set_passthrough(True)
+        server.passthrough = MagicMock(PassthroughRelay)
+        server.handler = MagicMock(spec=BinaryProtocolHandler)
+        stream = MagicMock(iostream.IOStream)
+        stream.socket = MagicMock()
+
+        server.handle_stream(stream, 'some address')
+
+        create_stream.assert_called_with(self.io_loop, '/var/run/memcached.sock', socket_options)
+        server.passthrough.relay.assert_called_with(stream, create_stream.return_value, ANY)
+        self.assertIn(stream, server.streams)
+        self.assertIsNone(server.backend)
+        self.assertFalse(server.handler.process.called)
+
+    @istest
+    def spreads_requests_over_the_backend_connections(self):
+        server = Server(io_loop=self.io_loop)
+        server.pool_repository = MagicMock(ProxyRepository)
+        server.pool_repository.connections = 2
+        server.pool_repository.default_node = ('127.0.0.1', 11211)
+        server.backend = 'some backend'
+        handler = MagicMock(spec=BinaryProtocolHandler)
+        stream = MagicMock(iostream.IOStream)
+        stream.socket = MagicMock()
+        stream.closed.side_effect = [False, True]
+
+        with patch.object(server, 'handler', handler):
+            server.handle_stream(stream, 'some address')
+
+        server.pool_repository.stream_for_node.assert_called_with(('127.0.0.1', 11211))
+        handler.process.assert_called_with(stream, server.pool_repository.stream_for_node.return_value, callback=ANY)
+
     @istest
     def passes_request_to_handler(self):
         server = Server(io_loop=self.io_loop)
         handler = MagicMock(spec=BinaryProtocolHandler)
         stream = MagicMock(iostream.IOStream)
+        stream.socket = MagicMock()
 
         stream.closed.side_effect = [False, True]
 
@@ -91,6 +457,146 @@ class ServerTest(ServerTestCase):
 
             handler.process.assert_called_with(stream, 'some backend', callback=ANY)
 
+    @istest
+    def closes_new_streams_while_draining(self):
+        server = Server(io_loop=self.io_loop)
+        stream = MagicMock(iostream.IOStream)
+        server.draining = True
+
+        server.handle_stream(stream, 'some address')
+
+        stream.close.assert_called_with()
+        self.assertNotIn(stream, server.streams)
+
+    @istest
+    def drains_idle_streams_immediately(self):
+        server = Server(io_loop=self.io_loop)
+        backend = MagicMock(iostream.IOStream)
+        stream = MagicMock(iostream.IOStream)
+        server.backend = backend
+        server.streams.add(stream)
+        stream.close.side_effect = lambda: server._forget_stream(stream)
+        callback = MagicMock()
+
+        server.drain(1, callback)
+
+        stream.close.assert_called_with()
+        backend.close.assert_called_with()
+        self.assertIsNone(server.backend)
+        callback.assert_called_with()
+
+    @istest
+    def waits_for_busy_streams_when_draining(self):
+        server = Server(io_loop=self.io_loop)
+        stream = MagicMock(iostream.IOStream)
+        server.backend = MagicMock(iostream.IOStream)
+        server.streams.add(stream)
+        server.handler.busy_streams.add(stream)
+        callback = MagicMock()
+
+        server.drain(1, callback)
+
+        self.assertFalse(stream.close.called)
+        self.assertFalse(callback.called)
+
+        server._forget_stream(stream)
+
+        callback.assert_called_with()
+
+    @istest
+    def closes_relayed_streams_once_idle_when_draining(self):
+        server = Server(io_loop=self.io_loop)
+        server.passthrough = MagicMock(PassthroughRelay)
+        stream = MagicMock(iostream.IOStream)
+        server.streams.add(stream)
+        callback = MagicMock()
+
+        server.drain(1, callback)
+
+        server.passthrough.close_when_idle.assert_called_with(stream)
+        self.assertFalse(stream.close.called)
+        self.assertFalse(callback.called)
+
+        server._forget_stream(stream)
+
+        callback.assert_called_with()
+
+    @istest
+    def waits_for_the_writes_behind_when_draining(self):
+        server = Server(io_loop=self.io_loop)
+        server.backend = MagicMock(iostream.IOStream)
+        server.set_write_behind(100)
+        backend_stream = UnflushedStream()
+        server.write_behind.write(backend_stream, 20, lambda flushed: backend_stream.write(b'delete foo noreply\r\n', flushed), MagicMock())
+        callback = MagicMock()
+
+        server.drain(1, callback)
+
+        self.assertFalse(callback.called)
+
+        backend_stream.flush()
+
+        callback.assert_called_with()
+
+    @istest
+    def gives_up_draining_after_timeout(self):
+        server = Server(io_loop=self.io_loop)
+        stream = MagicMock(iostream.IOStream)
+        server.streams.add(stream)
+        server.handler.busy_streams.add(stream)
+
+        server.drain(0.01, self.stop)
+        self.wait()
+
+        stream.close.assert_called_with()
+
+    @istest
+    def refuses_clients_above_the_limit(self):
+        server = Server(io_loop=self.io_loop)
+        server.set_limits(max_clients=1)
+        server.backend = 'some backend'
+        server.streams.add('some stream')
+        stream = MagicMock(iostream.IOStream)
+
+        server.handle_stream(stream, 'some address')
+
+        stream.close.assert_called_with()
+        self.assertNotIn(stream, server.streams)
+
+    @istest
+    def passes_backend_limits_to_handlers(self):
+        server = Server(io_loop=self.io_loop)
+
+        server.set_limits(max_in_flight=10, max_queue_wait=0.5, high_watermark=1024)
+        server.set_handler('text')
+
+        self.assertIsInstance(server.limits, BackendLimits)
+        self.assertIs(server.handler.limits, server.limits)
+        self.assertEqual(server.limits.max_in_flight, 10)
+        self.assertEqual(server.limits.max_queue_wait, 0.5)
+        self.assertEqual(server.limits.high_watermark, 1024)
+
+    @istest
+    def has_no_backend_limits_by_default(self):
+        server = Server(io_loop=self.io_loop)
+
+        server.set_limits(max_clients=10)
+
+        self.assertIsNone(server.limits)
+        self.assertIsNone(server.handler.limits)
+
+    @istest
+    def passes_compressor_to_handlers(self):
+        server = Server(io_loop=self.io_loop)
+
+        server.set_compression(1024)
+        server.set_handler('text')
+
+        self.assertIsInstance(server.compressor, ValueCompressor)
+        self.assertIs(server.handler.compressor, server.compressor)
+        self.assertEqual(server.compressor.threshold, 1024)
+        server.compressor.shutdown()
+
     @istest
     def sets_a_text_handler(self):
         server = Server(io_loop=self.io_loop)
@@ -117,41 +623,322 @@ class ArgumentParserTest(TestCase):
         self.assertEqual(options.port, 22322)
         self.assertEqual(options.address, 'localhost')
         self.assertFalse(options.is_text_protocol)
+        self.assertEqual(options.shutdown_timeout, 10.0)
+        self.assertIsNone(options.max_clients)
+        self.assertIsNone(options.max_in_flight)
+        self.assertIsNone(options.queue_timeout)
+        self.assertIsNone(options.backend_high_watermark)
+        self.assertIsNone(options.unix_socket)
+        self.assertEqual(options.backends, ['127.0.0.1:11211'])
+        self.assertIsNone(options.chunk_threshold)
+        self.assertEqual(options.chunk_size, 1000000)
+        self.assertIsNone(options.socket_buffer_size)
+        self.assertIsNone(options.backend_socket_buffer_size)
+        self.assertIsNone(options.keepalive)
+        self.assertIsNone(options.backend_keepalive)
+        self.assertTrue(options.write_batching)
+        self.assertIsNone(options.compression_threshold)
+        self.assertEqual(options.compression_threads, 2)
+        self.assertIsNone(options.negative_cache_ttl)
+        self.assertEqual(options.negative_cache_size, 1 << 20)
+        self.assertIsNone(options.lease_duration)
+        self.assertEqual(options.lease_max_stale, 60)
+        self.assertEqual(options.lease_hot_keys, 10000)
+        self.assertIsNone(options.rate_limit_ops)
+        self.assertIsNone(options.rate_limit_bytes)
+        self.assertEqual(options.rate_limit_burst, 1)
+        self.assertIsNone(options.rate_limit_prefix)
+        self.assertIsNone(options.write_behind_max_pending)
+        self.assertEqual(options.write_behind_policy, 'drop')
+        self.assertIsNone(options.shadow_backends)
+        self.assertEqual(options.shadow_read_fraction, 0.1)
+        self.assertIsNone(options.previous_backends)
+        self.assertIsNone(options.migration_window)
+        self.assertIsNone(options.migration_copy_ttl)
+        self.assertEqual(options.replicas, 1)
+        self.assertEqual(options.backend_connections, 1)
+        self.assertFalse(options.rewrite_opaques)
+        self.assertFalse(options.passthrough)
+        self.assertIsNone(options.hedge_percentile)
+        self.assertEqual(options.hedge_budget, 0.05)
+        self.assertIsNone(options.sasl_credentials)
+        self.assertIsNone(options.backend_sasl_credentials)
+        self.assertIsNone(options.tls_cert)
+        self.assertIsNone(options.tls_key)
+        self.assertEqual(options.tls_min_version, '1.2')
+        self.assertIsNone(options.tls_ciphers)
+        self.assertIsNone(options.trace_sample_rate)
+        self.assertEqual(options.trace_buffer_size, 1000)
+        self.assertIsNone(options.slow_request_threshold)
+        self.assertIsNone(options.slow_log)
+        self.assertIsNone(options.profile_dir)
+        self.assertEqual(options.profile_seconds, 30)
+        self.assertIsNone(options.key_sample_rate)
+        self.assertEqual(options.key_sample_max_keys, 10000)
+        self.assertIsNone(options.key_sample_prefix)
 
     @istest
     def parses_with_short_args(self):
         options = create_options_from_arguments([
             '-p', '1234',
             '-a', 'other.server',
-            '-t'
+            '-t',
+            '-s', '/tmp/memcrashed.sock',
+            '-b', '/var/run/memcached.sock',
+            '-b', 'other.server:11211',
         ])
         self.assertEqual(options.port, 1234)
         self.assertEqual(options.address, 'other.server')
         self.assertTrue(options.is_text_protocol)
+        self.assertEqual(options.unix_socket, '/tmp/memcrashed.sock')
+        self.assertEqual(options.backends, ['/var/run/memcached.sock', 'other.server:11211'])
+
+    @istest
+    def parses_client_credentials(self):
+        options = create_options_from_arguments(['--sasl-credentials=/etc/memcrashed/clients'])
+
+        self.assertEqual(options.sasl_credentials, '/etc/memcrashed/clients')
+
+    @istest
+    def parses_backend_credentials(self):
+        options = create_options_from_arguments(['--backend-sasl-credentials=/etc/memcrashed/backend'])
+
+        self.assertEqual(options.backend_sasl_credentials, '/etc/memcrashed/backend')
+
+    @istest
+    @patch('sys.stderr')
+    def refuses_client_credentials_with_text_protocol(self, stderr):
+        with self.assertRaises(SystemExit):
+            create_options_from_arguments(['--text-protocol', '--sasl-credentials=/etc/memcrashed/clients'])
+
+    @istest
+    @patch('sys.stderr')
+    def refuses_backend_credentials_with_text_protocol(self, stderr):
+        with self.assertRaises(SystemExit):
+            create_options_from_arguments(['--text-protocol', '--backend-sasl-credentials=/etc/memcrashed/backend'])
+
+    @istest
+    def parses_opaque_rewriting(self):
+        options = create_options_from_arguments(['--rewrite-opaques'])
+
+        self.assertTrue(options.rewrite_opaques)
+
+    @istest
+    @patch('sys.stderr')
+    def refuses_opaque_rewriting_with_text_protocol(self, stderr):
+        with self.assertRaises(SystemExit):
+            create_options_from_arguments(['--text-protocol', '--rewrite-opaques'])
+
+    @istest
+    def parses_passthrough(self):
+        options = create_options_from_arguments(['--passthrough', '-b', '/var/run/memcached.sock'])
+
+        self.assertTrue(options.passthrough)
+
+    @istest
+    @patch('sys.stderr')
+    def refuses_passthrough_with_many_backends(self, stderr):
+        with self.assertRaises(SystemExit):
+            create_options_from_arguments(['--passthrough', '-b', '10.0.0.1:11211', '-b', '10.0.0.2:11211'])
+
+    @istest
+    @patch('sys.stderr')
+    def refuses_passthrough_with_the_options_it_bypasses(self, stderr):
+        for args in (['--sasl-credentials=/etc/memcrashed/clients'], ['--backend-sasl-credentials=/etc/memcrashed/backend'],
+                     ['--rate-limit-ops=1000'], ['--rate-limit-bytes=1048576'], ['--max-in-flight=10'], ['--backend-high-watermark=65536'],
+                     ['--replicas=2'], ['--compression-threshold=4096'], ['--negative-cache-ttl=1'], ['--trace-sample-rate=0.5'],
+                     ['--slow-request-threshold=0'], ['--key-sample-rate=0.05']):
+            with self.assertRaises(SystemExit):
+                create_options_from_arguments(['--passthrough'] + args)
+
+    @istest
+    @patch('sys.stderr')
+    def refuses_backend_credentials_with_the_proxy_own_backend_commands(self, stderr):
+        for args in (['--chunk-threshold=1000'], ['--previous-backend=10.0.0.3:11211'], ['--hedge-percentile=95', '--replicas=2'],
+                     ['--lease-duration=1']):
+            with self.assertRaises(SystemExit):
+                create_options_from_arguments(['--backend-sasl-credentials=/etc/memcrashed/backend'] + args)
+
+    @istest
+    @patch('sys.stderr')
+    def refuses_a_tls_key_without_certificate(self, stderr):
+        with self.assertRaises(SystemExit):
+            create_options_from_arguments(['--tls-key=/etc/memcrashed/key.pem'])
 
     @istest
     def parses_with_long_args(self):
         options = create_options_from_arguments([
             '--port=1234',
             '--address=other.server',
-            '--text-protocol'
+            '--text-protocol',
+            '--shutdown-timeout=2.5',
+            '--max-clients=100',
+            '--max-in-flight=10',
+            '--queue-timeout=0.5',
+            '--backend-high-watermark=65536',
+            '--socket-buffer-size=4096',
+            '--backend-socket-buffer-size=8192',
+            '--keepalive=60',
+            '--backend-keepalive=30',
+            '--no-write-batching',
+            '--compression-threshold=1024',
+            '--compression-threads=3',
+            '--backend=127.0.0.1:11211',
+            '--chunk-threshold=2000000',
+            '--chunk-size=500000',
+            '--negative-cache-ttl=1.5',
+            '--negative-cache-size=4096',
+            '--lease-duration=3',
+            '--lease-max-stale=20',
+            '--lease-hot-keys=500',
+            '--rate-limit-ops=1000',
+            '--rate-limit-bytes=1048576',
+            '--rate-limit-burst=2',
+            '--rate-limit-prefix=:',
+            '--write-behind-max-pending=65536',
+            '--write-behind-policy=block',
+            '--key-sample-rate=0.05',
+            '--key-sample-max-keys=5000',
+            '--key-sample-prefix=:',
+            '--shadow-backend=10.0.0.1:11211',
+            '--shadow-backend=10.0.0.2:11211',
+            '--shadow-read-fraction=0.5',
+            '--previous-backend=10.0.0.1:11211',
+            '--migration-window=120',
+            '--migration-copy-ttl=600',
+            '--replicas=2',
+            '--backend-connections=4',
+            '--hedge-percentile=99',
+            '--hedge-budget=0.1',
+            '--tls-cert=/etc/memcrashed/cert.pem',
+            '--tls-key=/etc/memcrashed/key.pem',
+            '--tls-min-version=1.3',
+            '--tls-ciphers=ECDHE+AESGCM',
+            '--trace-sample-rate=0.5',
+            '--trace-buffer-size=100',
+            '--slow-request-threshold=0.25',
+            '--slow-log=/var/log/memcrashed/slow.log',
+            '--profile-dir=/var/tmp/memcrashed',
+            '--profile-seconds=10',
         ])
         self.assertEqual(options.port, 1234)
         self.assertEqual(options.address, 'other.server')
         self.assertTrue(options.is_text_protocol)
+        self.assertEqual(options.shutdown_timeout, 2.5)
+        self.assertEqual(options.max_clients, 100)
+        self.assertEqual(options.max_in_flight, 10)
+        self.assertEqual(options.queue_timeout, 0.5)
+        self.assertEqual(options.backend_high_watermark, 65536)
+        self.assertEqual(options.socket_buffer_size, 4096)
+        self.assertEqual(options.backend_socket_buffer_size, 8192)
+        self.assertEqual(options.keepalive, 60)
+        self.assertEqual(options.backend_keepalive, 30)
+        self.assertFalse(options.write_batching)
+        self.assertEqual(options.compression_threshold, 1024)
+        self.assertEqual(options.compression_threads, 3)
+        self.assertEqual(options.backends, ['127.0.0.1:11211'])
+        self.assertEqual(options.chunk_threshold, 2000000)
+        self.assertEqual(options.chunk_size, 500000)
+        self.assertEqual(options.negative_cache_ttl, 1.5)
+        self.assertEqual(options.negative_cache_size, 4096)
+        self.assertEqual(options.lease_duration, 3)
+        self.assertEqual(options.lease_max_stale, 20)
+        self.assertEqual(options.lease_hot_keys, 500)
+        self.assertEqual(options.rate_limit_ops, 1000)
+        self.assertEqual(options.rate_limit_bytes, 1048576)
+        self.assertEqual(options.rate_limit_burst, 2)
+        self.assertEqual(options.rate_limit_prefix, ':')
+        self.assertEqual(options.write_behind_max_pending, 65536)
+        self.assertEqual(options.write_behind_policy, 'block')
+        self.assertEqual(options.key_sample_rate, 0.05)
+        self.assertEqual(options.key_sample_max_keys, 5000)
+        self.assertEqual(options.key_sample_prefix, ':')
+        self.assertEqual(options.shadow_backends, ['10.0.0.1:11211', '10.0.0.2:11211'])
+        self.assertEqual(options.shadow_read_fraction, 0.5)
+        self.assertEqual(options.previous_backends, ['10.0.0.1:11211'])
+        self.assertEqual(options.migration_window, 120)
+        self.assertEqual(options.migration_copy_ttl, 600)
+        self.assertEqual(options.replicas, 2)
+        self.assertEqual(options.backend_connections, 4)
+        self.assertEqual(options.hedge_percentile, 99)
+        self.assertEqual(options.hedge_budget, 0.1)
+        self.assertEqual(options.tls_cert, '/etc/memcrashed/cert.pem')
+        self.assertEqual(options.tls_key, '/etc/memcrashed/key.pem')
+        self.assertEqual(options.tls_min_version, '1.3')
+        self.assertEqual(options.tls_ciphers, 'ECDHE+AESGCM')
+        self.assertEqual(options.trace_sample_rate, 0.5)
+        self.assertEqual(options.trace_buffer_size, 100)
+        self.assertEqual(options.slow_request_threshold, 0.25)
+        self.assertEqual(options.slow_log, '/var/log/memcrashed/slow.log')
+        self.assertEqual(options.profile_dir, '/var/tmp/memcrashed')
+        self.assertEqual(options.profile_seconds, 10)
 
 
 class InitializationTest(TestCase):
     @istest
+    @patch('memcrashed.server.install_shutdown_handler')
     @patch('memcrashed.server.Server')
     @patch('tornado.ioloop.IOLoop.instance')
-    def starts_the_server_with_provided_options(self, io_loop_instance, MockServer):
+    def starts_the_server_with_provided_options(self, io_loop_instance, MockServer, install_shutdown_handler):
         io_loop = io_loop_instance.return_value
 
         class options(object):
             is_text_protocol = False
             port = 'some port'
             address = 'some address'
+            shutdown_timeout = 'some timeout'
+            max_clients = 'some max clients'
+            max_in_flight = 'some max in flight'
+            queue_timeout = 'some queue timeout'
+            backend_high_watermark = 'some watermark'
+            unix_socket = None
+            backends = ['127.0.0.1:11211']
+            chunk_threshold = None
+            chunk_size = 1000000
+            socket_buffer_size = None
+            backend_socket_buffer_size = None
+            keepalive = None
+            backend_keepalive = None
+            write_batching = True
+            compression_threshold = None
+            compression_threads = 2
+            negative_cache_ttl = None
+            negative_cache_size = 1 << 20
+            lease_duration = None
+            lease_max_stale = 60.0
+            lease_hot_keys = 10000
+            rate_limit_ops = None
+            rate_limit_bytes = None
+            rate_limit_burst = 1.0
+            rate_limit_prefix = None
+            write_behind_max_pending = None
+            write_behind_policy = 'drop'
+            shadow_backends = None
+            shadow_read_fraction = 0.1
+            previous_backends = None
+            migration_window = None
+            migration_copy_ttl = None
+            replicas = 1
+            backend_connections = 1
+            rewrite_opaques = False
+            passthrough = False
+            hedge_percentile = None
+            hedge_budget = 0.05
+            sasl_credentials = None
+            backend_sasl_credentials = None
+            tls_cert = None
+            tls_key = None
+            tls_min_version = '1.2'
+            tls_ciphers = None
+            trace_sample_rate = None
+            trace_buffer_size = 1000
+            slow_request_threshold = None
+            slow_log = None
+            profile_dir = None
+            profile_seconds = 30
+            key_sample_rate = None
+            key_sample_max_keys = 10000
+            key_sample_prefix = None
 
         start_server(options)
 
@@ -159,18 +946,90 @@ class InitializationTest(TestCase):
         MockServer.assert_called_with(io_loop=io_loop)
         self.assertFalse(server_instance.set_handler.called)
         server_instance.listen.assert_called_with(options.port, options.address)
+        server_instance.set_backends.assert_called_with([('127.0.0.1', 11211)], ANY, True)
+        self.assertFalse(server_instance.set_chunking.called)
+        self.assertFalse(server_instance.set_negative_cache.called)
+        self.assertFalse(server_instance.set_leases.called)
+        self.assertFalse(server_instance.set_quotas.called)
+        self.assertFalse(server_instance.set_write_behind.called)
+        self.assertFalse(server_instance.set_opaque_rewriting.called)
+        self.assertFalse(server_instance.set_passthrough.called)
+        self.assertFalse(server_instance.set_shadow.called)
+        self.assertFalse(server_instance.set_hedging.called)
+        self.assertFalse(server_instance.set_authentication.called)
+        self.assertFalse(server_instance.set_backend_credentials.called)
+        self.assertFalse(server_instance.set_tls.called)
+        self.assertFalse(server_instance.set_tracing.called)
+        self.assertFalse(server_instance.set_analytics.called)
+        install_shutdown_handler.assert_called_with(server_instance, options.shutdown_timeout)
+        server_instance.set_limits.assert_called_with(
+            options.max_clients, options.max_in_flight, options.queue_timeout, options.backend_high_watermark)
         io_loop.start.assert_called_with()
 
     @istest
+    @patch('memcrashed.server.install_shutdown_handler')
     @patch('memcrashed.server.Server')
     @patch('tornado.ioloop.IOLoop.instance')
-    def starts_the_server_with_text_protocol(self, io_loop_instance, MockServer):
+    def starts_the_server_with_text_protocol(self, io_loop_instance, MockServer, install_shutdown_handler):
         io_loop = io_loop_instance.return_value
 
         class options(object):
             is_text_protocol = True
             port = 'some port'
             address = 'some address'
+            shutdown_timeout = 'some timeout'
+            max_clients = 'some max clients'
+            max_in_flight = 'some max in flight'
+            queue_timeout = 'some queue timeout'
+            backend_high_watermark = 'some watermark'
+            unix_socket = None
+            backends = ['127.0.0.1:11211']
+            chunk_threshold = None
+            chunk_size = 1000000
+            socket_buffer_size = None
+            backend_socket_buffer_size = None
+            keepalive = None
+            backend_keepalive = None
+            write_batching = True
+            compression_threshold = None
+            compression_threads = 2
+            negative_cache_ttl = None
+            negative_cache_size = 1 << 20
+            lease_duration = None
+            lease_max_stale = 60.0
+            lease_hot_keys = 10000
+            rate_limit_ops = None
+            rate_limit_bytes = None
+            rate_limit_burst = 1.0
+            rate_limit_prefix = None
+            write_behind_max_pending = None
+            write_behind_policy = 'drop'
+            shadow_backends = None
+            shadow_read_fraction = 0.1
+            previous_backends = None
+            migration_window = None
+            migration_copy_ttl = None
+            replicas = 1
+            backend_connections = 1
+            rewrite_opaques = False
+            passthrough = False
+            hedge_percentile = None
+            hedge_budget = 0.05
+            sasl_credentials = None
+            backend_sasl_credentials = None
+            tls_cert = None
+            tls_key = None
+            tls_min_version = '1.2'
+            tls_ciphers = None
+            trace_sample_rate = None
+            trace_buffer_size = 1000
+            slow_request_threshold = None
+            slow_log = None
+            profile_dir = None
+            profile_seconds = 30
+            key_sample_rate = None
+            key_sample_max_keys = 10000
+            key_sample_prefix = None
 
         start_server(options)
 
@@ -180,6 +1039,219 @@ class InitializationTest(TestCase):
         server_instance.listen.assert_called_with(options.port, options.address)
         io_loop.start.assert_called_with()
 
+    @istest
+    @patch('memcrashed.server.install_profile_handler')
+    @patch('memcrashed.server.open', create=True)
+    @patch('memcrashed.server.install_dump_handler')
+    @patch('memcrashed.server.read_credentials')
+    @patch('memcrashed.server.install_shutdown_handler')
+    @patch('memcrashed.server.Server')
+    @patch('tornado.ioloop.IOLoop.instance')
+    def starts_the_server_on_unix_socket(self, io_loop_instance, MockServer, install_shutdown_handler, read_credentials,
+                                         install_dump_handler, open_file, install_profile_handler):
+        credentials = {
+            '/etc/memcrashed/clients': [(b'user', b'secret'), (b'other', b'password')],
+            '/etc/memcrashed/backend': [(b'proxy', b'backend secret')],
+        }
+        read_credentials.side_effect = lambda path: credentials[path]
+
+        class options(object):
+            is_text_protocol = False
+            port = 'some port'
+            address = 'some address'
+            shutdown_timeout = 'some timeout'
+            max_clients = None
+            max_in_flight = None
+            queue_timeout = None
+            backend_high_watermark = None
+            unix_socket = '/tmp/memcrashed.sock'
+            backends = ['/var/run/memcached.sock']
+            chunk_threshold = 2000000
+            chunk_size = 500000
+            socket_buffer_size = 65536
+            backend_socket_buffer_size = 131072
+            keepalive = 60
+            backend_keepalive = 0
+            write_batching = False
+            compression_threshold = 4096
+            compression_threads = 4
+            negative_cache_ttl = 1.5
+            negative_cache_size = 4096
+            lease_duration = 3
+            lease_max_stale = 20
+            lease_hot_keys = 500
+            rate_limit_ops = 1000
+            rate_limit_bytes = 1048576
+            rate_limit_burst = 2
+            rate_limit_prefix = ':'
+            write_behind_max_pending = 65536
+            write_behind_policy = 'block'
+            shadow_backends = ['10.0.0.1:11211']
+            shadow_read_fraction = 0.5
+            previous_backends = ['10.0.0.1:11211']
+            migration_window = 120
+            migration_copy_ttl = 600
+            replicas = 2
+            backend_connections = 4
+            rewrite_opaques = True
+            passthrough = True
+            hedge_percentile = 95
+            hedge_budget = 0.1
+            sasl_credentials = '/etc/memcrashed/clients'
+            backend_sasl_credentials = '/etc/memcrashed/backend'
+            tls_cert = '/etc/memcrashed/cert.pem'
+            tls_key = '/etc/memcrashed/key.pem'
+            tls_min_version = '1.3'
+            tls_ciphers = 'ECDHE+AESGCM'
+            trace_sample_rate = 0.5
+            trace_buffer_size = 100
+            slow_request_threshold = 0.25
+            slow_log = '/var/log/memcrashed/slow.log'
+            profile_dir = '/var/tmp/memcrashed'
+            profile_seconds = 10
+            key_sample_rate = 0.05
+            key_sample_max_keys = 5000
+            key_sample_prefix = ':'
+
+        start_server(options)
+
+        server_instance = MockServer.return_value
+        server_instance.listen_unix.assert_called_with('/tmp/memcrashed.sock')
+        self.assertFalse(server_instance.listen.called)
+        server_instance.set_replicas.assert_called_with(2)
+        server_instance.set_backend_connections.assert_called_with(4)
+        server_instance.set_opaque_rewriting.assert_called_with(True)
+        server_instance.set_passthrough.assert_called_with(True)
+        server_instance.set_hedging.assert_called_with(95, 0.1)
+        server_instance.set_backend_credentials.assert_called_with(b'proxy', b'backend secret')
+        server_instance.set_authentication.assert_called_with([(b'user', b'secret'), (b'other', b'password')])
+        server_instance.set_tls.assert_called_with('/etc/memcrashed/cert.pem', '/etc/memcrashed/key.pem', '1.3', 'ECDHE+AESGCM')
+        open_file.assert_called_with('/var/log/memcrashed/slow.log', 'a')
+        server_instance.set_tracing.assert_called_with(0.5, 100, 0.25, open_file.return_value)
+        server_instance.set_analytics.assert_called_with(0.05, b':', 5000)
+        install_dump_handler.assert_called_with(server_instance)
+        install_profile_handler.assert_called_with(server_instance, '/var/tmp/memcrashed', 10)
+        server_instance.set_backends.assert_any_call([('10.0.0.1', 11211)], ANY, False)
+        server_instance.set_backends.assert_called_with(['/var/run/memcached.sock'], ANY, False, 120, 600)
+        backend_socket_options = server_instance.set_backends.call_args[0][1]
+        server_instance.set_chunking.assert_called_with(2000000, 500000)
+        self.assertEqual(server_instance.client_socket_options.send_buffer, 65536)
+        self.assertEqual(server_instance.client_socket_options.receive_buffer, 65536)
+        self.assertEqual(server_instance.client_socket_options.keepalive, 60)
+        self.assertEqual(backend_socket_options.send_buffer, 131072)
+        self.assertEqual(backend_socket_options.keepalive, 0)
+        server_instance.set_compression.assert_called_with(4096, 4)
+        server_instance.set_negative_cache.assert_called_with(1.5, 4096)
+        server_instance.set_leases.assert_called_with(3, 20, 500)
+        server_instance.set_quotas.assert_called_with(1000, 1048576, 2, b':')
+        server_instance.set_write_behind.assert_called_with(65536, 'block')
+        server_instance.set_shadow.assert_called_with([('10.0.0.1', 11211)], 0.5, backend_socket_options)
+
+    @istest
+    @patch('memcrashed.server.signal')
+    def drains_the_server_on_sigterm(self, signal_module):
+        server = MagicMock(Server)
+        server.io_loop = MagicMock()
+
+        install_shutdown_handler(server, 'some timeout')
+
+        signal_module.signal.assert_called_with(signal_module.SIGTERM, ANY)
+        handle_signal = signal_module.signal.call_args[0][1]
+        handle_signal(signal_module.SIGTERM, None)
+        shutdown = server.io_loop.add_callback.call_args[0][0]
+        shutdown()
+        server.drain.assert_called_with('some timeout', server.io_loop.stop)
+
+    @istest
+    @patch('memcrashed.server.signal')
+    def dumps_the_traces_on_sigusr1(self, signal_module):
+        server = MagicMock(Server)
+        server.io_loop = MagicMock()
+        server.tracer = MagicMock()
+        server.analytics = None
+        server.passthrough = None
+        server.write_behind = None
+
+        install_dump_handler(server, 'some output')
+
+        signal_module.signal.assert_called_with(signal_module.SIGUSR1, ANY)
+        handle_signal = signal_module.signal.call_args[0][1]
+        handle_signal(signal_module.SIGUSR1, None)
+        dump = server.io_loop.add_callback.call_args[0][0]
+        dump()
+        server.tracer.dump.assert_called_with('some output')
+
+    @istest
+    @patch('memcrashed.server.signal')
+    def dumps_the_key_space_analytics_on_sigusr1(self, signal_module):
+        server = MagicMock(Server)
+        server.io_loop = MagicMock()
+        server.tracer = None
+        server.analytics = MagicMock()
+        server.passthrough = None
+        server.write_behind = None
+
+        install_dump_handler(server, 'some output')
+
+        handle_signal = signal_module.signal.call_args[0][1]
+        handle_signal(signal_module.SIGUSR1, None)
+        dump = server.io_loop.add_callback.call_args[0][0]
+        dump()
+        server.analytics.dump.assert_called_with('some output')
+
+    @istest
+    @patch('memcrashed.server.signal')
+    def dumps_the_passthrough_counts_on_sigusr1(self, signal_module):
+        server = MagicMock(Server)
+        server.io_loop = MagicMock()
+        server.tracer = None
+        server.analytics = None
+        server.passthrough = MagicMock()
+        server.write_behind = None
+
+        install_dump_handler(server, 'some output')
+
+        handle_signal = signal_module.signal.call_args[0][1]
+        handle_signal(signal_module.SIGUSR1, None)
+        dump = server.io_loop.add_callback.call_args[0][0]
+        dump()
+        server.passthrough.dump.assert_called_with('some output')
+
+    @istest
+    @patch('memcrashed.server.signal')
+    def dumps_the_writes_behind_dropped_on_sigusr1(self, signal_module):
+        server = MagicMock(Server)
+        server.io_loop = MagicMock()
+        server.tracer = None
+        server.analytics = None
+        server.passthrough = None
+        server.write_behind = MagicMock()
+
+        install_dump_handler(server, 'some output')
+
+        handle_signal = signal_module.signal.call_args[0][1]
+        handle_signal(signal_module.SIGUSR1, None)
+        dump = server.io_loop.add_callback.call_args[0][0]
+        dump()
+        server.write_behind.dump.assert_called_with('some output')
+
+    @istest
+    @patch('memcrashed.server.Profiler')
+    @patch('memcrashed.server.signal')
+    def profiles_on_sigusr2(self, signal_module, MockProfiler):
+        server = MagicMock(Server)
+        server.io_loop = MagicMock()
+
+        profiler = install_profile_handler(server, '/var/tmp/memcrashed', 10)
+
+        MockProfiler.assert_called_with(server.io_loop, '/var/tmp/memcrashed')
+        signal_module.signal.assert_called_with(signal_module.SIGUSR2, ANY)
+        handle_signal = signal_module.signal.call_args[0][1]
+        handle_signal(signal_module.SIGUSR2, None)
+        start = server.io_loop.add_callback.call_args[0][0]
+        start()
+        profiler.start.assert_called_with(10)
+
     @istest
     @patch('memcrashed.server.create_options_from_arguments')
     @patch('memcrashed.server.start_server')
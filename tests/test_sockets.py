@@ -0,0 +1,180 @@
+import socket
+from unittest import TestCase
+
+from mock import MagicMock, call, patch
+from nose.tools import istest
+
+from memcrashed.sockets import BatchingStream, FlushCallbackStream, SocketOptions, create_stream, is_unix_address, parse_address
+
+
+class ParseAddressTest(TestCase):
+    @istest
+    def parses_tcp_address(self):
+        self.assertEqual(parse_address('127.0.0.1:11211'), ('127.0.0.1', 11211))
+
+    @istest
+    def parses_unix_socket_path(self):
+        self.assertEqual(parse_address('/var/run/memcached.sock'), '/var/run/memcached.sock')
+
+    @istest
+    def tells_unix_addresses_apart(self):
+        self.assertTrue(is_unix_address('/var/run/memcached.sock'))
+        self.assertFalse(is_unix_address(('127.0.0.1', 11211)))
+
+
+class CreateStreamTest(TestCase):
+    @istest
+    @patch('memcrashed.sockets.iostream')
+    @patch('memcrashed.sockets.socket.socket')
+    def connects_over_tcp(self, mock_socket, mock_iostream):
+        stream = create_stream('some ioloop', ('127.0.0.1', 11211))
+
+        mock_socket.assert_called_with(socket.AF_INET, socket.SOCK_STREAM)
+        mock_iostream.IOStream.assert_called_with(mock_socket.return_value, io_loop='some ioloop')
+        stream.connect.assert_called_with(('127.0.0.1', 11211))
+
+    @istest
+    @patch('memcrashed.sockets.iostream')
+    @patch('memcrashed.sockets.socket.socket')
+    def connects_over_unix_socket(self, mock_socket, mock_iostream):
+        stream = create_stream('some ioloop', '/var/run/memcached.sock')
+
+        mock_socket.assert_called_with(socket.AF_UNIX, socket.SOCK_STREAM)
+        stream.connect.assert_called_with('/var/run/memcached.sock')
+
+    @istest
+    @patch('memcrashed.sockets.iostream')
+    @patch('memcrashed.sockets.socket.socket')
+    def applies_socket_options_before_connecting(self, mock_socket, mock_iostream):
+        socket_options = MagicMock(SocketOptions)
+
+        create_stream('some ioloop', ('127.0.0.1', 11211), socket_options)
+
+        socket_options.apply.assert_called_with(mock_socket.return_value)
+
+
+class SocketOptionsTest(TestCase):
+    @istest
+    def sets_nodelay_on_tcp_sockets(self):
+        s = MagicMock()
+        s.family = socket.AF_INET
+
+        SocketOptions().apply(s)
+
+        s.setsockopt.assert_called_with(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    @istest
+    def skips_tcp_options_on_unix_sockets(self):
+        s = MagicMock()
+        s.family = socket.AF_UNIX
+
+        SocketOptions(keepalive=10).apply(s)
+
+        self.assertFalse(s.setsockopt.called)
+
+    @istest
+    def sets_buffer_sizes(self):
+        s = MagicMock()
+        s.family = socket.AF_UNIX
+
+        SocketOptions(send_buffer=1024, receive_buffer=2048).apply(s)
+
+        s.setsockopt.assert_has_calls([
+            call(socket.SOL_SOCKET, socket.SO_SNDBUF, 1024),
+            call(socket.SOL_SOCKET, socket.SO_RCVBUF, 2048),
+        ])
+
+    @istest
+    def enables_keepalive(self):
+        s = MagicMock()
+        s.family = socket.AF_INET
+
+        SocketOptions(keepalive=30).apply(s)
+
+        s.setsockopt.assert_any_call(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+
+    @istest
+    def disables_keepalive(self):
+        s = MagicMock()
+        s.family = socket.AF_INET
+
+        SocketOptions(keepalive=0).apply(s)
+
+        s.setsockopt.assert_any_call(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 0)
+
+
+class FlushCallbackStreamTest(TestCase):
+    def setUp(self):
+        self.stream = MagicMock()
+
+    @istest
+    def writes_right_away(self):
+        flush_callback_stream = FlushCallbackStream(self.stream)
+
+        flush_callback_stream.write(b'foo')
+
+        self.stream.write.assert_called_once_with(b'foo', flush_callback_stream._flushed)
+
+    @istest
+    def calls_back_every_writer_once_flushed(self):
+        flush_callback_stream = FlushCallbackStream(self.stream)
+        first = MagicMock()
+        second = MagicMock()
+
+        flush_callback_stream.write(b'foo', first)
+        flush_callback_stream.write(b'bar', second)
+
+        self.assertFalse(first.called)
+
+        flush_callback_stream._flushed()
+
+        first.assert_called_with()
+        second.assert_called_with()
+
+
+class BatchingStreamTest(TestCase):
+    def setUp(self):
+        self.io_loop = MagicMock()
+        self.stream = MagicMock()
+        self.stream.closed.return_value = False
+
+    def run_loop_iteration(self):
+        for args, kwargs in self.io_loop.add_callback.call_args_list:
+            args[0]()
+        self.io_loop.add_callback.reset_mock()
+
+    @istest
+    def joins_writes_of_the_same_iteration(self):
+        batching_stream = BatchingStream(self.stream, self.io_loop)
+
+        batching_stream.write(b'foo')
+        batching_stream.write(b'bar')
+        self.run_loop_iteration()
+
+        self.stream.write.assert_called_once_with(b'foobar', batching_stream._flushed)
+
+    @istest
+    def calls_back_every_writer_once_flushed(self):
+        batching_stream = BatchingStream(self.stream, self.io_loop)
+        first = MagicMock()
+        second = MagicMock()
+
+        batching_stream.write(b'foo', first)
+        self.run_loop_iteration()
+        batching_stream.write(b'bar', second)
+        self.run_loop_iteration()
+
+        self.assertFalse(first.called)
+
+        batching_stream._flushed()
+
+        first.assert_called_with()
+        second.assert_called_with()
+
+    @istest
+    def delegates_everything_else_to_the_stream(self):
+        batching_stream = BatchingStream(self.stream, self.io_loop)
+
+        batching_stream.read_bytes(3, 'some callback')
+
+        self.stream.read_bytes.assert_called_with(3, 'some callback')
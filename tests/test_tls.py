@@ -0,0 +1,47 @@
+import ssl
+from unittest import TestCase
+
+from mock import patch
+from nose.tools import istest
+
+from memcrashed.tls import create_server_context
+
+# Python 2.7 has no OP_NO_TICKET, like the code under test expects.
+OP_NO_TICKET = getattr(ssl, 'OP_NO_TICKET', 0)
+
+
+class ServerContextTest(TestCase):
+    @istest
+    @patch('memcrashed.tls.ssl.SSLContext')
+    def loads_the_certificate(self, SSLContext):
+        context = create_server_context('/etc/memcrashed/cert.pem', '/etc/memcrashed/key.pem')
+
+        self.assertIs(context, SSLContext.return_value)
+        context.load_cert_chain.assert_called_with('/etc/memcrashed/cert.pem', '/etc/memcrashed/key.pem')
+        self.assertFalse(context.set_ciphers.called)
+
+    @istest
+    def refuses_versions_older_than_the_minimum(self):
+        with patch('memcrashed.tls.ssl.SSLContext') as SSLContext, patch('memcrashed.tls.ssl.HAS_TLSv1_3', True, create=True):
+            SSLContext.return_value.options = 0
+            context = create_server_context('/etc/memcrashed/cert.pem', minimum_version='1.3')
+
+        self.assertTrue(context.options & ssl.OP_NO_TLSv1_1)
+        self.assertTrue(context.options & ssl.OP_NO_TLSv1_2)
+        self.assertFalse(context.options & OP_NO_TICKET)
+
+    @istest
+    def keeps_tls_1_2_by_default(self):
+        with patch('memcrashed.tls.ssl.SSLContext') as SSLContext:
+            SSLContext.return_value.options = OP_NO_TICKET
+            context = create_server_context('/etc/memcrashed/cert.pem', ciphers='ECDHE+AESGCM')
+
+        self.assertTrue(context.options & ssl.OP_NO_TLSv1)
+        self.assertFalse(context.options & ssl.OP_NO_TLSv1_2)
+        self.assertFalse(context.options & OP_NO_TICKET)
+        context.set_ciphers.assert_called_with('ECDHE+AESGCM')
+
+    @istest
+    def refuses_unknown_versions(self):
+        with self.assertRaises(ValueError):
+            create_server_context('/etc/memcrashed/cert.pem', minimum_version='1.0')
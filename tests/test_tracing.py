@@ -0,0 +1,83 @@
+from unittest import TestCase
+
+from mock import MagicMock
+from nose.tools import istest
+
+from memcrashed.tracing import RequestTracer, Trace
+
+
+class RequestTracerTest(TestCase):
+    def setUp(self):
+        self.now = 100.0
+        self.sampled = 0.0
+        self.output = MagicMock()
+        self.tracer = RequestTracer(sample_rate=0.5, buffer_size=2, slow_threshold=None, output=self.output,
+                                    clock=lambda: self.now, sample=lambda: self.sampled)
+        self.client_stream = MagicMock()
+        self.client_stream.socket.getpeername.return_value = ('10.0.0.9', 51234)
+
+    @istest
+    def skips_requests_out_of_the_sample(self):
+        self.sampled = 0.7
+
+        self.assertIsNone(self.tracer.start('get', [b'foo'], 9))
+
+    @istest
+    def keeps_sampled_traces(self):
+        trace = self.tracer.start('get', [b'foo'], 9)
+        self.now += 0.002
+        trace.backend_answered(('10.0.0.1', 11211), 0.001)
+
+        self.tracer.finish(trace, self.client_stream)
+
+        self.assertEqual(list(self.tracer.records), [trace])
+        self.assertEqual(trace.client, '10.0.0.9:51234')
+        self.assertAlmostEqual(trace.total, 0.002)
+        self.assertFalse(self.output.write.called)
+
+    @istest
+    def keeps_only_the_last_traces(self):
+        traces = [self.tracer.start('get', [b'foo'], 9) for index in range(3)]
+        for trace in traces:
+            self.tracer.finish(trace, self.client_stream)
+
+        self.assertEqual(list(self.tracer.records), traces[1:])
+
+    @istest
+    def times_every_request_for_the_slow_log(self):
+        self.tracer.slow_threshold = 0.1
+        self.sampled = 0.7
+        fast_trace = self.tracer.start('get', [b'foo'], 9)
+        self.tracer.finish(fast_trace, self.client_stream)
+        slow_trace = self.tracer.start('set', [b'bar'], 20)
+        self.now += 0.5
+
+        self.tracer.finish(slow_trace, self.client_stream)
+
+        self.assertEqual(len(self.tracer.records), 0)
+        self.output.write.assert_called_once_with('Slow request: {}\n'.format(slow_trace.describe()))
+
+    @istest
+    def dumps_the_buffered_traces(self):
+        trace = self.tracer.start('get', [b'foo'], 9)
+        self.tracer.finish(trace, self.client_stream)
+        output = MagicMock()
+
+        self.tracer.dump(output)
+
+        output.write.assert_called_once_with('Trace: {}\n'.format(trace.describe()))
+
+
+class TraceTest(TestCase):
+    @istest
+    def describes_the_request(self):
+        trace = Trace(100.0, True, 'get', [b'a', b'b', b'c', b'd', b'e'], 14)
+        trace.client = '10.0.0.9:51234'
+        trace.backend_answered(('10.0.0.1', 11211), 0.001)
+        trace.backend_answered('/var/run/memcached.sock', 0.003)
+        trace.response_bytes = 5
+        trace.total = 0.004
+
+        self.assertEqual(trace.describe(), (
+            'client=10.0.0.9:51234 command=get keys=[a b c (+2 keys)] nodes=10.0.0.1:11211,/var/run/memcached.sock '
+            'request_bytes=14 response_bytes=5 queue_wait=0.000000 round_trip=0.003000 total=0.004000'))
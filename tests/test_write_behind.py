@@ -0,0 +1,120 @@
+from unittest import TestCase
+
+from mock import MagicMock
+from nose.tools import istest
+
+from memcrashed.write_behind import WriteBehind
+from .utils import UnflushedStream
+
+
+class WriteBehindTest(TestCase):
+    def setUp(self):
+        self.stream = UnflushedStream()
+
+    def write(self, write_behind, request_bytes):
+        callback = MagicMock()
+        write_behind.write(self.stream, len(request_bytes), lambda flushed: self.stream.write(request_bytes, flushed), callback)
+        return callback
+
+    @istest
+    def takes_writes_before_they_are_flushed(self):
+        write_behind = WriteBehind(100)
+
+        callback = self.write(write_behind, b'set foo 0 0 1 noreply\r\nx\r\n')
+
+        callback.assert_called_with(True)
+        self.assertEqual(self.stream.written, [b'set foo 0 0 1 noreply\r\nx\r\n'])
+        self.assertEqual(write_behind.pending_bytes(self.stream), 26)
+
+    @istest
+    def forgets_the_writes_once_flushed(self):
+        write_behind = WriteBehind(100)
+        self.write(write_behind, b'delete foo noreply\r\n')
+
+        self.stream.flush()
+
+        self.assertEqual(write_behind.pending_bytes(self.stream), 0)
+
+    @istest
+    def waits_for_the_writes_taken_to_be_flushed(self):
+        write_behind = WriteBehind(100)
+        self.write(write_behind, b'delete foo noreply\r\n')
+        callback = MagicMock()
+
+        write_behind.wait_flushed(callback)
+
+        self.assertFalse(callback.called)
+
+        self.stream.flush()
+
+        callback.assert_called_with()
+
+    @istest
+    def calls_back_right_away_when_nothing_is_pending(self):
+        write_behind = WriteBehind(100)
+        callback = MagicMock()
+
+        write_behind.wait_flushed(callback)
+
+        callback.assert_called_with()
+
+    @istest
+    def drops_writes_not_fitting_in_the_backend(self):
+        write_behind = WriteBehind(30)
+        self.write(write_behind, b'delete foo noreply\r\n')
+
+        callback = self.write(write_behind, b'delete bar noreply\r\n')
+
+        callback.assert_called_with(False)
+        self.assertEqual(self.stream.written, [b'delete foo noreply\r\n'])
+        self.assertEqual(write_behind.dropped, 1)
+
+    @istest
+    def dumps_the_writes_dropped(self):
+        write_behind = WriteBehind(30)
+        self.write(write_behind, b'delete foo noreply\r\n')
+        self.write(write_behind, b'delete bar noreply\r\n')
+        output = MagicMock()
+
+        write_behind.dump(output)
+
+        output.write.assert_called_once_with('Write behind: dropped=1 pending_bytes=20 blocked=0\n')
+
+    @istest
+    def takes_a_write_bigger_than_the_limit_when_nothing_is_pending(self):
+        write_behind = WriteBehind(10)
+
+        callback = self.write(write_behind, b'delete foo noreply\r\n')
+
+        callback.assert_called_with(True)
+
+    @istest
+    def blocks_writes_until_there_is_room(self):
+        write_behind = WriteBehind(30, WriteBehind.BLOCK)
+        self.write(write_behind, b'delete foo noreply\r\n')
+        second_callback = self.write(write_behind, b'delete bar noreply\r\n')
+        third_callback = self.write(write_behind, b'touch baz 10 noreply\r\n')
+
+        self.assertFalse(second_callback.called)
+        self.assertEqual(self.stream.written, [b'delete foo noreply\r\n'])
+
+        self.stream.flush()
+
+        second_callback.assert_called_with(True)
+        self.assertFalse(third_callback.called)
+        self.assertEqual(self.stream.written, [b'delete foo noreply\r\n', b'delete bar noreply\r\n'])
+
+        self.stream.flush()
+
+        third_callback.assert_called_with(True)
+
+    @istest
+    def keeps_the_pending_bytes_of_each_backend_apart(self):
+        write_behind = WriteBehind(30)
+        other_stream = UnflushedStream()
+        self.write(write_behind, b'delete foo noreply\r\n')
+
+        callback = MagicMock()
+        write_behind.write(other_stream, 20, lambda flushed: other_stream.write(b'delete bar noreply\r\n', flushed), callback)
+
+        callback.assert_called_with(True)
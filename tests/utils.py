@@ -5,7 +5,7 @@ import sys
 import time
 
 import memcache
-from mock import patch
+from mock import MagicMock, patch
 from tornado.testing import AsyncTestCase
 
 try:
@@ -81,3 +81,93 @@ class ServerTestCase(AsyncTestCase):
 
 def command_for_lines(lines):
     return b''.join(line + b'\r\n' for line in lines)
+
+
+class SynchronousExecutor(object):
+    def submit(self, function, *args):
+        future = MagicMock()
+        future.result.return_value = function(*args)
+        future.add_done_callback.side_effect = lambda callback: callback(future)
+        return future
+
+
+def immediate_io_loop():
+    io_loop = MagicMock()
+    io_loop.add_callback.side_effect = lambda callback: callback()
+    return io_loop
+
+
+class ScriptedStream(object):
+    '''
+    In-memory stand-in for an IOStream, reading from the given bytes and keeping whatever gets written.
+    '''
+
+    def __init__(self, incoming=b''):
+        self.incoming = incoming
+        self.written = []
+        self.is_closed = False
+
+    def read_until(self, delimiter, callback):
+        end = self.incoming.index(delimiter) + len(delimiter)
+        self._consume(end, callback)
+
+    def read_bytes(self, byte_quantity, callback):
+        self._consume(byte_quantity, callback)
+
+    def _consume(self, byte_quantity, callback):
+        data, self.incoming = self.incoming[:byte_quantity], self.incoming[byte_quantity:]
+        callback(data)
+
+    def write(self, data, callback=None):
+        self.written.append(data)
+        if callback is not None:
+            callback()
+
+    def closed(self):
+        return self.is_closed
+
+    def close(self):
+        self.is_closed = True
+
+
+class HeldStream(ScriptedStream):
+    '''
+    ScriptedStream whose reads only complete once released, standing for a slow backend.
+    '''
+
+    def __init__(self, incoming=b''):
+        super(HeldStream, self).__init__(incoming)
+        self.held = True
+        self.held_reads = []
+
+    def _consume(self, byte_quantity, callback):
+        if self.held:
+            self.held_reads.append((byte_quantity, callback))
+        else:
+            super(HeldStream, self)._consume(byte_quantity, callback)
+
+    def release(self):
+        self.held = False
+        held_reads, self.held_reads = self.held_reads, []
+        for byte_quantity, callback in held_reads:
+            self._consume(byte_quantity, callback)
+
+
+class UnflushedStream(ScriptedStream):
+    '''
+    ScriptedStream whose writes only count as flushed once flushed, standing for a backend slow to take them.
+    '''
+
+    def __init__(self, incoming=b''):
+        super(UnflushedStream, self).__init__(incoming)
+        self.unflushed_callbacks = []
+
+    def write(self, data, callback=None):
+        self.written.append(data)
+        if callback is not None:
+            self.unflushed_callbacks.append(callback)
+
+    def flush(self):
+        callbacks, self.unflushed_callbacks = self.unflushed_callbacks, []
+        for callback in callbacks:
+            callback()